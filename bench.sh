@@ -0,0 +1,27 @@
+#!/bin/bash
+#
+# Runs all of the benchmarks (ngsutils/*/t/bench_*.py) and writes a JSON report
+# for each one to: outdir/bench_name.commit.json
+#
+# Usage: ./bench.sh {outdir} {options for the benchmarks}
+#
+REAL=`python -c 'import os,sys;print os.path.realpath(sys.argv[1])' "$0"`
+DIR=`dirname "$REAL"`
+
+. "$DIR"/venv/bin/activate
+export PYTHONPATH=$PYTHONPATH:"$DIR"
+export HIDE_ETA="1"
+
+OUTDIR="."
+if [ "$1" != "" ]; then
+    OUTDIR="$1"
+    shift
+fi
+
+COMMIT=$(cd "$DIR" && git rev-parse --short HEAD)
+
+for bench in "$DIR"/ngsutils/*/t/bench_*.py; do
+    name=$(basename "$bench" .py)
+    echo "$name"
+    python "$bench" -o "$OUTDIR/$name.$COMMIT.json" "$@"
+done
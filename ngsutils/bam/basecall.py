@@ -57,9 +57,11 @@ import math
 import collections
 import datetime
 from ngsutils.bam import bam_iter, bam_open
+from ngsutils.bam.engine.shard import Shard, bam_shards, run_shards
 from ngsutils.bed import BedFile
+from ngsutils.support.refcache import RefCache
 from eta import ETA
-import pysam
+import numpy
 
 
 def usage():
@@ -92,6 +94,9 @@ Options:
                (*must* be sorted and reduced with the -nostrand option)
 
 -variants      Only output positions that differ from reference
+
+-threads N     Call the bases for regions of the genome (1Mb, or the -bed
+               regions) in parallel, using N processes
 """
     sys.exit(1)
 
@@ -121,16 +126,215 @@ def calc_entropy(a, c, t, g):
 
     return acc
 
-MappingRecord = collections.namedtuple('MappingRecord', 'qpos cigar_op base qual read')
-MappingPos = collections.namedtuple('MappingPos', 'tid pos records')
-BasePosition = collections.namedtuple('BasePosition', 'tid pos total a c g t n deletions gaps insertions reads a_minor c_minor g_minor t_minor n_minor del_minor ins_minor')
+BasePosition = collections.namedtuple('BasePosition', 'tid pos total a c g t n deletions gaps insertions depth plus_depth mappings a_minor c_minor g_minor t_minor n_minor del_minor ins_minor')
+
+# base => channel (A, C, G, T, N)
+_base_codes = numpy.empty(256, dtype=numpy.int64)
+_base_codes.fill(4)
+for _i, _base in enumerate('ACGT'):
+    _base_codes[ord(_base)] = _i
+    _base_codes[ord(_base.lower())] = _i
+
+# count channels in the window (A-N are matches that pass the quality filter)
+_A, _C, _G, _T, _N = range(5)
+_PLUS = 5  # + strand counts for A-N are _PLUS + channel
+_DEL = 10
+_DEL_PLUS = 11
+_GAPS = 12
+_DEPTH = 13  # all of the reads at the position (matches, inserts, deletions and gaps)
+_DEPTH_PLUS = 14
+_MAPPINGS = 15  # total IH for the matches, inserts and deletions
+_channels = 16
+
+# flush the pending blocks after this many bases
+_flush_size = 500000
+
+
+class _PileupWindow(object):
+    '''
+    Counts for a window of positions on one chromosome, stored as a
+    (channel x position) array. Reads add blocks of positions (matches,
+    deletions, gaps) that are added to the counts with bincount when the
+    window is flushed. Insertions are kept in a side table.
+    '''
+    def __init__(self, tid, start, size=65536):
+        self.tid = tid
+        self.start = start
+        self.counts = numpy.zeros((_channels, size), dtype=numpy.int64)
+        self.end = start  # the end of the last block
+
+        self.insertions = {}  # pos => {seq: count}
+        self.ins_plus = {}  # pos => + strand count
+
+        # pending blocks: (positions, base codes or a channel, plus strand, IH)
+        self._matches = []
+        self._blocks = []
+        self._pending = 0
+
+    def add_match(self, positions, codes, plus, ih):
+        self._matches.append((positions, codes, plus, ih))
+        self._pending += len(positions)
+        if len(positions):
+            self.end = max(self.end, positions[-1] + 1)
+
+    def add_block(self, channel, start, end, plus, ih):
+        self._blocks.append((channel, start, end, plus, ih))
+        self._pending += end - start
+        self.end = max(self.end, end)
+
+    def add_insertion(self, pos, seq, plus, ih):
+        if pos not in self.insertions:
+            self.insertions[pos] = {}
+            self.ins_plus[pos] = 0
+
+        self.insertions[pos][seq] = self.insertions[pos].get(seq, 0) + 1
+        if plus:
+            self.ins_plus[pos] += 1
+        self.add_block(_DEPTH, pos, pos + 1, plus, ih)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def _apply(self):
+        size = self.counts.shape[1]
+        if self.end - self.start > size:
+            grown = numpy.zeros((_channels, max(size * 2, self.end - self.start)), dtype=numpy.int64)
+            grown[:, :size] = self.counts
+            self.counts = grown
+            size = grown.shape[1]
+
+        flat = self.counts.reshape(-1)
+
+        if self._matches:
+            positions = numpy.concatenate([x[0] for x in self._matches]) - self.start
+            codes = numpy.concatenate([x[1] for x in self._matches])
+            lens = [len(x[0]) for x in self._matches]
+            plus = numpy.repeat([x[2] for x in self._matches], lens)
+            ih = numpy.repeat([x[3] for x in self._matches], lens)
+
+            idx = numpy.concatenate([codes * size + positions,
+                                     (codes[plus] + _PLUS) * size + positions[plus],
+                                     _DEPTH * size + positions,
+                                     _DEPTH_PLUS * size + positions[plus]])
+            flat += numpy.bincount(idx, minlength=len(flat))
+            flat[_MAPPINGS * size:(_MAPPINGS + 1) * size] += numpy.bincount(positions, weights=ih, minlength=size).astype(numpy.int64)
+            self._matches = []
+
+        for channel, start, end, plus, ih in self._blocks:
+            s = start - self.start
+            e = end - self.start
+            if channel == _DEL:
+                self.counts[_DEL, s:e] += 1
+                if plus:
+                    self.counts[_DEL_PLUS, s:e] += 1
+            elif channel == _GAPS:
+                self.counts[_GAPS, s:e] += 1
+
+            self.counts[_DEPTH, s:e] += 1
+            if plus:
+                self.counts[_DEPTH_PLUS, s:e] += 1
+            if channel != _GAPS:
+                self.counts[_MAPPINGS, s:e] += ih
+        self._blocks = []
+        self._pending = 0
+
+    def flush(self, cutoff=None, region_start=None, region_end=None, min_count=0, showgaps=True):
+        '''
+        Yields the BasePositions for the positions before cutoff (or all of
+        them), and moves the start of the window to cutoff. Only positions
+        in [region_start, region_end] are returned (if given), with at least
+        min_count bases, deletions and distinct inserts (or a gap, if
+        showgaps).
+        '''
+        self._apply()
+
+        if cutoff is None:
+            cutoff = self.end
+        cutoff = max(cutoff, self.start)
+        n = cutoff - self.start
+        counts = self.counts[:, :n]
+
+        totals = counts[_A:_N + 1].sum(0)
+        big_totals = totals + counts[_DEL]
+        for pos in self.insertions:
+            if pos < cutoff:
+                big_totals[pos - self.start] += len(self.insertions[pos])
+
+        covered = big_totals > 0
+        if showgaps:
+            covered |= counts[_GAPS] > 0
+        if min_count > 0:
+            covered &= big_totals >= min_count
+
+        offsets = numpy.nonzero(covered)[0]
+        if region_start is not None:
+            offsets = offsets[(offsets + self.start >= region_start) & (offsets + self.start <= region_end)]
+
+        if len(offsets):
+            sel = counts[:, offsets]
+            minor = self._minor_pcts(sel, offsets)
+
+            cols = [x.tolist() for x in [offsets + self.start, totals[offsets]] + list(sel[_A:_N + 1]) + [sel[_DEL], sel[_GAPS], sel[_DEPTH], sel[_DEPTH_PLUS], sel[_MAPPINGS]]]
+            for i, (pos, total, a, c, g, t, nc, dels, gaps, depth, plus_depth, mappings) in enumerate(zip(*cols)):
+                yield BasePosition(self.tid, pos, total, a, c, g, t, nc, dels, gaps, self.insertions.get(pos, {}), depth, plus_depth, mappings, *[x[i] for x in minor])
+
+        for pos in [x for x in self.insertions if x < cutoff]:
+            del self.insertions[pos]
+            del self.ins_plus[pos]
+
+        # roll the window
+        size = self.counts.shape[1]
+        if n >= size:
+            self.counts[:] = 0
+        elif n:
+            self.counts[:, :size - n] = self.counts[:, n:]
+            self.counts[:, size - n:] = 0
+        self.start = cutoff
+        self.end = max(self.end, cutoff)
+
+    def _minor_pcts(self, sel, offsets):
+        '''
+        The minor strand % for A, C, G, T, N, deletions and insertions:
+        (+ strand count / count), or 1 - that if it is > 0.5.
+        '''
+        pcts = []
+        pairs = [(sel[x], sel[_PLUS + x]) for x in xrange(_A, _N + 1)] + [(sel[_DEL], sel[_DEL_PLUS])]
+
+        # insertions are counted after the first occurrence of each insert
+        # (the same as the original caller)
+        ins = numpy.zeros(len(offsets), dtype=numpy.int64)
+        ins_plus = numpy.zeros(len(offsets), dtype=numpy.int64)
+        if self.insertions:
+            for i, pos in enumerate((offsets + self.start).tolist()):
+                if pos in self.insertions:
+                    ins[i] = sum(self.insertions[pos].values()) - len(self.insertions[pos])
+                    ins_plus[i] = self.ins_plus[pos]
+        pairs.append((ins, ins_plus))
+
+        for count, plus in pairs:
+            pct = numpy.zeros(len(offsets))
+            mask = count > 0
+            pct[mask] = plus[mask].astype(float) / count[mask]
+            pct = numpy.where(pct > 0.5, 1 - pct, pct)
+            pcts.append(pct.tolist())
+        return pcts
 
 
 class BamBaseCaller(object):
-    def __init__(self, bam, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False):
+    '''
+    Counts the bases (and indels) at each position in a BAM file.
+
+    Reads are added to a rolling window of count arrays (_PileupWindow), one
+    block of bases at a time. Positions are returned once all of the reads
+    that could cover them have been added (reads are sorted).
+    '''
+    def __init__(self, bam, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, showgaps=True, shard=None):
         self.bam = bam
         self.min_qual = min_qual
-        self.min_count = 0
+        self.min_count = min_count
+        self.showgaps = showgaps
+        self.shard = shard
 
         self.regions = regions
         self.cur_chrom = None
@@ -140,217 +344,143 @@ class BamBaseCaller(object):
         self.mask = mask
         self.quiet = quiet
 
-        def _gen1():
-            if not self.quiet:
-                eta = ETA(self.regions.total)
-            else:
-                eta = None
-
-            count = 0
-            for region in self.regions:
-                working_chrom = None
-                if region.chrom in self.bam.references:
-                    working_chrom = region.chrom
-                elif chrom[0:3] == 'chr':
-                        if region.chrom[3:] in self.bam.references:
-                            working_chrom = region.chrom[3:]
-
-                if not working_chrom:
-                    continue
-
-                # for troubleshooting
-                self.cur_chrom = region.chrom
-                self.cur_start = region.start
-                self.cur_end = region.end
-
-                laststart = 0
-                for read in self.bam.fetch(working_chrom, region.start, region.end):
-                    if read.pos != laststart:
-                        count += 1
-                        laststart = read.pos
-
-                    if eta:
-                        eta.print_status(count, extra='%s/%s %s:%s' % (count, self.regions.total, self.bam.references[read.tid], read.pos))
-
-                    yield read
-            if eta:
-                eta.done()
+    def close(self):
+        pass
 
-        def _gen2():
+    def _region_reads(self):
+        '''
+        Yields (start, end, reads) for each region (or (None, None, all
+        reads) if there aren't any regions). Only the positions from start
+        to end (inclusive) are returned for the reads.
+
+        If there is a shard (see ngsutils.bam.engine.shard), only the
+        positions in the shard are returned, but all of the reads that
+        overlap the shard are counted.
+        '''
+        if self.shard:
+            yield self.shard.start, self.shard.end - 1, self.bam.fetch(self.shard.ref, self.shard.start, self.shard.end)
+            return
+
+        if not self.regions:
             def callback(read):
-                return '%s:%s (%s) %s:%s-%s' % (self.bam.getrname(read.tid), read.pos, len(self.buffer), self.cur_chrom, self.cur_start, self.cur_end)
-            for read in bam_iter(self.bam, quiet=self.quiet, callback=callback):
-                yield read
+                return '%s:%s' % (self.bam.getrname(read.tid), read.pos)
+            yield None, None, bam_iter(self.bam, quiet=self.quiet, callback=callback)
+            return
 
-        if regions:
-            self._gen = _gen1
+        if not self.quiet:
+            eta = ETA(self.regions.total)
         else:
-            self._gen = _gen2
+            eta = None
+
+        count = 0
+        for region in self.regions:
+            working_chrom = None
+            if region.chrom in self.bam.references:
+                working_chrom = region.chrom
+            elif region.chrom[0:3] == 'chr':
+                if region.chrom[3:] in self.bam.references:
+                    working_chrom = region.chrom[3:]
+
+            if not working_chrom:
+                continue
 
-        self.buffer = None
-        self.current_tid = None
+            # for troubleshooting
+            self.cur_chrom = region.chrom
+            self.cur_start = region.start
+            self.cur_end = region.end
 
-    def close(self):
-        pass
+            count += 1
+            if eta:
+                eta.print_status(count, extra='%s/%s %s:%s-%s' % (count, self.regions.total, region.chrom, region.start, region.end))
 
-    def _calc_pos(self, tid, pos, records):
-        if self.cur_start and pos < self.cur_start:
-            return None
-        if self.cur_end and self.cur_end < pos:
-            return None
-
-        counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0, 'ins': 0, 'del': 0}
-        plus_counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0, 'N': 0, 'ins': 0, 'del': 0}
-
-        insertions = {}
-        gaps = 0
-        total = 0
-        reads = []
-
-        for record in records:
-            qpos, cigar_op, base, qual, read = record
-            if cigar_op == 0:  # M
-                if qual >= self.min_qual and (read.flag & self.mask) == 0:
-                    total += 1
-                    reads.append(record)
-
-                    counts[base] += 1
-                    if not read.is_reverse:
-                        plus_counts[base] += 1
-            elif cigar_op == 1:  # I
-                if qual >= self.min_qual and (read.flag & self.mask) == 0:
-                    reads.append(record)
-
-                    if not base in insertions:
-                        insertions[base] = 1
-                    else:
-                        insertions[base] += 1
-
-                        counts['ins'] += 1
-                    if not read.is_reverse:
-                        plus_counts['ins'] += 1
-            elif cigar_op == 2:  # D
-                #total += 1 # not sure these should be included,
-                           # samtools mpileup includes them
-                           # IGV doesn't
-
-                counts['del'] += 1
-                reads.append(record)
-                if not read.is_reverse:
-                    plus_counts['del'] += 1
-            elif cigar_op == 3:  # N
-                gaps += 1
-                reads.append(record)
-            elif cigar_op == 4:  # S - soft clipping
-                pass
-            elif cigar_op == 5:  # H - hard clipping
-                pass
-
-        pcts = {'A': 0.0, 'C': 0.0, 'G': 0.0, 'T': 0.0, 'N': 0.0, 'ins': 0.0, 'del': 0.0}
-        for k in pcts:
-            if counts[k] > 0:
-                pcts[k] = float(plus_counts[k]) / counts[k]
-
-                if pcts[k] > 0.5:
-                    pcts[k] = 1 - pcts[k]
-
-        if total >= self.min_count:
-            return BasePosition(tid, pos, total, counts['A'], counts['C'], counts['G'], counts['T'], counts['N'], counts['del'], gaps, insertions, reads, pcts['A'], pcts['C'], pcts['G'], pcts['T'], pcts['N'], pcts['del'], pcts['ins'])
+            # the end position is included
+            yield region.start, region.end, self.bam.fetch(working_chrom, region.start, region.end + 1)
+
+        if eta:
+            eta.done()
 
     def fetch(self):
-        self.current_tid = None
-        self.buffer = collections.deque()
+        for start, end, reads in self._region_reads():
+            filters = (start, end, self.min_count, self.showgaps)
 
-        for read in self._gen():
-            if (read.flag & self.mask) > 0:
-                continue
-            if self.current_tid != read.tid:  # new chromosome
-                while self.buffer:
-                    tid, pos, records = self.buffer.popleft()
-                    y = self._calc_pos(tid, pos, records)
-                    if y:
-                        yield y
-
-                self.current_tid = read.tid
-
-            # handle all positions that are 5' of the current one
-            while self.buffer and read.pos > self.buffer[0].pos:
-                tid, pos, records = self.buffer.popleft()
-                y = self._calc_pos(tid, pos, records)
-                if y:
-                    yield y
-
-            self._push_read(read)
-
-        # flush buffer for the end
-        while self.buffer:
-            tid, pos, records = self.buffer.popleft()
-            y = self._calc_pos(tid, pos, records)
-            if y:
-                yield y
-
-    def _push_read(self, read):
-        if not self.buffer:
-            self.buffer.append(MappingPos(read.tid, read.pos, []))
-
-        while self.buffer[-1].pos < read.aend:
-            self.buffer.append(MappingPos(read.tid, self.buffer[-1].pos + 1, []))
-
-        buf_idx = 0
-        while self.buffer[buf_idx].pos < read.pos:
-            buf_idx += 1
+            window = None
+            for read in reads:
+                if read.flag & self.mask:
+                    continue
+
+                if window and window.tid != read.tid:  # new chromosome
+                    for basepos in window.flush(None, *filters):
+                        yield basepos
+                    window = None
+
+                if not window:
+                    window = _PileupWindow(read.tid, read.pos)
+                elif window.pending > _flush_size or read.pos - window.start > window.counts.shape[1] // 2:
+                    # all of the positions before this read are finished
+                    for basepos in window.flush(read.pos, *filters):
+                        yield basepos
+
+                self._push_read(window, read)
+
+            if window:
+                for basepos in window.flush(None, *filters):
+                    yield basepos
+
+    def _push_read(self, window, read):
+        plus = not read.is_reverse
+        ih = 1
+        for tag, val in read.tags:
+            if tag == 'IH':
+                ih = int(val)
+                break
+
+        codes = None
+        if read.qual:
+            quals = numpy.frombuffer(read.qual, dtype=numpy.uint8).astype(numpy.int64) - 33
+        else:
+            quals = None
 
+        ref_pos = read.pos
         read_idx = 0
         for op, length in read.cigar:
-            if op == 0:  # M
-                for i in xrange(length):
-                    try:
-                        if read.qual:
-                            qualval = ord(read.qual[read_idx]) - 33
-                        else:
-                            qualval = 0
-                        self.buffer[buf_idx].records.append(MappingRecord(read_idx, op, read.seq[read_idx], qualval, read))
-                    except Exception, e:
-                        print e
-                        sys.stderr.write('\n%s\nIf there is a BED file, is it sorted and reduced?\n' % e)
-                        sys.stderr.write('read: %s (%s:%s-%s)\n' % (read.qname, self.bam.references[read.tid], read.pos, read.aend))
-                        sys.stderr.write('%s\n' % str(read))
-                        if self.cur_chrom:
-                            sys.stderr.write('current range: %s:%s-%s\n' % (self.cur_chrom, self.cur_start, self.cur_end))
-                        sys.exit(1)
-                    buf_idx += 1
-                    read_idx += 1
+            if op == 0 or op == 7 or op == 8:  # M, =, X
+                if codes is None:
+                    codes = _base_codes[numpy.frombuffer(read.seq, dtype=numpy.uint8)]
+                block = numpy.arange(ref_pos, ref_pos + length)
+                block_codes = codes[read_idx:read_idx + length]
+                if self.min_qual > 0:
+                    if quals is None:
+                        passed = numpy.zeros(length, dtype=bool)
+                    else:
+                        passed = quals[read_idx:read_idx + length] >= self.min_qual
+                    block = block[passed]
+                    block_codes = block_codes[passed]
+                window.add_match(block, block_codes, plus, ih)
+                ref_pos += length
+                read_idx += length
 
             elif op == 1:  # I
-                inseq = ''
-                inqual = 0
-                for i in xrange(length):
-                    inseq += read.seq[read_idx]
-                    if read.qual:
-                        inqual += ord(read.qual[read_idx]) - 33
-                    read_idx += 1
-
-                inqual = inqual / len(inseq)  # use an average of the entire inserted bases
-                                              # as the quality for the whole insert
-
-                self.buffer[buf_idx].records.append(MappingRecord(read_idx, op, inseq, inqual, read))
+                inseq = read.seq[read_idx:read_idx + length]
+                if quals is not None:
+                    # use an average of the entire inserted bases as the
+                    # quality for the whole insert
+                    inqual = int(quals[read_idx:read_idx + length].sum()) // length
+                else:
+                    inqual = 0
+                if inqual >= self.min_qual:
+                    window.add_insertion(ref_pos, inseq, plus, ih)
+                read_idx += length
 
             elif op == 2:  # D
-                mr = MappingRecord(read_idx, op, None, None, read)
-                for i in xrange(length):
-                    self.buffer[buf_idx].records.append(mr)
-                    buf_idx += 1
+                window.add_block(_DEL, ref_pos, ref_pos + length, plus, ih)
+                ref_pos += length
 
             elif op == 3:  # N
-                mr = MappingRecord(read_idx, op, None, None, read)
-                for i in xrange(length):
-                    self.buffer[buf_idx].records.append(mr)
-                    buf_idx += 1
+                window.add_block(_GAPS, ref_pos, ref_pos + length, plus, ih)
+                ref_pos += length
+
             elif op == 4:  # S - soft clipping
                 read_idx += length
-                pass
-            elif op == 5:  # H - hard clipping
-                pass
 
 
 def _calculate_consensus_minor(minorpct, a, c, g, t):
@@ -406,12 +536,56 @@ def _calculate_heterozygosity(a, c, g, t):
     return float(minor - background) / (major - background + minor - background)
 
 
-def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, showgaps=False, showstrand=False, minorpct=0.01, altfreq=False, variants=False, profiler=None, out=sys.stdout):
-    if ref_fname:
-        ref = pysam.Fastafile(ref_fname)
-    else:
-        ref = None
+# the size of the shards for -threads
+_shard_size = 1000000
 
+_ref_cache = {}
+
+
+def _worker_ref(fname):
+    '''
+    Returns a RefCache for the reference, cached per process (see
+    ngsutils.bam.engine.shard.worker_bam)
+    '''
+    key = (os.getpid(), fname)
+    if key not in _ref_cache:
+        _ref_cache[key] = RefCache(fname)
+    return _ref_cache[key]
+
+
+def _basecall_worker(bam, shard, outs, ref_fname, min_qual, min_count, mask, showgaps, showstrand, minorpct, altfreq, variants):
+    bbc = BamBaseCaller(bam, min_qual, min_count, None, mask, True, showgaps, shard=shard)
+    ref = _worker_ref(ref_fname) if ref_fname else None
+    _write_basecalls(bbc, ref, outs[0], min_count, showgaps, showstrand, minorpct, altfreq, variants)
+
+
+def _basecall_shards(bam, regions=None, shard_size=_shard_size):
+    '''
+    Splits the BAM file (or the regions) into shards of at most shard_size
+    bases, in output order. Regions include their end position (the same
+    as BamBaseCaller).
+    '''
+    if not regions:
+        return bam_shards(bam, shard_size)
+
+    shards = []
+    for region in regions:
+        if region.chrom in bam.references:
+            ref = region.chrom
+        elif region.chrom[0:3] == 'chr' and region.chrom[3:] in bam.references:
+            ref = region.chrom[3:]
+        else:
+            continue
+
+        tid = bam.references.index(ref)
+        start = region.start
+        while start <= region.end:
+            shards.append(Shard(tid, ref, start, min(start + shard_size, region.end + 1)))
+            start += shard_size
+    return shards
+
+
+def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=1540, quiet=False, showgaps=False, showstrand=False, minorpct=0.01, altfreq=False, variants=False, profiler=None, out=sys.stdout, threads=1):
     out.write('chrom\tpos\tref\tcount\tconsensus call\tminor call\tave mappings')
     if altfreq:
         out.write('\talt. allele freq')
@@ -422,9 +596,38 @@ def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=154
 
     out.write('\n')
 
-    bbc = BamBaseCaller(bam, min_qual, min_count, regions, mask, quiet)
-    ebi_chr_convert = False
+    if threads > 1:
+        # the shards are called in parallel, and written in order. Each
+        # shard only writes its own positions, but counts all of the reads
+        # that overlap it.
+        shards = _basecall_shards(bam, regions, _shard_size)
+        if not quiet:
+            eta = ETA(len(shards))
+        else:
+            eta = None
+
+        args = (ref_fname, min_qual, min_count, mask, showgaps, showstrand, minorpct, altfreq, variants)
+        for i, (shard, result) in enumerate(run_shards(bam.filename, _basecall_worker, shards, threads, args=args, outputs=[out])):
+            if eta:
+                eta.print_status(i + 1, extra=str(shard))
+        if eta:
+            eta.done()
+        return
+
+    if ref_fname:
+        ref = RefCache(ref_fname)
+    else:
+        ref = None
+
+    bbc = BamBaseCaller(bam, min_qual, min_count, regions, mask, quiet, showgaps)
+    _write_basecalls(bbc, ref, out, min_count, showgaps, showstrand, minorpct, altfreq, variants, profiler)
 
+    bbc.close()
+    if ref:
+        ref.close()
+
+
+def _write_basecalls(bbc, ref, out, min_count, showgaps, showstrand, minorpct, altfreq, variants, profiler=None):
     for basepos in bbc.fetch():
         if basepos.pos < 0:
             continue
@@ -439,31 +642,16 @@ def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=154
         if big_total == 0 and not (showgaps and basepos.gaps > 0):
             continue
 
-        refbase = ''
         if ref:
-            if not ebi_chr_convert:
-                refbase = ref.fetch(bbc.bam.references[basepos.tid], basepos.pos, basepos.pos + 1).upper()
-                if not refbase and not bbc.bam.references[basepos.tid].startswith('chr'):
-                    ebi_chr_convert = True
-            if not refbase and ebi_chr_convert:
-                refbase = ref.fetch('chr%s' % bbc.bam.references[basepos.tid], basepos.pos, basepos.pos + 1).upper()
+            refbase = ref.base(bbc.bam.references[basepos.tid], basepos.pos)
         else:
             refbase = 'N'
 
         entropy = calc_entropy(basepos.a, basepos.c, basepos.g, basepos.t)
 
-        read_ih_acc = 0
-        plus_count = 0.0  # needs to be float
-        total_count = 0
-        for qpos, cigar_op, base, qual, read in basepos.reads:
-            total_count += 1
-            if not read.is_reverse:
-                plus_count += 1.0
-            if cigar_op in [0, 1, 2]:
-                try:
-                    read_ih_acc += int(read.opt('IH'))
-                except KeyError:
-                    read_ih_acc += 1
+        read_ih_acc = basepos.mappings
+        plus_count = float(basepos.plus_depth)  # needs to be float
+        total_count = basepos.depth
 
         inserts = []
         for insert in basepos.insertions:
@@ -523,10 +711,6 @@ def bam_basecall(bam, ref_fname, min_qual=0, min_count=0, regions=None, mask=154
 
         out.write('%s\n' % '\t'.join([str(x) for x in cols]))
 
-    bbc.close()
-    if ref:
-        ref.close()
-
 
 # class SingleRegion(object):
 #     def __init__(self, arg):
@@ -600,6 +784,7 @@ if __name__ == '__main__':
     variants = False
     minorpct = 0.04
     regions = None
+    threads = 1
 
     profile = None
 
@@ -635,6 +820,9 @@ if __name__ == '__main__':
             elif last == '-profile':
                 profile = arg
                 last = None
+            elif last == '-threads':
+                threads = int(arg)
+                last = None
             elif arg == '-h':
                 usage()
             elif arg == '-showstrand':
@@ -647,7 +835,7 @@ if __name__ == '__main__':
                 variants = True
             elif arg == '-altfreq':
                 altfreq = True
-            elif arg in ['-qual', '-count', '-mask', '-ref', '-minorpct', '-profile', '-bed']:
+            elif arg in ['-qual', '-count', '-mask', '-ref', '-minorpct', '-profile', '-bed', '-threads']:
                 last = arg
             elif not bam and os.path.exists(arg):
                 if os.path.exists('%s.bai' % arg):
@@ -682,5 +870,5 @@ if __name__ == '__main__':
             sys.stderr.write('Profiling...\n')
             cProfile.run('func()', profile)
         else:
-                bam_basecall(bamobj, ref, min_qual, min_count, regions, mask, quiet, showgaps, showstrand, minorpct, altfreq, variants, None)
+                bam_basecall(bamobj, ref, min_qual, min_count, regions, mask, quiet, showgaps, showstrand, minorpct, altfreq, variants, None, threads=threads)
         bamobj.close()
@@ -19,7 +19,11 @@ See: Zhang and Darnell, Nature Biotechnology (2011)
 
 import os
 import sys
-from ngsutils.bam import bam_pileup_iter
+from ngsutils.bam.engine import columns
+from ngsutils.bam.engine.columns import ColumnCounter
+from ngsutils.bam.engine.shard import bam_shards, run_shards
+from eta import ETA
+import numpy
 import pysam
 
 
@@ -44,6 +48,9 @@ Options:
 
     -window N        The maximum length of a deletion window
                      [default: 20]
+
+    -threads N       Count the deletions for regions of the genome (1Mb) in
+                     parallel, using N processes
 """
     sys.exit(1)
 
@@ -123,8 +130,6 @@ class RegionManager(object):
         self.last_chrom = None
         self.start = 0
         self.end = 0
-        self.del_reads = set()
-        self.total_reads = set()
 
     def emit(self):
         if self.last_chrom:
@@ -134,10 +139,8 @@ class RegionManager(object):
         self.last_chrom = new_chrom
         self.start = new_pos
         self.end = new_pos
-        self.del_reads = set()
-        self.total_reads = set()
 
-    def add(self, chrom, pos, strand, del_reads, total_reads):
+    def add(self, chrom, pos, strand):
         if self.strand and strand != self.strand:
             # ignore this if the strand doesn't match
             return
@@ -150,43 +153,49 @@ class RegionManager(object):
             self.reset(chrom, pos)
 
         self.end = pos
-        self.del_reads |= del_reads
-        self.total_reads |= total_reads
 
     def close(self):
         self.emit()
 
 
-def is_read_del_at_pos(read, pos, ppos=0):
-    last_op = None
-    idx = 0
-    for op, length in read.cigar:
-        if op in [0, 1]:
-            idx += length
+def find_deletions(bam, counter, strands, cutoff=0.1):
+    '''
+    Returns the positions where the fraction of reads with a deletion (of the
+    reads with a base or a deletion) is more than cutoff, as lists of
+    (chrom, pos) for each strand ('+', '-', or '' for both).
+    '''
+    found = dict([(strand, []) for strand in strands])
+
+    for cols in counter:
+        chrom = bam.getrname(cols.tid)
+
+        for strand in strands:
+            if strand == '+':
+                counts = cols.counts[:columns.MINUS]
+            elif strand == '-':
+                counts = cols.counts[columns.MINUS:]
+            else:
+                counts = cols.counts[:columns.MINUS] + cols.counts[columns.MINUS:]
+
+            deletions = counts[columns.DEL]
+            total = counts.sum(0)
 
-        if pos < idx:
-            if op == 2 and last_op != 3:
-                return True
-        last_op = op
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                pct = deletions.astype(float) / total
+            found[strand].extend([(chrom, pos) for pos in cols.pos[(total > 0) & (pct > cutoff)].tolist()])
 
-    return False
+    return found
 
 
-#TODO: Check this...
-def is_read_match_at_pos(read, pos):
-    idx = 0
-    for op, length in read.cigar:
-        if op in [0, 1]:
-            idx += length
+# the size of the shards for -threads
+_shard_size = 1000000
 
-        if pos < idx:
-            if op == 2 or op == 0:
-                return True
 
-    return False
+def _cims_worker(bam, shard, strands, cutoff):
+    return find_deletions(bam, ColumnCounter(bam, mask=1540, shard=shard, quiet=True), strands, cutoff)
 
 
-def bam_cims_finder(bam_fnames, output='bed', ref_fname=None, flanking=12, cutoff=0.1, stranded=True, window_size=20):
+def bam_cims_finder(bam_fnames, output='bed', ref_fname=None, flanking=12, cutoff=0.1, stranded=True, window_size=20, threads=1):
     for bam_fname in bam_fnames:
         sys.stderr.write('%s\n' % bam_fname)
         bam = pysam.Samfile(bam_fname, "rb")
@@ -201,41 +210,24 @@ def bam_cims_finder(bam_fnames, output='bed', ref_fname=None, flanking=12, cutof
         else:
             strands = ['']
 
+        if threads > 1:
+            shards = bam_shards(bam, _shard_size)
+            eta = ETA(len(shards))
+            found = dict([(strand, []) for strand in strands])
+            for i, (shard, result) in enumerate(run_shards(bam_fname, _cims_worker, shards, threads, args=(strands, cutoff))):
+                eta.print_status(i + 1, extra=str(shard))
+                for strand in strands:
+                    found[strand].extend(result[strand])
+            eta.done()
+        else:
+            found = find_deletions(bam, ColumnCounter(bam, mask=1540), strands, cutoff)
+
         for strand in strands:
             manager = RegionManager(emitter, strand, window_size)
-            for pileup in bam_pileup_iter(bam, mask=1540):
-                chrom = bam.getrname(pileup.tid)
-
-                deletions = 0.0
-                total = 0.0
-
-                del_reads = set()
-                total_reads = set()
-
-                for pileupread in pileup.pileups:
-                    if not strand or (strand == '+' and not pileupread.alignment.is_reverse) or (strand == '-' and pileupread.alignment.is_reverse):
-                        if is_read_match_at_pos(pileupread.alignment, pileupread.qpos):
-                            total += 1
-                            total_reads.add(pileupread.alignment.qname)
-
-                        if is_read_del_at_pos(pileupread.alignment, pileupread.qpos):
-                            deletions += 1
-                            del_reads.add(pileupread.alignment.qname)
-                            # print ""
-                            # print chrom
-                            # print pileup.pos
-                            # print pileupread.alignment.qname
-                            # print pileupread.alignment.pos
-                            # print pileupread.alignment.cigar
-                            # print pileupread.qpos
-
-                if total > 0:
-                    pct = deletions / total
-
-                    if pct > cutoff:
-                        manager.add(chrom, pileup.pos, strand, del_reads, total_reads)
-
+            for chrom, pos in found[strand]:
+                manager.add(chrom, pos, strand)
             manager.close()
+
         bam.close()
         emitter.close()
 
@@ -247,6 +239,7 @@ if __name__ == '__main__':
     flanking = 12
     stranded = True
     window = 20
+    threads = 1
 
     last = None
     for arg in sys.argv[1:]:
@@ -259,13 +252,16 @@ if __name__ == '__main__':
         elif last == '-window':
             window = float(arg)
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
         elif last == '-fasta' and not ref and os.path.exists(arg) and os.path.exists('%s.fai' % arg):
             output = 'fasta'
             ref = arg
             last = None
         elif arg == '-h':
             usage()
-        elif arg in ['-flanking', '-fasta', '-cutoff', '-window']:
+        elif arg in ['-flanking', '-fasta', '-cutoff', '-window', '-threads']:
             last = arg
         elif arg == '-ns':
             stranded = False
@@ -278,4 +274,4 @@ if __name__ == '__main__':
     if not bams:
         usage()
     else:
-        bam_cims_finder(bams, output, ref, flanking, cutoff, stranded, window)
+        bam_cims_finder(bams, output, ref, flanking, cutoff, stranded, window, threads)
@@ -101,6 +101,7 @@ import os
 
 import count
 from ngsutils.bam import bam_open
+from ngsutils.support.nameset import read_nameset
 
 
 def usage(msg=None):
@@ -129,6 +130,7 @@ Other options:
                        unstranded - fragments mapped in either FR or RF
 
     -coverage          calculate average coverage for genes/regions
+                       (mean/stdev/median depth over all bases in the regions)
     -uniq              only count unique starting positions
                        (avoids possible PCR artifacts, not recommended)
     -startonly         Only take into account the start pos of the read to assign counts
@@ -142,11 +144,25 @@ Other options:
                        (only these read-names will be used in the calcs)
     -blacklist file    file containing a black-list of read names
                        (these read-names will not be used in the calcs)
+                       (either list can be a name set saved with:
+                       python -m ngsutils.support.nameset)
+    -threads N         count each chromosome in parallel, using N processes
+                       (the output is the same as with one process; not used
+                       for -repeatfam)
+    -matrix fname      for -bin, also write the counts to a NumPy .npz file
+                       (one array per chromosome: strand x bin, with the +
+                       strand first)
+    -idxstats          for -norm all, use the number of mapped reads from the
+                       BAM index. Only valid if each read has one alignment
+                       (multiple mappings are flagged with IH/NH tags).
+                       Not used with -whitelist/-blacklist.
 
 Possible values for [-norm]:
     (If -norm is not given, can't be calculated)
 
     all         Use the number of all reads that mapped (anywhere)
+                (counted while counting the regions, and cached in
+                bamfile.mapped for the next run)
     mapped      Use the number of reads that map in the model (genes/regions)
     median      Use the median value
                 (genes/regions without reads excluded)
@@ -180,6 +196,9 @@ if __name__ == '__main__':
     model_arg = None
     bamfile = None
     library_type = 'FR'
+    threads = 1
+    idxstats = False
+    matrix = None
 
     last = None
 
@@ -203,24 +222,26 @@ if __name__ == '__main__':
                 usage('Invalid option for -multiple: %s' % arg)
             multiple = arg
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-matrix':
+            matrix = arg
+            last = None
         elif last == '-whitelist':
-            whitelist = []
             if not os.path.exists(arg):
                 usage('Whitelist file does not exist: %s' % arg)
-            with open(arg) as f:
-                for line in f:
-                    whitelist.append(line.strip())
+            whitelist = read_nameset(arg, bloom_bits=10)
+            last = None
         elif last == '-blacklist':
-            blacklist = []
             if not os.path.exists(arg):
                 usage('Blacklist file does not exist: %s' % arg)
-            with open(arg) as f:
-                for line in f:
-                    blacklist.append(line.strip())
+            blacklist = read_nameset(arg, bloom_bits=10)
+            last = None
         elif arg in ['-%s' % x for x in count.models]:
             model = arg[1:]
             last = arg
-        elif arg in ['-norm', '-multiple', '-whitelist', '-blacklist', '-library']:
+        elif arg in ['-norm', '-multiple', '-whitelist', '-blacklist', '-library', '-threads', '-matrix']:
             last = arg
         elif arg == '-startonly':
             startonly = True
@@ -230,6 +251,8 @@ if __name__ == '__main__':
             fpkm = True
         elif arg == '-uniq':
             uniq_only = True
+        elif arg == '-idxstats':
+            idxstats = True
         elif arg == '-h':
             usage()
         elif not bamfile:
@@ -245,7 +268,13 @@ if __name__ == '__main__':
     elif not bamfile:
         usage('Missing BAM file!')
 
-    modelobj = count.models[model](model_arg)
+    if matrix and model != 'bin':
+        usage('-matrix is only valid with -bin')
+
+    if matrix:
+        modelobj = count.models[model](model_arg, matrix=matrix)
+    else:
+        modelobj = count.models[model](model_arg)
     bam = bam_open(bamfile)
-    modelobj.count(bam, library_type, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, start_only=startonly)
+    modelobj.count(bam, library_type, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, start_only=startonly, threads=threads, idxstats=idxstats)
     bam.close()
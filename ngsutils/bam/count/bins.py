@@ -0,0 +1,186 @@
+'''
+Counts the reads in fixed-size bins across a chromosome with one pass over
+the reads.
+
+The reads for a chromosome are read once, and the start/end bin of each read
+is stored in (compact) arrays. The bin counts are then calculated with
+NumPy, instead of running a separate query for each bin.
+
+The counts are the same as counting each bin as a separate region (see
+sweep.ReadSweep): a read is counted in every bin that its alignment span
+overlaps (including gaps), reads are assigned to a strand by the library
+type, and for uniq_only, the first read with a given starting position is
+counted in each bin. With start_only, a read is only counted in the bin
+with its starting position (the end of the alignment for reverse reads).
+'''
+
+import array
+
+import numpy
+
+from sweep import _frag_strand, _read_ih, _read_end
+
+
+class BinCounter(object):
+    '''
+    Counts reads in bins of binsize bases. If the library is stranded, there
+    are separate counts for each strand.
+
+    count() returns the counts for a chromosome as an array (strand x bin,
+    with '+' first), and a boolean array that is True for counts that
+    include a fractional (multiple=partial) read. If count_mapped is True,
+    the mapped reads are also counted (see mapped_reads()).
+    '''
+    def __init__(self, bam, binsize, library_type='FR', multiple='complete', whitelist=None, blacklist=None, uniq_only=False, start_only=False, count_mapped=False):
+        assert multiple in ['complete', 'partial', 'ignore']
+
+        self.bam = bam
+        self.binsize = binsize
+        self.library_type = library_type
+        self.multiple = multiple
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self.uniq_only = uniq_only
+        self.start_only = start_only
+        self.count_mapped = count_mapped
+
+        self.strands = ['+', '-'] if library_type in ['FR', 'RF'] else ['+']
+
+        self._mapped_refs = set()
+        self._mapped_single = 0
+        self._mapped_multi = set()
+
+    def count(self, chrom, chrom_len):
+        binsize = self.binsize
+        nbins = (chrom_len + binsize - 1) // binsize
+        nstrands = len(self.strands)
+
+        starts, ends, strands, keys, weights, fractional = self._read_bins(chrom)
+
+        if self.start_only:
+            # the bin with the start of the read (the last aligned base for
+            # reverse reads)
+            first = numpy.where(keys % 2 == 0, keys // 2, keys // 2 - 1) // binsize
+            valid = (keys >= 0) & (first < nbins)
+        else:
+            first = starts // binsize
+            last = numpy.minimum((ends - 1) // binsize, nbins - 1)
+            valid = last >= first
+
+        idx = numpy.arange(len(starts))[valid]
+        if self.start_only:
+            bins = first[valid]
+        else:
+            # one entry for each (read, bin) pair, in read order
+            spans = (last - first + 1)[valid]
+            offsets = numpy.arange(spans.sum()) - numpy.repeat(numpy.cumsum(spans) - spans, spans)
+            idx = numpy.repeat(idx, spans)
+            bins = first[idx] + offsets
+
+        cells = bins * nstrands + strands[idx]
+
+        if self.uniq_only and len(cells):
+            # only the first read with the same starting position (and
+            # direction) in each bin is counted
+            order = numpy.lexsort((numpy.arange(len(cells)), keys[idx], cells))
+            sorted_cells = cells[order]
+            sorted_keys = keys[idx][order]
+            is_first = numpy.ones(len(cells), dtype=bool)
+            is_first[1:] = (sorted_cells[1:] != sorted_cells[:-1]) | (sorted_keys[1:] != sorted_keys[:-1])
+            keep = numpy.zeros(len(cells), dtype=bool)
+            keep[order[is_first]] = True
+            cells = cells[keep]
+            idx = idx[keep]
+
+        # bincount adds the weights in read order, the same as the sweep
+        counts = numpy.bincount(cells, weights=weights[idx], minlength=nbins * nstrands)
+        partial = numpy.bincount(cells, weights=fractional[idx], minlength=nbins * nstrands) > 0
+
+        return counts.reshape((nbins, nstrands)).T, partial.reshape((nbins, nstrands)).T
+
+    def _read_bins(self, chrom):
+        '''
+        Reads the reads for a chromosome and returns arrays of the read
+        starts, ends, strand index, key, weight, and whether the weight is
+        fractional. The key is the starting position and direction of the
+        read (pos * 2 for forward reads, aend * 2 + 1 for reverse reads, -1
+        if unknown).
+        '''
+        library_type = self.library_type
+        whitelist = self.whitelist
+        blacklist = self.blacklist
+        multiple = self.multiple
+        stranded = len(self.strands) > 1
+
+        count_mapped = self.count_mapped and chrom not in self._mapped_refs
+        if count_mapped:
+            self._mapped_refs.add(chrom)
+        mapped_multi = self._mapped_multi
+        mapped_single = 0
+        need_ih = count_mapped or multiple != 'complete'
+
+        starts = array.array('l')
+        ends = array.array('l')
+        strands = array.array('b')
+        keys = array.array('l')
+        weights = array.array('d')
+        fractional = array.array('b')
+
+        for read in self.bam.fetch(chrom):
+            qname = read.qname
+            if blacklist and qname in blacklist:
+                continue
+            if whitelist and qname not in whitelist:
+                continue
+
+            # the IH/NH tag is only needed for multiple=partial/ignore, or to
+            # count the mapped reads
+            ih = _read_ih(read) if need_ih else 0
+            if count_mapped and not read.is_unmapped:
+                if ih > 1:
+                    mapped_multi.add(qname)
+                else:
+                    mapped_single += 1
+
+            if stranded:
+                strands.append(0 if _frag_strand(read, library_type) == '+' else 1)
+            else:
+                strands.append(0)
+
+            starts.append(read.pos)
+            ends.append(_read_end(read))
+
+            if read.is_reverse:
+                # reverse reads start at the end of the alignment
+                if read.aend is None:
+                    keys.append(-1)
+                else:
+                    keys.append(read.aend * 2 + 1)
+            else:
+                keys.append(read.pos * 2)
+
+            if ih <= 1 or multiple == 'complete':
+                weights.append(1)
+                fractional.append(0)
+            elif multiple == 'partial':
+                weights.append(1.0 / ih)
+                fractional.append(1)
+            else:
+                weights.append(0)
+                fractional.append(0)
+
+        self._mapped_single += mapped_single
+
+        return (numpy.frombuffer(starts, dtype=starts.typecode), numpy.frombuffer(ends, dtype=ends.typecode),
+                numpy.frombuffer(strands, dtype=numpy.int8).astype(numpy.intp), numpy.frombuffer(keys, dtype=keys.typecode),
+                numpy.frombuffer(weights, dtype=numpy.float64), numpy.frombuffer(fractional, dtype=numpy.int8).astype(numpy.float64))
+
+    def mapped_reads(self, chroms=None):
+        'The same as ReadSweep.mapped_reads'
+        assert self.count_mapped
+
+        for ref in self.bam.references:
+            if ref not in self._mapped_refs and (chroms is None or chroms(ref)):
+                self._read_bins(ref)
+
+        return self._mapped_single, self._mapped_multi
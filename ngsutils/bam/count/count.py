@@ -1,25 +1,57 @@
 import ngsutils.support.stats
+import os
 import sys
+import heapq
 import tempfile
 import ngsutils
 
+from sweep import ReadSweep, read_blocks as _calc_read_regions, _read_ih
+from ngsutils.bam.engine.shard import Shard, bam_shards, run_shards
 from ngsutils.bam.t import MockBam
 assert(MockBam)  # just for linting... it is used in a doctest
 
 
+def _parse_count(val):
+    '''
+    >>> _parse_count('3')
+    3
+    >>> _parse_count('3.5')
+    3.5
+    '''
+    try:
+        return int(val)
+    except ValueError:
+        return float(val)
+
+
 class TmpCountFile(object):
-    def __init__(self):
-        self.tmpfile = tempfile.TemporaryFile()
+    '''
+    Temporary storage for the output rows. Each row is tagged with the
+    position of its region in the model (order), so that the rows from
+    separate workers can be merged back into model order.
 
-    def write(self, count, coding_len, cols):
-        self.tmpfile.write('%s\t%s\t%s\n' % (count, coding_len, '\t'.join([str(x) for x in cols])))
+    If fname is given, the rows are written to (or read from) that file
+    instead of an anonymous temporary file.
+    '''
+    def __init__(self, fname=None, mode='w+'):
+        self.fname = fname
+        if fname:
+            self.tmpfile = open(fname, mode)
+        else:
+            self.tmpfile = tempfile.TemporaryFile()
+
+    def write(self, count, coding_len, cols, order=0):
+        self.tmpfile.write('%s\t%r\t%s\t%s\n' % (order, count, coding_len, '\t'.join([str(x) for x in cols])))
 
-    def fetch(self):
+    def fetch(self, with_order=False):
         self.tmpfile.flush()
         self.tmpfile.seek(0)
         for line in self.tmpfile:
             cols = line.strip('\n').split('\t')
-            yield (int(cols[0]), int(cols[1]), cols[2:])
+            if with_order:
+                yield (int(cols[0]), _parse_count(cols[1]), int(cols[2]), cols[3:])
+            else:
+                yield (_parse_count(cols[1]), int(cols[2]), cols[3:])
 
     def close(self):
         self.tmpfile.close()
@@ -27,7 +59,11 @@ class TmpCountFile(object):
 
 class Model(object):
     def __init__(self):
-        pass
+        self._sweep = None
+        self._stranded = False
+        self._chroms = None
+        self._prefetched = {}
+        self._mapped_reads = None
 
     def get_source(self):
         raise NotImplemented
@@ -59,23 +95,118 @@ class Model(object):
     def get_postheaders(self):
         return None
 
-    def count(self, bam, library_type='FR', coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False):
-        # bam = pysam.Samfile(bamfile, 'rb')
+    def prefetch(self, chrom, strand, starts, ends):
+        '''
+        Tells the counting engine that the reads for these regions will be
+        needed by a callback (see fetch_reads), so that they can be counted in
+        the same pass as the regions from get_regions. This should be called
+        from get_regions before the region is yielded.
+        '''
+        if self._sweep is not None and self._want_chrom(chrom):
+            key = (chrom, strand, tuple(starts), tuple(ends))
+            self._prefetched[key] = self._sweep.add(chrom, strand, starts, ends, keep_reads=True)
+
+    def prefetch_excluding(self, chrom, strand, start, end):
+        'Same as prefetch, for reads that exclude a region (see fetch_reads_excluding)'
+        if self._sweep is not None and self._want_chrom(chrom):
+            key = (chrom, strand, start, end)
+            self._prefetched[key] = self._sweep.add(chrom, strand, [start], [end], excluding=True, keep_reads=True)
+
+    def _prefetched_result(self, key):
+        count, reads = self._sweep.result(self._prefetched[key])
+        return count, set(reads)
+
+    def fetch_reads(self, bam, chrom, strand, starts, ends):
+        'Returns the count and read names for the regions (for use in a callback)'
+        key = (chrom, strand, tuple(starts), tuple(ends))
+        if key in self._prefetched:
+            return self._prefetched_result(key)
+
+        sweep = self._sweep
+        return _fetch_reads(bam, chrom, strand, starts, ends, sweep.multiple, False, sweep.whitelist, sweep.blacklist, sweep.uniq_only, sweep.library_type)
+
+    def fetch_reads_excluding(self, bam, chrom, strand, start, end):
+        'Returns the count and read names for reads that exclude a region (for use in a callback)'
+        key = (chrom, strand, start, end)
+        if key in self._prefetched:
+            return self._prefetched_result(key)
+
+        sweep = self._sweep
+        return _fetch_reads_excluding(bam, chrom, strand, start, end, sweep.multiple, sweep.whitelist, sweep.blacklist, sweep.library_type)
+
+    def _model_chroms(self):
+        'Returns the set of chromosomes with regions in the model'
+        chroms = set()
+        for region in self.get_regions():
+            chroms.add(region[0])
+        return chroms
+
+    def _want_chrom(self, chrom):
+        return self._chroms is None or self._chroms(chrom)
+
+    def _region_counts(self, start_only=False, coverage=False):
+        '''
+        Counts the reads for the regions from get_regions, one chromosome at
+        a time (with a single pass over the reads). Yields the region tuples
+        with the count, read names and coverage (mean, stdev, median) appended,
+        in the same order as get_regions. The position of the region in
+        get_regions is the first value. If coverage is False, the coverage is
+        None.
+        '''
+        batch = []
+        for order, region in enumerate(self.get_regions()):
+            chrom, starts, ends, strand, cols, callback = region
+            if not self._want_chrom(chrom):
+                continue
 
-        # region_counts = []
-        # multireads = set()
-        # single_count = 0
-        tmpcounts = TmpCountFile()
+            if batch and batch[-1][1][0] != chrom:
+                for val in self._run_batch(batch, coverage):
+                    yield val
+                batch = []
 
-        counts_tally = {}
-        total_count = 0.0
+            qid = self._sweep.add(chrom, strand if self._stranded else None, starts, ends, start_only, keep_reads=callback is not None, coverage=coverage)
+            batch.append((order, region, qid))
 
-        if library_type in ['FR', 'RF']:
-            stranded = True
-        else:
-            stranded = False
+        if batch:
+            for val in self._run_batch(batch, coverage):
+                yield val
+
+    def _run_batch(self, batch, coverage=False):
+        chrom = batch[0][1][0]
+        self._sweep.run(chrom)
+        for order, region, qid in batch:
+            count, reads = self._sweep.result(qid)
+            depth = self._sweep.coverage(qid) if coverage else None
+            yield (order, ) + region + (count, reads, depth)
+
+        for order, region, qid in batch:
+            self._sweep.discard(qid)
+
+        # queries for the next chromosome may have already been prefetched
+        for key in self._prefetched.keys():
+            if key[0] == chrom:
+                self._sweep.discard(self._prefetched[key])
+                del self._prefetched[key]
+
+    def _count_regions(self, bam, tmpcounts, library_type='FR', coverage=False, uniq_only=False, multiple='complete', whitelist=None, blacklist=None, start_only=False, count_mapped=False, chroms=None):
+        '''
+        Counts the reads for each region and writes the output rows to
+        tmpcounts. Yields the (order, count) for each region.
 
-        for chrom, starts, ends, strand, cols, callback in self.get_regions():
+        If chroms is given, only the regions for which chroms(chrom) is True
+        are counted.
+
+        If count_mapped is True, the mapped reads are also counted during the
+        sweep (the single-mapped count and multi-mapped names are stored in
+        self._mapped_reads, see ReadSweep.mapped_reads).
+        '''
+        stranded = library_type in ['FR', 'RF']
+
+        self._sweep = ReadSweep(bam, library_type, multiple, whitelist, blacklist, uniq_only, count_mapped)
+        self._stranded = stranded
+        self._chroms = chroms
+
+        for order, chrom, starts, ends, strand, cols, callback, count, reads, depth in self._region_counts(start_only, coverage):
             outcols = cols[:]
 
             coding_len = 0
@@ -83,41 +214,103 @@ class Model(object):
                 coding_len += e - s
             outcols.append(coding_len)
 
-            count, reads = _fetch_reads(bam, chrom, strand if stranded else None, starts, ends, multiple, False, whitelist, blacklist, uniq_only, library_type, start_only)
             outcols.append('')
-            total_count += count
-
-            # for read in reads:
-            #     if read.tags and 'IH' in read.tags:
-            #         ih = int(read.opt('IH'))
-            #     else:
-            #         ih = 1
-
-            #     if ih == 1:
-            #         single_count += 1
-            #     else:
-            #         multireads.add(read.qname)
 
             if coverage:
-                mean, stdev, median = calc_coverage(bam, chrom, strand if stranded else None, starts, ends, whitelist, blacklist, library_type=library_type)
+                mean, stdev, median = depth
                 outcols.append(mean)
                 outcols.append(stdev)
                 outcols.append(median)
 
+            if callback:
+                for callback_cols in callback(bam, count, reads, outcols):
+                    tmpcounts.write(count, coding_len, callback_cols, order)
+            else:
+                tmpcounts.write(count, coding_len, outcols, order)
+
+            yield order, count
+
+        if count_mapped:
+            self._mapped_reads = self._sweep.mapped_reads(chroms)
+
+        self._sweep = None
+        self._chroms = None
+
+    def _count_parallel(self, bam, tmpcounts, threads, kwargs):
+        '''
+        Counts each chromosome in a separate process. Each worker writes its
+        rows to a separate file, and these are merged back into model order
+        in tmpcounts. Yields the (order, count) for each region (in order).
+        '''
+        global _shard_model
+        _shard_model = (self, kwargs)
+
+        chroms = self._model_chroms()
+
+        # one shard per reference (in the model, or all of them if the mapped
+        # reads are counted), and one for regions on references that aren't
+        # in the BAM file
+        shards = [shard for shard in bam_shards(bam) if shard.ref in chroms or kwargs.get('count_mapped')]
+        if chroms - set(bam.references):
+            shards.append(Shard(-1, None, 0, 0))
+
+        fnames = []
+        region_counts = []
+        mapped_single = 0
+        mapped_multi = set()
+        try:
+            for shard, (fname, counts, mapped) in run_shards(bam.filename, _count_shard, shards, threads):
+                fnames.append(fname)
+                region_counts.append(counts)
+                if mapped:
+                    mapped_single += mapped[0]
+                    mapped_multi.update(mapped[1])
+
+            parts = [TmpCountFile(fname, 'r') for fname in fnames]
+            for order, count, coding_len, cols in heapq.merge(*[part.fetch(True) for part in parts]):
+                tmpcounts.write(count, coding_len, cols, order)
+
+            for part in parts:
+                part.close()
+        finally:
+            for fname in fnames:
+                os.unlink(fname)
+            _shard_model = None
+
+        if kwargs.get('count_mapped'):
+            self._mapped_reads = (mapped_single, mapped_multi)
+
+        for order, count in heapq.merge(*region_counts):
+            yield order, count
+
+    def count(self, bam, library_type='FR', coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False, threads=1, idxstats=False):
+        tmpcounts = TmpCountFile()
+
+        counts_tally = {}
+        total_count = 0.0
+
+        # for norm=all, the number of mapped reads is counted during the
+        # sweep, unless it is already known (BAM index or cached)
+        mapped_count = None
+        if norm == 'all':
+            mapped_count = known_mapped_count(bam, whitelist, blacklist, idxstats)
+
+        kwargs = {'library_type': library_type, 'coverage': coverage, 'uniq_only': uniq_only, 'multiple': multiple, 'whitelist': whitelist, 'blacklist': blacklist, 'start_only': start_only, 'count_mapped': norm == 'all' and mapped_count is None}
+
+        if threads > 1 and bam.filename:
+            region_counts = self._count_parallel(bam, tmpcounts, threads, kwargs)
+        else:
+            region_counts = self._count_regions(bam, tmpcounts, **kwargs)
+
+        for order, count in region_counts:
+            total_count += count
+
             if count > 0:
                 if not count in counts_tally:
                     counts_tally[count] = 1
                 else:
                     counts_tally[count] += 1
 
-            if callback:
-                for callback_cols in callback(bam, count, reads, outcols):
-                    tmpcounts.write(count, coding_len, callback_cols)
-                    # region_counts.append((count, coding_len, callback_cols))
-            else:
-                    tmpcounts.write(count, coding_len, outcols)
-                # region_counts.append((count, coding_len, outcols))
-
         if not quiet:
             sys.stderr.write('Calculating normalization...')
 
@@ -125,14 +318,19 @@ class Model(object):
         norm_val_orig = None
 
         if norm == 'all':
-            norm_val_orig = _find_mapped_count(bam, whitelist, blacklist, quiet)
+            if mapped_count is None:
+                mapped_count = self._mapped_reads[0] + len(self._mapped_reads[1])
+                self._mapped_reads = None
+                if not whitelist and not blacklist:
+                    write_mapped_count_cache(bam, mapped_count)
+            norm_val_orig = mapped_count
         elif norm == 'mapped':
             # norm_val_orig = single_count + len(multireads)
             norm_val_orig = total_count
         # elif norm == 'quantile':
         #     norm_val_orig = _find_mapped_count_pcts([x[0] for x in region_counts])
         elif norm == 'median':
-            norm_val_orig = ngsutils.support.stats.count_median(counts_tally)
+            norm_val_orig = ngsutils.support.stats.counts_median(counts_tally)
             # norm_val_orig = _find_mapped_count_median([x[0] for x in region_counts])
 
         if norm_val_orig:
@@ -184,7 +382,11 @@ class Model(object):
                         out.write(str(count / norm_val))
                         if fpkm:
                             out.write('\t')
-                            out.write(str(count / (coding_len / 1000.0) / norm_val))
+                            if coding_len:
+                                out.write(str(count / (coding_len / 1000.0) / norm_val))
+                            else:
+                                # zero-length features have no FPKM
+                                out.write('0')
 
                 else:
                     out.write(str(col))
@@ -193,26 +395,27 @@ class Model(object):
         tmpcounts.close()
 
 
-def _calc_read_regions(read):
-    'Find regions of reference the read covers - breaking on long gaps (N)'
-    regions = []
-    start = read.pos
-    end = read.pos
-    for op, length in read.cigar:
-        if op == 0:
-            end += length
-        elif op == 1:
-            pass
-        elif op == 2:
-            end += length
-        elif op == 3:
-            regions.append((start, end))
-            end += length
-            start = end
+# the model (and count options) for the worker processes
+_shard_model = None
+
+
+def _count_shard(bam, shard):
+    model, kwargs = _shard_model
+    if shard.tid < 0:
+        chroms = lambda chrom: chrom not in bam.references
+    else:
+        chroms = lambda chrom: chrom == shard.ref
 
-    regions.append((start, end))
+    fd, fname = tempfile.mkstemp(prefix='.tmp_count')
+    os.close(fd)
 
-    return regions
+    tmpcounts = TmpCountFile(fname)
+    region_counts = list(model._count_regions(bam, tmpcounts, chroms=chroms, **kwargs))
+    tmpcounts.close()
+
+    if kwargs.get('count_mapped'):
+        return fname, region_counts, model._mapped_reads
+    return fname, region_counts, None
 
 
 def _fetch_reads_excluding(bam, chrom, strand, start, end, multiple, whitelist=None, blacklist=None, library_type='FR'):
@@ -388,48 +591,6 @@ def _fetch_reads(bam, chrom, strand, starts, ends, multiple, exclusive, whitelis
     return count, reads
 
 
-def calc_coverage(bam, chrom, strand, starts, ends, whitelist, blacklist, library_type='FR'):
-    if not chrom in bam.references:
-        return 0, 0, 0
-
-    coverage = []
-    for start, end in zip(starts, ends):
-        for pileup in bam.pileup(chrom, start, end):
-            count = 0
-            for pileupread in pileup.pileups:
-                if blacklist and pileupread.alignment.qname in blacklist:
-                    continue
-                if not whitelist or pileupread.alignment.qname in whitelist:
-                    if strand:
-                        frag_strand = None
-                        if library_type == 'FR':
-                            if pileupread.alignment.is_read2:
-                                frag_strand = '-' if not pileupread.alignment.is_reverse else '+'
-                            else:
-                                frag_strand = '+' if not pileupread.alignment.is_reverse else '-'
-                        elif library_type == 'RF':
-                            if pileupread.alignment.is_read2:
-                                frag_strand = '+' if not pileupread.alignment.is_reverse else '-'
-                            else:
-                                frag_strand = '-' if not pileupread.alignment.is_reverse else '+'
-
-                        if strand != frag_strand:
-                            continue
-
-                    if not pileupread.is_del:
-                        count += 1
-
-            coverage.append(count)
-
-    if coverage:
-        mean, stdev = ngsutils.support.stats.mean_stdev(coverage)
-        median = ngsutils.support.stats.median(coverage)
-
-        return mean, stdev, median
-    else:
-        return 0, 0, 0
-
-
 def _find_mapped_count_median(counts):
     '''
     >>> _find_mapped_count_median([10, 20, 30, 10, 30])
@@ -469,6 +630,101 @@ def _find_mapped_count_pcts(counts, min_pct=0.0, max_pct=0.75):
     return acc
 
 
+def _mapped_count_cache_fname(bam):
+    return '%s.mapped' % bam.filename
+
+
+def _bam_file_key(fname):
+    st = os.stat(fname)
+    return '%r\t%s\t%s' % (st.st_mtime, st.st_ino, st.st_size)
+
+
+def known_mapped_count(bam, whitelist=None, blacklist=None, idxstats=False):
+    '''
+    Returns the number of mapped reads in a BAM file if it can be found
+    without reading the file, otherwise None. This is only possible if there
+    isn't a whitelist or blacklist.
+
+    If idxstats is True, multi-mapped reads are flagged with IH/NH tags (and
+    each read has only one alignment), so the number of mapped reads is the
+    number of mapped alignments in the BAM index. Otherwise, the count is
+    loaded from a cache file (bamfile.mapped) if the BAM file hasn't changed
+    since it was written (same mtime, inode and size).
+    '''
+    if whitelist or blacklist or not bam.filename:
+        return None
+
+    if idxstats:
+        return bam.mapped
+
+    cache_fname = _mapped_count_cache_fname(bam)
+    if os.path.exists(cache_fname):
+        try:
+            with open(cache_fname) as f:
+                key, count = f.read().rsplit('\t', 1)
+            if key == _bam_file_key(bam.filename):
+                return int(count)
+        except (IOError, OSError, ValueError):
+            pass
+
+    return None
+
+
+def _is_mapped_count_cache(fname):
+    'Is fname a cache file written by write_mapped_count_cache?'
+    try:
+        with open(fname) as f:
+            cols = f.read(1024).split('\t')
+        int(cols[-1])
+        return len(cols) in [3, 4]
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def write_mapped_count_cache(bam, count):
+    '''
+    Saves the exact number of mapped reads (without a whitelist or blacklist)
+    to bamfile.mapped. This is skipped if the directory isn't writable, or if
+    bamfile.mapped exists and isn't a cache file.
+
+    The cache is written to a temporary file first, and then renamed, so a
+    partial cache is never left behind.
+    '''
+    if not bam.filename:
+        return
+
+    cache_fname = _mapped_count_cache_fname(bam)
+    dirname = os.path.dirname(os.path.abspath(cache_fname))
+    if not os.access(dirname, os.W_OK):
+        return
+    if os.path.exists(cache_fname) and not _is_mapped_count_cache(cache_fname):
+        return
+
+    tmp_fname = None
+    try:
+        fd, tmp_fname = tempfile.mkstemp(prefix='.%s.' % os.path.basename(cache_fname), dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            f.write('%s\t%s\n' % (_bam_file_key(bam.filename), count))
+        os.chmod(tmp_fname, 0o644)
+        os.rename(tmp_fname, cache_fname)
+    except (IOError, OSError):
+        if tmp_fname and os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+
+
+def find_mapped_count(bam, whitelist=None, blacklist=None, idxstats=False, quiet=False):
+    '''
+    Returns the number of mapped reads, using the BAM index or cache if
+    possible (see known_mapped_count), otherwise reading the entire file.
+    '''
+    mapped_count = known_mapped_count(bam, whitelist, blacklist, idxstats)
+    if mapped_count is None:
+        mapped_count = _find_mapped_count(bam, whitelist, blacklist, quiet)
+        if not whitelist and not blacklist:
+            write_mapped_count_cache(bam, mapped_count)
+    return mapped_count
+
+
 def _find_mapped_count(bam, whitelist=None, blacklist=None, quiet=False):
     '''
     >>> _find_mapped_count(MockBam(['chr1']).add_read('foo1', tid=0, pos=100, cigar='50M').add_read('foo2', tid=0, pos=100, cigar='50M').add_read('foo3', tid=0, pos=100, cigar='50M').add_read('foo4'), quiet=True)
@@ -489,17 +745,12 @@ def _find_mapped_count(bam, whitelist=None, blacklist=None, quiet=False):
         if blacklist and read.qname in blacklist:
             continue
         if not whitelist or read.qname in whitelist:
-            if not read.is_unmapped and not read.qname in multinames:
-                mapped_count += 1
-                try:
-                    ih = int(read.opt('IH'))
-                except:
-                    try:
-                        ih = int(read.opt('NH'))
-                    except:
-                        ih = 1
-                if ih > 1:
+            if not read.is_unmapped:
+                if _read_ih(read) > 1:
                     multinames.add(read.qname)
+                else:
+                    mapped_count += 1
+    mapped_count += len(multinames)
     bam.seek(0)
     if not quiet:
         sys.stderr.write("%s mapped reads\n" % mapped_count)
@@ -1,10 +1,16 @@
-from count import Model, _fetch_reads, _find_mapped_count, _fetch_reads_excluding
+from count import Model, known_mapped_count, write_mapped_count_cache
+from bins import BinCounter
+from repeats import RepeatCounter, read_repeats
 from eta import ETA
 from ngsutils.gtf import GTF
 from ngsutils.bed import BedFile
-import ngsutils.support.ngs_utils
 import os
 import sys
+import shutil
+import tempfile
+import zipfile
+
+import numpy
 
 
 class GTFModel(Model):
@@ -127,7 +133,19 @@ class ExonModel(Model):
                 else:
                     was_last_const = False
 
-            def callback(bam, common_count, common_reads, common_cols):
+            # the reads for the constant spans and each region are counted
+            # along with the gene
+            strand = gene.strand if self.stranded else None
+            for span in const_spans:
+                self.prefetch(gene.chrom, strand, [start for start, end in span], [end for start, end in span])
+
+            for num, start, end, const, names in gene.regions:
+                self.prefetch(gene.chrom, strand, [start], [end])
+                self.prefetch_excluding(gene.chrom, strand, start, end)
+
+            # (the callback is called once the whole chromosome has been
+            # counted, so bind the values for this gene)
+            def callback(bam, common_count, common_reads, common_cols, gene=gene, strand=strand, const_spans=const_spans):
                 # gather constant reads
                 const_count = 0
                 for span in const_spans:
@@ -138,13 +156,13 @@ class ExonModel(Model):
                         starts.append(start)
                         ends.append(end)
 
-                    count, reads = _fetch_reads(bam, gene.chrom, gene.strand if self.stranded else None, starts, ends, self.multiple, False, self.whitelist, self.blacklist, self.uniq_only, self.library_type)
+                    count, reads = self.fetch_reads(bam, gene.chrom, strand, starts, ends)
                     const_count += count
 
                 #find counts for each region
                 for num, start, end, const, names in gene.regions:
-                    count, reads = _fetch_reads(bam, gene.chrom, gene.strand if self.stranded else None, [start], [end], self.multiple, False, self.whitelist, self.blacklist, self.uniq_only, self.library_type)
-                    excl_count, excl_reads = _fetch_reads_excluding(bam, gene.chrom, gene.strand if self.stranded else None, start, end, self.multiple, self.whitelist, self.blacklist, self.library_type)
+                    count, reads = self.fetch_reads(bam, gene.chrom, strand, [start], [end])
+                    excl_count, excl_reads = self.fetch_reads_excluding(bam, gene.chrom, strand, start, end)
 
                     # remove reads that exclude this region
                     for read in excl_reads:
@@ -186,7 +204,7 @@ class ExonModel(Model):
             yield (gene.chrom, starts, ends, gene.strand, geneout, callback)
         eta.done()
 
-    def count(self, bam, library_type, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False):
+    def count(self, bam, library_type, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False, threads=1, idxstats=False):
         self.uniq_only = uniq_only
         self.multiple = multiple
         self.whitelist = whitelist
@@ -195,12 +213,22 @@ class ExonModel(Model):
 
         self.stranded = library_type in ['FR', 'RF']
 
-        Model.count(self, bam, library_type, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, start_only)
+        Model.count(self, bam, library_type, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, start_only, threads, idxstats)
 
 
 class BinModel(Model):
-    def __init__(self, binsize):
+    '''
+    Counts reads in bins of {binsize} bases across each chromosome.
+
+    The bins for each chromosome are counted at once by a BinCounter (unless
+    coverage is needed). If matrix is given, the counts are also written to
+    this file as a NumPy .npz archive with one array per chromosome (strand x
+    bin, with the '+' strand first).
+    '''
+    def __init__(self, binsize, matrix=None):
         self.binsize = int(binsize)
+        self.matrix = matrix
+        self._matrix_dir = None
         Model.__init__(self)
 
     def get_source(self):
@@ -237,17 +265,83 @@ class BinModel(Model):
             yield (chrom, [pos], [chrom_len], '+', [chrom, pos, chrom_len, '+'], None)
             if self.stranded:
                 eta.print_status(pos_acc, extra='%s:%s[-]' % (chrom, bin))
-                yield (chrom, [pos], [chrom_len], '- ', [chrom, pos, chrom_len, '-'], None)
+                yield (chrom, [pos], [chrom_len], '-', [chrom, pos, chrom_len, '-'], None)
+
+        eta.done()
+
+    def _model_chroms(self):
+        return set([chrom for chrom, chrom_len in self.chrom_lens])
+
+    def _count_regions(self, bam, tmpcounts, library_type='FR', coverage=False, uniq_only=False, multiple='complete', whitelist=None, blacklist=None, start_only=False, count_mapped=False, chroms=None):
+        if coverage:
+            for val in Model._count_regions(self, bam, tmpcounts, library_type, coverage, uniq_only, multiple, whitelist, blacklist, start_only, count_mapped, chroms):
+                yield val
+            return
+
+        counter = BinCounter(bam, self.binsize, library_type, multiple, whitelist, blacklist, uniq_only, start_only, count_mapped)
+        strands = counter.strands
+
+        eta = ETA(sum([chrom_len for chrom, chrom_len in self.chrom_lens]))
+        pos_acc = 0
+        order = 0
+        for chrom, chrom_len in self.chrom_lens:
+            nbins = (chrom_len + self.binsize - 1) // self.binsize
+            if chroms is None or chroms(chrom):
+                eta.print_status(pos_acc, extra=chrom)
+                counts, partial = counter.count(chrom, chrom_len)
+
+                if self._matrix_dir:
+                    numpy.save(os.path.join(self._matrix_dir, '%s.npy' % chrom), counts)
+
+                # rows are in the same order as get_regions (bins, then strands)
+                cells = zip(counts.T.ravel().tolist(), partial.T.ravel().tolist())
+                for k, (count, is_partial) in enumerate(cells):
+                    if not is_partial:
+                        count = int(count)
+                    start = (k // len(strands)) * self.binsize
+                    end = min(start + self.binsize, chrom_len)
+
+                    tmpcounts.write(count, end - start, [chrom, start, end, strands[k % len(strands)], end - start, ''], order + k)
+                    yield order + k, count
+
+            order += nbins * len(strands)
+            pos_acc += chrom_len
 
         eta.done()
 
-    def count(self, bam, library_type, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False):
+        if count_mapped:
+            self._mapped_reads = counter.mapped_reads(chroms)
+
+    def count(self, bam, library_type, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False, threads=1, idxstats=False):
         self.stranded = library_type in ['FR', 'RF']
         self.chrom_lens = []
 
         for chrom, chrom_len in zip(bam.references, bam.lengths):
             self.chrom_lens.append((chrom, chrom_len))
-        Model.count(self, bam, library_type, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, start_only)
+
+        if self.matrix and coverage:
+            sys.stderr.write('Coverage calculations not supported with a bin matrix\n')
+            sys.exit(1)
+
+        if self.matrix:
+            self._matrix_dir = tempfile.mkdtemp(prefix='.tmp_bins', dir=os.path.dirname(os.path.abspath(self.matrix)))
+
+        try:
+            Model.count(self, bam, library_type, coverage, uniq_only, fpkm, norm, multiple, whitelist, blacklist, out, quiet, start_only, threads, idxstats)
+
+            if self.matrix:
+                self._write_matrix()
+        finally:
+            if self._matrix_dir:
+                shutil.rmtree(self._matrix_dir)
+                self._matrix_dir = None
+
+    def _write_matrix(self):
+        with zipfile.ZipFile(self.matrix, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for chrom, chrom_len in self.chrom_lens:
+                fname = os.path.join(self._matrix_dir, '%s.npy' % chrom)
+                if os.path.exists(fname):
+                    zf.write(fname, '%s.npy' % chrom)
 
 
 class BEDModel(Model):
@@ -278,24 +372,8 @@ class BEDModel(Model):
 
 
 def _repeatreader(fname):
-    with ngsutils.support.ngs_utils.gzip_opener(fname) as repeat_f:
-        eta = ETA(os.stat(fname).st_size, fileobj=repeat_f)
-        repeat_f.next()
-        repeat_f.next()
-        repeat_f.next()
-
-        for line in repeat_f:
-            cols = line.strip().split()
-            chrom = cols[4]
-            start = int(cols[5]) - 1
-            end = int(cols[6])
-            strand = '+' if cols[8] == '+' else '-'
-            family = cols[10]
-            member = cols[9]
-
-            eta.print_status(extra='%s|%s %s:%s-%s[%s]' % (family, member, chrom, start, end, strand))
-            yield (family, member, chrom, start, end, strand)
-        eta.done()
+    for family, member, chrom, start, end, strand in read_repeats(fname):
+        yield (family, member, chrom, start, end, strand)
 
 
 class RepeatModel(Model):
@@ -335,12 +413,10 @@ class RepeatFamilyModel(Model):
         for family, member, chrom, start, end, strand in _repeatreader(self.fname):
             yield (chrom, [start], [end], strand, [family, member, chrom, start, end, strand], None)
 
-    def count(self, bam, library_type, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False):
+    def count(self, bam, library_type, coverage=False, uniq_only=False, fpkm=False, norm='', multiple='complete', whitelist=None, blacklist=None, out=sys.stdout, quiet=False, start_only=False, threads=1, idxstats=False):
         # This is a separate count implementation because for repeat families,
         # we need to combine the counts from multiple regions in the genome,
-        # so the usual chrom, starts, ends loop breaks down.
-
-        stranded = library_type in ['FR', 'RF']
+        # so the usual chrom, starts, ends loop breaks down (see RepeatCounter).
 
         if coverage:
             sys.stderr.write('Coverage calculations not supported with repeatmasker family models\n')
@@ -350,40 +426,12 @@ class RepeatFamilyModel(Model):
             sys.stderr.write('Normalization "%s" not supported with repeatmasker family models\n' % norm)
             sys.exit(1)
 
-        # multireads = set()
-        # single_count = 0
-        repeats = {}
-        total_count = 0.0
-        for family, member, chrom, start, end, strand in _repeatreader(self.fname):
-            if not (family, member) in repeats:
-                repeats[(family, member)] = {'count': 0, 'size': 0}
-
-            if not (family, '*') in repeats:
-                repeats[(family, '*')] = {'count': 0, 'size': 0}
-
-            if not chrom in bam.references:
-                continue
-
-            size = end - start
-            repeats[(family, '*')]['size'] += size
-            repeats[(family, member)]['size'] += size
-
-            count, reads = _fetch_reads(bam, chrom, strand if stranded else None, [start], [end], multiple, False, whitelist, blacklist, library_type=library_type)
-            repeats[(family, '*')]['count'] += count
-            repeats[(family, member)]['count'] += count
-
-            total_count += count
-
-            # for read in reads:
-            #     if read.tags and 'IH' in read.tags:
-            #         ih = int(read.opt('IH'))
-            #     else:
-            #         ih = 1
+        mapped_count = None
+        if norm == 'all':
+            mapped_count = known_mapped_count(bam, whitelist, blacklist, idxstats)
 
-            #     if ih == 1:
-            #         single_count += 1
-            #     else:
-            #         multireads.add(read.qname)
+        counter = RepeatCounter(read_repeats(self.fname), bam, library_type, multiple, whitelist, blacklist, count_mapped=norm == 'all' and mapped_count is None)
+        repeats, total_count = counter.count()
 
         sys.stderr.write('Calculating normalization...')
 
@@ -391,9 +439,12 @@ class RepeatFamilyModel(Model):
         norm_val_orig = None
 
         if norm == 'all':
-            norm_val_orig = _find_mapped_count(bam, whitelist, blacklist)
+            if mapped_count is None:
+                mapped_count = counter.mapped_single + len(counter.mapped_multi)
+                if not whitelist and not blacklist:
+                    write_mapped_count_cache(bam, mapped_count)
+            norm_val_orig = mapped_count
         elif norm == 'mapped':
-            # norm_val_orig = single_count + len(multireads)
             norm_val_orig = total_count
 
         if norm_val_orig:
@@ -431,11 +482,12 @@ class RepeatFamilyModel(Model):
                 elif not class_level and k[1] == '*':
                     continue
 
-                cols = [k[0], k[1], repeats[k]['size'], repeats[k]['count']]
+                size, count = repeats[k]
+                cols = [k[0], k[1], size, count]
 
                 if norm_val:
-                    cols.append(repeats[k]['count'] / norm_val)
+                    cols.append(count / norm_val)
                     if fpkm:
-                        cols.append(repeats[k]['count'] / (repeats[k]['size'] / 1000.0) / norm_val)
+                        cols.append(count / (size / 1000.0) / norm_val)
 
                 out.write('%s\n' % '\t'.join([str(x) for x in cols]))
@@ -0,0 +1,368 @@
+'''
+Support for counting reads in RepeatMasker repeat families with one pass
+over the reads.
+
+The RepeatMasker file (rmsk.txt from UCSC or a RepeatMasker .out file) is
+parsed into arrays of intervals (chrom, start, end, strand, repeat), and
+these arrays are saved to a binary cache next to the file
+(.{filename}.cache), so the text only needs to be parsed once. The cache is
+rebuilt if the file changes (mtime, inode or size).
+
+To count, the intervals for each chromosome are sorted by start, and the
+reads for the chromosome are read once. Each read is matched to the
+intervals that overlap it (as in count._fetch_reads), and the counts are
+accumulated per (family, member) and per family.
+
+Multi-mapped reads (IH/NH > 1) are counted once for each repeat (and
+family) by name, so a read with alignments in several copies of the same
+repeat isn't counted more than once. With multiple=partial, the read adds
+the fraction of its alignments that are in the repeat. These names are kept
+until all of the chromosomes have been read, so memory grows with the number
+of multi-mapped reads that are in repeats.
+
+Uniquely mapped pairs are counted once for each repeat that either mate is
+in. The first mate is held until its mate is read (or the end of the
+chromosome), so only the pairs that span the current position are kept.
+Mates on different chromosomes are counted separately.
+'''
+
+import os
+import sys
+import array
+import tempfile
+
+import numpy
+
+import ngsutils.support.ngs_utils
+from eta import ETA
+from sweep import _frag_strand, _read_ih, _read_end
+
+_cache_version = 1
+
+
+def _cache_fname(fname):
+    return os.path.join(os.path.dirname(fname), '.%s.cache' % os.path.basename(fname))
+
+
+def _file_key(fname):
+    st = os.stat(fname)
+    return [_cache_version, repr(st.st_mtime), st.st_ino, st.st_size]
+
+
+class RepeatIntervals(object):
+    '''
+    The intervals from a RepeatMasker file, stored as arrays (in file order).
+
+    repeats is the list of (family, member) names, chroms is the list of
+    chromosome names, and chrom_idx, starts, ends, strands (0 for +, 1 for -)
+    and repeat_idx have one value for each interval.
+    '''
+    def __init__(self, repeats, chroms, chrom_idx, starts, ends, strands, repeat_idx):
+        self.repeats = repeats
+        self.chroms = chroms
+        self.chrom_idx = chrom_idx
+        self.starts = starts
+        self.ends = ends
+        self.strands = strands
+        self.repeat_idx = repeat_idx
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        'Yields (family, member, chrom, start, end, strand) in file order'
+        repeats = self.repeats
+        chroms = self.chroms
+        for c, start, end, strand, r in zip(self.chrom_idx.tolist(), self.starts.tolist(), self.ends.tolist(), self.strands.tolist(), self.repeat_idx.tolist()):
+            yield (repeats[r][0], repeats[r][1], chroms[c], start, end, '-' if strand else '+')
+
+    def chrom_intervals(self, chrom):
+        '''
+        Returns the starts, ends, strands and repeat_idx for the intervals on
+        a chromosome, sorted by start (as lists).
+        '''
+        if chrom not in self.chroms:
+            return [], [], [], []
+
+        mask = self.chrom_idx == self.chroms.index(chrom)
+        order = numpy.argsort(self.starts[mask], kind='mergesort')
+        return [self.starts[mask][order].tolist(), self.ends[mask][order].tolist(), self.strands[mask][order].tolist(), self.repeat_idx[mask][order].tolist()]
+
+    @staticmethod
+    def parse(fname):
+        repeats = []
+        repeat_ids = {}
+        chroms = []
+        chrom_ids = {}
+
+        chrom_idx = array.array('i')
+        starts = array.array('l')
+        ends = array.array('l')
+        strands = array.array('b')
+        repeat_idx = array.array('i')
+
+        with ngsutils.support.ngs_utils.gzip_opener(fname) as repeat_f:
+            eta = ETA(os.stat(fname).st_size, fileobj=repeat_f)
+            repeat_f.next()
+            repeat_f.next()
+            repeat_f.next()
+
+            for line in repeat_f:
+                cols = line.strip().split()
+                chrom = cols[4]
+                family = cols[10]
+                member = cols[9]
+
+                if chrom not in chrom_ids:
+                    chrom_ids[chrom] = len(chroms)
+                    chroms.append(chrom)
+                if (family, member) not in repeat_ids:
+                    repeat_ids[(family, member)] = len(repeats)
+                    repeats.append((family, member))
+
+                chrom_idx.append(chrom_ids[chrom])
+                starts.append(int(cols[5]) - 1)
+                ends.append(int(cols[6]))
+                strands.append(0 if cols[8] == '+' else 1)
+                repeat_idx.append(repeat_ids[(family, member)])
+
+                eta.print_status(extra='%s|%s %s:%s-%s' % (family, member, chrom, cols[5], cols[6]))
+            eta.done()
+
+        return RepeatIntervals(repeats, chroms, numpy.array(chrom_idx, dtype=numpy.int32), numpy.array(starts, dtype=numpy.int64),
+                               numpy.array(ends, dtype=numpy.int64), numpy.array(strands, dtype=numpy.int8), numpy.array(repeat_idx, dtype=numpy.int32))
+
+    def save(self, fname, key):
+        '''
+        Saves the intervals to a cache file. The cache is written to a
+        temporary file first, and then renamed, so a partial cache is never
+        left behind.
+        '''
+        fd, tmp_fname = tempfile.mkstemp(prefix='%s.' % os.path.basename(fname), dir=os.path.dirname(os.path.abspath(fname)))
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                numpy.savez(out, key=numpy.array([str(x) for x in key]),
+                            families=numpy.array([x[0] for x in self.repeats]), members=numpy.array([x[1] for x in self.repeats]),
+                            chroms=numpy.array(self.chroms), chrom_idx=self.chrom_idx, starts=self.starts, ends=self.ends,
+                            strands=self.strands, repeat_idx=self.repeat_idx)
+            os.chmod(tmp_fname, 0o644)
+            os.rename(tmp_fname, fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.unlink(tmp_fname)
+
+    @staticmethod
+    def load(fname, key):
+        'Loads the intervals from a cache file (returns None if the cache is out of date)'
+        with open(fname, 'rb') as f:
+            data = numpy.load(f)
+            if data['key'].tolist() != [str(x) for x in key]:
+                return None
+
+            repeats = zip(data['families'].tolist(), data['members'].tolist())
+            return RepeatIntervals(repeats, data['chroms'].tolist(), data['chrom_idx'], data['starts'], data['ends'], data['strands'], data['repeat_idx'])
+
+
+def read_repeats(fname, cache=True):
+    '''
+    Reads the intervals from a RepeatMasker file, using (or writing) the
+    binary cache if cache is True.
+    '''
+    if not cache:
+        return RepeatIntervals.parse(fname)
+
+    cache_fname = _cache_fname(fname)
+    key = _file_key(fname)
+    if os.path.exists(cache_fname):
+        try:
+            intervals = RepeatIntervals.load(cache_fname, key)
+            if intervals is not None:
+                return intervals
+        except Exception:
+            sys.stderr.write('Failed reading cache! Processing original file.\n')
+
+    intervals = RepeatIntervals.parse(fname)
+    try:
+        intervals.save(cache_fname, key)
+    except (IOError, OSError):
+        sys.stderr.write('Unable to write cache: %s\n' % cache_fname)
+
+    return intervals
+
+
+class RepeatCounter(object):
+    '''
+    Counts the reads in each repeat (family, member) and family (family, '*')
+    with one pass over the reads.
+
+    If count_mapped is True, all of the mapped reads are counted at the same
+    time (see ReadSweep.mapped_reads).
+    '''
+    def __init__(self, intervals, bam, library_type='FR', multiple='complete', whitelist=None, blacklist=None, count_mapped=False):
+        assert multiple in ['complete', 'partial', 'ignore']
+
+        self.intervals = intervals
+        self.bam = bam
+        self.library_type = library_type
+        self.multiple = multiple
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self.count_mapped = count_mapped
+
+        self.families = sorted(set([family for family, member in intervals.repeats]))
+        family_ids = dict([(family, i) for i, family in enumerate(self.families)])
+
+        # counts are kept by id: repeats first, then the families
+        self._family_of = [len(intervals.repeats) + family_ids[family] for family, member in intervals.repeats]
+        self._counts = [0] * (len(intervals.repeats) + len(self.families))
+        self._total = 0
+
+        # multi-mapped reads: (qname, id) => [alignments for read1 (or unpaired), alignments for read2]
+        self._named = {}
+        self._ih = {}
+
+        self.mapped_single = 0
+        self.mapped_multi = set()
+
+    def count(self):
+        '''
+        Counts the reads on all of the chromosomes in the BAM file. Returns
+        a dict of (family, member) => [size, count] (members named '*' are
+        family totals) and the total count for all repeats.
+        '''
+        bam_chroms = set(self.bam.references)
+        for ref in self.bam.references:
+            self._count_chrom(ref)
+
+        self._count_named()
+
+        results = {}
+        for family, member in self.intervals.repeats:
+            results[(family, member)] = [0, 0]
+            results[(family, '*')] = [0, 0]
+
+        for chrom, start, end, r in zip(self.intervals.chrom_idx.tolist(), self.intervals.starts.tolist(), self.intervals.ends.tolist(), self.intervals.repeat_idx.tolist()):
+            if self.intervals.chroms[chrom] in bam_chroms:
+                family, member = self.intervals.repeats[r]
+                results[(family, member)][0] += end - start
+                results[(family, '*')][0] += end - start
+
+        for r, (family, member) in enumerate(self.intervals.repeats):
+            results[(family, member)][1] = self._counts[r]
+        for f, family in enumerate(self.families):
+            results[(family, '*')][1] = self._counts[len(self.intervals.repeats) + f]
+
+        return results, self._total
+
+    def _count_chrom(self, chrom):
+        starts, ends, strands, repeat_idx = self.intervals.chrom_intervals(chrom)
+        if not starts and not self.count_mapped:
+            return
+
+        library_type = self.library_type
+        stranded = library_type in ['FR', 'RF']
+        whitelist = self.whitelist
+        blacklist = self.blacklist
+        count_mapped = self.count_mapped
+        family_of = self._family_of
+        counts = self._counts
+        named = self._named
+
+        # unique pairs waiting for their mate: qname => ids
+        pending = {}
+
+        n = len(starts)
+        nxt = 0
+        active = []
+
+        for read in self.bam.fetch(chrom):
+            qname = read.qname
+            if blacklist and qname in blacklist:
+                continue
+            if whitelist and qname not in whitelist:
+                continue
+
+            ih = _read_ih(read)
+            if count_mapped and not read.is_unmapped:
+                if ih > 1:
+                    self.mapped_multi.add(qname)
+                else:
+                    self.mapped_single += 1
+
+            pos = read.pos
+            while nxt < n and starts[nxt] <= pos:
+                active.append(nxt)
+                nxt += 1
+
+            active = [j for j in active if ends[j] > pos]
+
+            hits = active
+            end = _read_end(read)
+            if nxt < n and starts[nxt] < end:
+                hits = active[:]
+                i = nxt
+                while i < n and starts[i] < end:
+                    hits.append(i)
+                    i += 1
+
+            if not hits:
+                continue
+
+            if stranded:
+                strand = 0 if _frag_strand(read, library_type) == '+' else 1
+                ids = set([repeat_idx[j] for j in hits if strands[j] == strand])
+            else:
+                ids = set([repeat_idx[j] for j in hits])
+
+            if not ids:
+                continue
+
+            ids.update([family_of[r] for r in ids])
+
+            if ih <= 1:
+                if read.is_paired and not read.mate_is_unmapped and read.rnext == read.tid:
+                    if qname in pending:
+                        ids.update(pending.pop(qname))
+                    elif read.pnext >= pos:
+                        # the mate hasn't been read yet
+                        pending[qname] = ids
+                        continue
+
+                for r in ids:
+                    counts[r] += 1
+                self._total += 1
+            else:
+                # counted by name at the end
+                self._ih[qname] = ih
+                mate = 1 if read.is_read2 else 0
+                ids.add(-1)
+                for r in ids:
+                    if (qname, r) not in named:
+                        named[(qname, r)] = [0, 0]
+                    named[(qname, r)][mate] += 1
+
+        # pairs whose mate wasn't in a repeat (or wasn't read)
+        for ids in pending.itervalues():
+            for r in ids:
+                counts[r] += 1
+            self._total += 1
+
+    def _count_named(self):
+        multiple = self.multiple
+        counts = self._counts
+        for (qname, r), alignments in sorted(self._named.iteritems()):
+            ih = self._ih[qname]
+            if ih <= 1 or multiple == 'complete':
+                weight = 1
+            elif multiple == 'partial':
+                weight = min(1.0, float(max(alignments)) / ih)
+            else:
+                weight = 0
+
+            if r == -1:
+                self._total += weight
+            else:
+                counts[r] += weight
+
+        self._named = {}
+        self._ih = {}
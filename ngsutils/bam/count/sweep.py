@@ -0,0 +1,467 @@
+'''
+Single-pass read counting for bamutils count
+
+Instead of fetching the reads for each feature (and each region of each
+feature) separately, all of the queries for a chromosome are added to a
+ReadSweep, which groups them into clusters of nearby regions. The reads for
+each cluster are fetched once (in coordinate order), and each read is
+assigned to all of the regions it overlaps with a sweep over the regions
+(sorted by start position). Reads between clusters are never fetched.
+
+The counts are the same as fetching the reads for each region separately
+(see count._fetch_reads): a read overlaps a region if any part of its
+alignment span (including gaps) overlaps the region (0-based, half-open),
+a read is counted once for each region of the feature that it overlaps,
+and for uniq_only, the first read (in region order) with a given starting
+position is counted.
+
+Coverage (depth) is calculated from the aligned blocks of each read (M, =
+and X operations; deletions and gaps aren't counted, and reads that pileup
+skips by default are ignored). The blocks are added to a difference array for
+each region, and the depth for each position is the cumulative sum. Once a
+region has been passed, the depths are reduced to a histogram, so only the
+regions that overlap the current read are held in memory. The mean, stdev
+and median depth are calculated over all of the bases in the regions
+(including bases without any reads).
+'''
+
+import operator
+
+import numpy
+
+# reads with these flags aren't included in the coverage (the same as
+# pileup): unmapped, secondary, QC fail, duplicate
+_coverage_mask = 0x704
+
+# Clusters of regions that are less than this far apart are fetched together
+_merge_gap = 50000
+
+# ...unless the cluster is already larger than this
+_max_cluster = 10000000
+
+
+def _frag_strand(read, library_type):
+    if library_type == 'FR':
+        if read.is_read2:
+            return '+' if read.is_reverse else '-'
+        return '-' if read.is_reverse else '+'
+    elif library_type == 'RF':
+        if read.is_read2:
+            return '-' if read.is_reverse else '+'
+        return '+' if read.is_reverse else '-'
+    return None
+
+
+def _read_ih(read):
+    for tag, val in read.tags:
+        if tag == 'IH' or tag == 'NH':
+            return int(val)
+    return 0
+
+
+def _read_end(read):
+    'The end of the alignment span (as used by the BAM index)'
+    if read.is_unmapped or not read.cigar:
+        return read.pos + 1
+    return read.aend
+
+
+def read_aligned_blocks(read):
+    '''
+    Find the regions of the reference that are aligned to bases in the read
+    (not deletions or gaps)
+    '''
+    blocks = []
+    pos = read.pos
+    for op, length in read.cigar:
+        if op == 0 or op == 7 or op == 8:
+            blocks.append((pos, pos + length))
+            pos += length
+        elif op == 2 or op == 3:
+            pos += length
+    return blocks
+
+
+def depth_stats(hist):
+    '''
+    Returns the mean, stdev and median of depths stored as a histogram
+    (hist[depth] = number of bases). These are the same values as
+    ngsutils.support.stats.mean_stdev and median.
+
+    >>> depth_stats(numpy.array([0, 1, 3, 1]))  # [1, 2, 2, 2, 3]
+    (2.0, 0.7071067811865476, 2)
+    >>> depth_stats(numpy.array([1, 1, 1, 1]))  # [0, 1, 2, 3]
+    (1.5, 1.2909944487358056, 1.5)
+    >>> depth_stats(numpy.array([0, 0, 2]))
+    (2.0, 0.0, 2.0)
+    >>> depth_stats(numpy.array([], dtype=int))
+    (0, 0, 0)
+    '''
+    n = int(hist.sum())
+    if not n:
+        return 0, 0, 0
+
+    depths = numpy.arange(len(hist))
+    mean = float((depths * hist).sum()) / n
+
+    if n > 2:
+        stdev = float(numpy.sqrt(((depths - mean) ** 2 * hist).sum() / (n - 1)))
+    else:
+        stdev = 0.0
+
+    # the depth at (0-based) position i is the first depth with more than i
+    # positions at or below it
+    cumulative = numpy.cumsum(hist)
+    if n % 2 == 1:
+        median = int(numpy.searchsorted(cumulative, n // 2 + 1))
+    else:
+        median = float(numpy.searchsorted(cumulative, n // 2) + numpy.searchsorted(cumulative, n // 2 + 1)) / 2
+
+    return mean, stdev, median
+
+
+class _Depth(object):
+    'Difference array for the depth over one region (stored as lists of block starts and ends)'
+    __slots__ = ['start', 'end', 'starts', 'ends']
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.starts = []
+        self.ends = []
+
+    def add(self, blocks):
+        for bstart, bend in blocks:
+            if bstart < self.end and bend > self.start:
+                self.starts.append(max(bstart, self.start) - self.start)
+                self.ends.append(min(bend, self.end) - self.start)
+
+    def histogram(self):
+        length = self.end - self.start
+        diff = numpy.bincount(self.starts, minlength=length + 1) - numpy.bincount(self.ends, minlength=length + 1)
+        return numpy.bincount(numpy.cumsum(diff[:length]))
+
+
+def read_blocks(read):
+    'Find regions of reference the read covers - breaking on long gaps (N)'
+    blocks = []
+    start = read.pos
+    end = read.pos
+    for op, length in read.cigar:
+        if op == 0 or op == 2:
+            end += length
+        elif op == 3:
+            blocks.append((start, end))
+            end += length
+            start = end
+
+    blocks.append((start, end))
+    return blocks
+
+
+class _Query(object):
+    __slots__ = ['chrom', 'strand', 'starts', 'ends', 'start_only', 'excluding', 'keep_reads', 'coverage', 'pending', 'hits', 'count', 'reads', 'depth_hist', 'depth_len']
+
+    def __init__(self, chrom, strand, starts, ends, start_only, excluding, keep_reads, coverage):
+        self.chrom = chrom
+        self.strand = strand
+        self.starts = starts
+        self.ends = ends
+        self.start_only = start_only
+        self.excluding = excluding
+        self.keep_reads = keep_reads
+        self.coverage = coverage
+        self.pending = True
+        self.hits = []
+        self.count = 0
+        self.reads = set()
+        self.depth_hist = numpy.zeros(1, dtype=numpy.int64)
+        self.depth_len = 0
+
+    def add_depth(self, depth):
+        hist = depth.histogram()
+        if len(hist) > len(self.depth_hist):
+            hist[:len(self.depth_hist)] += self.depth_hist
+            self.depth_hist = hist
+        else:
+            self.depth_hist[:len(hist)] += hist
+        self.depth_len += depth.end - depth.start
+
+    def start_ok(self, pos):
+        for s, e in zip(self.starts, self.ends):
+            if s <= pos <= e:
+                return True
+        return False
+
+    def excludes(self, read):
+        'Does the read skip over this (single) region?'
+        start = self.starts[0]
+        end = self.ends[0]
+        for s, e in read_blocks(read):
+            if start <= s <= end or start <= e <= end:
+                return False
+        return True
+
+
+class ReadSweep(object):
+    '''
+    Counts the reads for a set of queries (features) at once.
+
+    Queries are added with add(), which returns an id for the query. When
+    run() is called, the reads for the pending queries are counted, and the
+    (count, reads) for each query can be retrieved with result().
+    reads is the set of read names that were counted (only kept if
+    keep_reads is True for the query).
+
+    If excluding is True, the query has a single region and counts the reads
+    that span the region without covering it (see count._fetch_reads_excluding).
+
+    If coverage is True, the mean, stdev and median depth for the regions can
+    be retrieved with coverage().
+
+    If count_mapped is True, each chromosome is read in full (instead of only
+    the clusters of regions), and the mapped reads are counted at the same
+    time (see mapped_reads()).
+    '''
+    def __init__(self, bam, library_type='FR', multiple='complete', whitelist=None, blacklist=None, uniq_only=False, count_mapped=False):
+        assert multiple in ['complete', 'partial', 'ignore']
+
+        self.bam = bam
+        self.library_type = library_type
+        self.multiple = multiple
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self.uniq_only = uniq_only
+
+        self.count_mapped = count_mapped
+
+        self._queries = {}
+        self._next_qid = 0
+        self._mapped_refs = set()
+        self._mapped_single = 0
+        self._mapped_multi = set()
+
+    def add(self, chrom, strand, starts, ends, start_only=False, excluding=False, keep_reads=False, coverage=False):
+        qid = self._next_qid
+        self._next_qid += 1
+        self._queries[qid] = _Query(chrom, strand, starts, ends, start_only, excluding, keep_reads, coverage)
+        return qid
+
+    def result(self, qid):
+        query = self._queries[qid]
+        return query.count, query.reads
+
+    def coverage(self, qid):
+        'Returns the mean, stdev and median depth over the regions'
+        return depth_stats(self._queries[qid].depth_hist)
+
+    def discard(self, qid):
+        'Removes a query (and its result)'
+        del self._queries[qid]
+
+    def run(self, chrom=None):
+        '''
+        Counts the reads for all of the pending queries (or only the queries
+        for one chromosome).
+        '''
+        by_chrom = {}
+        for qid, query in self._queries.iteritems():
+            if query.pending and (chrom is None or query.chrom == chrom):
+                if query.chrom not in by_chrom:
+                    by_chrom[query.chrom] = []
+                by_chrom[query.chrom].append(qid)
+
+        for ref in by_chrom:
+            if ref in self.bam.references:
+                regions = []
+                for qid in by_chrom[ref]:
+                    query = self._queries[qid]
+                    for i, (s, e) in enumerate(zip(query.starts, query.ends)):
+                        if s < e:
+                            regions.append((s, e, qid, i))
+
+                regions.sort()
+                if self.count_mapped and ref not in self._mapped_refs:
+                    # all of the reads on the chromosome are needed
+                    self._sweep(ref, None, None, regions)
+                else:
+                    for cstart, cend, cluster in self._clusters(regions):
+                        self._sweep(ref, cstart, cend, cluster)
+
+            for qid in by_chrom[ref]:
+                self._finish(self._queries[qid])
+
+    def mapped_reads(self, chroms=None):
+        '''
+        Returns the number of mapped reads that aren't multi-mapped, and the
+        set of multi-mapped read names (IH/NH > 1), filtered by the
+        whitelist/blacklist. Requires count_mapped. Chromosomes that haven't
+        been swept yet (or only those where chroms(ref) is True) are read now.
+        '''
+        assert self.count_mapped
+
+        for ref in self.bam.references:
+            if ref not in self._mapped_refs and (chroms is None or chroms(ref)):
+                self._sweep(ref, None, None, [])
+
+        return self._mapped_single, self._mapped_multi
+
+    def _clusters(self, regions):
+        'Groups regions (sorted by start) into clusters to fetch together'
+        cluster = []
+        cstart = cend = None
+        for region in regions:
+            if cluster and (region[0] > cend + _merge_gap or (region[0] >= cend and cend - cstart > _max_cluster)):
+                yield cstart, cend, cluster
+                cluster = []
+
+            if not cluster:
+                cstart = region[0]
+                cend = region[1]
+            elif region[1] > cend:
+                cend = region[1]
+            cluster.append(region)
+
+        if cluster:
+            yield cstart, cend, cluster
+
+    def _sweep(self, chrom, cstart, cend, regions):
+        queries = self._queries
+        library_type = self.library_type
+        whitelist = self.whitelist
+        blacklist = self.blacklist
+        multiple = self.multiple
+
+        count_mapped = self.count_mapped and chrom not in self._mapped_refs
+        if count_mapped:
+            self._mapped_refs.add(chrom)
+        mapped_multi = self._mapped_multi
+        mapped_single = 0
+
+        n = len(regions)
+        nxt = 0
+        active = []
+        seq = 0
+        depths = {}
+
+        if cstart is None:
+            reads = self.bam.fetch(chrom)
+        else:
+            reads = self.bam.fetch(chrom, cstart, cend)
+
+        for read in reads:
+            pos = read.pos
+            if count_mapped and not read.is_unmapped:
+                qname = read.qname
+                if not (blacklist and qname in blacklist) and not (whitelist and qname not in whitelist):
+                    if _read_ih(read) > 1:
+                        mapped_multi.add(qname)
+                    else:
+                        mapped_single += 1
+
+            while nxt < n and regions[nxt][0] <= pos:
+                active.append(regions[nxt])
+                nxt += 1
+
+            # regions that start before (or at) the read, and end after it
+            passed = len(active)
+            active = [region for region in active if region[1] > pos]
+            if depths and passed > len(active):
+                self._close_depths(depths, pos)
+
+            hits = active
+
+            # regions that start inside the read
+            if nxt < n and regions[nxt][0] < _read_end(read):
+                hits = active[:]
+                end = _read_end(read)
+                i = nxt
+                while i < n and regions[i][0] < end:
+                    hits.append(regions[i])
+                    i += 1
+
+            if not hits:
+                continue
+
+            qname = read.qname
+            if blacklist and qname in blacklist:
+                continue
+            if whitelist and qname not in whitelist:
+                continue
+
+            seq += 1
+            frag_strand = _frag_strand(read, library_type)
+            key = None
+            weight = None
+            blocks = None
+
+            for s, e, qid, i in hits:
+                query = queries[qid]
+                if query.strand and query.strand != frag_strand:
+                    continue
+
+                if query.coverage and not read.flag & _coverage_mask:
+                    if blocks is None:
+                        blocks = read_aligned_blocks(read)
+                    if (qid, i) not in depths:
+                        depths[(qid, i)] = _Depth(s, e)
+                    depths[(qid, i)].add(blocks)
+
+                if query.excluding:
+                    if query.excludes(read):
+                        query.hits.append((i, seq, None, 1, qname))
+                    continue
+
+                if query.start_only and not query.start_ok(read.aend if read.is_reverse else pos):
+                    continue
+
+                if weight is None:
+                    key = (read.aend, '-') if read.is_reverse else (pos, '+')
+                    ih = _read_ih(read)
+                    if ih <= 1 or multiple == 'complete':
+                        weight = 1
+                    elif multiple == 'partial':
+                        weight = 1.0 / ih
+                    else:
+                        weight = 0
+
+                query.hits.append((i, seq, key, weight, qname))
+
+        self._close_depths(depths)
+        self._mapped_single += mapped_single
+
+    def _close_depths(self, depths, pos=None):
+        'Adds the depths for the regions that end before pos (or all regions) to their queries'
+        for key in depths.keys():
+            depth = depths[key]
+            if pos is None or depth.end <= pos:
+                self._queries[key[0]].add_depth(depth)
+                del depths[key]
+
+    def _finish(self, query):
+        # hits are counted in region order (then read order), the same as
+        # fetching the reads for each region in turn
+        query.hits.sort(key=operator.itemgetter(0, 1))
+
+        count = 0
+        seen = set()
+        uniq = self.uniq_only and not query.excluding
+        for i, seq, key, weight, qname in query.hits:
+            if uniq:
+                if key in seen:
+                    continue
+                seen.add(key)
+
+            if query.keep_reads:
+                query.reads.add(qname)
+            count += weight
+
+        query.count = count
+        query.hits = []
+        query.pending = False
+
+        if query.coverage:
+            # bases in regions without any reads
+            length = sum([max(0, e - s) for s, e in zip(query.starts, query.ends)])
+            query.depth_hist[0] += length - query.depth_len
+            query.depth_len = length
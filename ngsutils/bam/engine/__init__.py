@@ -0,0 +1,3 @@
+'''
+Shared processing engines for bamutils commands
+'''
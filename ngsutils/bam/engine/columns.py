@@ -0,0 +1,207 @@
+'''
+Per-position (column) base and deletion counts for a sorted BAM file
+
+This is a replacement for looping over a pysam pileup, where each read's
+sequence and qualities are looked up again for every position (column) that
+the read covers. Here, each read is decoded once: the bases of its aligned
+blocks (and its deletions) are scattered into a (channel x position) count
+array for a rolling window of the chromosome. Once all of the reads that
+could cover a position have been added (reads are sorted), the counts for
+the finished positions are returned as a chunk (Columns).
+
+The channels are the matches (A, C, G, T, N) that pass the quality filter
+and the deletions, for each strand: counts[channel] are the + strand counts
+and counts[MINUS + channel] are the - strand counts (see: Columns.total).
+
+If a shard is given (see: ngsutils.bam.engine.shard), all of the reads that
+overlap the shard are counted, but only the positions in the shard are
+returned, so that shards can be processed in parallel.
+'''
+
+import collections
+
+import numpy
+
+from ngsutils.bam import bam_iter
+
+# base => channel (A, C, G, T, N)
+_base_codes = numpy.empty(256, dtype=numpy.int64)
+_base_codes.fill(4)
+for _i, _base in enumerate('ACGT'):
+    _base_codes[ord(_base)] = _i
+    _base_codes[ord(_base.lower())] = _i
+
+A, C, G, T, N, DEL = range(6)
+MINUS = 6  # - strand counts are MINUS + channel
+_channels = 12
+
+# add the pending blocks to the counts after this many bases
+_flush_size = 500000
+
+
+class Columns(collections.namedtuple('Columns', 'tid pos counts')):
+    '''
+    The counts for a chunk of positions on one reference. pos is an array of
+    the positions (0-based) with at least one base or deletion, and counts
+    is a (channel x position) array.
+    '''
+    def total(self, channel):
+        'The count for both strands'
+        return self.counts[channel] + self.counts[MINUS + channel]
+
+
+class ColumnCounter(object):
+    '''
+    Counts the bases and deletions at each position of a sorted BAM file (or
+    a shard of an indexed BAM file).
+
+    min_qual      Only count bases with at least this quality (Sanger scale)
+    mask          Skip reads with these flags
+    skip_indel    Don't count the last base before an insertion or a deletion
+                  (the bases where pysam's pileupread.indel isn't 0)
+    '''
+    def __init__(self, bam, min_qual=0, mask=1540, skip_indel=False, shard=None, quiet=False, size=65536):
+        self.bam = bam
+        self.min_qual = min_qual
+        self.mask = mask
+        self.skip_indel = skip_indel
+        self.shard = shard
+        self.quiet = quiet
+        self.size = size
+
+        self._counts = None
+        self._tid = None
+        self._start = 0  # the first position in the window
+        self._end = 0  # the end of the last read
+        self._pending = []  # (channels, positions)
+        self._pending_size = 0
+
+    def _reads(self):
+        if self.shard:
+            return self.bam.fetch(self.shard.ref, self.shard.start, self.shard.end)
+
+        def callback(read):
+            return '%s:%s' % (self.bam.getrname(read.tid), read.pos)
+
+        return bam_iter(self.bam, quiet=self.quiet, callback=callback)
+
+    def __iter__(self):
+        for read in self._reads():
+            if read.flag & self.mask or read.tid < 0 or not read.cigar:
+                continue
+
+            if read.tid != self._tid:
+                if self._tid is not None:
+                    for cols in self._flush(None):
+                        yield cols
+
+                self._tid = read.tid
+                self._start = read.pos
+                self._end = read.pos
+                self._counts = numpy.zeros((_channels, self.size), dtype=numpy.int64)
+
+            elif self._pending_size > _flush_size or read.pos - self._start > self.size // 2:
+                # all of the positions before this read are finished
+                for cols in self._flush(read.pos):
+                    yield cols
+
+            self._push_read(read)
+
+        if self._tid is not None:
+            for cols in self._flush(None):
+                yield cols
+            self._tid = None
+
+    def _push_read(self, read):
+        strand = MINUS if read.is_reverse else 0
+        cigar = read.cigar
+
+        if read.seq:
+            codes = _base_codes[numpy.frombuffer(read.seq, dtype=numpy.uint8)] + strand
+        else:
+            codes = numpy.repeat(N + strand, sum([length for op, length in cigar if op in (0, 1, 4, 7, 8)]))
+        if self.min_qual > 0:
+            if read.qual:
+                passed = numpy.frombuffer(read.qual, dtype=numpy.uint8) >= self.min_qual + 33
+            else:
+                passed = numpy.zeros(len(codes), dtype=bool)
+        else:
+            passed = None
+
+        ref_pos = read.pos
+        read_idx = 0
+        for k, (op, length) in enumerate(cigar):
+            if op == 0 or op == 7 or op == 8:  # M, =, X
+                keep = length
+                if self.skip_indel and k + 1 < len(cigar) and cigar[k + 1][0] in (1, 2):
+                    keep -= 1
+
+                block_codes = codes[read_idx:read_idx + keep]
+                positions = numpy.arange(ref_pos, ref_pos + keep)
+                if passed is not None:
+                    block_passed = passed[read_idx:read_idx + keep]
+                    block_codes = block_codes[block_passed]
+                    positions = positions[block_passed]
+
+                self._pending.append((block_codes, positions))
+                self._pending_size += keep
+                ref_pos += length
+                read_idx += length
+
+            elif op == 2:  # D
+                self._pending.append((numpy.repeat(strand + DEL, length), numpy.arange(ref_pos, ref_pos + length)))
+                self._pending_size += length
+                ref_pos += length
+
+            elif op == 3:  # N
+                ref_pos += length
+
+            elif op == 1 or op == 4:  # I, S
+                read_idx += length
+
+        self._end = max(self._end, ref_pos)
+
+    def _flush(self, cutoff):
+        '''
+        Yields the Columns for the positions before cutoff (or all of them),
+        and moves the start of the window to cutoff.
+        '''
+        size = self._counts.shape[1]
+        if self._end - self._start > size:
+            grown = numpy.zeros((_channels, max(size * 2, self._end - self._start)), dtype=numpy.int64)
+            grown[:, :size] = self._counts
+            self._counts = grown
+            size = grown.shape[1]
+
+        if self._pending:
+            channels = numpy.concatenate([x[0] for x in self._pending])
+            positions = numpy.concatenate([x[1] for x in self._pending]) - self._start
+            flat = self._counts.reshape(-1)
+            flat += numpy.bincount(channels * size + positions, minlength=_channels * size)
+            self._pending = []
+            self._pending_size = 0
+
+        if cutoff is None:
+            cutoff = self._end
+        cutoff = max(cutoff, self._start)
+        n = min(cutoff - self._start, size)
+
+        counts = self._counts[:, :n]
+        offsets = numpy.nonzero(counts.any(0))[0]
+        pos = offsets + self._start
+        if self.shard:
+            keep = (pos >= self.shard.start) & (pos < self.shard.end)
+            offsets = offsets[keep]
+            pos = pos[keep]
+
+        if len(offsets):
+            yield Columns(self._tid, pos, counts[:, offsets])
+
+        # roll the window
+        if n >= size:
+            self._counts[:] = 0
+        elif n:
+            self._counts[:, :size - n] = self._counts[:, n:]
+            self._counts[:, size - n:] = 0
+        self._start = cutoff
+        self._end = max(self._end, cutoff)
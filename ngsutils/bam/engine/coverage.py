@@ -0,0 +1,165 @@
+'''
+Read depth (coverage) as runs of positions with the same depth
+
+Instead of keeping a count for every position of a chromosome (and adding 1
+to each position a read covers), only the edges of the aligned blocks are
+recorded: +1 at the start of each block and -1 at the end (a sparse
+difference array). The depth is the cumulative sum of the edges (in order),
+and the runs of positions with the same depth are found where the depth
+changes (numpy.diff). The work is proportional to the number of blocks,
+not the length of the chromosome.
+
+Blocks are added in order of their start (a sorted BAM file), so the depth
+before the start of the current block is final. The edges are resolved
+into runs whenever enough of them are pending (see: DepthRuns.flush), so the
+memory used doesn't depend on the size of the chromosome either.
+'''
+
+import collections
+from array import array
+
+import numpy
+
+from ngsutils.bam import bam_iter
+
+# resolve the pending edges after this many blocks
+_flush_size = 1000000
+
+
+class Runs(collections.namedtuple('Runs', 'tid starts ends depths')):
+    '''
+    Runs of positions (0-based, half-open) with the same depth on one
+    reference, as arrays. Positions without any depth aren't included.
+    '''
+    pass
+
+
+class DepthRuns(object):
+    '''
+    The depth for one chromosome, from blocks (intervals) that are added in
+    order of their start.
+
+    >>> depth = DepthRuns()
+    >>> depth.add(10, 20)
+    >>> depth.add(15, 30)
+    >>> depth.add(30, 40)
+    >>> [x.tolist() for x in depth.flush()]
+    [[10, 15, 20], [15, 20, 40], [1, 2, 1]]
+    '''
+    def __init__(self):
+        self.starts = array('l')
+        self.ends = array('l')
+
+        # the last run isn't finished until there are no edges before its end
+        self._run_start = 0
+        self._run_depth = 0
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        if end > start:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def flush(self, cutoff=None):
+        '''
+        Returns arrays of the (starts, ends, depths) of the finished runs
+        (depth > 0) before cutoff (or all of them). All of the blocks that
+        are added later must start at or after cutoff.
+        '''
+        starts = numpy.array(self.starts, dtype=numpy.int64)
+        ends = numpy.array(self.ends, dtype=numpy.int64)
+
+        pos = numpy.concatenate([starts, ends])
+        deltas = numpy.concatenate([numpy.ones(len(starts), dtype=numpy.int64), -numpy.ones(len(ends), dtype=numpy.int64)])
+
+        # the edges after cutoff are kept for later
+        if cutoff is not None:
+            done = pos < cutoff
+            pos = pos[done]
+            deltas = deltas[done]
+            self.starts = array('l', starts[starts >= cutoff].tolist())
+            self.ends = array('l', ends[ends >= cutoff].tolist())
+        else:
+            self.starts = array('l')
+            self.ends = array('l')
+
+        # the depth after each distinct edge
+        order = numpy.argsort(pos, kind='mergesort')
+        pos = pos[order]
+        deltas = deltas[order]
+
+        first = numpy.flatnonzero(numpy.r_[True, numpy.diff(pos) != 0]) if len(pos) else numpy.zeros(0, dtype=numpy.int64)
+        points = numpy.concatenate([numpy.array([self._run_start], dtype=numpy.int64), pos[first]])
+        depths = numpy.concatenate([numpy.array([self._run_depth], dtype=numpy.int64), self._run_depth + numpy.cumsum(numpy.add.reduceat(deltas, first)) if len(first) else numpy.zeros(0, dtype=numpy.int64)])
+
+        # merge the neighboring runs with the same depth
+        changes = numpy.flatnonzero(numpy.r_[True, numpy.diff(depths) != 0])
+        points = points[changes]
+        depths = depths[changes]
+
+        # the last run is still open
+        self._run_start = int(points[-1])
+        self._run_depth = int(depths[-1])
+
+        run_starts = points[:-1]
+        run_ends = points[1:]
+        run_depths = depths[:-1]
+        keep = run_depths != 0
+        return run_starts[keep], run_ends[keep], run_depths[keep]
+
+
+class CoverageCounter(object):
+    '''
+    The read depth for a sorted BAM file (optionally, only for the reads on
+    one strand, or the reads from a region), as Runs for each reference.
+
+    The aligned blocks of each read (M, =, X) are counted. Insertions,
+    deletions and gaps (N) aren't.
+    '''
+    def __init__(self, bam, strand=None, ref=None, start=None, end=None, quiet=False):
+        self.bam = bam
+        self.strand = strand
+        self.ref = ref
+        self.start = start
+        self.end = end
+        self.quiet = quiet
+
+    def __iter__(self):
+        tid = None
+        depth = None
+
+        def callback(read):
+            return '%s:%s' % (self.bam.getrname(read.tid), read.pos)
+
+        for read in bam_iter(self.bam, ref=self.ref, start=self.start, end=self.end, quiet=self.quiet, callback=callback):
+            if read.is_unmapped:
+                continue
+            if self.strand:
+                if self.strand == '+' and read.is_reverse:
+                    continue
+                elif self.strand == '-' and not read.is_reverse:
+                    continue
+
+            if read.tid != tid:
+                if depth is not None:
+                    yield Runs(tid, *depth.flush())
+                tid = read.tid
+                depth = DepthRuns()
+
+            elif len(depth) > _flush_size:
+                runs = depth.flush(read.pos)
+                if len(runs[0]):
+                    yield Runs(tid, *runs)
+
+            refpos = read.pos
+            for op, size in read.cigar:
+                if op == 0 or op == 7 or op == 8:
+                    depth.add(refpos, refpos + size)
+                    refpos += size
+                elif op == 2 or op == 3:
+                    refpos += size
+
+        if depth is not None:
+            yield Runs(tid, *depth.flush())
@@ -0,0 +1,164 @@
+'''
+Streaming region-membership checks (is a read in any of these regions?)
+
+Regions are stored per chromosome (and strand) as sorted arrays of merged
+(non-overlapping) intervals. Since only membership is needed, overlapping
+regions are merged when the index is built, so each chromosome is just two
+sorted lists: starts and ends.
+
+Queries from a coordinate-sorted BAM file only ever move forward, so each
+chromosome keeps a cursor into its interval array and each query is
+amortized O(1). If the queries aren't sorted (the query start moves
+backwards, or jumps far ahead), the cursor is repositioned with a binary
+search over the interval ends, which works like an interval tree query
+(the merged intervals don't overlap), so unsorted input is O(log n) per
+query.
+
+Intervals and queries are both treated as closed ranges [start, end], so a
+read that "touches" a region overlaps it (the same as BedFile.fetch).
+'''
+
+import bisect
+
+from ngsutils.bed import BedStreamer
+
+# How far the cursor will scan forward before using a binary search
+_max_scan = 8
+
+
+class _Intervals(object):
+    def __init__(self):
+        self.regions = []
+        self.starts = None
+        self.ends = None
+        self.cursor = 0
+        self.last = None
+
+    def add(self, start, end):
+        self.regions.append((start, end))
+
+    def build(self):
+        self.regions.sort()
+        self.starts = []
+        self.ends = []
+
+        for start, end in self.regions:
+            if self.ends and start <= self.ends[-1]:
+                if end > self.ends[-1]:
+                    self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+        self.regions = None
+        self.cursor = 0
+        self.last = None
+
+    def overlaps(self, start, end):
+        ends = self.ends
+        i = self.cursor
+
+        if self.last is not None and start < self.last:
+            # unsorted query
+            i = bisect.bisect_left(ends, start)
+        else:
+            steps = 0
+            while i < len(ends) and ends[i] < start:
+                i += 1
+                steps += 1
+                if steps > _max_scan:
+                    i = bisect.bisect_left(ends, start, i)
+                    break
+
+        self.cursor = i
+        self.last = start
+
+        return i < len(ends) and self.starts[i] <= end
+
+
+class RegionIndex(object):
+    '''
+    A set of genomic regions that can be checked for overlaps.
+
+    Regions are added with add(), and the index is built on the first query
+    (or with build()). If a region has a strand, it is only matched by
+    queries for that strand (or queries without a strand). Regions without a
+    strand are only matched by queries without a strand.
+
+    >>> index = RegionIndex()
+    >>> index.add('chr1', 100, 150, '+')
+    >>> index.add('chr1', 140, 200, '-')
+    >>> index.add('chr1', 500, 600)
+    >>> [index.overlaps('chr1', x, x + 10) for x in [50, 95, 150, 205, 300, 550]]
+    [False, True, True, False, False, True]
+    >>> [index.overlaps('chr1', x, x + 10, '+') for x in [50, 95, 150, 205, 300, 550]]
+    [False, True, True, False, False, False]
+    >>> [index.overlaps('chr1', x, x + 10, '-') for x in [550, 95, 150]]
+    [False, False, True]
+    >>> index.overlaps('chr2', 100, 150)
+    False
+    >>> index.spans('chr1')
+    [(100, 200), (500, 600)]
+    '''
+    def __init__(self):
+        self._intervals = {}
+        self._built = False
+
+    def add(self, chrom, start, end, strand=None):
+        keys = [(chrom, None)]
+        if strand in ['+', '-']:
+            keys.append((chrom, strand))
+
+        for key in keys:
+            if key not in self._intervals:
+                self._intervals[key] = _Intervals()
+            self._intervals[key].add(start, end)
+
+        self._built = False
+
+    def build(self):
+        for intervals in self._intervals.values():
+            if intervals.regions is not None:
+                intervals.build()
+        self._built = True
+
+    def overlaps(self, chrom, start, end, strand=None):
+        'Does [start, end] overlap any region on this chromosome (and strand)?'
+        if not self._built:
+            self.build()
+
+        intervals = self._intervals.get((chrom, strand))
+        if intervals is None:
+            return False
+        return intervals.overlaps(start, end)
+
+    def spans(self, chrom):
+        'Returns the merged regions for a chromosome (any strand) as (start, end) tuples'
+        if not self._built:
+            self.build()
+
+        intervals = self._intervals.get((chrom, None))
+        if intervals is None:
+            return []
+        return zip(intervals.starts, intervals.ends)
+
+    @property
+    def chroms(self):
+        return sorted(set([chrom for chrom, strand in self._intervals]))
+
+
+def bed_region_index(fname, unstranded_matches_both=False):
+    '''
+    Loads the regions from a BED file into a RegionIndex. If
+    unstranded_matches_both is True, regions without a strand are matched
+    by queries for either strand.
+    '''
+    index = RegionIndex()
+    for region in BedStreamer(fname, quiet=True):
+        if region.strand in ['+', '-'] or not unstranded_matches_both:
+            index.add(region.chrom, region.start, region.end, region.strand)
+        else:
+            index.add(region.chrom, region.start, region.end, '+')
+            index.add(region.chrom, region.start, region.end, '-')
+    index.build()
+    return index
@@ -0,0 +1,345 @@
+'''
+Region-sharded (multiprocess) execution for indexed BAM files
+
+An indexed BAM file is split into shards: either one shard per reference, or
+fixed-size genomic windows. A worker function is called for each shard (in a
+pool of worker processes if threads > 1), and the results are returned in
+genomic (shard) order.
+
+Reads that cross a shard boundary are assigned to exactly one shard: the
+shard that contains the start position of the read (see: shard_reads).
+
+Worker functions are called as:
+
+    func(bam, shard, *args)             if no outputs are given
+    func(bam, shard, outs, *args)       with outputs
+
+Worker functions (and their arguments) must be picklable, so they need to
+be defined at the top level of a module (no lambdas or closures).
+
+Outputs can be text (any file-like object) or BAM (BAMOutput). When running
+with threads > 1, each worker writes its output for a shard to a temporary
+file, and the parent process merges them in order: text parts are copied,
+BAM parts are concatenated at the BGZF block level (not re-encoded).
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import collections
+import multiprocessing
+
+import pysam
+
+from ngsutils.support.bgzip import bgzf_blocks, bgzf_decompress, bgzf_compress, BGZF_EOF
+
+_int32 = struct.Struct('<i')
+
+
+class Shard(collections.namedtuple('Shard', 'tid ref start end')):
+    '''
+    A genomic region of a BAM file (0-based, half-open). The unmapped shard
+    (for reads without a reference) has a tid of -1.
+    '''
+    def __str__(self):
+        if self.tid < 0:
+            return 'unmapped'
+        return '%s:%s-%s' % (self.ref, self.start + 1, self.end)
+
+    def contains(self, read):
+        'Is this read assigned to this shard (by its start position)?'
+        if self.tid < 0:
+            return read.tid < 0
+        return read.tid == self.tid and self.start <= read.pos < self.end
+
+
+def bam_shards(bam, shard_size=None, ref=None, start=None, end=None, unmapped=False):
+    '''
+    Splits an indexed BAM file into shards (in the order of the BAM header).
+
+    If shard_size is None, each reference is one shard. Otherwise, each
+    reference is split into windows of shard_size bases. If ref (and start,
+    end) are given, only that region is split. If unmapped is True, a final
+    shard is added for the unmapped reads (without a reference).
+
+    >>> bam = pysam.Samfile(os.path.join(os.path.dirname(__file__), '..', 't', 'test.bam'))
+    >>> [str(x) for x in bam_shards(bam)]
+    ['chr1:1-2000', 'chr2:1-2000']
+    >>> [str(x) for x in bam_shards(bam, 800, unmapped=True)]
+    ['chr1:1-800', 'chr1:801-1600', 'chr1:1601-2000', 'chr2:1-800', 'chr2:801-1600', 'chr2:1601-2000', 'unmapped']
+    >>> [str(x) for x in bam_shards(bam, 300, 'chr1', 100, 700)]
+    ['chr1:101-400', 'chr1:401-700']
+    '''
+    if bam.filename and not os.path.exists('%s.bai' % bam.filename) and not os.path.exists('%s.bai' % os.path.splitext(bam.filename)[0]):
+        raise ValueError("BAM file must be indexed: %s" % bam.filename)
+
+    shards = []
+    for tid, (name, length) in enumerate(zip(bam.references, bam.lengths)):
+        if ref and name != ref:
+            continue
+
+        s = start if ref and start else 0
+        e = min(end, length) if ref and end else length
+
+        if not shard_size:
+            shards.append(Shard(tid, name, s, e))
+            continue
+
+        while s < e:
+            shards.append(Shard(tid, name, s, min(s + shard_size, e)))
+            s += shard_size
+
+    if ref and not shards:
+        raise ValueError('Missing reference: %s' % ref)
+
+    if unmapped:
+        shards.append(Shard(-1, None, 0, 0))
+
+    return shards
+
+
+def shard_reads(bam, shard):
+    '''
+    Yields the reads assigned to a shard: the reads that start in the shard.
+
+    >>> bam = pysam.Samfile(os.path.join(os.path.dirname(__file__), '..', 't', 'test.bam'))
+    >>> [[x.qname for x in shard_reads(bam, shard)] for shard in bam_shards(bam, 175, unmapped=True) if shard.tid < 1]
+    [['A', 'B', 'E'], [], ['C', 'D'], [], ['F'], [], [], [], [], [], [], [], ['Z']]
+    '''
+    if shard.tid < 0:
+        try:
+            reads = bam.fetch('*')
+        except (ValueError, KeyError):
+            reads = bam.fetch(until_eof=True)
+
+        for read in reads:
+            if read.tid < 0:
+                yield read
+        return
+
+    for read in bam.fetch(shard.ref, shard.start, shard.end):
+        # reads that start in an earlier shard are handled there
+        if read.pos >= shard.start:
+            yield read
+
+
+class BAMOutput(object):
+    '''
+    A BAM output file for run_shards. The header is copied from the input
+    BAM file.
+    '''
+    def __init__(self, fname):
+        self.fname = fname
+
+
+_bam_cache = {}
+
+
+def worker_bam(fname):
+    '''
+    Returns an open BAM file handle, cached per process (forked processes
+    can't share a file handle with the parent).
+    '''
+    key = (os.getpid(), fname)
+    if key not in _bam_cache:
+        _bam_cache[key] = pysam.Samfile(fname, 'rb')
+    return _bam_cache[key]
+
+
+def _shard_job(job):
+    func, fname, shard, args, kinds, tmpdir = job
+    bam = worker_bam(fname)
+
+    if kinds is None:
+        return None, func(bam, shard, *args)
+
+    tmpnames = []
+    outs = []
+    try:
+        for kind in kinds:
+            tmp = tempfile.NamedTemporaryFile(prefix='.tmp_shard', suffix='.bam' if kind == 'bam' else '.txt', dir=tmpdir, delete=False)
+            tmpnames.append(tmp.name)
+            if kind == 'bam':
+                tmp.close()
+                outs.append(pysam.Samfile(tmp.name, 'wb', template=bam))
+            else:
+                outs.append(tmp)
+
+        result = func(bam, shard, outs, *args)
+    finally:
+        for out in outs:
+            out.close()
+
+    return tmpnames, result
+
+
+def run_shards(fname, func, shards, threads=1, args=(), outputs=None, tmpdir=None):
+    '''
+    Calls func for each shard of the BAM file (fname), and yields tuples
+    (shard, result) in shard order.
+
+    outputs is an optional list of text outputs (file-like objects) and
+    BAMOutputs. The worker function is passed a matching list of files to
+    write to for each shard, and the output is written to the final outputs
+    in shard order.
+
+    Note: the outputs are only complete once all of the results have been
+    read.
+    '''
+    opened = []
+    if outputs is not None:
+        outs = []
+        for out in outputs:
+            if isinstance(out, BAMOutput):
+                if threads > 1:
+                    outs.append(BAMConcatWriter(out.fname, worker_bam(fname)))
+                else:
+                    outs.append(pysam.Samfile(out.fname, 'wb', template=worker_bam(fname)))
+                opened.append(outs[-1])
+            else:
+                outs.append(out)
+        kinds = ['bam' if isinstance(out, BAMOutput) else 'text' for out in outputs]
+    else:
+        outs = None
+        kinds = None
+
+    try:
+        if threads <= 1:
+            bam = worker_bam(fname)
+            for shard in shards:
+                if outs is None:
+                    yield shard, func(bam, shard, *args)
+                else:
+                    yield shard, func(bam, shard, outs, *args)
+            return
+
+        if tmpdir is None and outputs:
+            for out in outputs:
+                if isinstance(out, BAMOutput):
+                    tmpdir = os.path.dirname(os.path.abspath(out.fname))
+                    break
+
+        pool = multiprocessing.Pool(threads)
+        try:
+            jobs = [(func, fname, shard, args, kinds, tmpdir) for shard in shards]
+            for shard, (tmpnames, result) in zip(shards, pool.imap(_shard_job, jobs)):
+                if tmpnames:
+                    for out, tmpname in zip(outs, tmpnames):
+                        if isinstance(out, BAMConcatWriter):
+                            out.append(tmpname)
+                        else:
+                            with open(tmpname) as f:
+                                shutil.copyfileobj(f, out)
+                        os.unlink(tmpname)
+
+                yield shard, result
+        except:
+            pool.terminate()
+            pool.join()
+            raise
+
+        pool.close()
+        pool.join()
+    finally:
+        for out in opened:
+            out.close()
+
+
+def _read_int(data, pos):
+    return _int32.unpack(data[pos:pos + 4])[0]
+
+
+def _bam_header_size(data):
+    '''
+    Returns the size of the BAM header in (uncompressed) data, or None if
+    data doesn't contain the full header.
+    '''
+    if len(data) < 12:
+        return None
+
+    if data[:4] != 'BAM\1':
+        raise ValueError("Not a BAM file")
+
+    pos = 8 + _read_int(data, 4)
+    if len(data) < pos + 4:
+        return None
+
+    n_ref = _read_int(data, pos)
+    pos += 4
+    for i in xrange(n_ref):
+        if len(data) < pos + 4:
+            return None
+        pos += 8 + _read_int(data, pos)
+
+    if len(data) < pos:
+        return None
+    return pos
+
+
+def bam_body_blocks(fname):
+    '''
+    Yields the BGZF blocks for the alignments in a BAM file (skipping the
+    header and the EOF block). Blocks are yielded as-is (still compressed),
+    unless the header and the first alignments share a block, in which case
+    the alignments in that block are recompressed.
+    '''
+    data = ''
+    header_size = None
+
+    with open(fname, 'rb') as f:
+        for block, isize in bgzf_blocks(f):
+            if not isize:
+                # empty (EOF) block
+                continue
+
+            if header_size is None:
+                data += bgzf_decompress(block)
+                header_size = _bam_header_size(data)
+                if header_size is not None and header_size < len(data):
+                    yield bgzf_compress(data[header_size:])
+                continue
+
+            yield block
+
+
+class BAMConcatWriter(object):
+    '''
+    Writes a BAM file by concatenating the alignments from other BAM files
+    (with the same header) at the BGZF block level.
+    '''
+    def __init__(self, fname, template):
+        # pysam writes the header and an EOF block, remove the EOF block and
+        # append the other files' alignments.
+        tmp = pysam.Samfile(fname, 'wb', template=template)
+        tmp.close()
+
+        self.fileobj = open(fname, 'r+b')
+        self.fileobj.seek(-len(BGZF_EOF), 2)
+        if self.fileobj.read() == BGZF_EOF:
+            self.fileobj.seek(-len(BGZF_EOF), 2)
+            self.fileobj.truncate()
+
+    def append(self, fname):
+        for block in bam_body_blocks(fname):
+            self.fileobj.write(block)
+
+    def close(self):
+        if self.fileobj:
+            self.fileobj.write(BGZF_EOF)
+            self.fileobj.close()
+            self.fileobj = None
+
+
+def bam_concat(fnames, outname, template=None):
+    '''
+    Concatenates BAM files (with the same header) without re-encoding the
+    alignments. The header is taken from template (or the first file).
+    '''
+    if template is None:
+        template = pysam.Samfile(fnames[0], 'rb')
+
+    writer = BAMConcatWriter(outname, template)
+    for fname in fnames:
+        writer.append(fname)
+    writer.close()
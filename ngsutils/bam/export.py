@@ -12,6 +12,7 @@ reference, the mapped position, and the CIGAR alignment string for a read.
 import sys
 import os
 from ngsutils.bam import bam_iter, cigar_tostr, bam_open
+from ngsutils.support.nameset import read_nameset
 
 
 def bam_export(bam, mapped=True, unmapped=True, whitelist=None, blacklist=None, fields=None, out=sys.stdout, quiet=False):
@@ -106,6 +107,8 @@ Options:
 
   -whitelist file.txt  Output only reads that are listed in a text file
   -blacklist file.txt  Output only reads that are not listed in a text file
+                       (either file can be a name set saved with:
+                       python -m ngsutils.support.nameset)
 
 Fields:
   -name          Read name
@@ -145,15 +148,13 @@ if __name__ == "__main__":
             if not os.path.exists(arg):
                 print "Error: %s missing!" % arg
                 usage()
-            with open(arg) as f:
-                wl = [x.strip() for x in f]
+            wl = read_nameset(arg, bloom_bits=10)
             last = None
         elif last == '-blacklist':
             if not os.path.exists(arg):
                 print "Error: %s missing!" % arg
                 usage()
-            with open(arg) as f:
-                bl = [x.strip() for x in f]
+            bl = read_nameset(arg, bloom_bits=10)
             last = None
         elif arg in ['-blacklist', '-whitelist']:
             last = arg
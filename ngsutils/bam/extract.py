@@ -10,7 +10,12 @@ map to the given BED regions.
 Specifically, if a read starts or ends within a BED region, it is extracted.
 However, if a read completely spans a region (starting before and ending
 after), it is ignored. If the read "touches" the region at all, it is
-extracted.
+extracted. Each read is only written once (even if it touches more than one
+region), in the same order as the input BAM file.
+
+Reads must be on the same strand as the region, unless -ns is given. Regions
+without a strand (or with '.' as the strand) match reads on either strand.
+(Before, regions with '.' as the strand only matched reads with -ns.)
 
 This tends to be faster than running 'bamutils filter' because this extracts
 reads from a region, without iterating over all of the reads in the BAM file.
@@ -24,7 +29,7 @@ from eta import ETA
 import pysam
 
 from ngsutils.bam import read_alignment_fragments_gen
-from ngsutils.bed import BedFile
+from ngsutils.bam.engine.regions import bed_region_index
 
 
 def usage():
@@ -39,35 +44,58 @@ Options:
 
 
 def bam_extract(inbam, outbam, bedfile, nostrand=False, quiet=False):
-    bed = BedFile(bedfile)
+    regions = bed_region_index(bedfile, unstranded_matches_both=True)
+
+    spans = []
+    for chrom in inbam.references:
+        for start, end in regions.spans(chrom):
+            spans.append((chrom, start, end))
+
     if not quiet:
-        eta = ETA(os.stat(bedfile).st_size, fileobj=bed)
+        eta = ETA(len(spans))
     else:
         eta = None
 
     passed = 0
+    last_chrom = None
+    carry = set()
 
-    for region in bed:
+    for i, (chrom, start, end) in enumerate(spans):
         if eta:
-            eta.print_status(extra="extracted:%s" % (passed))
+            eta.print_status(i, extra="extracted:%s" % (passed))
 
-        if not region.chrom in inbam.references:
-            continue
+        if chrom != last_chrom:
+            carry = set()
+            last_chrom = chrom
 
-        if not nostrand:
-            strand = region.strand
-        else:
-            strand = None
+        # reads that overlap more than one span are only written once
+        next_carry = set()
+        for read in inbam.fetch(chrom, start, end):
+            key = (read.qname, read.pos, read.flag, read.aend)
+            if read.aend > end:
+                next_carry.add(key)
+            if key in carry:
+                continue
 
-        for read in bam_extract_reads(inbam, region.chrom, region.start, region.end, strand):
-            outbam.write(read)
-            passed += 1
+            if bam_read_in_regions(regions, chrom, read, None if nostrand else '-' if read.is_reverse else '+'):
+                outbam.write(read)
+                passed += 1
+
+        carry = next_carry
 
     if not quiet:
         eta.done()
         sys.stderr.write("%s extracted\n" % (passed,))
 
 
+def bam_read_in_regions(regions, chrom, read, strand=None):
+    'Does any aligned fragment of the read overlap a region (RegionIndex)?'
+    for frag_start, frag_end in read_alignment_fragments_gen(read):
+        if regions.overlaps(chrom, frag_start, frag_end, strand):
+            return True
+    return False
+
+
 def bam_extract_reads(bamfile, chrom, start, end, strand=None):
     for read in bamfile.fetch(chrom, start, end):
         if strand is None or (read.is_reverse and strand == '-') or (not read.is_reverse and strand == '+'):
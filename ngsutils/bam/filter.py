@@ -47,6 +47,12 @@ Currently, the available filters are:
                                Example command for indexing:
                                ngsutils tabixindex snp.txt.gz -s 2 -b 3 -e 4 -0
 
+                               For repeated use, the dbSNP dump can also be
+                               converted (once) into a compact binary cache,
+                               which can be used in place of the dump:
+                               python -m ngsutils.support.dbsnp snp.txt.bgz \\
+                                   snp.snpcache
+
     -mismatch_ref num ref.fa   # mismatches or indel - looks up mismatches
                                directly in a reference FASTA file
                                (use if NM tag not present)
@@ -84,7 +90,9 @@ Currently, the available filters are:
     -whitelist fname           Remove reads that aren't on this list (by name)
     -blacklist fname           Remove reads that are on this list (by name)
                                  These lists can be whitespace-delimited with
-                                 the read name as the first column.
+                                 the read name as the first column, or a
+                                 name set saved with:
+                                 python -m ngsutils.support.nameset
     -maximum_mismatch_ratio val
                                Filter by maximum mismatch ratio (fraction of length)
 
@@ -110,11 +118,29 @@ Common tags to filter by:
 
 import os
 import sys
+import time
+import heapq
+import resource
 import pysam
 from ngsutils.bam import bam_iter
+from ngsutils.bam.engine.shard import bam_shards, shard_reads, run_shards, BAMOutput
 from ngsutils.support.dbsnp import DBSNP
+from ngsutils.support.refcache import RefCache
+from ngsutils.support.nameset import read_nameset, name_hash
+from ngsutils.support.memory import peak_rss_kb
 from ngsutils.bam import read_calc_mismatches, read_calc_mismatches_ref, read_calc_mismatches_gen, read_calc_variations
-from ngsutils.bed import BedFile
+from ngsutils.bam.engine.regions import bed_region_index
+
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_MATE_REVERSE = 0x20
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_DUPLICATE = 0x400
 
 
 def usage():
@@ -126,6 +152,21 @@ Options:
   -failed fname    A text file containing the read names of all reads
                    that were removed with filtering
 
+  -threads N       Filter genomic shards in parallel, using N processes.
+                   The input BAM file must be sorted and indexed.
+
+  -v               Verbose output, including the number of reads checked
+                   and rejected by each criterion (and the time spent)
+
+The summary includes the peak memory used (RSS) and the peak number of
+reads tracked by -uniq/-uniq_start.
+
+Criteria are checked from cheapest to most expensive (flags first, then
+read lengths/positions, tags, BED regions, and reference/dbSNP lookups), not
+necessarily in the order given. Criteria that depend on the reads that came
+before them (-uniq, -uniq_start) or that add tags (-mismatch_dbsnp,
+-mismatch_ref_dbsnp) are always checked in the order given.
+
 Example:
 bamutils filter filename.bam output.bam -mapped -gte AS:i 1000
 
@@ -136,6 +177,14 @@ value less than 1000.
 
 
 class Unique(object):
+    '''
+    Removes reads with the same sequence as another read at the same start
+    position. Only a 64-bit fingerprint of each sequence is kept (for the
+    current position).
+    '''
+    cost = 2
+    ordered = True
+
     def __init__(self, length=None):
         if length:
             self.length = int(length)
@@ -144,6 +193,7 @@ class Unique(object):
 
         self.last_pos = None
         self.pos_reads = set()
+        self.peak_entries = 0
 
     def __repr__(self):
         return "uniq"
@@ -161,10 +211,13 @@ class Unique(object):
         if self.length:
             seq = seq[:self.length]
 
-        if seq in self.pos_reads:
+        fingerprint = name_hash(seq)
+        if fingerprint in self.pos_reads:
             return False
 
-        self.pos_reads.add(seq)
+        self.pos_reads.add(fingerprint)
+        if len(self.pos_reads) > self.peak_entries:
+            self.peak_entries = len(self.pos_reads)
         return True
 
     def close(self):
@@ -172,10 +225,22 @@ class Unique(object):
 
 
 class UniqueStart(object):
+    '''
+    Removes reads that start at the same position as another read (on the
+    same strand). For reverse reads, the start is the 3' end (aend).
+    '''
+    # Reverse reads are compared by their 3' end, so a read can be a
+    # duplicate of a read that starts in an earlier shard (see: _prime_shard)
+    shard_overlap = True
+    cost = 1
+    ordered = True
+
     def __init__(self):
         self.last_tid = None
         self.last_fwd_pos = -1
-        self.rev_pos_list = None
+        self.rev_pos = set()
+        self.rev_heap = []
+        self.peak_entries = 0
 
     def __repr__(self):
         return "uniq_start"
@@ -184,55 +249,47 @@ class UniqueStart(object):
         if self.last_tid is None or self.last_tid != read.tid:
             self.last_tid = read.tid
             self.rev_pos = set()
+            self.rev_heap = []
             self.last_fwd_pos = -1
-            self.last_rev_pos = -1
 
         if read.is_reverse:
             # check reverse reads from their start (3' aend)
             # these aren't necessarily in the correct
-            # order in the file, so we have to track them in a set
+            # order in the file, so we have to track them in a set.
+            #
+            # An aend before the start of this read can't match any later
+            # read (the file is sorted), so those are evicted in order from
+            # a heap, keeping the set to the reads that overlap this one.
+
+            heap = self.rev_heap
+            while heap and heap[0] < read.pos:
+                self.rev_pos.remove(heapq.heappop(heap))
 
             start_pos = read.aend
+            if start_pos in self.rev_pos:
+                return False
 
-            # clean up hash if necesary
-            # Allow up to 100k over, to balance cleaning up the rev_pos hash
-            # and memory
-            if read.pos > (self.last_rev_pos + 100000):
-                self.last_rev_pos = start_pos
-                del_list = []
-                for k in self.rev_pos:
-                    if k < read.pos:
-                        del_list.append(k)
-
-                for k in del_list:
-                    self.rev_pos.remove(k)
-
-            if not start_pos in self.rev_pos:
-                self.rev_pos.add(start_pos)
-                return True
-            return False
+            self.rev_pos.add(start_pos)
+            heapq.heappush(heap, start_pos)
+            if len(heap) > self.peak_entries:
+                self.peak_entries = len(heap)
+            return True
         else:
             if read.pos != self.last_fwd_pos:
                 self.last_fwd_pos = read.pos
                 return True
             return False
 
-        # if self.last_pos != (read.tid, read.pos):
-        #     self.last_pos = (read.tid, read.pos)
-        #     return True
-        # return False
-
     def close(self):
         pass
 
 
 class Blacklist(object):
+    cost = 2
+
     def __init__(self, fname):
         self.fname = fname
-        self.notallowed = set()
-        with open(fname) as f:
-            for line in f:
-                self.notallowed.add(line.strip().split()[0])
+        self.notallowed = read_nameset(fname, bloom_bits=10)
 
     def filter(self, bam, read):
         return read.qname not in self.notallowed
@@ -245,12 +302,11 @@ class Blacklist(object):
 
 
 class Whitelist(object):
+    cost = 2
+
     def __init__(self, fname):
         self.fname = fname
-        self.allowed = set()
-        with open(fname) as f:
-            for line in f:
-                self.allowed.add(line.strip().split()[0])
+        self.allowed = read_nameset(fname, bloom_bits=10)
 
     def filter(self, bam, read):
         return read.qname in self.allowed
@@ -263,10 +319,12 @@ class Whitelist(object):
 
 
 class IncludeRegion(object):
+    cost = 1
     _excludes = []
     _last = None
 
     def __init__(self, region):
+        self.region = region
         IncludeRegion._excludes.append(ExcludeRegion(region))
         # self.excl = ExcludeRegion(region)
 
@@ -283,13 +341,15 @@ class IncludeRegion(object):
 
         # return not self.excl.filter(bam,read)
     def __repr__(self):
-        return 'Including: %s' % (self.excl.region)
+        return 'Including: %s' % (self.region)
 
     def close(self):
         pass
 
 
 class IncludeBED(object):
+    cost = 3
+
     def __init__(self, fname, nostrand=None):
         self.excl = ExcludeBED(fname, nostrand)
 
@@ -304,6 +364,8 @@ class IncludeBED(object):
 
 
 class ExcludeRegion(object):
+    cost = 1
+
     def __init__(self, region):
         self.region = region
         spl = region.split(':')
@@ -329,6 +391,8 @@ class ExcludeRegion(object):
 
 
 class ExcludeRef(object):
+    cost = 1
+
     def __init__(self, ref):
         self.ref = ref
 
@@ -344,7 +408,10 @@ class ExcludeRef(object):
     def close(self):
         pass
 
+
 class IncludeRef(object):
+    cost = 1
+
     def __init__(self, ref):
         self.ref = ref
 
@@ -362,38 +429,16 @@ class IncludeRef(object):
 
 
 class ExcludeBED(object):
+    cost = 3
+
     def __init__(self, fname, nostrand=None):
-        self.regions = {}  # store BED regions as keyed bins (chrom, bin)
         self.fname = fname
         if nostrand == 'nostrand':
             self.nostrand = True
         else:
             self.nostrand = False
 
-        self.bed = BedFile(fname)
-        # with open(fname) as f:
-        #     for line in f:
-        #         if not line:
-        #             continue
-        #         if line[0] == '#':
-        #             continue
-        #         cols = line.strip().split('\t')
-
-        #         chrom = cols[0]
-        #         start = int(cols[1])
-        #         end = int(cols[2])
-        #         if self.nostrand:
-        #             strand = '?'
-        #         else:
-        #             strand = cols[5]
-
-        #         startbin = start / 100000
-        #         endbin = end / 100000
-
-        #         for bin in xrange(startbin, endbin + 1):
-        #             if not (chrom, bin) in self.regions:
-        #                 self.regions[(chrom, bin)] = []
-        #         self.regions[(chrom, bin)].append((start, end, strand))
+        self.regions = bed_region_index(fname)
 
     def filter(self, bam, read):
         if not read.is_unmapped:
@@ -404,29 +449,11 @@ class ExcludeBED(object):
             else:
                 strand = '+'
 
-            for region in self.bed.fetch(bam.getrname(read.tid), read.pos, read.aend, strand):
+            if self.regions.overlaps(bam.getrname(read.tid), read.pos, read.aend, strand):
                 # region found, exclude read
                 return False
             return True
 
-        #     bin = read.pos / 100000
-        #     ref = bam.getrname(read.tid)
-
-        #     if not (ref, bin) in self.regions:
-        #         return True
-
-        #     for start, end, strand in self.regions[(ref, bin)]:
-        #         if not self.nostrand:
-        #             if strand == '+' and read.is_reverse:
-        #                 continue
-        #             if strand == '-' and not read.is_reverse:
-        #                 continue
-        #         if start <= read.pos <= end:
-        #             return False
-        #         if start <= read.aend <= end:
-        #             return False
-        # return True
-
     def __repr__(self):
         return 'Excluding from BED: %s%s' % (self.fname, ' nostrand' if self.nostrand else '')
 
@@ -435,6 +462,8 @@ class ExcludeBED(object):
 
 
 class Mismatch(object):
+    cost = 2
+
     def __init__(self, num):
         self.num = int(num)
 
@@ -455,14 +484,16 @@ class Mismatch(object):
 
 
 class MismatchRef(object):
+    cost = 5
+
     def __init__(self, num, refname):
         self.num = int(num)
         self.refname = refname
 
-        if not os.path.exists('%s.fai' % refname):
-            pysam.faidx(refname)
+        self.ref = RefCache(refname)
 
-        self.ref = pysam.Fastafile(refname)
+    def reopen(self):
+        self.ref = RefCache(self.refname)
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -482,6 +513,9 @@ class MismatchRef(object):
 
 
 class MismatchDbSNP(object):
+    cost = 5
+    ordered = True  # adds a ZS tag
+
     def __init__(self, num, fname, verbose=None):
         sys.stderr.write('Note: MismatchDbSNP is considered *experimental*\n')
 
@@ -493,6 +527,9 @@ class MismatchDbSNP(object):
         else:
             self.verbose = False
 
+    def reopen(self):
+        self.dbsnp = DBSNP(self.fname)
+
     def filter(self, bam, read):
         if read.is_unmapped:
             return False
@@ -527,16 +564,21 @@ class MismatchDbSNP(object):
 
 
 class MismatchRefDbSNP(object):
+    cost = 5
+    ordered = True  # adds a ZS tag
+
     def __init__(self, num, refname, dbsnpname):
         sys.stderr.write('Note: MismatchRefDbSNP is considered *experimental*\n')
         self.num = int(num)
         self.refname = refname
+        self.dbsnpname = dbsnpname
         self.dbsnp = DBSNP(dbsnpname)
 
-        if not os.path.exists('%s.fai' % refname):
-            pysam.faidx(refname)
+        self.ref = RefCache(refname)
 
-        self.ref = pysam.Fastafile(refname)
+    def reopen(self):
+        self.ref = RefCache(self.refname)
+        self.dbsnp = DBSNP(self.dbsnpname)
 
     def filter(self, bam, read):
         if read.is_unmapped:
@@ -570,6 +612,8 @@ class MismatchRefDbSNP(object):
 
 
 class Mapped(object):
+    cost = 0
+
     def __init__(self):
         pass
 
@@ -580,6 +624,13 @@ class Mapped(object):
             return False
         return True
 
+    def filter_flag(self, flag):
+        if flag & FLAG_PAIRED and flag & (FLAG_UNMAPPED | FLAG_MATE_UNMAPPED):
+            return False
+        elif flag & FLAG_UNMAPPED:
+            return False
+        return True
+
     def __repr__(self):
         return 'is mapped'
 
@@ -588,6 +639,8 @@ class Mapped(object):
 
 
 class Unmapped(object):
+    cost = 0
+
     def __init__(self):
         pass
 
@@ -598,6 +651,13 @@ class Unmapped(object):
             return True
         return False
 
+    def filter_flag(self, flag):
+        if flag & FLAG_PAIRED and flag & (FLAG_UNMAPPED | FLAG_MATE_UNMAPPED):
+            return True
+        elif flag & FLAG_UNMAPPED:
+            return True
+        return False
+
     def __repr__(self):
         return 'is unmapped'
 
@@ -606,6 +666,8 @@ class Unmapped(object):
 
 
 class ProperPair(object):
+    cost = 0
+
     def __init__(self):
         pass
 
@@ -621,6 +683,18 @@ class ProperPair(object):
 
         return read.is_proper_pair
 
+    def filter_flag(self, flag):
+        if not flag & FLAG_PAIRED:
+            return False
+
+        if flag & (FLAG_UNMAPPED | FLAG_MATE_UNMAPPED):
+            return False
+
+        if bool(flag & FLAG_REVERSE) == bool(flag & FLAG_MATE_REVERSE):
+            return False
+
+        return bool(flag & FLAG_PROPER_PAIR)
+
     def __repr__(self):
         return 'proper pair'
 
@@ -629,6 +703,8 @@ class ProperPair(object):
 
 
 class NoProperPair(object):
+    cost = 0
+
     def __init__(self):
         self.proper = ProperPair()
         pass
@@ -636,6 +712,9 @@ class NoProperPair(object):
     def filter(self, bam, read):
         return not self.proper.filter(bam, read)
 
+    def filter_flag(self, flag):
+        return not self.proper.filter_flag(flag)
+
     def __repr__(self):
         return 'not proper pairs'
 
@@ -644,6 +723,8 @@ class NoProperPair(object):
 
 
 class MaskFlag(object):
+    cost = 0
+
     def __init__(self, value):
         if type(value) == type(1):
             self.flag = value
@@ -659,22 +740,32 @@ class MaskFlag(object):
     def filter(self, bam, read):
         return (read.flag & self.flag) == 0
 
+    def filter_flag(self, flag):
+        return (flag & self.flag) == 0
+
     def close(self):
         pass
 
 
 class SecondaryFlag(object):
+    cost = 0
+
     def __repr__(self):
         return "no 0x100 (secondary) flag"
 
     def filter(self, bam, read):
         return not read.is_secondary
 
+    def filter_flag(self, flag):
+        return not flag & FLAG_SECONDARY
+
     def close(self):
         pass
 
 
 class ReadMinLength(object):
+    cost = 1
+
     def __init__(self, minval):
         self.minval = int(minval)
 
@@ -689,6 +780,8 @@ class ReadMinLength(object):
 
 
 class ReadMaxLength(object):
+    cost = 1
+
     def __init__(self, val):
         self.val = int(val)
 
@@ -703,6 +796,8 @@ class ReadMaxLength(object):
 
 
 class MaximumMismatchRatio(object):
+    cost = 2
+
     def __init__(self, ratio):
         self.ratio = float(ratio)
 
@@ -717,28 +812,40 @@ class MaximumMismatchRatio(object):
 
 
 class QCFailFlag(object):
+    cost = 0
+
     def __repr__(self):
         return "no 0x200 (qcfail) flag"
 
     def filter(self, bam, read):
         return not read.is_qcfail
 
+    def filter_flag(self, flag):
+        return not flag & FLAG_QCFAIL
+
     def close(self):
         pass
 
 
 class PCRDupFlag(object):
+    cost = 0
+
     def __repr__(self):
         return "no 0x400 (pcrdup) flag"
 
     def filter(self, bam, read):
         return not read.is_duplicate
 
+    def filter_flag(self, flag):
+        return not flag & FLAG_DUPLICATE
+
     def close(self):
         pass
 
 
 class _TagCompare(object):
+    cost = 2
+
     def __init__(self, tag, value):
         self.args = '%s %s' % (tag, value)
 
@@ -775,6 +882,9 @@ class _TagCompare(object):
 
         return None
 
+    def filter(self, bam, read):
+        return self.compare(self.get_value(read))
+
     def __repr__(self):
         return "%s %s %s" % (self.tag, self.__class__.op, self.value)
 
@@ -785,46 +895,36 @@ class _TagCompare(object):
 class TagLessThan(_TagCompare):
     op = '<'
 
-    def filter(self, bam, read):
-        if self.get_value(read) < self.value:
-            return True
-        return False
+    def compare(self, value):
+        return value < self.value
 
 
 class TagLessThanEqual(_TagCompare):
     op = '<='
 
-    def filter(self, bam, read):
-        if self.get_value(read) <= self.value:
-            return True
-        return False
+    def compare(self, value):
+        return value <= self.value
 
 
 class TagGreaterThan(_TagCompare):
     op = '>'
 
-    def filter(self, bam, read):
-        if self.get_value(read) > self.value:
-            return True
-        return False
+    def compare(self, value):
+        return value > self.value
 
 
 class TagGreaterThanEqual(_TagCompare):
     op = '>='
 
-    def filter(self, bam, read):
-        if self.get_value(read) >= self.value:
-            return True
-        return False
+    def compare(self, value):
+        return value >= self.value
 
 
 class TagEqual(_TagCompare):
     op = '='
 
-    def filter(self, bam, read):
-        if self.get_value(read) == self.value:
-            return True
-        return False
+    def compare(self, value):
+        return value == self.value
 
 _criteria = {
     'mapped': Mapped,
@@ -856,25 +956,283 @@ _criteria = {
     'minlen': ReadMinLength,
     'maxlen': ReadMaxLength,
     'uniq': Unique,
+    'uniq_start': UniqueStart,
     'maximum_mismatch_ratio': MaximumMismatchRatio
 }
 
 
-def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
+class FilterPlan(object):
+    '''
+    A compiled set of criteria. Criteria are run in order of their cost:
+
+        0  flag-only criteria (fused into a single lookup by flag value)
+        1  read attributes (length, reference, position)
+        2  tags and read names (tag values are extracted once per read and
+           shared by all tag comparisons)
+        3  BED regions
+        5  reference / dbSNP lookups (MD and sequence parsing)
+
+    Criteria with the same cost keep the order they were given in. Criteria
+    that are order-dependent (they keep state across reads, like -uniq, or
+    modify the read, like -mismatch_dbsnp) are never moved; criteria are
+    only reordered between them.
+
+    filter() returns None if a read passes, otherwise the criterion that
+    rejected it. The number of reads checked and rejected by each criterion
+    (and the time spent in each, if profile is True) are tracked for the
+    report. The stats are a list in the order the criteria are checked (see
+    order()), so the stats from another copy of the plan (such as a worker
+    process) can be merged.
+    '''
+    def __init__(self, criteria, profile=False):
+        self.criteria = criteria
+        self.profile = profile
+        self.steps = []
+
+        segment = []
+        for criterion in criteria:
+            if getattr(criterion, 'ordered', False):
+                self._compile_segment(segment)
+                self.steps.append(('read', [criterion]))
+                segment = []
+            else:
+                segment.append(criterion)
+        self._compile_segment(segment)
+
+        # each step also has the position of its first criterion (in order())
+        first = 0
+        for i, step in enumerate(self.steps):
+            self.steps[i] = (step[0], step[1], first) + step[2:]
+            first += len(step[1])
+
+        self.reset_stats()
+
+    def _compile_segment(self, segment):
+        segment = sorted(segment, key=lambda x: getattr(x, 'cost', 2))  # stable
+
+        flag_criteria = [x for x in segment if hasattr(x, 'filter_flag')]
+        if flag_criteria:
+            # flag value => the first criterion to reject it (filled in as
+            # flag values are seen, there are only a few in any BAM file)
+            self.steps.append(('flag', flag_criteria, {}))
+
+        others = [x for x in segment if not hasattr(x, 'filter_flag')]
+        while others:
+            # consecutive tag comparisons share the read's tag values
+            kind = 'tag' if isinstance(others[0], _TagCompare) else 'read'
+            group = [others.pop(0)]
+            while others and (kind == 'tag') == isinstance(others[0], _TagCompare):
+                group.append(others.pop(0))
+            self.steps.append((kind, group))
+
+    def order(self):
+        'The criteria in the order they are checked'
+        ret = []
+        for step in self.steps:
+            ret.extend(step[1])
+        return ret
+
+    def reset_stats(self):
+        self.stats = [[0, 0, 0.0, 0] for x in self.order()]  # checked, rejected, time, peak entries
+
+    def update_peaks(self):
+        'Records the peak number of entries tracked by the duplicate filters'
+        for criterion, stats in zip(self.order(), self.stats):
+            if hasattr(criterion, 'peak_entries'):
+                stats[3] = max(stats[3], criterion.peak_entries)
+
+    def merge_stats(self, stats):
+        for mine, other in zip(self.stats, stats):
+            for i in xrange(3):
+                mine[i] += other[i]
+            mine[3] = max(mine[3], other[3])
+
+    def filter(self, bam, read):
+        stats = self.stats
+        profile = self.profile
+        tags = None
+
+        for step in self.steps:
+            kind, group, first = step[:3]
+            if profile:
+                start = time.time()
+
+            # the position of the rejecting criterion (in order())
+            rejected = None
+            if kind == 'flag':
+                flag = read.flag
+                if flag not in step[3]:
+                    step[3][flag] = None
+                    for i, criterion in enumerate(group):
+                        if not criterion.filter_flag(flag):
+                            step[3][flag] = first + i
+                            break
+
+                rejected = step[3][flag]
+                for i in xrange(first, first + len(group) if rejected is None else rejected + 1):
+                    stats[i][0] += 1
+            else:
+                if kind == 'tag' and tags is None:
+                    tags = read_tag_values(read)
+
+                for i, criterion in enumerate(group):
+                    stats[first + i][0] += 1
+                    if kind == 'tag':
+                        passed = criterion.compare(read.mapq if criterion.tag == 'MAPQ' else tags.get(criterion.tag))
+                    else:
+                        passed = criterion.filter(bam, read)
+
+                    if not passed:
+                        rejected = first + i
+                        break
+
+            if profile:
+                elapsed = time.time() - start
+                for i in xrange(first, first + len(group)):
+                    stats[i][2] += elapsed / len(group)
+
+            if rejected is not None:
+                stats[rejected][1] += 1
+                return group[rejected - first]
+
+        return None
+
+    def write_report(self, out=sys.stderr):
+        '''
+        Writes the number of reads checked/rejected by each criterion (and
+        the time spent). Fused flag criteria share a single timing.
+        '''
+        out.write('#criterion\tchecked\trejected\trejected_pct')
+        if self.profile:
+            out.write('\ttime_sec')
+        out.write('\n')
+
+        for criterion, stats in zip(self.order(), self.stats):
+            checked, rejected, elapsed = stats[:3]
+            out.write('%s\t%s\t%s\t%.2f' % (criterion, checked, rejected, float(rejected) * 100 / checked if checked else 0))
+            if self.profile:
+                out.write('\t%.3f' % elapsed)
+            out.write('\n')
+
+    def write_memory_report(self, out=sys.stderr, threads=1):
+        '''
+        Writes the peak number of entries tracked by the duplicate filters,
+        and the peak memory used (RSS) by this process (and the worker
+        processes).
+        '''
+        for criterion, stats in zip(self.order(), self.stats):
+            if hasattr(criterion, 'peak_entries'):
+                out.write('%s: peak tracked entries: %s\n' % (criterion, stats[3]))
+
+        out.write('Peak memory (RSS): %s KB\n' % peak_rss_kb())
+        if threads > 1:
+            out.write('Peak memory (RSS), largest worker: %s KB\n' % peak_rss_kb(resource.RUSAGE_CHILDREN))
+
+
+def read_tag_values(read):
+    '''
+    Returns a dict of the tag values for a read (for duplicated tags, the
+    first value is used).
+    '''
+    tags = {}
+    for name, value in read.tags:
+        if name not in tags:
+            tags[name] = value
+    return tags
+
+
+def _filter_reads(bam, reads, plan, outfile, failed_out):
+    '''
+    Writes the reads that pass all of the criteria (FilterPlan) to outfile.
+    Returns (passed, failed) counts.
+    '''
+    passed = 0
+    failed = 0
+
+    for read in reads:
+        rejected = plan.filter(bam, read)
+        if rejected is None:
+            passed += 1
+            outfile.write(read)
+        else:
+            failed += 1
+            if failed_out:
+                failed_out.write('%s\t%s\n' % (read.qname, rejected))
+            #outfile.write(read_to_unmapped(read))
+
+    plan.update_peaks()
+    return passed, failed
+
+
+# The plan is inherited by the worker processes (when they are forked)
+# instead of being pickled for each shard, since some criteria hold open files.
+_shard_plan = None
+_shard_pid = None
+
+
+def _prime_shard(bam, shard, plan):
+    '''
+    Criteria that carry state across reads (UniqueStart) can reject a read
+    because of a read that started in an earlier shard. Before filtering a
+    shard, the reads that start before the shard and overlap it (and any
+    other reads at those start positions) are replayed through the criteria
+    (up to the last stateful one), without writing anything.
+    '''
+    criteria = plan.criteria
+    last = -1
+    for i, criterion in enumerate(criteria):
+        if getattr(criterion, 'shard_overlap', False):
+            last = i
+
+    if last == -1 or shard.tid < 0 or shard.start == 0:
+        return
+
+    minpos = None
+    for read in bam.fetch(shard.ref, shard.start, shard.start + 1):
+        if read.pos < shard.start and (minpos is None or read.pos < minpos):
+            minpos = read.pos
+
+    if minpos is None:
+        return
+
+    # stateful criteria aren't reordered, so this matches the full plan
+    prime = FilterPlan(criteria[:last + 1])
+    for read in bam.fetch(shard.ref, minpos, shard.start):
+        if read.pos < minpos or read.pos >= shard.start:
+            continue
+        prime.filter(bam, read)
+
+
+def _filter_shard(bam, shard, outs):
+    global _shard_pid
+    if _shard_pid != os.getpid():
+        # new worker process, reopen any files
+        _shard_pid = os.getpid()
+        for criterion in _shard_plan.criteria:
+            if hasattr(criterion, 'reopen'):
+                criterion.reopen()
+
+    _prime_shard(bam, shard, _shard_plan)
+
+    _shard_plan.reset_stats()
+    passed, failed = _filter_reads(bam, shard_reads(bam, shard), _shard_plan, outs[0], outs[1] if len(outs) > 1 else None)
+    return passed, failed, _shard_plan.stats
+
+
+def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False, threads=1, shard_size=10000000):
+    plan = FilterPlan(criteria, profile=verbose)
+
     if verbose:
         sys.stderr.write('Input file  : %s\n' % infile)
         sys.stderr.write('Output file : %s\n' % outfile)
         if failedfile:
             sys.stderr.write('Failed reads: %s\n' % failedfile)
-        sys.stderr.write('Criteria:\n')
-        for criterion in criteria:
+        sys.stderr.write('Criteria (in order checked):\n')
+        for criterion in plan.order():
             sys.stderr.write('    %s\n' % criterion)
 
         sys.stderr.write('\n')
 
-    bamfile = pysam.Samfile(infile, "rb")
-    outfile = pysam.Samfile(outfile, "wb", template=bamfile)
-
     if failedfile:
         failed_out = open(failedfile, 'w')
     else:
@@ -883,29 +1241,43 @@ def bam_filter(infile, outfile, criteria, failedfile=None, verbose=False):
     passed = 0
     failed = 0
 
-    def _callback(read):
-        return "%s | %s kept,%s failed" % ('%s:%s' % (bamfile.getrname(read.tid), read.pos) if read.tid > -1 else 'unk', passed, failed)
+    if threads > 1:
+        global _shard_plan, _shard_pid
+        _shard_plan = plan
+        _shard_pid = os.getpid()
 
-    for read in bam_iter(bamfile):
-        p = True
+        bamfile = pysam.Samfile(infile, "rb")
+        shards = bam_shards(bamfile, shard_size, unmapped=True)
+        bamfile.close()
 
-        for criterion in criteria:
-            if not criterion.filter(bamfile, read):
-                p = False
-                failed += 1
-                if failed_out:
-                    failed_out.write('%s\t%s\n' % (read.qname, criterion))
-                #outfile.write(read_to_unmapped(read))
-                break
-        if p:
-            passed += 1
-            outfile.write(read)
+        outputs = [BAMOutput(outfile)]
+        if failed_out:
+            outputs.append(failed_out)
+
+        for shard, (shard_passed, shard_failed, stats) in run_shards(infile, _filter_shard, shards, threads, outputs=outputs):
+            passed += shard_passed
+            failed += shard_failed
+            plan.merge_stats(stats)
+            if verbose:
+                sys.stderr.write('%s | %s kept,%s failed\n' % (shard, passed, failed))
+
+    else:
+        bamfile = pysam.Samfile(infile, "rb")
+        outbam = pysam.Samfile(outfile, "wb", template=bamfile)
+
+        passed, failed = _filter_reads(bamfile, bam_iter(bamfile), plan, outbam, failed_out)
+
+        bamfile.close()
+        outbam.close()
 
-    bamfile.close()
-    outfile.close()
     if failed_out:
         failed_out.close()
     sys.stdout.write("%s kept\n%s failed\n" % (passed, failed))
+    plan.write_memory_report(out=sys.stdout, threads=threads)
+
+    if verbose:
+        sys.stderr.write('\n')
+        plan.write_report()
 
     for criterion in criteria:
         criterion.close()
@@ -940,14 +1312,18 @@ if __name__ == '__main__':
     last = None
     verbose = False
     fail = False
+    threads = 1
 
     for arg in sys.argv[1:]:
         if last == '-failed':
             failed = arg
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
         elif arg == '-h':
             usage()
-        elif arg == '-failed':
+        elif arg in ['-failed', '-threads']:
             last = arg
         elif arg == '-v':
             verbose = True
@@ -983,4 +1359,4 @@ if __name__ == '__main__':
             print "Missing: filtering criteria"
         usage()
     else:
-        bam_filter(infile, outfile, criteria, failed, verbose)
+        bam_filter(infile, outfile, criteria, failed, verbose, threads)
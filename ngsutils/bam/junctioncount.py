@@ -10,49 +10,72 @@ You can specify a particular genome range to scan (like a gene region).
 import sys
 import os
 from ngsutils.bam import bam_iter, bam_open
+from ngsutils.bam.engine.shard import bam_shards, run_shards
 
-def bam_junction_count(bam, ref=None, start=None, end=None, out=sys.stdout, quiet=False):
+
+def _read_junction(read):
+    'Returns the (start, end) of the first gap in a read, or None'
+    pos = read.pos
+    for op, size in read.cigar:
+        if op == 0:
+            pos += size
+        elif op == 1:
+            pass
+        elif op == 2:
+            pos += size
+        elif op == 3:
+            return (pos, pos + size)
+        elif op == 4:
+            pos += size
+
+    return None
+
+
+def _write_junctions(junctions, out):
+    for junction in junctions:
+        out.write('%s\t%s\n' % (junction, len(junctions[junction])))
+
+
+def _junction_count(bam, reads, out):
     last_tid = None
     junctions = {}
-    for read in bam_iter(bam, ref=ref, start=start, end=end, quiet=quiet):
+    for read in reads:
         if read.is_unmapped:
             continue
 
-        if read.tid != last_tid and junctions:
-            for junction in junctions:
-                sys.stdout.write('%s\t%s\n' % (junction, len(junctions[junction])))
+        if read.tid != last_tid:
+            _write_junctions(junctions, out)
             junctions = {}
             last_tid = read.tid
 
-        hasgap = False
-        pos = read.pos
-        end = None
-        for op, size in read.cigar:
-            if op == 0:
-                pos += size
-            elif op == 1:
-                pass
-            elif op == 2:
-                pos += size
-            elif op == 3:
-                hasgap = True
-                end = pos + size
-                break
-            elif op == 4:
-                pos += size
-
-
-        if not hasgap:
+        gap = _read_junction(read)
+        if not gap:
             continue
 
-        junction = '%s:%s-%s' % (bam.references[read.tid], pos, end)
+        junction = '%s:%s-%s' % (bam.references[read.tid], gap[0], gap[1])
         if not junction in junctions:
             junctions[junction] = set()
 
         junctions[junction].add(read.qname)
 
-    for junction in junctions:
-        sys.stdout.write('%s\t%s\n' % (junction, len(junctions[junction])))
+    _write_junctions(junctions, out)
+
+
+def _junction_count_worker(bam, shard, outs):
+    _junction_count(bam, bam_iter(bam, ref=shard.ref, start=shard.start, end=shard.end, quiet=True), outs[0])
+
+
+def bam_junction_count(bam, ref=None, start=None, end=None, out=sys.stdout, quiet=False, threads=1):
+    if threads > 1:
+        # one shard per reference, so that all of the reads for a junction
+        # are counted together
+        shards = bam_shards(bam, ref=ref, start=start, end=end)
+        for shard, result in run_shards(bam.filename, _junction_count_worker, shards, threads, outputs=[out]):
+            if not quiet:
+                sys.stderr.write('%s\n' % shard)
+        return
+
+    _junction_count(bam, bam_iter(bam, ref=ref, start=start, end=end, quiet=quiet), out)
 
 
 def usage(msg=""):
@@ -65,6 +88,10 @@ Usage: bamutils junctioncount {opts} bamfile {region}
 
 Region should be: chr:start-end (start 1-based)
 
+Options:
+    -threads N    Count each reference in parallel, using N processes
+                  (requires an indexed BAM file)
+
 """
     sys.exit(1)
 
@@ -73,17 +100,24 @@ if __name__ == "__main__":
     ref = None
     start = None
     end = None
+    threads = 1
 
+    last = None
     for arg in sys.argv[1:]:
-        if arg == '-h':
+        if last == '-threads':
+            threads = int(arg)
+            last = None
+        elif arg == '-h':
             usage()
+        elif arg in ['-threads']:
+            last = arg
         elif not fname:
             if os.path.exists(arg):
                 fname = arg
             else:
                 usage("%s doesn't exist!")
         else:
-            chrom, se = arg.split(':')
+            ref, se = arg.split(':')
             start, end = [int(x) for x in se.split('-')]
             start = start - 1
 
@@ -91,5 +125,5 @@ if __name__ == "__main__":
         usage()
 
     bamfile = bam_open(fname)
-    bam_junction_count(bamfile, ref, start, end)
+    bam_junction_count(bamfile, ref, start, end, threads=threads)
     bamfile.close()
@@ -13,17 +13,25 @@ This assumes that if a SNP exists, there is likely only one possible variation.
 So, this calculation will fail if more than one minor allele is present.  This
 also ignores indels.
 
-If R is installed and -alleles is given, this will also calculate a 95%
-confidence interval. If rpy2 is installed, that bridge will be used to call R,
-otherwise a process is forked for each allele.
+If -alleles is given, this will also calculate a 95% Clopper-Pearson
+confidence interval. This is calculated natively, or with R (if -r is given).
+If rpy2 is installed, that bridge will be used to call R, otherwise a process
+is forked for each allele.
 """
 
 import os
 import sys
 import math
+import collections
 import subprocess
-from ngsutils.bam import bam_pileup_iter
+import numpy
+from ngsutils.bam.engine import columns
+from ngsutils.bam.engine.columns import ColumnCounter
+from ngsutils.bam.engine.shard import bam_shards, run_shards
+from ngsutils.support.refcache import RefCache
+from ngsutils.support.stats import beta_ppf
 import pysam
+from eta import ETA
 
 
 class Blackhole(object):
@@ -32,26 +40,48 @@ class Blackhole(object):
 
 __sink = Blackhole()
 
-try:
-    __rsrc = os.path.join(os.path.dirname(__file__), 'support', 'minorallele_cpci.R')
-    import rpy2.robjects as robjects
-    rscript = True
-    with open(__rsrc) as f:
-        robjects.r(f.read())
-except Exception:
-    robjects = None
-    rscript = os.path.join(os.path.dirname(__file__), 'support', 'minorallele_cpci.rsh')
-    if not os.path.exists(rscript):
-        sys.stderr.write('Missing R script: %s\n' % rscript)
-        sys.exit(-1)
+# R is only loaded if it is used (-r)
+robjects = None
+rscript = None
+
+
+def _load_r():
+    '''
+    Loads the CP.CI function in R, with rpy2 (or the Rscript wrapper if rpy2
+    isn't installed). Returns False if R isn't available.
+    '''
+    global robjects, rscript
+    if robjects or rscript:
+        return True
+
+    rsrc = os.path.join(os.path.dirname(__file__), 'support', 'minorallele_cpci.R')
+    try:
+        import rpy2.robjects
+        with open(rsrc) as f:
+            rpy2.robjects.r(f.read())
+        robjects = rpy2.robjects
+        return True
+    except Exception:
+        pass
+
+    script = os.path.join(os.path.dirname(__file__), 'support', 'minorallele_cpci.rsh')
+    if not os.path.exists(script):
+        sys.stderr.write('Missing R script: %s\n' % script)
+        return False
 
     stdout = sys.stdout
     sys.stdout = __sink
-    retval = subprocess.Popen([rscript], stdout=subprocess.PIPE).wait()
+    try:
+        retval = subprocess.Popen([script], stdout=subprocess.PIPE).wait()
+    except OSError:
+        retval = -1
     sys.stdout = stdout
     if retval != 0:
-        sys.stderr.write('Error calling R script: %s\n' % rscript)
-        rscript = None
+        sys.stderr.write('Error calling R script: %s\n' % script)
+        return False
+
+    rscript = script
+    return True
 
 
 def usage():
@@ -73,106 +103,220 @@ Options:
                  (default: show all)
   -alleles val   The number of alleles included in this sample
                  If given, a Clopper-Pearson style confidence interval will
-                 be calculated. (requires rpy2 or R)
+                 be calculated.
+  -r             Calculate the confidence interval with R (rpy2 or R)
+                 instead of natively
+  -threads N     Count the bases for regions of the genome (1Mb) in
+                 parallel, using N processes
 """
-    if robjects:
-        print "rpy2 detected!"
-    else:
-        print "rpy2 not detected! Consider installing rpy2 for faster processing!"
-
     sys.exit(1)
 
 
-def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0, name=None, min_ci_low=None):
+def bam_minorallele(bam_fname, ref_fname, min_qual=0, min_count=0, num_alleles=0, name=None, min_ci_low=None, use_r=False, out=sys.stdout, threads=1, quiet=False):
     bam = pysam.Samfile(bam_fname, "rb")
-    ref = pysam.Fastafile(ref_fname)
 
     if not name:
         name = os.path.basename(bam_fname)
 
-    if num_alleles:
-        print "# %s" % num_alleles
-
-    sys.stdout.write('\t'.join("chrom pos refbase altbase total refcount altcount background refback altback".split()))
-    if num_alleles and rscript:
-        sys.stdout.write("\tci_low\tci_high\tallele_lowt\tallele_high")
-    sys.stdout.write('\n')
-
-    for pileup in bam_pileup_iter(bam, mask=1540):
-        chrom = bam.getrname(pileup.tid)
-
-        counts = {'A': 0, 'C': 0, 'G': 0, 'T': 0}
-        total = 0
-
-        for pileupread in pileup.pileups:
-            if not pileupread.is_del:
-                if min_qual:
-                    if pileupread.alignment.qual[pileupread.qpos] < min_qual:
-                        continue
-                if pileupread.indel == 0:
-                    base = pileupread.alignment.seq[pileupread.qpos].upper()
-                    if base != 'N':
-                        counts[base] += 1
-                        total += 1
-
-        if total > min_count:
-            refbase = ref.fetch(chrom, pileup.pos, pileup.pos + 1).upper()
-            if not refbase in counts:
-                continue
-
-            refcount = counts[refbase]
-
-            # sort non-ref counts.  first is alt, next is background
+    if num_alleles and use_r and not _load_r():
+        sys.stderr.write('R is not available, calculating the CI natively\n')
+        use_r = False
 
-            scounts = []
-            for c in counts:
-                if c != refbase:
-                    scounts.append((counts[c], c))
+    if num_alleles:
+        out.write("# %s\n" % num_alleles)
 
-            scounts.sort()
-            scounts.reverse()
+    out.write('\t'.join("chrom pos refbase altbase total refcount altcount background refback altback".split()))
+    if num_alleles:
+        out.write("\tci_low\tci_high\tallele_lowt\tallele_high")
+    out.write('\n')
+
+    if threads > 1:
+        # the shards are counted in parallel, and written in order
+        shards = bam_shards(bam, _shard_size)
+        if not quiet:
+            eta = ETA(len(shards))
+        else:
+            eta = None
+
+        args = (ref_fname, min_qual, min_count, num_alleles, min_ci_low, use_r)
+        for i, (shard, result) in enumerate(run_shards(bam_fname, _minorallele_worker, shards, threads, args=args, outputs=[out])):
+            if eta:
+                eta.print_status(i + 1, extra=str(shard))
+        if eta:
+            eta.done()
+    else:
+        ref = RefCache(ref_fname)
+        counter = ColumnCounter(bam, min_qual, mask=1540, skip_indel=True, quiet=quiet)
+        _write_minorallele(bam, counter, ref, min_count, num_alleles, min_ci_low, use_r, out)
+        ref.close()
 
-            altbase = scounts[0][1]
-            altcount = scounts[0][0]
-            background = scounts[1][0]
+    bam.close()
 
-            refback = refcount - background
-            altback = altcount - background
 
-            if (altback + refback) == 0:
+# the size of the shards for -threads
+_shard_size = 1000000
+
+_ref_cache = {}
+
+
+def _worker_ref(fname):
+    '''
+    Returns a RefCache for the reference, cached per process (see
+    ngsutils.bam.engine.shard.worker_bam)
+    '''
+    key = (os.getpid(), fname)
+    if key not in _ref_cache:
+        _ref_cache[key] = RefCache(fname)
+    return _ref_cache[key]
+
+
+def _minorallele_worker(bam, shard, outs, ref_fname, min_qual, min_count, num_alleles, min_ci_low, use_r):
+    if use_r:
+        _load_r()
+    counter = ColumnCounter(bam, min_qual, mask=1540, skip_indel=True, shard=shard, quiet=True)
+    _write_minorallele(bam, counter, _worker_ref(ref_fname), min_count, num_alleles, min_ci_low, use_r, outs[0])
+
+
+def _write_minorallele(bam, counter, ref, min_count, num_alleles, min_ci_low, use_r, out):
+    '''
+    Writes the minor allele for each position (chunk of columns) with more
+    than min_count A/C/G/T bases.
+    '''
+    for cols in counter:
+        counts = numpy.vstack([cols.total(x) for x in (columns.A, columns.C, columns.G, columns.T)])
+        totals = counts.sum(0)
+
+        keep = totals > min_count
+        if not keep.any():
+            continue
+
+        pos = cols.pos[keep]
+        counts = counts[:, keep]
+        totals = totals[keep]
+
+        chrom = bam.getrname(cols.tid)
+        refseq = ref.fetch(chrom, int(pos[0]), int(pos[-1]) + 1).upper()
+        refcodes = numpy.array(['ACGT'.find(refseq[x]) if x < len(refseq) else -1 for x in (pos - pos[0]).tolist()])
+
+        keep = refcodes >= 0
+        pos = pos[keep]
+        counts = counts[:, keep]
+        totals = totals[keep]
+        refcodes = refcodes[keep]
+        idx = numpy.arange(len(pos))
+
+        # sort the non-ref counts (ties go to the later base).
+        # the first is alt, the next is background.
+        keys = counts * 4 + numpy.arange(4)[:, None]
+        keys[refcodes, idx] = -1
+        order = numpy.argsort(keys, 0)
+        altcodes = order[3]
+        backcodes = order[2]
+
+        refcount = counts[refcodes, idx]
+        altcount = counts[altcodes, idx]
+        background = counts[backcodes, idx]
+        refback = refcount - background
+        altback = altcount - background
+
+        rows = []
+        for vals in zip(*[x.tolist() for x in (pos, refcodes, altcodes, totals, refcount, altcount, background, refback, altback)]):
+            p, refcode, altcode, total, rc, ac, bg, rb, ab = vals
+            if (ab + rb) == 0:
                 altfreq = 0
             else:
-                altfreq = float(altback) / (altback + refback)
-
-            cols = [chrom, pileup.pos + 1, refbase, altbase, total, refcount, altcount, background, refback, altback, altfreq]
-            if num_alleles and rscript:
-                ci_low, ci_high = calc_cp_ci(refback + altback, altback, num_alleles)
-                allele_low = ci_low * num_alleles
-                allele_high = ci_high * num_alleles
-
-                cols.append(ci_low)
-                cols.append(ci_high)
-                cols.append(allele_low)
-                cols.append(allele_high)
-            else:
-                ci_low = 0
+                altfreq = float(ab) / (ab + rb)
+            rows.append([chrom, p + 1, 'ACGT'[refcode], 'ACGT'[altcode], total, rc, ac, bg, rb, ab, altfreq])
 
-            if not math.isnan(ci_low) and (min_ci_low is None or ci_low > min_ci_low):
-                print '\t'.join([str(x) for x in cols])
+        _write_chunk(rows, num_alleles, min_ci_low, use_r, out)
 
-    bam.close()
-    ref.close()
 
+def _write_chunk(chunk, num_alleles, min_ci_low, use_r, out):
+    if num_alleles and chunk:
+        cis = calc_cp_cis([cols[8] + cols[9] for cols in chunk], [cols[9] for cols in chunk], num_alleles, use_r)
+    else:
+        cis = None
+
+    lines = []
+    for i, cols in enumerate(chunk):
+        if cis:
+            ci_low, ci_high = cis[i]
+            cols.append(ci_low)
+            cols.append(ci_high)
+            cols.append(ci_low * num_alleles)
+            cols.append(ci_high * num_alleles)
+        else:
+            ci_low = 0
+
+        if not math.isnan(ci_low) and (min_ci_low is None or ci_low > min_ci_low):
+            lines.append('%s\n' % '\t'.join([str(x) for x in cols]))
+
+    out.write(''.join(lines))
+
+
+def cp_ci(n, x, num_alleles, ci=0.95):
+    '''
+    Clopper-Pearson confidence intervals (the same as CP.CI in
+    support/minorallele_cpci.R) for arrays of observations (n) and
+    successes (x). The boundaries are adjusted to the closest nominal level:
+    a multiple of max(1/n, 0.5/num_alleles). Returns arrays of the low and
+    high boundaries (NaN if n is 0, or if x isn't between 0 and n).
+
+    >>> [x.tolist() for x in cp_ci([10, 10, 0], [0, 5, 0], 2)]
+    [[0.0, 0.0, nan], [0.5, 1.0, nan]]
+    >>> [x.tolist() for x in cp_ci([100], [30], 5)]
+    [[0.2], [0.4]]
+    '''
+    n = numpy.asarray(n, dtype=float)
+    x = numpy.asarray(x, dtype=float)
+    low_ci = (1 - ci) / 2
+    high_ci = 1 - low_ci
+
+    tl = beta_ppf(low_ci, x + 1, n - x + 1)
+    th = beta_ppf(high_ci, x + 1, n - x + 1)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        res = numpy.maximum(1 / n, 0.5 / num_alleles)
+        tl = numpy.floor(tl / res) * res
+        th = numpy.ceil(th / res) * res
+
+    tl[n <= 0] = numpy.nan
+    th[n <= 0] = numpy.nan
+    return tl, th
+
+
+# (N, count, num_alleles) => (low, high), for at most _ci_cache_size values
+__ci_cache = collections.OrderedDict()
+_ci_cache_size = 100000
+
+
+def calc_cp_cis(Ns, counts, num_alleles, use_r=False):
+    '''
+    Returns a list of the (low, high) CIs for each N, count (see: cp_ci).
+    The CIs that aren't already cached are calculated together.
+    '''
+    missing = sorted(set([(N, count) for N, count in zip(Ns, counts) if (N, count, num_alleles) not in __ci_cache]))
+    if missing:
+        if use_r:
+            vals = [_calc_r_ci(N, count, num_alleles) for N, count in missing]
+        else:
+            lows, highs = cp_ci([N for N, count in missing], [count for N, count in missing], num_alleles)
+            vals = zip(lows.tolist(), highs.tolist())
 
-__ci_cache = {}
+        for (N, count), val in zip(missing, vals):
+            __ci_cache[(N, count, num_alleles)] = tuple(val)
 
+        while len(__ci_cache) > max(_ci_cache_size, len(missing)):
+            __ci_cache.popitem(last=False)
 
-def calc_cp_ci(N, count, num_alleles):
-    if (N, count, num_alleles) in __ci_cache:
-        return __ci_cache[(N, count, num_alleles)]
+    return [__ci_cache[(N, count, num_alleles)] for N, count in zip(Ns, counts)]
 
-    vals = (float('nan'), float('nan'))
 
+def calc_cp_ci(N, count, num_alleles, use_r=False):
+    return calc_cp_cis([N], [count], num_alleles, use_r)[0]
+
+
+def _calc_r_ci(N, count, num_alleles):
     if robjects:
         stdout = sys.stdout
         sys.stdout = __sink
@@ -184,8 +328,7 @@ def calc_cp_ci(N, count, num_alleles):
     else:
         vals = [float(x) for x in subprocess.Popen([str(x) for x in [rscript, N, count, num_alleles]], stdout=subprocess.PIPE).communicate()[0].split()]
 
-    __ci_cache[(N, count, num_alleles)] = vals
-    return vals
+    return [float(x) for x in vals]
 
 if __name__ == '__main__':
     bam = None
@@ -196,6 +339,8 @@ if __name__ == '__main__':
     min_ci = None
     num_alleles = 0
     name = None
+    use_r = False
+    threads = 1
 
     last = None
     for arg in sys.argv[1:]:
@@ -214,9 +359,14 @@ if __name__ == '__main__':
         elif last == '-name':
             name = arg
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
         elif arg == '-h':
             usage()
-        elif arg in ['-qual', '-count', '-alleles', '-name', '-ci-low']:
+        elif arg == '-r':
+            use_r = True
+        elif arg in ['-qual', '-count', '-alleles', '-name', '-ci-low', '-threads']:
             last = arg
         elif not bam and os.path.exists(arg) and os.path.exists('%s.bai' % arg):
             bam = arg
@@ -233,4 +383,4 @@ if __name__ == '__main__':
     if not bam or not ref:
         usage()
 
-    bam_minorallele(bam, ref, min_qual, min_count, num_alleles, name, min_ci)
+    bam_minorallele(bam, ref, min_qual, min_count, num_alleles, name, min_ci, use_r, threads=threads)
@@ -8,10 +8,17 @@ Calculates simple stats for a BAM file
 import os
 import sys
 from ngsutils.bam import read_calc_mismatches, bam_iter, bam_open
+from ngsutils.bam.engine.shard import bam_shards, shard_reads, run_shards
 from ngsutils.gtf import GTF
+from ngsutils.support.nameset import NameHashSet, name_hash
 from ngsutils.support.regions import RegionTagger
 from ngsutils.support.stats import counts_mean_stdev
 
+_shard_size = 10000000
+
+# the number of distinct values (for reads) that are kept before counting
+_pending_size = 100000
+
 
 class FeatureBin(object):
     '''track feature stats'''
@@ -71,32 +78,45 @@ class FeatureBin(object):
         return self._max
 
     def add(self, read):
+        self.add_value(self.value(read))
+
+    def value(self, read):
+        'Returns the value for a read (or None if the tag is missing)'
         if self.tag in ['LENGTH', 'LEN']:
-            val = len(read.seq)
+            return len(read.seq)
 
         elif self.tag == 'MAPQ':
-            val = read.mapq
+            return read.mapq
 
         elif self.tag == 'MISMATCH':
-            val = read_calc_mismatches(read)
+            return read_calc_mismatches(read)
 
-        else:
-            try:
-                val = read.opt(self.tag)
-            except KeyError:
-                self.missing += 1
-                return
+        try:
+            return read.opt(self.tag)
+        except KeyError:
+            return None
+
+    def add_value(self, val, count=1):
+        if val is None:
+            self.missing += count
+            return
 
         if not val in self.bins:
             self.bins[val] = 0
             self._keys.append(val)
 
-        self.bins[val] += 1
+        self.bins[val] += count
         if not self._min or self._min > val:
             self._min = val
         if not self._max or self._max < val:
             self._max = val
 
+    def merge(self, other):
+        'Adds the values from another FeatureBin (for the same tag)'
+        self.missing += other.missing
+        for val in other._keys:
+            self.add_value(val, other.bins[val])
+
 
 def usage():
     print __doc__
@@ -115,6 +135,10 @@ Options:
     -region chrom:start-end
             Only calculate statistics for this region
 
+    -threads N
+            Count genomic shards in parallel, using N processes. The BAM
+            files must be sorted and indexed.
+
     -tags tag_name{:sort_order},tag_name{:sort_order},...
 
             For each tag that is given, the values for that tag will be
@@ -179,16 +203,228 @@ class FlagCounts(object):
         for fd in flag_descriptions:
             self.counts[fd] = 0
 
-    def add(self, flag):
+    def add(self, flag, count=1):
         for fd in flag_descriptions:
             if (fd & flag) > 0:
-                self.counts[fd] += 1
+                self.counts[fd] += count
+
+    def merge(self, other):
+        for fd in flag_descriptions:
+            self.counts[fd] += other.counts[fd]
+
+
+class ReadCounts(object):
+    '''
+    The counts for a set of reads. Counts can be merged, so that the shards
+    of a BAM file can be counted separately.
+
+    Reads are counted in two steps: the values that are counted for a read
+    are found (read_values), and then added (add). Most reads have the same
+    values as many others, so the values are kept as a count for each
+    distinct set of values, and the counts are only updated in batches (see:
+    flush).
+    '''
+    def __init__(self, references, delim=None, tags=[], regiontagger=None):
+        self.references = references
+        self.total = 0
+        self.mapped = 0
+        self.unmapped = 0
+        self.flag_counts = FlagCounts()
+        self.tlen_counts = {}
+
+        self.refs = {}
+        self._ref_names = []
+        for rname in references:
+            if delim:
+                rname = rname.split(delim)[0]
+            self.refs[rname] = 0
+            self._ref_names.append(rname)
+
+        self._tags = list(tags)
+        self.tagbins = {}
+        for tag in tags:
+            self.tagbins[tag] = FeatureBin(tag)
+
+        self.region_counts = None
+        if regiontagger:
+            self.region_counts = dict([(k, 0) for k in regiontagger.counts])
+
+        self._pending = {}
+
+    def read_values(self, read, regiontagger=None):
+        '''
+        Returns the values that are counted for a read (as a tuple), so that
+        they can be counted later
+        '''
+        if read.is_unmapped:
+            return (read.flag, None, None, None, None)
+
+        tlen = None
+        if read.is_proper_pair and read.tid == read.mrnm:
+            # we don't care about reads that don't map to the same reference
+
+            # note: this doesn't work for RNA mapped to a reference genome...
+            # for RNA, you'd need to map to a transcript library (refseq) to get
+            # an accurate template length
+            #
+            # just skipping 'N' cigar values won't cut it either... since the pairs
+            # will likely silently span a gap.
+
+            if read.is_reverse:
+                tlen = -read.tlen
+            else:
+                tlen = read.tlen
+
+        region = None
+        if regiontagger:
+            tag, is_rev = regiontagger.tag_read(read, self.references[read.tid])
+            if tag:
+                region = '%s-rev' % tag if is_rev else tag
+
+        return (read.flag, tlen, read.tid, region, tuple([self.tagbins[name].value(read) for name in self._tags]))
+
+    def add(self, values):
+        pending = self._pending
+        if values in pending:
+            pending[values] += 1
+        else:
+            pending[values] = 1
+            if len(pending) > _pending_size:
+                self.flush()
+
+    def flush(self):
+        'Updates the counts for the values that have been added'
+        for values, count in self._pending.iteritems():
+            self._add_values(values, count)
+        self._pending = {}
+
+    def _add_values(self, values, count):
+        flag, tlen, tid, region, tagvals = values
+
+        self.flag_counts.add(flag, count)
+        self.total += count
+        if flag & 0x4:
+            self.unmapped += count
+            return
+
+        self.mapped += count
+
+        if tlen is not None:
+            if not tlen in self.tlen_counts:
+                self.tlen_counts[tlen] = count
+            else:
+                self.tlen_counts[tlen] += count
+
+        self.refs[self._ref_names[tid]] += count
+
+        if region:
+            self.region_counts[region] += count
+
+        for tag, val in zip(self._tags, tagvals):
+            self.tagbins[tag].add_value(val, count)
+
+    def merge(self, other):
+        'Adds the counts from another ReadCounts (for the same BAM file)'
+        self.flush()
+        other.flush()
+
+        self.total += other.total
+        self.mapped += other.mapped
+        self.unmapped += other.unmapped
+        self.flag_counts.merge(other.flag_counts)
+
+        for k in other.tlen_counts:
+            if not k in self.tlen_counts:
+                self.tlen_counts[k] = other.tlen_counts[k]
+            else:
+                self.tlen_counts[k] += other.tlen_counts[k]
+
+        for k in other.refs:
+            self.refs[k] += other.refs[k]
+
+        for tag in other.tagbins:
+            self.tagbins[tag].merge(other.tagbins[tag])
+
+        if other.region_counts:
+            for k in other.region_counts:
+                self.region_counts[k] += other.region_counts[k]
+
+
+def _count_reads(reads, counts, names, show_all=False, regiontagger=None, multi=None):
+    '''
+    Counts reads. Reads with multiple alignments (IH or NH > 1) are only
+    counted once (the first alignment), using the hashes of their names
+    (names, a NameHashSet).
+
+    If multi is given (a list), the values for the first alignment of these
+    reads are added to it as (name hash, values) instead of being counted,
+    so that they can be counted once across shards.
+    '''
+    has_ih = True
+    has_nh = True
+
+    for read in reads:
+        if not show_all and read.is_paired and not read.is_read1:
+            # only operate on the first fragment
+            continue
+
+        is_multi = False
+
+        if has_ih:
+            try:
+                if read.opt('IH') > 1:
+                    is_multi = True
+            except KeyError:
+                if not read.is_unmapped:
+                    has_ih = False
+                #missing IH tag - ignore
+                pass
+
+        if has_nh:
+            try:
+                if read.opt('NH') > 1:
+                    is_multi = True
+            except KeyError:
+                if not read.is_unmapped:
+                    has_nh = False
+                #missing NH tag - ignore
+                pass
+
+        if is_multi:
+            h = name_hash(read.qname)
+            if not names.add_hash(h):
+                # reads only count once for this...
+                continue
+
+            if multi is not None:
+                multi.append((h, counts.read_values(read, regiontagger)))
+                continue
+
+        counts.add(counts.read_values(read, regiontagger))
+
+
+# The region tagger is inherited by the worker processes (when they are
+# forked) instead of being pickled for each shard (see: bamutils filter)
+_shard_regiontagger = None
+
+
+def _stats_worker(bamfile, shard, first_start, delim, tags, show_all):
+    if shard.start == first_start:
+        # the first shard of a region also has the reads that start before it
+        reads = bamfile.fetch(shard.ref, shard.start, shard.end)
+    else:
+        reads = shard_reads(bamfile, shard)
+
+    counts = ReadCounts(bamfile.references, delim, tags, _shard_regiontagger)
+    multi = []
+    _count_reads(reads, counts, NameHashSet(), show_all, _shard_regiontagger, multi)
+    counts.flush()
+    return counts, multi
 
 
 class BamStats(object):
-    def __init__(self, bamfile, gtf=None, region=None, delim=None, tags=[], show_all=False):
+    def __init__(self, bamfile, gtf=None, region=None, delim=None, tags=[], show_all=False, threads=1):
         regiontagger = None
-        flag_counts = FlagCounts()
 
         ref = None
         start = None
@@ -208,123 +444,53 @@ class BamStats(object):
                 end = int(startend)
                 sys.stderr.write('Region: %s:%s\n' % (ref, start + 1))
 
-        total = 0
-        mapped = 0
-        unmapped = 0
-        
-        tlen_counts = {}
-
-        names = set()
-        refs = {}
+        counts = ReadCounts(bamfile.references, delim, tags, regiontagger)
 
-        tagbins = {}
-        for tag in tags:
-            tagbins[tag] = FeatureBin(tag)
-
-        for rname in bamfile.references:
-            if delim:
-                refs[rname.split(delim)[0]] = 0
-            else:
-                refs[rname] = 0
-
-        # setup region or whole-file readers
-        def _foo1():
-            for read in bamfile.fetch(ref, start, end):
-                yield read
-
-        def _foo2():
-            for read in bam_iter(bamfile):
-                yield read
-
-        if region:
-            read_gen = _foo1
-        else:
-            read_gen = _foo2
-
-        has_ih = True
-        has_nh = True
+        # the names of the reads with multiple alignments (as hashes)
+        names = NameHashSet()
 
         try:
-            for read in read_gen():
-                if not show_all and read.is_paired and not read.is_read1:
-                    # only operate on the first fragment
-                    continue
-
-                try:
-                    if has_ih and read.opt('IH') > 1:
-                        if read.qname in names:
-                            # reads only count once for this...
-                            continue
-                        names.add(read.qname)
-                except KeyError:
-                    if not read.is_unmapped:
-                        has_ih = False
-                    #missing IH tag - ignore
-                    pass
-
-                try:
-                    if has_nh and read.opt('NH') > 1:
-                        if read.qname in names:
-                            # reads only count once for this...
-                            continue
-                        names.add(read.qname)
-                except KeyError:
-                    if not read.is_unmapped:
-                        has_nh = False
-                    #missing NH tag - ignore
-                    pass
-
-                flag_counts.add(read.flag)
-
-                total += 1
-                if read.is_unmapped:
-                    unmapped += 1
-                    continue
-
-                mapped += 1
-
-                if read.is_proper_pair and read.tid == read.mrnm:
-                    # we don't care about reads that don't map to the same reference
-
-                    # note: this doesn't work for RNA mapped to a reference genome...
-                    # for RNA, you'd need to map to a transcript library (refseq) to get
-                    # an accurate template length
-                    #
-                    # just skipping 'N' cigar values won't cut it either... since the pairs
-                    # will likely silently span a gap.
-
-                    if read.is_reverse:
-                        k = -read.tlen
-                    else:
-                        k = read.tlen
-
-                    if not k in tlen_counts:
-                        tlen_counts[k] = 1
-                    else:
-                        tlen_counts[k] += 1
-
-                if delim:
-                    refs[bamfile.getrname(read.rname).split(delim)[0]] += 1
+            if threads > 1:
+                # each shard is counted separately. The reads with multiple
+                # alignments are only counted for the first shard they are
+                # in (in order).
+                global _shard_regiontagger
+                _shard_regiontagger = regiontagger
+
+                if region:
+                    shards = bam_shards(bamfile, _shard_size, ref, start, end)
                 else:
-                    refs[bamfile.getrname(read.rname)] += 1
+                    shards = bam_shards(bamfile, _shard_size, unmapped=True)
+
+                for shard, (shard_counts, multi) in run_shards(bamfile.filename, _stats_worker, shards, threads, args=(start if region else None, delim, tags, show_all)):
+                    counts.merge(shard_counts)
+                    for h, values in multi:
+                        if names.add_hash(h):
+                            counts.add(values)
 
-                if regiontagger:
-                    regiontagger.add_read(read, bamfile.getrname(read.rname))
+            else:
+                if region:
+                    reads = bamfile.fetch(ref, start, end)
+                else:
+                    reads = bam_iter(bamfile)
 
-                for tag in tagbins:
-                    tagbins[tag].add(read)
+                _count_reads(reads, counts, names, show_all, regiontagger)
 
         except KeyboardInterrupt:
             sys.stderr.write('*** Interrupted - displaying stats up to this point! ***\n\n')
 
-        self.total = total
-        self.mapped = mapped
-        self.unmapped = unmapped
-        self.flag_counts = flag_counts
-        self.tagbins = tagbins
-        self.refs = refs
+        counts.flush()
+        if regiontagger:
+            regiontagger.merge_counts(counts.region_counts)
+
+        self.total = counts.total
+        self.mapped = counts.mapped
+        self.unmapped = counts.unmapped
+        self.flag_counts = counts.flag_counts
+        self.tagbins = counts.tagbins
+        self.refs = counts.refs
         self.regiontagger = regiontagger
-        self.tlen_counts = tlen_counts
+        self.tlen_counts = counts.tlen_counts
 
     def distribution_gen(self, tag):
         acc = 0.0
@@ -334,7 +500,7 @@ class BamStats(object):
             yield (val, count, pct)
 
 
-def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all=False, fillin_stats=True):
+def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all=False, fillin_stats=True, threads=1):
     if gtf_file:
         gtf = GTF(gtf_file)
     else:
@@ -342,7 +508,7 @@ def bam_stats(infiles, gtf_file=None, region=None, delim=None, tags=[], show_all
 
     sys.stderr.write('Calculating Read stats...\n')
 
-    stats = [BamStats(bam_open(x), gtf, region, delim, tags, show_all=show_all) for x in infiles]
+    stats = [BamStats(bam_open(x), gtf, region, delim, tags, show_all=show_all, threads=threads) for x in infiles]
 
     sys.stdout.write('\t')
     for fname, stat in zip(infiles, stats):
@@ -507,6 +673,7 @@ if __name__ == '__main__':
     show_all = False
     fillin_stats = True
     tags = []
+    threads = 1
 
     last = None
     for arg in sys.argv[1:]:
@@ -524,11 +691,14 @@ if __name__ == '__main__':
         elif last == '-tags':
             tags = arg.split(',')
             last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
         elif arg == '-all':
             show_all = True
         elif arg == '-nofill':
             fillin_stats = False
-        elif arg in ['-gtf', '-delim', '-tags', '-region']:
+        elif arg in ['-gtf', '-delim', '-tags', '-region', '-threads']:
             last = arg
         elif os.path.exists(arg):
             infiles.append(arg)
@@ -539,4 +709,4 @@ if __name__ == '__main__':
     if not infiles:
         usage()
     else:
-        bam_stats(infiles, gtf, region, delim, tags, show_all=show_all, fillin_stats=fillin_stats)
+        bam_stats(infiles, gtf, region, delim, tags, show_all=show_all, fillin_stats=fillin_stats, threads=threads)
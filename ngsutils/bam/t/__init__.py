@@ -1,6 +1,5 @@
 import ngsutils.bam
 import ngsutils.bam.export
-import ngsutils.bam.basecall
 import ngsutils.bed
 import StringIO
 import collections
@@ -105,35 +104,40 @@ class MockBam(object):
             raise StopIteration
 
     def pileup(self, ref, start, end):
-        ''' A cheap pileup knock-off using BamBaseCaller '''
-
-        basecaller = ngsutils.bam.basecall.BamBaseCaller(self, regions=ngsutils.bed.BedFile(region='%s:%s-%s' % (ref, start + 1, end)))
-        for basepos in basecaller.fetch():
-            pileups = []
-            for record in basepos.reads:
-                indel = 0  # size of indel, ins > 0, del < 0
-                level = 0  # don't know what this is...
-                is_del = False
-                is_head = False  # Guessing about these
-                is_tail = False
-                if record.qpos == 0:
-                    if record.read.is_reverse:
-                        is_tail = True
-                    else:
-                        is_head = True
-
-                # Doubt these do the right thing
-                if basepos.insertions:
-                    indel = max([len(ins) for ins in basepos.insertions])
-
-                if basepos.deletions:
-                    indel = - max(basepos.deletions)
-                    is_del = True
-
-                pr = PileupRead(record.read, indel, is_del, is_head, is_tail, level, record.qpos)
-                pileups.append(pr)
-
-            yield PileupRecords(basepos.tid, basepos.pos, basepos.total, pileups)
+        ''' A cheap pileup knock-off (matches and deletions from the CIGAR) '''
+
+        columns = {}
+        for read in self.fetch(ref, start, end):
+            if read.flag & 1540:
+                continue
+            ref_pos = read.pos
+            read_idx = 0
+            for op, length in read.cigar:
+                if op in [0, 2, 7, 8]:
+                    for i in xrange(length):
+                        is_del = op == 2
+                        is_head = False  # Guessing about these
+                        is_tail = False
+                        if read_idx == 0:
+                            if read.is_reverse:
+                                is_tail = True
+                            else:
+                                is_head = True
+
+                        indel = -length if is_del else 0
+                        columns.setdefault(ref_pos, []).append(PileupRead(read, indel, is_del, is_head, is_tail, 0, read_idx))
+                        ref_pos += 1
+                        if not is_del:
+                            read_idx += 1
+                elif op == 3:
+                    ref_pos += length
+                elif op in [1, 4]:
+                    read_idx += length
+
+        tid = self._refs.index(ref)
+        for pos in sorted(columns):
+            if start <= pos < end:
+                yield PileupRecords(tid, pos, len(columns[pos]), columns[pos])
 
     def fetch(self, ref=None, start=-1, end=-1, region=None):
         if region:
@@ -197,10 +201,12 @@ class MockRead(object):
         self.mate_is_reverse = mate_is_reverse
         self.is_read1 = is_read1
         self.is_read2 = is_read2
+        self.is_proper_pair = False
 
         if flag:
             self._flag = flag
             self.is_paired = 0x1 & self.flag > 0
+            self.is_proper_pair = 0x2 & self.flag > 0
             self.is_unmapped = 0x4 & self.flag > 0
             self.mate_is_unmapped = 0x8 & self.flag > 0
             self.is_reverse = 0x10 & self.flag > 0
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+'''
+Throughput benchmarks for bamutils basecall
+
+Calls the bases for all of the positions in a BAM file (with the default
+options, with a minimum quality, with -showstrand, and with -threads 4). By default, a
+synthetic reference (FASTA) and alignments (BAM) are generated, but a real
+reference (and BAM file) can be given. The reads/sec, wall time and peak RSS
+for each benchmark are written to a JSON report that can be compared to a
+report from another commit with:
+
+    python -m ngsutils.support.bench old.json new.json
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+import pysam
+
+from ngsutils.support.bench import BenchmarkSuite, write_report, read_report, compare_reports
+from ngsutils.support.synthetic import SyntheticGenes
+
+import ngsutils.bam.basecall
+
+
+class BaseCallDatasets(object):
+    'The reference and BAM files for the benchmarks (synthetic, unless given)'
+    def __init__(self, tmpdir, ref=None, bam=None, num_genes=500, num_reads=50000, read_length=50, seed=1):
+        self.tmpdir = tmpdir
+
+        if ref and bam:
+            self.ref = ref
+            self.bam = bam
+            self.read_count = pysam.Samfile(bam, 'rb').mapped
+        else:
+            genes = SyntheticGenes(num_genes, num_reads, read_length, seed)
+            self.ref = os.path.join(tmpdir, 'ref.fa')
+            with open(self.ref, 'w') as out:
+                genes.write_fasta(out)
+            pysam.faidx(self.ref)
+            self.bam = os.path.join(tmpdir, 'reads.bam')
+            self.read_count = genes.write_bam(self.bam)
+
+
+def _basecall(data, **kwargs):
+    bam = pysam.Samfile(data.bam, 'rb')
+    with open(os.devnull, 'w') as out:
+        ngsutils.bam.basecall.bam_basecall(bam, data.ref, out=out, quiet=True, **kwargs)
+    bam.close()
+    return data.read_count
+
+
+def bench_basecall(data):
+    return _basecall(data)
+
+
+def bench_basecall_qual(data):
+    return _basecall(data, min_qual=20)
+
+
+def bench_basecall_strand(data):
+    return _basecall(data, showstrand=True)
+
+
+def bench_basecall_threads(data):
+    return _basecall(data, threads=4)
+
+
+def basecall_benchmarks(data, params=None):
+    suite = BenchmarkSuite('bamutils basecall', params)
+    suite.add('basecall', bench_basecall, data)
+    suite.add('basecall_qual', bench_basecall_qual, data)
+    suite.add('basecall_strand', bench_basecall_strand, data)
+    suite.add('basecall_threads', bench_basecall_threads, data)
+    return suite
+
+
+def usage():
+    print __doc__
+    print """Usage: bench_basecall.py {opts}
+
+Options:
+  -o fname          Write the JSON report to this file (default: stdout)
+  -compare fname    Compare the results to a previous report
+
+  -ref fname        Use this reference FASTA file (indexed)
+  -bam fname        ...and this (sorted, indexed) BAM file
+                    (default: synthetic reference and reads)
+
+  -genes num        Number of synthetic genes (default: 500)
+  -reads num        Number of synthetic reads (default: 50000)
+  -len num          Read length (default: 50)
+  -seed num         Random seed (default: 1)
+
+  -only name,name   Only run these benchmarks (basecall, basecall_qual,
+                    basecall_strand, basecall_threads)
+  -t dir            Temporary directory
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    report_fname = None
+    compare_fname = None
+    ref = None
+    bam = None
+    num_genes = 500
+    num_reads = 50000
+    read_length = 50
+    seed = 1
+    only = None
+    tmpdir = None
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-o':
+            report_fname = arg
+            last = None
+        elif last == '-compare':
+            compare_fname = arg
+            last = None
+        elif last == '-ref':
+            ref = arg
+            last = None
+        elif last == '-bam':
+            bam = arg
+            last = None
+        elif last == '-genes':
+            num_genes = int(arg)
+            last = None
+        elif last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-len':
+            read_length = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif last == '-only':
+            only = arg.split(',')
+            last = None
+        elif last == '-t':
+            tmpdir = arg
+            last = None
+        elif arg in ['-o', '-compare', '-ref', '-bam', '-genes', '-reads', '-len', '-seed', '-only', '-t']:
+            last = arg
+        else:
+            usage()
+
+    if bool(ref) != bool(bam):
+        usage()
+
+    if ref:
+        params = {'ref': os.path.basename(ref), 'bam': os.path.basename(bam)}
+    else:
+        params = {'genes': num_genes, 'reads': num_reads, 'read_length': read_length, 'seed': seed}
+
+    workdir = tempfile.mkdtemp(prefix='.tmp_bench', dir=tmpdir)
+    try:
+        sys.stderr.write('Generating test data...\n')
+        data = BaseCallDatasets(workdir, ref, bam, num_genes, num_reads, read_length, seed)
+        report = basecall_benchmarks(data, params).run(only)
+    finally:
+        shutil.rmtree(workdir)
+
+    write_report(report, report_fname)
+
+    if compare_fname:
+        compare_reports(read_report(compare_fname), report, out=sys.stderr)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+Throughput benchmarks for bamutils count
+
+Counts the reads in a BAM file for each of the gtf, exon, bed, repeatfam and
+bin (1kb) models (and the gtf model with -coverage). By default, a synthetic set of
+genes (GTF) and alignments (BAM) are generated, but a full GTF file (and BAM
+file) can be given to benchmark a real annotation. The reads/sec, wall time
+and peak RSS for each model are written to a JSON report that can be
+compared to a report from another commit with:
+
+    python -m ngsutils.support.bench old.json new.json
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+import pysam
+
+from ngsutils.support.bench import BenchmarkSuite, write_report, read_report, compare_reports
+from ngsutils.support.synthetic import SyntheticGenes
+
+import ngsutils.bam.count
+
+
+class CountDatasets(object):
+    'The GTF, BED and BAM files for the benchmarks (synthetic, unless given)'
+    def __init__(self, tmpdir, gtf=None, bam=None, num_genes=2000, num_reads=200000, read_length=50, seed=1):
+        self.tmpdir = tmpdir
+
+        if gtf and bam:
+            # copy the GTF, so that the GTF cache is written to tmpdir
+            self.gtf = os.path.join(tmpdir, os.path.basename(gtf))
+            shutil.copy(gtf, self.gtf)
+            self.bam = bam
+            self.read_count = pysam.Samfile(bam, 'rb').mapped
+        else:
+            genes = SyntheticGenes(num_genes, num_reads, read_length, seed)
+            self.gtf = os.path.join(tmpdir, 'genes.gtf')
+            with open(self.gtf, 'w') as out:
+                genes.write_gtf(out)
+            self.bam = os.path.join(tmpdir, 'reads.bam')
+            self.read_count = genes.write_bam(self.bam)
+
+        # one region per exon (for the bed model), and one repeat per exon
+        # (in 20 families of 5 members, for the repeatfam model)
+        self.bed = os.path.join(tmpdir, 'exons.bed')
+        self.repeats = os.path.join(tmpdir, 'repeats.out')
+        with open(self.bed, 'w') as out:
+            with open(self.repeats, 'w') as rep_out:
+                rep_out.write('RepeatMasker\nheader\n\n')
+                for i, gene in enumerate(ngsutils.bam.count.models['gtf'](self.gtf).gtf.genes):
+                    for num, start, end, const, names in gene.regions:
+                        out.write('%s\t%s\t%s\t%s.%s\t0\t%s\n' % (gene.chrom, start, end, gene.gene_id, num, gene.strand))
+                        rep_out.write('0 0 0 0 %s %s %s (0) %s rep%s_%s fam%s 0 0 0 0\n' % (gene.chrom, start + 1, end, '+' if gene.strand == '+' else 'C', i % 20, i % 100, i % 20))
+
+
+def _count(data, model, library_type='FR', **kwargs):
+    bam = pysam.Samfile(data.bam, 'rb')
+    with open(os.devnull, 'w') as out:
+        model.count(bam, library_type, out=out, quiet=True, **kwargs)
+    bam.close()
+    return data.read_count
+
+
+def bench_gtf(data):
+    return _count(data, ngsutils.bam.count.models['gtf'](data.gtf))
+
+
+def bench_gtf_uniq(data):
+    return _count(data, ngsutils.bam.count.models['gtf'](data.gtf), uniq_only=True, multiple='ignore')
+
+
+def bench_gtf_coverage(data):
+    return _count(data, ngsutils.bam.count.models['gtf'](data.gtf), coverage=True)
+
+
+def bench_exon(data):
+    return _count(data, ngsutils.bam.count.models['exon'](data.gtf))
+
+
+def bench_bed(data):
+    return _count(data, ngsutils.bam.count.models['bed'](data.bed), 'unstranded')
+
+
+def bench_repeatfam(data):
+    return _count(data, ngsutils.bam.count.models['repeatfam'](data.repeats))
+
+
+def bench_bin(data):
+    return _count(data, ngsutils.bam.count.models['bin'](1000))
+
+
+def count_benchmarks(data, params=None):
+    suite = BenchmarkSuite('bamutils count', params)
+    suite.add('gtf', bench_gtf, data)
+    suite.add('gtf_uniq', bench_gtf_uniq, data)
+    suite.add('gtf_coverage', bench_gtf_coverage, data)
+    suite.add('exon', bench_exon, data)
+    suite.add('bed', bench_bed, data)
+    suite.add('repeatfam', bench_repeatfam, data)
+    suite.add('bin', bench_bin, data)
+    return suite
+
+
+def usage():
+    print __doc__
+    print """Usage: bench_count.py {opts}
+
+Options:
+  -o fname          Write the JSON report to this file (default: stdout)
+  -compare fname    Compare the results to a previous report
+
+  -gtf fname        Use this GTF file (a full annotation)
+  -bam fname        ...and this (sorted, indexed) BAM file
+                    (default: synthetic genes and reads)
+
+  -genes num        Number of synthetic genes (default: 2000)
+  -reads num        Number of synthetic reads (default: 200000)
+  -len num          Read length (default: 50)
+  -seed num         Random seed (default: 1)
+
+  -only name,name   Only run these benchmarks (gtf, gtf_uniq,
+                    gtf_coverage, exon, bed, repeatfam, bin)
+  -t dir            Temporary directory
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    report_fname = None
+    compare_fname = None
+    gtf = None
+    bam = None
+    num_genes = 2000
+    num_reads = 200000
+    read_length = 50
+    seed = 1
+    only = None
+    tmpdir = None
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-o':
+            report_fname = arg
+            last = None
+        elif last == '-compare':
+            compare_fname = arg
+            last = None
+        elif last == '-gtf':
+            gtf = arg
+            last = None
+        elif last == '-bam':
+            bam = arg
+            last = None
+        elif last == '-genes':
+            num_genes = int(arg)
+            last = None
+        elif last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-len':
+            read_length = int(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif last == '-only':
+            only = arg.split(',')
+            last = None
+        elif last == '-t':
+            tmpdir = arg
+            last = None
+        elif arg in ['-o', '-compare', '-gtf', '-bam', '-genes', '-reads', '-len', '-seed', '-only', '-t']:
+            last = arg
+        else:
+            usage()
+
+    if bool(gtf) != bool(bam):
+        usage()
+
+    if gtf:
+        params = {'gtf': os.path.basename(gtf), 'bam': os.path.basename(bam)}
+    else:
+        params = {'genes': num_genes, 'reads': num_reads, 'read_length': read_length, 'seed': seed}
+
+    workdir = tempfile.mkdtemp(prefix='.tmp_bench', dir=tmpdir)
+    try:
+        sys.stderr.write('Generating test data...\n')
+        data = CountDatasets(workdir, gtf, bam, num_genes, num_reads, read_length, seed)
+        report = count_benchmarks(data, params).run(only)
+    finally:
+        shutil.rmtree(workdir)
+
+    write_report(report, report_fname)
+
+    if compare_fname:
+        compare_reports(read_report(compare_fname), report, out=sys.stderr)
@@ -4,9 +4,12 @@ Tests for bamutils basecall
 '''
 
 import os
+import random
 import StringIO
 import unittest
 
+import pysam
+
 from ngsutils.bam.t import MockBam
 from ngsutils.bed import BedFile
 import ngsutils.bam.basecall
@@ -236,10 +239,135 @@ test2|12|G|2|G||1.5|1.36179536943|0|0|2|0|0|0|0|0|
 '''.replace('|', '\t')
         self.assertEqual(valid, out.getvalue())
 
+    def _calls(self, bam, **kwargs):
+        return [(x.pos, x.total, x.a, x.c, x.g, x.t, x.n, x.deletions, x.gaps, x.insertions, x.depth, x.plus_depth, x.mappings) for x in ngsutils.bam.basecall.BamBaseCaller(bam, quiet=True, **kwargs).fetch()]
+
+    def testBaseCallerMatchOps(self):
+        # =/X are counted the same as M
+        bam = MockBam(['test2'])
+        bam.add_read('foo1', 'atcgatcg', '........', 0, 0, cigar='8M')
+        bam.add_read('foo2', 'atcgaTtcg', '.........', 0, 2, cigar='3M1I2M1D3M', tags=[('IH', 2)])
+        bam.add_read('foo3', 'accg', '####', 0, 4, cigar='2M10N2M', is_reverse=True)
+
+        bam2 = MockBam(['test2'])
+        bam2.add_read('foo1', 'atcgatcg', '........', 0, 0, cigar='2=1X5=')
+        bam2.add_read('foo2', 'atcgaTtcg', '.........', 0, 2, cigar='2=1X1I2=1D3X', tags=[('IH', 2)])
+        bam2.add_read('foo3', 'accg', '####', 0, 4, cigar='2X10N1=1X', is_reverse=True)
+
+        calls = self._calls(bam)
+        self.assertEqual(calls, self._calls(bam2))
+
+        self.assertEqual((5, 3, 1, 1, 0, 1, 0, 0, 0, {'G': 1}, 4, 3, 6), calls[5])  # insert
+        self.assertEqual((7, 1, 0, 0, 1, 0, 0, 1, 1, {}, 3, 2, 3), calls[7])  # deletion
+        self.assertEqual((8, 1, 0, 0, 0, 1, 0, 0, 1, {}, 2, 1, 2), calls[8])  # gap
+        self.assertEqual(range(18), [x[0] for x in calls])
+
+    def testBaseCallerRegions(self):
+        # each region is finished before the next one starts
+        bam = MockBam(['test2'])
+        bam.add_read('foo1', 'atcgatcg', '........', 0, 0, cigar='8M')
+        bam.add_read('foo2', 'atcgatcg', 'AAAAAAAA', 0, 4, cigar='8M')
+        bam.add_read('foo3', 'atcgatcg', 'AAAAAAAA', 0, 20, cigar='8M')
+
+        bed = BedFile(fileobj=StringIO.StringIO('''\
+test2|0|5
+test2|10|22
+'''.replace('|', '\t')))
+
+        self.assertEqual([0, 1, 2, 3, 4, 5, 10, 11, 20, 21, 22], [x[0] for x in self._calls(bam, regions=bed)])
+
+    def testBaseCallerFlush(self):
+        # flushing the window after every read doesn't change the counts
+        bam = MockBam(['test2'])
+        bam.add_read('foo1', 'atcgatcg', '........', 0, 0, cigar='8M')
+        bam.add_read('foo2', 'atcgaTtcg', '.........', 0, 2, cigar='3M1I2M1D3M', tags=[('IH', 2)])
+        bam.add_read('foo3', 'accgatcg', '####AAAA', 0, 4, cigar='2M10N6M', is_reverse=True)
+        bam.add_read('foo4', 'accgatcg', '####AAAA', 0, 6, cigar='8M')
+
+        calls = self._calls(bam, min_qual=10)
+        flush_size = ngsutils.bam.basecall._flush_size
+        try:
+            ngsutils.bam.basecall._flush_size = 0
+            self.assertEqual(calls, self._calls(bam, min_qual=10))
+        finally:
+            ngsutils.bam.basecall._flush_size = flush_size
+
     def testHeterzygosity(self):
         self.assertEqual(0.0, ngsutils.bam.basecall._calculate_heterozygosity(10, 5, 5, 0))
         self.assertEqual(0.5, ngsutils.bam.basecall._calculate_heterozygosity(5, 5, 0, 0))
         self.assertEqual(0.1, ngsutils.bam.basecall._calculate_heterozygosity(9, 1, 0, 0))
 
+class ThreadedBaseCallTest(unittest.TestCase):
+    def setUp(self):
+        dirname = os.path.dirname(__file__)
+        self.fname = os.path.join(dirname, 'tmp_basecall.bam')
+        self.ref = os.path.join(dirname, 'tmp_basecall.fa')
+        self.bed = os.path.join(dirname, 'tmp_basecall.bed')
+
+        rand = random.Random(1)
+        with open(self.ref, 'w') as out:
+            for chrom in ['chr1', 'chr2']:
+                out.write('>%s\n%s\n' % (chrom, ''.join([rand.choice('ACGT') for i in xrange(1000)])))
+        pysam.faidx(self.ref)
+
+        with open(self.bed, 'w') as out:
+            out.write('chr1\t0\t150\nchr1\t400\t700\nchr2\t100\t900\n')
+
+        reads = []
+        for i in xrange(300):
+            tid = rand.randint(0, 1)
+            pos = rand.randint(0, 900)
+            cigar = rand.choice([[(0, 40)], [(4, 2), (0, 18), (2, 2), (0, 20)], [(0, 20), (3, rand.randint(10, 50)), (0, 20)], [(0, 10), (1, 2), (0, 28)]])
+            seq = ''.join([rand.choice('ACGT') for j in xrange(40)])
+            qual = ''.join([chr(33 + rand.randint(0, 40)) for j in xrange(40)])
+            flag = rand.choice([0, 16, 0, 16, 1024])
+            tags = [('IH', rand.choice([1, 1, 2]))]
+            reads.append((tid, pos, 'read%s' % i, cigar, seq, qual, flag, tags))
+
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+        bam = pysam.Samfile(self.fname, 'wb', header=header)
+        for tid, pos, name, cigar, seq, qual, flag, tags in sorted(reads):
+            read = pysam.AlignedRead()
+            read.qname = name
+            read.tid = tid
+            read.pos = pos
+            read.seq = seq
+            read.qual = qual
+            read.cigar = cigar
+            read.flag = flag
+            read.mapq = 50
+            read.tags = tags
+            bam.write(read)
+        bam.close()
+        pysam.index(self.fname)
+
+    def tearDown(self):
+        for fname in [self.fname, '%s.bai' % self.fname, self.ref, '%s.fai' % self.ref, self.bed]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _basecall(self, threads, **kwargs):
+        bam = pysam.Samfile(self.fname, 'rb')
+        out = StringIO.StringIO()
+        ngsutils.bam.basecall.bam_basecall(bam, self.ref, out=out, quiet=True, threads=threads, **kwargs)
+        bam.close()
+        return out.getvalue()
+
+    def testThreads(self):
+        # small shards, so that reads (and gaps) cross the shard edges
+        shard_size = ngsutils.bam.basecall._shard_size
+        try:
+            ngsutils.bam.basecall._shard_size = 77
+            for kwargs in [{}, {'min_qual': 20, 'showstrand': True, 'showgaps': True}, {'variants': True, 'min_count': 2}]:
+                serial = self._basecall(1, **kwargs)
+                self.assertTrue(len(serial.split('\n')) > 500)
+                self.assertEqual(serial, self._basecall(3, **kwargs))
+
+            serial = self._basecall(1, regions=BedFile(self.bed), showstrand=True)
+            self.assertEqual(serial, self._basecall(3, regions=BedFile(self.bed), showstrand=True))
+        finally:
+            ngsutils.bam.basecall._shard_size = shard_size
+
+
 if __name__ == '__main__':
     unittest.main()
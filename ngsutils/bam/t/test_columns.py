@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.bam.engine.columns
+'''
+
+import os
+import random
+import unittest
+
+import pysam
+
+from ngsutils.bam.engine import columns
+from ngsutils.bam.engine.columns import ColumnCounter
+from ngsutils.bam.engine.shard import bam_shards
+
+
+def _naive_counts(fname, min_qual=0, skip_indel=False):
+    'Counts the bases/deletions for each position, one read at a time'
+    counts = {}
+    bam = pysam.Samfile(fname, 'rb')
+    for read in bam:
+        if read.flag & 1540:
+            continue
+        strand = columns.MINUS if read.is_reverse else 0
+        ref_pos = read.pos
+        read_idx = 0
+        for k, (op, length) in enumerate(read.cigar):
+            if op == 0:
+                for i in xrange(length):
+                    if skip_indel and i == length - 1 and k + 1 < len(read.cigar) and read.cigar[k + 1][0] in [1, 2]:
+                        continue
+                    if ord(read.qual[read_idx + i]) - 33 < min_qual:
+                        continue
+                    channel = strand + 'ACGTN'.index(read.seq[read_idx + i].upper())
+                    counts.setdefault((read.tid, ref_pos + i), [0] * 12)[channel] += 1
+                ref_pos += length
+                read_idx += length
+            elif op == 2:
+                for i in xrange(length):
+                    counts.setdefault((read.tid, ref_pos + i), [0] * 12)[strand + columns.DEL] += 1
+                ref_pos += length
+            elif op == 3:
+                ref_pos += length
+            elif op in [1, 4]:
+                read_idx += length
+    bam.close()
+    return counts
+
+
+def _columns(counter):
+    counts = {}
+    for cols in counter:
+        for pos, vals in zip(cols.pos.tolist(), cols.counts.T.tolist()):
+            counts[(cols.tid, pos)] = vals
+    return counts
+
+
+class ColumnCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'tmp_columns.bam')
+
+        rand = random.Random(1)
+        reads = []
+        for i in xrange(300):
+            tid = rand.randint(0, 1)
+            pos = rand.randint(0, 900)
+            cigar = rand.choice([[(0, 40)], [(4, 2), (0, 18), (2, 2), (0, 20)], [(0, 20), (3, rand.randint(10, 200)), (0, 20)], [(0, 10), (1, 2), (0, 28)]])
+            seq = ''.join([rand.choice('ACGTN') for j in xrange(40)])
+            qual = ''.join([chr(33 + rand.randint(0, 40)) for j in xrange(40)])
+            flag = rand.choice([0, 16, 0, 16, 1024])
+            reads.append((tid, pos, 'read%s' % i, cigar, seq, qual, flag))
+
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+        bam = pysam.Samfile(self.fname, 'wb', header=header)
+        for tid, pos, name, cigar, seq, qual, flag in sorted(reads):
+            read = pysam.AlignedRead()
+            read.qname = name
+            read.tid = tid
+            read.pos = pos
+            read.seq = seq
+            read.qual = qual
+            read.cigar = cigar
+            read.flag = flag
+            read.mapq = 50
+            bam.write(read)
+        bam.close()
+        pysam.index(self.fname)
+
+    def tearDown(self):
+        for fname in [self.fname, '%s.bai' % self.fname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def testCounts(self):
+        for kwargs in [{}, {'min_qual': 20}, {'skip_indel': True}]:
+            expected = _naive_counts(self.fname, **kwargs)
+
+            # a small window, so that it is rolled (and grown for the gaps)
+            bam = pysam.Samfile(self.fname, 'rb')
+            self.assertEqual(expected, _columns(ColumnCounter(bam, quiet=True, size=64, **kwargs)))
+            bam.close()
+
+    def testShards(self):
+        # the shards don't include reads that run past the end of the reference
+        expected = dict([(k, v) for k, v in _naive_counts(self.fname).items() if k[1] < 1000])
+
+        bam = pysam.Samfile(self.fname, 'rb')
+        counts = {}
+        for shard in bam_shards(bam, 77):
+            shard_counts = _columns(ColumnCounter(bam, shard=shard, size=64))
+            for tid, pos in shard_counts:
+                self.assertEqual(shard.tid, tid)
+                self.assertTrue(shard.start <= pos < shard.end)
+            counts.update(shard_counts)
+        bam.close()
+
+        self.assertEqual(expected, counts)
+
+    def testTotal(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        for cols in ColumnCounter(bam, quiet=True):
+            self.assertEqual((cols.counts[columns.A] + cols.counts[columns.MINUS + columns.A]).tolist(), cols.total(columns.A).tolist())
+        bam.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,12 +3,22 @@
 Tests for bamutils count
 '''
 
+import os
+import random
 import unittest
 import StringIO
 
+import numpy
+import pysam
+
 import ngsutils.bam
 import ngsutils.bam.count
 import ngsutils.bam.count.models
+import ngsutils.support.stats
+from ngsutils.bam.count.count import Model, _fetch_reads, _fetch_reads_excluding, _find_mapped_count, known_mapped_count, write_mapped_count_cache
+from ngsutils.bam.count.sweep import ReadSweep
+from ngsutils.bam.count.models import BinModel, _repeatreader
+from ngsutils.bam.count.repeats import RepeatIntervals, _cache_fname as _repeat_cache_fname, _file_key as _repeat_file_key
 
 from ngsutils.bam.t import MockBam
 
@@ -337,6 +347,380 @@ chr1|300|350|foo|1|-|50|1
         self.assertEquals(out.getvalue(), valid)
 
 
+class _SweepModel(Model):
+    'Regions on two chromosomes (out of order), with a callback that uses prefetched reads'
+    def __init__(self, regions):
+        Model.__init__(self)
+        self.regions = regions
+        self.callback_results = []
+
+    def get_source(self):
+        return 'test'
+
+    def get_name(self):
+        return 'sweep'
+
+    def get_headers(self):
+        return ['chrom', 'start']
+
+    def get_regions(self):
+        for chrom, starts, ends, strand in self.regions:
+            self.prefetch(chrom, strand, starts[:1], ends[:1])
+            self.prefetch_excluding(chrom, strand, starts[-1], ends[-1])
+
+            def callback(bam, count, reads, cols, chrom=chrom, strand=strand, starts=starts, ends=ends):
+                self.callback_results.append((count, reads, self.fetch_reads(bam, chrom, strand, starts[:1], ends[:1]), self.fetch_reads_excluding(bam, chrom, strand, starts[-1], ends[-1])))
+                yield cols
+
+            yield (chrom, starts, ends, strand, [chrom, starts[0]], callback)
+
+
+def _write_bam(fname, reads):
+    '''
+    Writes (tid, pos, name, cigar, flag, tags) reads to a sorted, indexed BAM
+    file (2 refs). Paired reads can add the mate's (tid, pos).
+    '''
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 2200}, {'SN': 'chr2', 'LN': 2200}]}
+    bam = pysam.Samfile(fname, 'wb', header=header)
+    for vals in sorted(reads):
+        tid, pos, name, cigar, flag, tags = vals[:6]
+        read = pysam.AlignedRead()
+        read.qname = name
+        read.tid = tid
+        read.pos = pos
+        read.seq = 'A' * 40
+        read.qual = 'I' * 40
+        read.cigar = cigar
+        read.flag = flag
+        read.mapq = 50
+        read.tags = tags
+        if len(vals) > 6:
+            read.rnext, read.pnext = vals[6]
+        bam.write(read)
+    bam.close()
+    pysam.index(fname)
+
+
+class _SweepBinModel(BinModel):
+    'Counts the bins as separate regions (with a ReadSweep)'
+    _count_regions = Model._count_regions
+    _model_chroms = Model._model_chroms
+
+
+class SweepTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'tmp_count.bam')
+
+        rand = random.Random(1)
+        reads = []
+        for i in xrange(600):
+            tid = rand.randint(0, 1)
+            pos = rand.randint(0, 1800)
+            if rand.random() < 0.3:
+                cigar = [(0, 20), (3, rand.randint(10, 200)), (0, 20)]
+            else:
+                cigar = [(4, 2), (0, 18), (2, 2), (0, 20)]
+            flag = rand.choice([0, 16, 0x41, 0x51, 0x81, 0x91])
+            tags = [('IH', rand.choice([1, 1, 2, 3]))] if rand.random() < 0.5 else []
+            reads.append((tid, pos, 'read%s' % (i % 500), cigar, flag, tags))
+
+        _write_bam(self.fname, reads)
+
+        self.features = []
+        for i in xrange(60):
+            chrom = rand.choice(['chr1', 'chr2', 'chr3'])
+            starts = []
+            ends = []
+            pos = rand.randint(0, 1500)
+            for j in xrange(rand.randint(1, 3)):
+                starts.append(pos)
+                ends.append(pos + rand.randint(0, 100))
+                pos = ends[-1] + rand.randint(1, 150)
+            self.features.append((chrom, starts, ends, rand.choice(['+', '-', None])))
+
+        # a zero-length feature (no FPKM)
+        self.features.append(('chr1', [700], [700], '+'))
+
+    def tearDown(self):
+        for fname in [self.fname, '%s.bai' % self.fname, '%s.mapped' % self.fname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def testSweep(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        whitelist = set(['read%s' % i for i in xrange(0, 500, 2)])
+        blacklist = set(['read%s' % i for i in xrange(0, 500, 3)])
+
+        for library_type in ['FR', 'RF', 'unstranded']:
+            for multiple in ['complete', 'partial', 'ignore']:
+                for uniq in [False, True]:
+                    for start_only in [False, True]:
+                        for wl, bl in [(None, None), (whitelist, None), (None, blacklist)]:
+                            sweep = ReadSweep(bam, library_type, multiple, wl, bl, uniq)
+                            qids = []
+                            for chrom, starts, ends, strand in self.features:
+                                qids.append(sweep.add(chrom, strand, starts, ends, start_only, keep_reads=True))
+                            sweep.run()
+
+                            for qid, (chrom, starts, ends, strand) in zip(qids, self.features):
+                                self.assertEqual(_fetch_reads(bam, chrom, strand, starts, ends, multiple, False, wl, bl, uniq, library_type, start_only), sweep.result(qid))
+
+        sweep = ReadSweep(bam)
+        qids = []
+        for chrom, starts, ends, strand in self.features:
+            qids.append(sweep.add(chrom, strand, starts[:1], ends[:1], excluding=True, keep_reads=True))
+        sweep.run()
+        for qid, (chrom, starts, ends, strand) in zip(qids, self.features):
+            self.assertEqual(_fetch_reads_excluding(bam, chrom, strand, starts[0], ends[0], 'complete'), sweep.result(qid))
+
+        bam.close()
+
+    def testCoverage(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        reads = list(bam.fetch('chr1')) + list(bam.fetch('chr2'))
+        whitelist = set(['read%s' % i for i in xrange(0, 500, 2)])
+
+        def _strand(read, library_type):
+            if library_type == 'unstranded':
+                return None
+            if (library_type == 'FR') == (not read.is_read2):
+                return '-' if read.is_reverse else '+'
+            return '+' if read.is_reverse else '-'
+
+        for library_type, wl in [('FR', None), ('RF', whitelist), ('unstranded', None)]:
+            sweep = ReadSweep(bam, library_type, whitelist=wl)
+            qids = []
+            for chrom, starts, ends, strand in self.features:
+                qids.append(sweep.add(chrom, strand, starts, ends, coverage=True))
+            sweep.run()
+
+            for qid, (chrom, starts, ends, strand) in zip(qids, self.features):
+                depths = []
+                for start, end in zip(starts, ends):
+                    for pos in xrange(start, end):
+                        depth = 0
+                        for read in reads:
+                            if bam.getrname(read.tid) != chrom or (wl and read.qname not in wl):
+                                continue
+                            if strand and _strand(read, library_type) != strand:
+                                continue
+                            refpos = read.pos
+                            for op, length in read.cigar:
+                                if op == 0 and refpos <= pos < refpos + length:
+                                    depth += 1
+                                if op in [0, 2, 3]:
+                                    refpos += length
+                        depths.append(depth)
+
+                if depths:
+                    mean, stdev = ngsutils.support.stats.mean_stdev(depths)
+                    expected = (mean, stdev, ngsutils.support.stats.median(depths))
+                else:
+                    expected = (0, 0, 0)
+
+                for val, exp in zip(sweep.coverage(qid), expected):
+                    self.assertAlmostEqual(exp, val)
+
+        bam.close()
+
+    def testModel(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        model = _SweepModel(self.features)
+        out = StringIO.StringIO('')
+        model.count(bam, 'FR', out=out, quiet=True)
+        rows = [line.split('\t') for line in out.getvalue().split('\n') if line and line[0] != '#'][1:]
+
+        self.assertEqual(len(self.features), len(rows))
+        for (chrom, starts, ends, strand), row, (count, reads, prefetched, excluding) in zip(self.features, rows, model.callback_results):
+            self.assertEqual([chrom, str(starts[0])], row[:2])
+            self.assertEqual(_fetch_reads(bam, chrom, strand, starts, ends, 'complete', False, library_type='FR'), (count, reads))
+            self.assertEqual(_fetch_reads(bam, chrom, strand, starts[:1], ends[:1], 'complete', False, library_type='FR'), prefetched)
+            self.assertEqual(_fetch_reads_excluding(bam, chrom, strand, starts[-1], ends[-1], 'complete', library_type='FR'), excluding)
+
+        bam.close()
+
+    def testThreads(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        for kwargs in [{}, {'multiple': 'partial', 'norm': 'mapped', 'fpkm': True}, {'norm': 'median', 'uniq_only': True}]:
+            outputs = []
+            for threads in [1, 3]:
+                out = StringIO.StringIO('')
+                _SweepModel(self.features).count(bam, 'FR', out=out, quiet=True, threads=threads, **kwargs)
+                outputs.append(out.getvalue())
+
+            self.assertEqual(outputs[0], outputs[1])
+            rows = [x.split('\t') for x in outputs[0].split('\n') if x and x[0] != '#']
+            self.assertEqual(len(self.features) + 1, len(rows))
+            if kwargs.get('fpkm'):
+                self.assertEqual('0', rows[-1][-1])
+
+        bam.close()
+
+    def testMappedCount(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        whitelist = set(['read%s' % i for i in xrange(0, 500, 2)])
+        chr1 = [feature for feature in self.features if feature[0] == 'chr1']
+
+        for wl in [whitelist, None]:
+            expected = _find_mapped_count(bam, wl, quiet=True)
+            for threads in [1, 3]:
+                model = _SweepModel(chr1)
+                out = StringIO.StringIO('')
+                model.count(bam, 'FR', norm='all', whitelist=wl, out=out, quiet=True, threads=threads)
+                self.assertIn('## norm all %s\n' % float(expected), out.getvalue())
+
+        # without a whitelist, the count is cached (for the same BAM file)
+        self.assertEqual(expected, known_mapped_count(bam))
+        self.assertEqual(None, known_mapped_count(bam, whitelist))
+
+        with open('%s.mapped' % self.fname) as f:
+            key = f.read().split('\t')[:3]
+        with open('%s.mapped' % self.fname, 'w') as f:
+            f.write('%s\t1234\n' % '\t'.join(key))
+        self.assertEqual(1234, known_mapped_count(bam))
+
+        # the cache is rewritten, but other files aren't replaced
+        write_mapped_count_cache(bam, expected)
+        self.assertEqual(expected, known_mapped_count(bam))
+        with open('%s.mapped' % self.fname, 'w') as f:
+            f.write('not a cache\n')
+        write_mapped_count_cache(bam, expected)
+        self.assertEqual(None, known_mapped_count(bam))
+        with open('%s.mapped' % self.fname) as f:
+            self.assertEqual('not a cache\n', f.read())
+        os.unlink('%s.mapped' % self.fname)
+        write_mapped_count_cache(bam, expected)
+
+        # a change to the mtime (even under a second) invalidates the cache
+        st = os.stat(self.fname)
+        os.utime(self.fname, (st.st_atime, st.st_mtime + 0.5))
+        self.assertEqual(None, known_mapped_count(bam))
+
+        self.assertEqual(bam.mapped, known_mapped_count(bam, idxstats=True))
+        bam.close()
+
+    def testBins(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        whitelist = set(['read%s' % i for i in xrange(0, 500, 2)])
+
+        for library_type in ['FR', 'unstranded']:
+            for kwargs in [{}, {'multiple': 'partial', 'norm': 'median'}, {'multiple': 'ignore', 'uniq_only': True}, {'start_only': True, 'whitelist': whitelist}, {'start_only': True, 'uniq_only': True, 'norm': 'all'}, {'threads': 3, 'multiple': 'partial', 'fpkm': True, 'norm': 'mapped'}]:
+                outputs = []
+                for model in [_SweepBinModel(150), BinModel(150)]:
+                    out = StringIO.StringIO('')
+                    model.count(bam, library_type, out=out, quiet=True, **kwargs)
+                    outputs.append(out.getvalue())
+
+                self.assertEqual(outputs[0], outputs[1])
+
+        bam.close()
+
+    def testBinMatrix(self):
+        bam = pysam.Samfile(self.fname, 'rb')
+        matrix = os.path.join(os.path.dirname(__file__), 'tmp_count.npz')
+        try:
+            for threads in [1, 2]:
+                out = StringIO.StringIO('')
+                BinModel(500, matrix=matrix).count(bam, 'FR', out=out, quiet=True, threads=threads)
+
+                rows = [line.split('\t') for line in out.getvalue().split('\n') if line and line[0] != '#'][1:]
+                arrays = numpy.load(matrix)
+                self.assertEqual(['chr1', 'chr2'], sorted(arrays.files))
+                self.assertEqual((2, 5), arrays['chr1'].shape)
+                for row in rows:
+                    self.assertEqual(float(row[5]), arrays[row[0]][0 if row[3] == '+' else 1][int(row[1]) // 500])
+        finally:
+            if os.path.exists(matrix):
+                os.unlink(matrix)
+
+        bam.close()
+
+    def _write_repeats(self, fname, rand):
+        with open(fname, 'w') as out:
+            out.write('   SW  perc perc perc  query      position in query           matching       repeat              position in  repeat\n')
+            out.write('score  div. del. ins.  sequence    begin     end    (left)    repeat         class/family         begin  end (left)   ID\n')
+            out.write('\n')
+            for i in xrange(80):
+                start = rand.randint(1, 2000)
+                family = rand.choice(['LINE/L1', 'SINE/Alu', 'LTR/ERV'])
+                member = '%s_%s' % (family.split('/')[1], rand.randint(1, 3))
+                out.write('100 1.0 0.0 0.0 %s %s %s (0) %s %s %s 1 10 (0) %s\n' % (rand.choice(['chr1', 'chr2', 'chr3']), start, start + rand.randint(0, 150), rand.choice(['+', 'C']), member, family, i))
+
+    def testRepeatFamily(self):
+        # read names are unique, except for multi-mapped (IH > 1) and paired reads
+        rand = random.Random(3)
+        reads = []
+        for i in xrange(400):
+            name = 'rep%s' % i
+            tid = rand.randint(0, 1)
+            pos = rand.randint(0, 1800)
+            ih = rand.choice([1, 1, 1, 2, 3])
+            if ih > 1:
+                for j in xrange(ih):
+                    reads.append((rand.randint(0, 1), rand.randint(0, 1800), name, [(0, 40)], rand.choice([0, 16]), [('IH', ih)]))
+            elif rand.random() < 0.3:
+                mpos = pos + rand.randint(0, 200)
+                reads.append((tid, pos, name, [(0, 40)], 0x61, [], (tid, mpos)))
+                reads.append((tid, mpos, name, [(0, 40)], 0x91, [], (tid, pos)))
+            else:
+                reads.append((tid, pos, name, [(0, 20), (3, rand.randint(10, 200)), (0, 20)], rand.choice([0, 16]), []))
+
+        bamfname = os.path.join(os.path.dirname(__file__), 'tmp_count_rep.bam')
+        fname = os.path.join(os.path.dirname(__file__), 'tmp_count.rmsk')
+        whitelist = set(['rep%s' % i for i in xrange(0, 400, 2)])
+        self._write_repeats(fname, random.Random(2))
+        _write_bam(bamfname, reads)
+        bam = pysam.Samfile(bamfname, 'rb')
+        try:
+            repeats = list(_repeatreader(fname))
+            self.assertEqual(80, len(repeats))
+            self.assertTrue(os.path.exists(_repeat_cache_fname(fname)))
+
+            # the second time, the repeats are read from the cache
+            self.assertEqual(repeats, list(_repeatreader(fname)))
+
+            # a change to the mtime (even under a second) invalidates the cache
+            st = os.stat(fname)
+            os.utime(fname, (st.st_atime, st.st_mtime + 0.5))
+            self.assertEqual(None, RepeatIntervals.load(_repeat_cache_fname(fname), _repeat_file_key(fname)))
+            self.assertEqual(repeats, list(_repeatreader(fname)))
+            self.assertNotEqual(None, RepeatIntervals.load(_repeat_cache_fname(fname), _repeat_file_key(fname)))
+
+            multi = set([x[2] for x in reads if x[5]])
+            for library_type, multiple, wl in [('FR', 'complete', None), ('unstranded', 'complete', whitelist), ('unstranded', 'ignore', None)]:
+                # each read is counted once per repeat (and family)
+                expected = {}
+                for family, member, chrom, start, end, strand in repeats:
+                    for key in [(family, member), (family, '*')]:
+                        if key not in expected:
+                            expected[key] = [0, set()]
+                        if chrom in bam.references:
+                            expected[key][0] += end - start
+                            names = _fetch_reads(bam, chrom, strand if library_type == 'FR' else None, [start], [end], 'complete', False, wl, library_type=library_type)[1]
+                            if multiple == 'ignore':
+                                names = names - multi
+                            expected[key][1] |= names
+
+                out = StringIO.StringIO('')
+                ngsutils.bam.count.models['repeatfam'](fname).count(bam, library_type, multiple=multiple, whitelist=wl, out=out)
+                rows = [line.split('\t') for line in out.getvalue().split('\n') if line and line[0] != '#']
+                self.assertEqual(len(expected), len(rows))
+                for family, member, size, count in rows:
+                    self.assertEqual([expected[(family, member)][0], len(expected[(family, member)][1])], [int(size), int(count)])
+
+            # partial: multi-mapped reads add the fraction of their alignments
+            # in the repeat (expected has the unstranded single-mapped reads)
+            out = StringIO.StringIO('')
+            ngsutils.bam.count.models['repeatfam'](fname).count(bam, 'unstranded', multiple='partial', out=out)
+            partial = dict([((x[0], x[1]), float(x[3])) for x in [line.split('\t') for line in out.getvalue().split('\n') if line and line[0] != '#']])
+            for key, (size, names) in expected.items():
+                self.assertTrue(len(names) <= partial[key] <= len(names) + len(multi))
+        finally:
+            bam.close()
+            for name in [fname, _repeat_cache_fname(fname), bamfname, '%s.bai' % bamfname]:
+                if os.path.exists(name):
+                    os.unlink(name)
+
 def dump(s, t):
     print 'valid:'
     print s.replace('\t', '|')
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.bam.engine.coverage
+'''
+
+import os
+import random
+import unittest
+import doctest
+
+import ngsutils.bam
+import ngsutils.bam.engine.coverage
+from ngsutils.bam.engine.coverage import DepthRuns, CoverageCounter
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.engine.coverage))
+    return tests
+
+
+def _runs(depth):
+    'Runs from an array of depths (one per position)'
+    runs = []
+    last = 0
+    for pos, val in enumerate(depth + [0]):
+        if val != last:
+            if last:
+                runs[-1][1] = pos
+            if val:
+                runs.append([pos, None, val])
+            last = val
+    return [tuple(x) for x in runs]
+
+
+class DepthRunsTest(unittest.TestCase):
+    def testRandom(self):
+        rand = random.Random(1)
+        for i in xrange(20):
+            blocks = sorted([(x, x + rand.randint(0, 30)) for x in [rand.randint(0, 500) for j in xrange(100)]])
+
+            depth = [0] * 600
+            for start, end in blocks:
+                for pos in xrange(start, end):
+                    depth[pos] += 1
+
+            # resolve the edges at random points (before the next block)
+            runs = DepthRuns()
+            found = []
+            for start, end in blocks:
+                if rand.random() < 0.2:
+                    found.extend(zip(*[x.tolist() for x in runs.flush(start)]))
+                runs.add(start, end)
+            found.extend(zip(*[x.tolist() for x in runs.flush()]))
+
+            self.assertEqual(_runs(depth), found)
+
+
+class CoverageCounterTest(unittest.TestCase):
+    def _runs(self, **kwargs):
+        bam = ngsutils.bam.bam_open(os.path.join(os.path.dirname(__file__), 'test.bam'))
+        runs = [(bam.references[x.tid], x.starts.tolist(), x.ends.tolist(), x.depths.tolist()) for x in CoverageCounter(bam, quiet=True, **kwargs)]
+        bam.close()
+        return runs
+
+    def testCoverage(self):
+        self.assertEqual([('chr1', [99, 174, 399, 699, 724], [149, 199, 499, 724, 774], [1, 2, 1, 2, 1])], self._runs())
+        self.assertEqual([('chr1', [724], [774], [1])], self._runs(strand='-'))
+        self.assertEqual([('chr1', [174, 399, 699], [199, 424, 724], [2, 1, 1])], self._runs(ref='chr1', start=180, end=190))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,6 +48,25 @@ class ExtractTest(unittest.TestCase):
         passed = [x.qname for x in outbam]
         self.assertTrue(_matches(['foo2', 'foo5', 'foo1', 'foo4'], passed))
 
+    def testExtractOnce(self):
+        bam = MockBam(['chr1', 'chr2'])
+        bam.add_read('foo1', tid=0, pos=100, aend=300, cigar='200M')  # overlaps both regions
+        bam.add_read('foo2', tid=0, pos=100, aend=400, cigar='50M200N50M')  # spans the first region
+        bam.add_read('foo3', tid=0, pos=240, aend=260, cigar='20M')  # between regions
+        bam.add_read('foo4', tid=1, pos=125, aend=150, cigar='25M')  # wrong chrom
+
+        fname = os.path.join(os.path.dirname(__file__), 'testbam3')
+        with open(fname, 'w') as f:
+            f.write('chr1\t280\t290\n')
+            f.write('chr1\t120\t130\n')
+            f.write('chr1\t125\t200\n')
+
+        outbam = MockBam(['chr1', 'chr2'])
+        ngsutils.bam.extract.bam_extract(bam, outbam, fname, quiet=True)
+        os.unlink(fname)
+
+        self.assertEqual(['foo1', 'foo2'], [x.qname for x in outbam])
+
     def testExtract(self):
         passed = [x.qname for x in ngsutils.bam.extract.bam_extract_reads(testbam1, 'chr1', 200, 250, '+')]
         self.assertTrue(_matches(['foo2', 'foo4'], passed))
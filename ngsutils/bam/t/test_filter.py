@@ -4,7 +4,12 @@ Tests for bamutils filter
 '''
 
 import os
+import sys
+import pickle
 import unittest
+import StringIO
+
+import pysam
 
 import ngsutils.bam
 import ngsutils.bam.filter
@@ -69,9 +74,14 @@ class FilterTest(unittest.TestCase):
         self.assertTrue(uniqpos.filter(None, read3))
         self.assertTrue(uniqpos.filter(None, read4))
         self.assertTrue(uniqpos.filter(None, read5))
+        self.assertEqual(4, len(uniqpos.rev_pos))
         self.assertTrue(uniqpos.filter(None, read6))
         self.assertFalse(uniqpos.filter(None, read7))
 
+        # aends before the current read are evicted
+        self.assertEqual(set([150011]), uniqpos.rev_pos)
+        self.assertEqual(4, uniqpos.peak_entries)
+
     def testBlacklist(self):
         'Blacklist'
         tmp_fname = os.path.join(os.path.dirname(__file__), 'tmp_list')
@@ -359,5 +369,159 @@ class FilterTest(unittest.TestCase):
         pass
 
 
+class FilterPlanTest(unittest.TestCase):
+    def testFilterFlag(self):
+        'Flag-only criteria match their read-based filters'
+        criteria = [ngsutils.bam.filter.Mapped(), ngsutils.bam.filter.Unmapped(), ngsutils.bam.filter.SecondaryFlag(), ngsutils.bam.filter.QCFailFlag(), ngsutils.bam.filter.MaskFlag('0x14'), ngsutils.bam.filter.ProperPair(), ngsutils.bam.filter.NoProperPair()]
+        for flag in xrange(0x400):
+            read = MockRead('foo', tid=0, pos=0, rnext=0, pnext=0, flag=flag)
+            for criterion in criteria:
+                self.assertEqual(criterion.filter(None, read), criterion.filter_flag(flag))
+
+    def testOrder(self):
+        tag = ngsutils.bam.filter.TagGreaterThan('AS:i', 5)
+        minlen = ngsutils.bam.filter.ReadMinLength(5)
+        mapped = ngsutils.bam.filter.Mapped()
+        uniq = ngsutils.bam.filter.UniqueStart()
+        tag2 = ngsutils.bam.filter.TagLessThan('MAPQ', 10)
+        qcfail = ngsutils.bam.filter.QCFailFlag()
+        mask = ngsutils.bam.filter.MaskFlag(0x400)
+
+        plan = ngsutils.bam.filter.FilterPlan([tag, minlen, mapped, uniq, tag2, qcfail, mask])
+        self.assertEqual([mapped, minlen, tag, uniq, qcfail, mask, tag2], plan.order())
+        self.assertEqual(['flag', 'read', 'tag', 'read', 'flag', 'tag'], [x[0] for x in plan.steps])
+
+    def testFilter(self):
+        reads = [MockRead('foo1', 'AAAAAAAAAA', tid=0, pos=1, rnext=0, pnext=0, tags=[('AS', 10)], mapq=0),
+                 MockRead('foo2', 'AAAAAAAAAA', tid=0, pos=1, rnext=0, pnext=0, tags=[('AS', 10)], mapq=0),  # dup
+                 MockRead('foo3', 'AAAAAAAAAA', tid=0, pos=2, rnext=0, pnext=0, tags=[('AS', 1)], mapq=0),  # AS
+                 MockRead('foo4', 'AAAAAAAAAA', tid=0, pos=3, rnext=0, pnext=0, tags=[('AS', 10)], mapq=20),  # MAPQ
+                 MockRead('foo5', 'AAAAAAAAAA', tid=0, pos=4, rnext=0, pnext=0, tags=[('AS', 10)], flag=0x204),  # unmapped
+                 MockRead('foo6', 'AAAAAAAAAA', tid=0, pos=5, rnext=0, pnext=0, tags=[('AS', 10)], flag=0x200),  # qcfail
+                 MockRead('foo7', 'AAA', tid=0, pos=6, rnext=0, pnext=0, tags=[('AS', 10)]),  # minlen
+                 MockRead('foo8', 'AAAAAAAAAA', tid=0, pos=7, rnext=0, pnext=0, tags=[('AS', 10), ('AS', 1)])]
+
+        criteria = [ngsutils.bam.filter.TagGreaterThan('AS:i', 5),
+                    ngsutils.bam.filter.ReadMinLength(5),
+                    ngsutils.bam.filter.Mapped(),
+                    ngsutils.bam.filter.UniqueStart(),
+                    ngsutils.bam.filter.TagLessThan('MAPQ', 10),
+                    ngsutils.bam.filter.QCFailFlag()]
+
+        plan = ngsutils.bam.filter.FilterPlan(criteria, profile=True)
+        rejected = [plan.filter(None, read) for read in reads]
+        self.assertEqual([None, criteria[3], criteria[0], criteria[4], criteria[2], criteria[5], criteria[1], None], rejected)
+
+        # the stats are in the order the criteria are checked
+        order = plan.order()
+        self.assertEqual([7, 1], plan.stats[order.index(criteria[1])][:2])
+        self.assertEqual([8, 1], plan.stats[order.index(criteria[2])][:2])
+        self.assertEqual([6, 1], plan.stats[order.index(criteria[0])][:2])
+        self.assertEqual([5, 1], plan.stats[order.index(criteria[3])][:2])
+        self.assertEqual([4, 1], plan.stats[order.index(criteria[5])][:2])
+        self.assertEqual([3, 1], plan.stats[order.index(criteria[4])][:2])
+
+        out = StringIO.StringIO()
+        plan.write_report(out)
+        lines = out.getvalue().split('\n')
+        self.assertEqual('#criterion\tchecked\trejected\trejected_pct\ttime_sec', lines[0])
+        self.assertEqual('is mapped\t8\t1\t12.50', lines[1][:lines[1].rfind('\t')])
+
+        plan.update_peaks()
+        out = StringIO.StringIO()
+        plan.write_memory_report(out)
+        lines = out.getvalue().split('\n')
+        self.assertEqual('uniq_start: peak tracked entries: 0', lines[0])
+        self.assertTrue(lines[1].startswith('Peak memory (RSS): '))
+
+        # stats from a copy of the plan (as from a worker) merge by position
+        copy = pickle.loads(pickle.dumps(plan))
+        copy.reset_stats()
+        for read in reads:
+            copy.filter(None, read)
+        plan.merge_stats(copy.stats)
+        self.assertEqual([14, 2], plan.stats[order.index(criteria[1])][:2])
+        self.assertEqual([16, 2], plan.stats[order.index(criteria[2])][:2])
+
+
+class ThreadedFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.dirname(__file__)
+        self.fname = os.path.join(self.dirname, 'tmp_filter_in.bam')
+        self.tmpfiles = [self.fname, '%s.bai' % self.fname]
+
+        # reverse reads ending at the same position (UniqueStart duplicates),
+        # that start on different sides of a 100bp shard boundary
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+        reads = [('A', 0, 10, 20, False), ('B', 0, 90, 20, True), ('C', 0, 95, 10, False),
+                 ('D', 0, 105, 5, True), ('E', 0, 150, 30, True), ('F', 0, 160, 20, True),
+                 ('G', 1, 199, 2, True), ('H', 1, 200, 1, True), ('I', 1, 300, 10, False),
+                 ('J', 1, 300, 10, False)]
+
+        bam = pysam.Samfile(self.fname, 'wb', header=header)
+        for name, tid, pos, length, rev in reads:
+            read = pysam.AlignedRead()
+            read.qname = name
+            read.tid = tid
+            read.pos = pos
+            read.seq = 'A' * length
+            read.qual = 'I' * length
+            read.cigar = [(0, length)]
+            read.mapq = 50
+            read.flag = 16 if rev else 0
+            bam.write(read)
+        bam.close()
+        pysam.index(self.fname)
+
+    def tearDown(self):
+        for fname in self.tmpfiles:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _filter(self, criteria, threads, shard_size=None):
+        outname = os.path.join(self.dirname, 'tmp_filter_%s.bam' % threads)
+        failedname = os.path.join(self.dirname, 'tmp_filter_%s.txt' % threads)
+        self.tmpfiles.extend([outname, failedname])
+
+        ngsutils.bam.filter.bam_filter(self.fname, outname, criteria(), failedname, threads=threads, shard_size=shard_size)
+
+        bam = pysam.Samfile(outname, 'rb')
+        names = [read.qname for read in bam]
+        bam.close()
+
+        with open(failedname) as f:
+            failed = f.read()
+
+        return names, failed
+
+    def testUniqueStart(self):
+        criteria = lambda: [ngsutils.bam.filter.UniqueStart()]
+        serial = self._filter(criteria, 1)
+        self.assertEqual(['A', 'B', 'C', 'E', 'G', 'I'], serial[0])
+        self.assertEqual('D\tuniq_start\nF\tuniq_start\nH\tuniq_start\nJ\tuniq_start\n', serial[1])
+
+        for shard_size in [None, 100, 50, 7]:
+            self.assertEqual(serial, self._filter(criteria, 3, shard_size))
+
+    def testChain(self):
+        criteria = lambda: [ngsutils.bam.filter.ReadMinLength(5), ngsutils.bam.filter.UniqueStart(), ngsutils.bam.filter.IncludeRef('chr1')]
+        serial = self._filter(criteria, 1)
+        self.assertEqual(['A', 'B', 'C', 'E'], serial[0])
+        self.assertEqual(serial, self._filter(criteria, 2, 100))
+
+    def testSummary(self):
+        'The summary includes the tracked entries and memory used'
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self._filter(lambda: [ngsutils.bam.filter.UniqueStart()], 1)
+            lines = sys.stdout.getvalue().split('\n')
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual(['6 kept', '4 failed', 'uniq_start: peak tracked entries: 1'], lines[:3])
+        self.assertTrue(lines[3].startswith('Peak memory (RSS): '))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,7 +3,11 @@
 Tests for bamutils minorallele
 '''
 
+import math
 import unittest
+import warnings
+
+import ngsutils.bam.minorallele
 
 
 class MinorAlleleTest(unittest.TestCase):
@@ -11,5 +15,56 @@ class MinorAlleleTest(unittest.TestCase):
         'MISSING TEST/EXPERIMENTAL'
         pass
 
+
+class CPCITest(unittest.TestCase):
+    def testCI(self):
+        # x = 0: the high boundary is 1 - 0.025 ** (1 / (n + 1))
+        # x = n: the low boundary is 0.025 ** (1 / (n + 1))
+        for n in [1, 2, 5, 10, 33, 100, 1000]:
+            res = max(1.0 / n, 0.5 / 20)
+            high = 1 - 0.025 ** (1.0 / (n + 1))
+            low = 0.025 ** (1.0 / (n + 1))
+
+            self.assertEqual((0.0, math.ceil(high / res) * res), ngsutils.bam.minorallele.calc_cp_ci(n, 0, 20))
+            self.assertEqual((math.floor(low / res) * res, 1.0), ngsutils.bam.minorallele.calc_cp_ci(n, n, 20))
+
+    def testCIs(self):
+        Ns = [10, 10, 0, 100, 100, 10]
+        counts = [0, 5, 0, 30, 30, 5]
+        cis = ngsutils.bam.minorallele.calc_cp_cis(Ns, counts, 5)
+
+        self.assertEqual(6, len(cis))
+        self.assertEqual([0.0, 0.3], [round(x, 12) for x in cis[0]])  # 0..0.285
+        self.assertEqual([0.2, 0.8], [round(x, 12) for x in cis[1]])  # 0.234..0.766
+        self.assertTrue(math.isnan(cis[2][0]))
+        self.assertEqual([0.2, 0.4], [round(x, 12) for x in cis[3]])  # 0.220..0.400 (resolution 0.1)
+        self.assertEqual(cis[3], cis[4])
+        self.assertEqual(cis[1], cis[5])
+
+        for N, count, ci in zip(Ns, counts, cis):
+            if N:
+                self.assertEqual(ci, ngsutils.bam.minorallele.calc_cp_ci(N, count, 5))
+
+    def testOutOfRange(self):
+        'Counts larger than N (a negative refback) are NaN, without warnings'
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            cis = ngsutils.bam.minorallele.calc_cp_cis([10, 5, 10], [20, -1, 5], 5)
+
+        self.assertTrue(math.isnan(cis[0][0]) and math.isnan(cis[0][1]))
+        self.assertTrue(math.isnan(cis[1][0]) and math.isnan(cis[1][1]))
+        self.assertEqual([0.2, 0.8], [round(x, 12) for x in cis[2]])
+
+    def testCache(self):
+        size = ngsutils.bam.minorallele._ci_cache_size
+        try:
+            ngsutils.bam.minorallele._ci_cache_size = 10
+            ngsutils.bam.minorallele.calc_cp_cis(range(1, 50), [1] * 49, 3)
+            self.assertTrue(len(ngsutils.bam.minorallele.__dict__['__ci_cache']) <= 49)
+            ngsutils.bam.minorallele.calc_cp_ci(500, 1, 3)
+            self.assertEqual(10, len(ngsutils.bam.minorallele.__dict__['__ci_cache']))
+        finally:
+            ngsutils.bam.minorallele._ci_cache_size = size
+
 if __name__ == '__main__':
     unittest.main()
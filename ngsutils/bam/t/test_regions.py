@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.bam.engine.regions
+'''
+
+import os
+import random
+import unittest
+import doctest
+
+import ngsutils.bam.engine.regions
+from ngsutils.bam.engine.regions import RegionIndex, bed_region_index
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.engine.regions))
+    return tests
+
+
+class RegionIndexTest(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.regions = []
+        for i in xrange(200):
+            chrom = rand.choice(['chr1', 'chr2'])
+            start = rand.randint(0, 100000)
+            self.regions.append((chrom, start, start + rand.randint(0, 500), rand.choice(['+', '-', None])))
+
+        self.queries = []
+        for i in xrange(2000):
+            chrom = rand.choice(['chr1', 'chr2', 'chr3'])
+            start = rand.randint(0, 101000)
+            self.queries.append((chrom, start, start + rand.randint(0, 100), rand.choice(['+', '-', None])))
+
+        self.index = RegionIndex()
+        for region in self.regions:
+            self.index.add(*region)
+
+    def _expected(self, chrom, start, end, strand):
+        for r_chrom, r_start, r_end, r_strand in self.regions:
+            if r_chrom == chrom and r_start <= end and r_end >= start:
+                if strand is None or strand == r_strand:
+                    return True
+        return False
+
+    def testSorted(self):
+        for query in sorted(self.queries):
+            self.assertEqual(self._expected(*query), self.index.overlaps(*query))
+
+    def testUnsorted(self):
+        for query in self.queries:
+            self.assertEqual(self._expected(*query), self.index.overlaps(*query))
+
+    def testBED(self):
+        fname = os.path.join(os.path.dirname(__file__), 'tmp_regions.bed')
+        with open(fname, 'w') as f:
+            f.write('chr1\t100\t150\tfoo\t1\t+\nchr1\t200\t250\n')
+
+        index = bed_region_index(fname)
+        self.assertTrue(index.overlaps('chr1', 140, 160, '+'))
+        self.assertFalse(index.overlaps('chr1', 140, 160, '-'))
+        self.assertFalse(index.overlaps('chr1', 240, 260, '-'))
+        self.assertTrue(index.overlaps('chr1', 240, 260))
+
+        index = bed_region_index(fname, unstranded_matches_both=True)
+        self.assertTrue(index.overlaps('chr1', 240, 260, '-'))
+        self.assertTrue(index.overlaps('chr1', 240, 260, '+'))
+        self.assertFalse(index.overlaps('chr1', 140, 160, '-'))
+
+        os.unlink(fname)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.bam.engine.shard
+'''
+
+import os
+import unittest
+import doctest
+import StringIO
+
+import pysam
+
+import ngsutils.bam
+import ngsutils.bam.engine.shard
+import ngsutils.bam.tobedgraph
+import ngsutils.bam.junctioncount
+from ngsutils.bam.engine.shard import bam_shards, shard_reads, run_shards, BAMOutput, bam_concat
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.bam.engine.shard))
+    return tests
+
+
+def _names_worker(bam, shard):
+    return [read.qname for read in shard_reads(bam, shard)]
+
+
+def _copy_worker(bam, shard, outs, tag):
+    count = 0
+    for read in shard_reads(bam, shard):
+        outs[0].write(read)
+        outs[1].write('%s\t%s\t%s\n' % (tag, shard, read.qname))
+        count += 1
+    return count
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'test.bam')
+        self.outname = os.path.join(os.path.dirname(__file__), 'tmp_shard.bam')
+        self.bam = ngsutils.bam.bam_open(self.fname)
+
+    def tearDown(self):
+        self.bam.close()
+        if os.path.exists(self.outname):
+            os.unlink(self.outname)
+
+    def testShardReads(self):
+        # each read is assigned to exactly one shard, in order
+        for size in [None, 1, 50, 175, 1000]:
+            names = []
+            for shard in bam_shards(self.bam, size, unmapped=True):
+                names.extend([read.qname for read in shard_reads(self.bam, shard)])
+            self.assertEqual(['A', 'B', 'E', 'C', 'D', 'F', 'Z'], names)
+
+    def testRunShards(self):
+        shards = bam_shards(self.bam, 175, unmapped=True)
+        serial = list(run_shards(self.fname, _names_worker, shards))
+        parallel = list(run_shards(self.fname, _names_worker, shards, threads=3))
+        self.assertEqual(serial, parallel)
+        self.assertEqual(shards, [x[0] for x in parallel])
+
+    def testRunShardsOutputs(self):
+        shards = bam_shards(self.bam, 300, unmapped=True)
+        outputs = {}
+        for threads in [1, 3]:
+            sio = StringIO.StringIO()
+            counts = [x[1] for x in run_shards(self.fname, _copy_worker, shards, threads, args=('foo',), outputs=[BAMOutput(self.outname), sio])]
+            self.assertEqual(7, sum(counts))
+
+            bam = pysam.Samfile(self.outname, 'rb')
+            self.assertEqual(self.bam.references, bam.references)
+            outputs[threads] = ([(x.qname, x.tid, x.pos) for x in bam.fetch(until_eof=True)], sio.getvalue())
+            bam.close()
+
+        self.assertEqual(outputs[1], outputs[3])
+        self.assertEqual(['A', 'B', 'E', 'C', 'D', 'F', 'Z'], [x[0] for x in outputs[3][0]])
+        self.assertTrue(outputs[3][1].startswith('foo\tchr1:1-300\tA\n'))
+
+    def testConcat(self):
+        bam_concat([self.fname, self.fname], self.outname)
+        bam = pysam.Samfile(self.outname, 'rb')
+        self.assertEqual(['A', 'B', 'E', 'C', 'D', 'F', 'Z'] * 2, [x.qname for x in bam.fetch(until_eof=True)])
+        bam.close()
+
+    def testBEDGraph(self):
+        serial = StringIO.StringIO()
+        ngsutils.bam.tobedgraph.bam_tobedgraph(self.bam, out=serial)
+        parallel = StringIO.StringIO()
+        ngsutils.bam.tobedgraph.bam_tobedgraph(self.bam, out=parallel, threads=2)
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+
+    def testJunctionCount(self):
+        serial = StringIO.StringIO()
+        ngsutils.bam.junctioncount.bam_junction_count(self.bam, out=serial, quiet=True)
+        parallel = StringIO.StringIO()
+        ngsutils.bam.junctioncount.bam_junction_count(self.bam, out=parallel, quiet=True, threads=2)
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+        self.assertEqual(sorted(['chr1:199-399\t1', 'chr1:199-699\t1', 'chr1:499-699\t1']), sorted(serial.getvalue().strip().split('\n')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,11 @@ Tests for bamutils stats
 '''
 
 import os
+import random
 import unittest
 
+import pysam
+
 import ngsutils.bam
 import ngsutils.bam.stats
 
@@ -32,5 +35,61 @@ class StatsTest(unittest.TestCase):
         # Add a test with a mock GTF file
         pass
 
+
+class StatsThreadsTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'tmp_stats.bam')
+
+        # reads with multiple alignments (NH > 1) on different references
+        rand = random.Random(1)
+        reads = []
+        for i in xrange(300):
+            count = rand.choice([1, 1, 2, 3])
+            for j in xrange(count):
+                flag = rand.choice([0, 16]) | (256 if j else 0)
+                reads.append((rand.randint(0, 1), rand.randint(0, 950), 'read%s' % i, flag, [('NH', count), ('AS', rand.randint(0, 5))]))
+        for i in xrange(10):
+            reads.append((-1, -1, 'unmapped%s' % i, 4, []))
+
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 1000}, {'SN': 'chr2', 'LN': 1000}]}
+        bam = pysam.Samfile(self.fname, 'wb', header=header)
+        for tid, pos, name, flag, tags in sorted(reads, key=lambda x: (x[0] < 0, x[0], x[1])):
+            read = pysam.AlignedRead()
+            read.qname = name
+            read.tid = tid
+            read.pos = pos
+            read.seq = 'A' * 40
+            read.qual = 'I' * 40
+            if tid >= 0:
+                read.cigar = [(0, 40)]
+                read.mapq = 50
+            read.flag = flag
+            read.tags = tags
+            bam.write(read)
+        bam.close()
+        pysam.index(self.fname)
+
+        self._shard_size = ngsutils.bam.stats._shard_size
+        ngsutils.bam.stats._shard_size = 200
+
+    def tearDown(self):
+        ngsutils.bam.stats._shard_size = self._shard_size
+        for fname in [self.fname, '%s.bai' % self.fname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _stats(self, threads, region=None):
+        bam = ngsutils.bam.bam_open(self.fname)
+        stats = ngsutils.bam.stats.BamStats(bam, region=region, tags=['AS', 'MAPQ'], threads=threads)
+        bam.close()
+        return (stats.total, stats.mapped, stats.unmapped, stats.flag_counts.counts, stats.refs, dict([(k, (v.bins, v.missing, v.max)) for k, v in stats.tagbins.items()]))
+
+    def testThreads(self):
+        serial = self._stats(1)
+        self.assertEqual(310, serial[0])  # each read is only counted once
+        self.assertEqual(serial, self._stats(2))
+        self.assertEqual(self._stats(1, 'chr1:101-700'), self._stats(2, 'chr1:101-700'))
+
+
 if __name__ == '__main__':
     unittest.main()
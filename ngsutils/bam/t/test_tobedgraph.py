@@ -4,11 +4,13 @@ Tests for bamutils tobedgraph
 '''
 
 import os
+import tempfile
 import unittest
 
 import ngsutils.bam
 import ngsutils.bam.tobedgraph
 import StringIO
+from ngsutils.support.t.test_bigwig import read_bigwig
 
 
 class ToBEDGraphTest(unittest.TestCase):
@@ -52,5 +54,17 @@ chr1\t724\t774\t1
 ''')
         sio.close()
 
+    def testBigWig(self):
+        fd, fname = tempfile.mkstemp(suffix='.bw')
+        os.close(fd)
+
+        for threads in [1, 2]:
+            ngsutils.bam.tobedgraph.bam_tobedgraph(self.bam, normalize=0.5, threads=threads, bigwig=fname)
+            sizes, runs, levels = read_bigwig(fname)
+            self.assertEqual({'chr1': 2000}, sizes)
+            self.assertEqual([('chr1', 99, 149, 0.5), ('chr1', 174, 199, 1), ('chr1', 399, 499, 0.5), ('chr1', 699, 724, 1), ('chr1', 724, 774, 0.5)], runs)
+
+        os.unlink(fname)
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,7 @@ import ngsutils.bam.tofastq
 import StringIO
 
 read = MockRead('foo', 'ACGT', 'AAAA', tags=[('CS', 'T0123'), ('CQ', 'BBBB')])
+read_nocs = MockRead('bar', 'ACGT', 'ABCD')
 
 
 class FASTXTest(unittest.TestCase):
@@ -37,6 +38,18 @@ class FASTXTest(unittest.TestCase):
         self.assertEqual(sio.getvalue(), '>foo\nT0123\n')
         sio.close()
 
+    def testFASTQ_cs_convert(self):
+        sio = StringIO.StringIO("")
+        ngsutils.bam.tofastq.write_fastx([read, read_nocs], sio, colorspace=True)
+        self.assertEqual(sio.getvalue(), '@foo\nT0123\n+\nBBBB\n@bar\nT3131\n+\nABCD\n')
+        sio.close()
+
+    def testFASTA_cs_convert(self):
+        sio = StringIO.StringIO("")
+        ngsutils.bam.tofastq.write_fasta(read_nocs, sio, colorspace=True)
+        self.assertEqual(sio.getvalue(), '>bar\nT3131\n')
+        sio.close()
+
 
 if __name__ == '__main__':
     unittest.main()
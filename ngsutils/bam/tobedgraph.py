@@ -8,14 +8,18 @@ account gaps in RNAseq alignments and not display any coverage across introns.
 This can optionally normalize the counts by a given factor or display only
 coverage for a specific strand.
 
+The coverage can also be written directly to a bigWig file (without the UCSC
+bedGraphToBigWig tool).
+
  See: http://genome.ucsc.edu/goldenPath/help/bedgraph.html
       http://genome.ucsc.edu/goldenPath/help/bigWig.html
 '''
 
 import sys
 import os
-from array import array
-from ngsutils.bam import bam_iter
+from ngsutils.bam.engine.coverage import CoverageCounter
+from ngsutils.bam.engine.shard import bam_shards, run_shards
+from ngsutils.support.bigwig import BigWigWriter
 import pysam
 
 
@@ -28,92 +32,63 @@ def write_bedgraph(chrom, start, end, count, normalize=None, out=sys.stdout):
 
 
 class BamCounter(object):
-    def __init__(self, normalization_factor=1, strand=None, out=sys.stdout):
+    '''
+    Writes the read depth for a BAM file as bedGraph (see:
+    ngsutils.bam.engine.coverage), or to a BigWigWriter
+    '''
+    def __init__(self, normalization_factor=1, strand=None, out=sys.stdout, bigwig=None):
         self.normalization_factor = normalization_factor
-
-        self.pos_counts = None
-
-        self.cur_tid = None
-        self.cur_chrom = None
-
-        self._last_val = 0
-        self._last_start = None
-        self._last_pos = None
-
-        self.out = out
         self.strand = strand
-
-
-    def _add_read(self, read):
-        refpos = read.pos
-        for op, size in read.cigar:
-            if op == 0:
-                self.incr_count(refpos, refpos + size)
-                refpos += size
-            elif op == 1:
-                pass
-            elif op == 2:
-                refpos += size
-            elif op == 3:
-                refpos += size
-            pass
-
+        self.out = out
+        self.bigwig = bigwig
 
     def get_counts(self, bam, ref=None, start=None, end=None, quiet=False):
-        for read in bam_iter(bam, ref=ref, start=start, end=end, quiet=quiet, callback=lambda x: '%s:%s (%s)' % (self.cur_chrom, x.pos, len(self.pos_counts) if self.pos_counts else 0)):
-            if read.is_unmapped:
-                continue
-            if self.strand:
-                if self.strand == '+' and read.is_reverse:
-                    continue
-                elif self.strand == '-' and not read.is_reverse:
-                    continue
-
-            if self.cur_tid is None or read.tid != self.cur_tid:
-                if self.pos_counts:
-                    self.flush()
+        for runs in CoverageCounter(bam, self.strand, ref, start, end, quiet):
+            self.write_runs(bam.references[runs.tid], runs)
 
-                self.pos_counts = array('I', [0,] * bam.lengths[read.tid])
+    def write_runs(self, chrom, runs):
+        norm = self.normalization_factor
+        if self.bigwig:
+            self.bigwig.add(chrom, runs.starts, runs.ends, runs.depths * norm)
+            return
 
-                self.cur_tid = read.tid
-                self.cur_chrom = bam.references[read.tid]
+        self.out.write(''.join(['%s\t%s\t%s\t%s\n' % (chrom, s, e, depth * norm) for s, e, depth in zip(runs.starts.tolist(), runs.ends.tolist(), runs.depths.tolist())]))
 
-            self._add_read(read)
 
-        self.flush()
+def _bedgraph_worker(bam, shard, outs, strand, normalize):
+    counter = BamCounter(normalize, strand, outs[0])
+    counter.get_counts(bam, shard.ref, shard.start, shard.end, quiet=True)
 
-    def incr_count(self, start, end=None):
-        if not end:
-            end = start
 
-        for pos in xrange(start, end):
-            self.pos_counts[pos] += 1
+def _bigwig_worker(bam, shard, strand):
+    return [(bam.references[x.tid], x) for x in CoverageCounter(bam, strand, shard.ref, shard.start, shard.end, quiet=True)]
 
-    def write(self, pos, val):
-        if val == self._last_val:
-            self._last_pos = pos
-        else:
-            if self._last_val:
-                self.out.write('%s\t%s\t%s\t%s\n' % (self.cur_chrom, self._last_start, self._last_pos+1, (self._last_val * self.normalization_factor)))
-            self._last_val = val
-            self._last_start = pos
-            self._last_pos = pos
 
-    def flush(self):
-        for i, count in enumerate(self.pos_counts):
-            self.write(i, count)
-
-        if self._last_val:
-            self.out.write('%s\t%s\t%s\t%s\n' % (self.cur_chrom, self._last_start, self._last_pos+1, (self._last_val * self.normalization_factor)))
-
-        self._last_val = 0
-        self._last_start = None
-        self._last_pos = None
-
-
-def bam_tobedgraph(bamfile, strand=None, normalize=None, ref=None, start=None, end=None, out=sys.stdout):
+def bam_tobedgraph(bamfile, strand=None, normalize=None, ref=None, start=None, end=None, out=sys.stdout, threads=1, bigwig=None):
     if normalize is None:
         normalize = 1
+
+    if bigwig:
+        writer = BigWigWriter(bigwig, dict(zip(bamfile.references, bamfile.lengths)))
+        counter = BamCounter(normalize, strand, bigwig=writer)
+        if threads > 1:
+            # the runs are added to the bigWig file in order (by the parent)
+            shards = bam_shards(bamfile, ref=ref, start=start, end=end)
+            for shard, result in run_shards(bamfile.filename, _bigwig_worker, shards, threads, args=(strand, )):
+                for chrom, runs in result:
+                    counter.write_runs(chrom, runs)
+        else:
+            counter.get_counts(bamfile, ref, start, end)
+        writer.close()
+        return
+
+    if threads > 1:
+        # each reference is counted separately, then written in order
+        shards = bam_shards(bamfile, ref=ref, start=start, end=end)
+        for shard, result in run_shards(bamfile.filename, _bedgraph_worker, shards, threads, args=(strand, normalize), outputs=[out]):
+            pass
+        return
+
     counter = BamCounter(normalize, strand, out)
     counter.get_counts(bamfile, ref, start, end)
 
@@ -135,6 +110,11 @@ Options:
 
     -region chr:start-end    Count reads mapping to this genome region
                              (start is 1-based)
+
+    -threads N        Count each reference in parallel, using N processes
+
+    -bigwig out.bw    Write the coverage to a bigWig file (instead of
+                      bedGraph to stdout)
 """
     sys.exit(1)
 
@@ -145,6 +125,8 @@ if __name__ == "__main__":
     ref = None
     start = None
     end = None
+    threads = 1
+    bigwig = None
 
     last = None
     for arg in sys.argv[1:]:
@@ -161,7 +143,13 @@ if __name__ == "__main__":
             start, end = [int(x) for x in se.split('-')]
             start = start - 1
             last = None
-        elif arg in ['-norm', '-ref', '-region']:
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
+        elif last == '-bigwig':
+            bigwig = arg
+            last = None
+        elif arg in ['-norm', '-ref', '-region', '-threads', '-bigwig']:
             last = arg
         elif arg == '-plus':
             strand = '+'
@@ -177,5 +165,5 @@ if __name__ == "__main__":
         usage()
 
     bamfile = pysam.Samfile(bam, "rb")
-    bam_tobedgraph(bamfile, strand, norm, ref, start, end, out=sys.stdout)
+    bam_tobedgraph(bamfile, strand, norm, ref, start, end, out=sys.stdout, threads=threads, bigwig=bigwig)
     bamfile.close()
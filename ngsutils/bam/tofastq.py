@@ -3,21 +3,26 @@
 ## desc Convert BAM reads back to FASTQ sequences
 '''
 Convert BAM reads back to FASTA/FASTQ sequences (mapped or unmapped)
+
+Color-space sequences are taken from the CS/CQ tags. If a read doesn't have
+a CS tag, the base-space sequence is converted to color-space.
 '''
 
 import sys
 import os
 from ngsutils.bam import bam_iter, bam_open
 from ngsutils.support import revcomp
+from ngsutils.support.colorspace import encode_batch
 
 
-def bam_tofastx(fname, colorspace=False, show_mapped=True, show_unmapped=True, fastq=True, read1=True, read2=True, proper=False):
+def bam_tofastx(fname, colorspace=False, show_mapped=True, show_unmapped=True, fastq=True, read1=True, read2=True, proper=False, out=sys.stdout, batch_size=10000):
     if show_mapped is False and show_unmapped is False:
         return
 
     sam = bam_open(fname)
 
     last_key = None
+    batch = []
 
     for read in bam_iter(sam):
         if not read1 and read.is_read1:
@@ -41,47 +46,80 @@ def bam_tofastx(fname, colorspace=False, show_mapped=True, show_unmapped=True, f
         if not show:
             continue
 
-        if fastq:
-            write_fastq(read, colorspace=colorspace)
-        else:
-            write_fasta(read, colorspace=colorspace)
+        batch.append(read)
+        if len(batch) >= batch_size:
+            write_fastx(batch, out, colorspace=colorspace, fastq=fastq)
+            batch = []
 
         last_key = k
 
+    if batch:
+        write_fastx(batch, out, colorspace=colorspace, fastq=fastq)
 
 
-def write_fasta(read, out=sys.stdout, colorspace=False):
-    if colorspace:
-        seq = read.opt('CS')
-    else:
-        seq = read.seq
+def _opt(read, tag):
+    try:
+        return read.opt(tag)
+    except KeyError:
+        return None
 
+
+def read_basespace(read):
+    'Returns the (seq, qual) for a read, in the original orientation of the read'
     if not read.is_unmapped and read.is_reverse:
-        if colorspace:
-            seq = seq[::-1]
+        return revcomp(read.seq), read.qual[::-1]
+    return read.seq, read.qual
+
+
+def read_colorspace(reads):
+    '''
+    Returns the color-space (seq, qual) for each read in a list. The CS/CQ
+    tags are used if present, otherwise the base-space sequence is converted
+    to color-space (all at once).
+    '''
+    ret = []
+    convert_idx = []
+    convert_seqs = []
+
+    for read in reads:
+        cs = _opt(read, 'CS')
+        if cs:
+            qual = _opt(read, 'CQ') or read.qual
+            if not read.is_unmapped and read.is_reverse:
+                cs = cs[::-1]
+                qual = qual[::-1]
+            ret.append((cs, qual))
         else:
-            seq = revcomp(seq)
+            seq, qual = read_basespace(read)
+            convert_idx.append(len(ret))
+            convert_seqs.append(seq)
+            ret.append((None, qual))
 
-    out.write('>%s\n%s\n' % (read.qname, seq))
+    for idx, cs in zip(convert_idx, encode_batch(convert_seqs)):
+        ret[idx] = (cs, ret[idx][1])
 
+    return ret
 
-def write_fastq(read, out=sys.stdout, colorspace=False):
+
+def write_fastx(reads, out=sys.stdout, colorspace=False, fastq=True):
     if colorspace:
-        seq = read.opt('CS')
-        qual = read.opt('CQ')
+        seqquals = read_colorspace(reads)
     else:
-        seq = read.seq
-        qual = read.qual
+        seqquals = [read_basespace(read) for read in reads]
 
-    if not read.is_unmapped and read.is_reverse:
-        if colorspace:
-            seq = seq[::-1]
+    for read, (seq, qual) in zip(reads, seqquals):
+        if fastq:
+            out.write('@%s\n%s\n+\n%s\n' % (read.qname, seq, qual))
         else:
-            seq = revcomp(seq)
+            out.write('>%s\n%s\n' % (read.qname, seq))
 
-        qual = qual[::-1]
 
-    out.write('@%s\n%s\n+\n%s\n' % (read.qname, seq, qual))
+def write_fasta(read, out=sys.stdout, colorspace=False):
+    write_fastx([read], out, colorspace=colorspace, fastq=False)
+
+
+def write_fastq(read, out=sys.stdout, colorspace=False):
+    write_fastx([read], out, colorspace=colorspace, fastq=True)
 
 
 def usage(fastq=True):
@@ -94,7 +132,8 @@ def usage(fastq=True):
 
     print """
 Options:
-    -cs        Output color-space sequences
+    -cs        Output color-space sequences (from the CS/CQ tags, or
+               converted from the base-space sequence if missing)
     -mapped    Only output mapped sequences
     -unmapped  Only output unmapped sequences
 
@@ -3,11 +3,14 @@
 Tests for bedutils tobedgraph
 '''
 
+import os
+import tempfile
 import unittest
 
 import ngsutils.bed.tobedgraph
 import StringIO
 from ngsutils.bed import BedFile
+from ngsutils.support.t.test_bigwig import read_bigwig
 
 bedtest = BedFile(fileobj=StringIO.StringIO('''\
 test1|10|20|foo1|10|+
@@ -63,5 +66,42 @@ test1|10|20|1
         self.assertEqual(valid, sio.getvalue())
         sio.close()
 
+    def testOverlaps(self):
+        'Nested and overlapping regions (the text and bigWig runs match)'
+        bed = BedFile(fileobj=StringIO.StringIO('''\
+chr2|63|99|foo1|1|+
+chr2|67|82|foo2|1|+
+chr2|92|94|foo3|1|+
+chr2|97|126|foo4|1|+
+'''.replace('|', '\t')))
+        valid = [('chr2', 63, 67, 1), ('chr2', 67, 82, 2), ('chr2', 82, 92, 1), ('chr2', 92, 94, 2), ('chr2', 94, 97, 1), ('chr2', 97, 99, 2), ('chr2', 99, 126, 1)]
+
+        sio = StringIO.StringIO("")
+        ngsutils.bed.tobedgraph.bed_tobedgraph(bed, out=sio)
+        self.assertEqual(''.join(['%s\t%s\t%s\t%s\n' % x for x in valid]), sio.getvalue())
+
+        fd, fname = tempfile.mkstemp(suffix='.bw')
+        os.close(fd)
+        try:
+            ngsutils.bed.tobedgraph.bed_tobigwig(bed, fname)
+            self.assertEqual(valid, read_bigwig(fname)[1])
+        finally:
+            os.unlink(fname)
+
+    def testBigWig(self):
+        fd, fname = tempfile.mkstemp(suffix='.bw')
+        os.close(fd)
+
+        ngsutils.bed.tobedgraph.bed_tobigwig(bedtest, fname)
+        sizes, runs, levels = read_bigwig(fname)
+        self.assertEqual({'test1': 150}, sizes)
+        self.assertEqual([('test1', 10, 15, 2), ('test1', 15, 20, 3), ('test1', 20, 25, 1), ('test1', 100, 150, 1)], runs)
+
+        ngsutils.bed.tobedgraph.bed_tobigwig(bedtest, fname, only_strand='+', normalize=2)
+        sizes, runs, levels = read_bigwig(fname)
+        self.assertEqual([('test1', 10, 15, 2), ('test1', 15, 20, 4), ('test1', 20, 25, 2), ('test1', 100, 150, 2)], runs)
+
+        os.unlink(fname)
+
 if __name__ == '__main__':
     unittest.main()
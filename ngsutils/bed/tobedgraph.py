@@ -5,6 +5,9 @@
 Takes a BED file with overlapping regions and produces a BedGraph file.  This
 can optionally normalize the counts by a given factor.
 
+The counts can also be written directly to a bigWig file (without the UCSC
+bedGraphToBigWig tool).
+
  See: http://genome.ucsc.edu/goldenPath/help/bedgraph.html
       http://genome.ucsc.edu/goldenPath/help/bigWig.html
 '''
@@ -12,67 +15,73 @@ can optionally normalize the counts by a given factor.
 import sys
 import os
 from ngsutils.bed import BedFile
+from ngsutils.bam.engine.coverage import DepthRuns
+from ngsutils.support.bigwig import BigWigWriter
 
-
-def write_regions(regions, normalize=None, out=sys.stdout):
-    while regions:
-        regions.sort()
-        fragment = None
-
-        for chrom, start, end in regions:
-            if start != regions[0][1]:
-                fragment = (regions[0][1], start)
-                break
-
-        if not fragment:
-            for chrom, start, end in regions:
-                fragment = (regions[0][1], end)
-                break
-
-        new_regions = []
-        count = 0
-        for chrom, start, end in regions:
-            if fragment[0] <= start < fragment[1]:
-                count += 1
-                if end > fragment[1]:
-                    new_regions.append((chrom, fragment[1], end))
-            else:
-                new_regions.append((chrom, start, end))
-
-        if normalize:
-            out.write('%s\t%s\t%s\t%s\n' % (chrom, fragment[0], fragment[1], int(normalize * count)))
-        else:
-            out.write('%s\t%s\t%s\t%s\n' % (chrom, fragment[0], fragment[1], count))
-
-        regions = new_regions
+# resolve the depth after this many regions
+_flush_size = 1000000
 
 
-def bed_tobedgraph(bed, only_strand=None, normalize=None, out=sys.stdout):
-    regions = []
-    last_end = 0
+def bed_depth_runs(bed, only_strand=None, normalize=None):
+    '''
+    Yields (chrom, starts, ends, counts) arrays with the depth of the regions
+    in a BED file. The regions must be in order (as a BedFile is iterated).
+    If normalize is given, each count is floor(count * normalize).
+    '''
+    depth = None
     last_chrom = None
+    last_start = 0
 
     for region in bed:
         if only_strand and only_strand != region.strand:
             continue
 
-        if last_chrom != region.chrom or region.start > last_end:
-            write_regions(regions, normalize, out)
+        if last_chrom != region.chrom:
+            if depth is not None:
+                yield _normalized(last_chrom, depth.flush(), normalize)
             last_chrom = region.chrom
-            regions = []
+            depth = DepthRuns()
+        elif region.start < last_start:
+            raise ValueError('The BED file must be sorted (%s:%s)' % (region.chrom, region.start))
+        elif len(depth) > _flush_size:
+            yield _normalized(last_chrom, depth.flush(region.start), normalize)
+
+        depth.add(region.start, region.end)
+        last_start = region.start
+
+    if depth is not None:
+        yield _normalized(last_chrom, depth.flush(), normalize)
 
-        regions.append((region.chrom, region.start, region.end))
-        if region.end > last_end:
-            last_end = region.end
 
-    if regions:
-        write_regions(regions, normalize, out)
+def _normalized(chrom, runs, normalize):
+    starts, ends, counts = runs
+    if normalize:
+        counts = (counts * normalize).astype(int)
+    return chrom, starts, ends, counts
+
+
+def bed_tobedgraph(bed, only_strand=None, normalize=None, out=sys.stdout):
+    for chrom, starts, ends, counts in bed_depth_runs(bed, only_strand, normalize):
+        for start, end, count in zip(starts.tolist(), ends.tolist(), counts.tolist()):
+            out.write('%s\t%s\t%s\t%s\n' % (chrom, start, end, count))
+
+
+def bed_tobigwig(bed, fname, only_strand=None, normalize=None):
+    '''
+    Writes the counts for a BED file to a bigWig file (the same runs as
+    bed_tobedgraph). The size of each chromosome is the end of its last
+    region.
+    '''
+    writer = BigWigWriter(fname)
+    for chrom, starts, ends, counts in bed_depth_runs(bed, only_strand, normalize):
+        writer.add(chrom, starts, ends, counts)
+    writer.close()
 
 
 def usage():
     print __doc__
     print """\
-Usage: bedutils tobedgraph [-plus | -minus] {-norm N} bamfile
+Usage: bedutils tobedgraph [-plus | -minus] {-norm N} {-bigwig out.bw} bedfile
 
 Options:
     -plus             only count reads on the plus strand
@@ -81,6 +90,9 @@ Options:
 
     -norm VAL         the count at every position is calculated as:
                       floor(count * VAL).
+
+    -bigwig out.bw    write the counts to a bigWig file (instead of bedGraph
+                      to stdout)
 """
     sys.exit(1)
 
@@ -88,6 +100,7 @@ if __name__ == "__main__":
     bed = None
     strand = None
     norm = None
+    bigwig = None
 
     last = None
     for arg in sys.argv[1:]:
@@ -96,7 +109,10 @@ if __name__ == "__main__":
         if last == '-norm':
             norm = float(arg)
             last = None
-        elif arg in ['-norm']:
+        elif last == '-bigwig':
+            bigwig = arg
+            last = None
+        elif arg in ['-norm', '-bigwig']:
             last = arg
         elif arg == '-plus':
             strand = '+'
@@ -111,4 +127,7 @@ if __name__ == "__main__":
     if not bed:
         usage()
 
-    bed_tobedgraph(BedFile(bed), strand, norm)
+    if bigwig:
+        bed_tobigwig(BedFile(bed), bigwig, strand, norm)
+    else:
+        bed_tobedgraph(BedFile(bed), strand, norm)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+## category Conversion
+## desc Converts between base-space and color-space FASTQ files
+'''
+Converts a base-space FASTQ file to color-space, or a color-space FASTQ file
+to base-space. The direction is determined automatically from the file.
+
+Color-space reads are written with a primer base (T by default), followed by
+one color for each base in the read. The quality values are kept as-is (one
+per color).
+
+When decoding color-space reads, any base after an unknown color (.) is
+written as an N.
+'''
+
+import os
+import sys
+
+from ngsutils.fastq import FASTQ
+from ngsutils.support.colorspace import encode_batch, decode_batch
+
+
+def _convert_batch(batch, out, tocs, primer):
+    if tocs:
+        seqs = encode_batch([read.seq for read in batch], primer)
+    else:
+        seqs = decode_batch([read.seq for read in batch])
+
+    for read, seq in zip(batch, seqs):
+        read.clone(seq=seq).write(out)
+
+
+def fastq_csconvert(fastq, out=sys.stdout, tocs=None, primer='T', quiet=False, batch_size=10000):
+    '''
+    Converts reads to color-space (tocs=True) or base-space (tocs=False). If
+    tocs is None, the direction is the opposite of the file's current space.
+    '''
+    if tocs is None:
+        tocs = not fastq.is_colorspace
+
+    batch = []
+    for read in fastq.fetch(quiet=quiet):
+        batch.append(read)
+        if len(batch) >= batch_size:
+            _convert_batch(batch, out, tocs, primer)
+            batch = []
+
+    if batch:
+        _convert_batch(batch, out, tocs, primer)
+
+
+def usage():
+    print __doc__
+    print """Usage: fastqutils csconvert {opts} filename.fastq{.gz}
+
+Options:
+    -tocs        Force conversion to color-space
+    -tobase      Force conversion to base-space
+    -primer base The primer base to use for color-space reads (default: T)
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    fname = None
+    tocs = None
+    primer = 'T'
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-primer':
+            primer = arg.upper()
+            if primer not in 'ACGT' or len(primer) != 1:
+                usage()
+            last = None
+        elif arg == '-tocs':
+            tocs = True
+        elif arg == '-tobase':
+            tocs = False
+        elif arg in ['-primer']:
+            last = arg
+        elif os.path.exists(arg):
+            fname = arg
+
+    if not fname:
+        usage()
+
+    fq = FASTQ(fname)
+    fastq_csconvert(fq, tocs=tocs, primer=primer)
+    fq.close()
@@ -19,39 +19,37 @@ import os
 import sys
 
 from ngsutils.fastq import FASTQ
-
-_encoding = {
-'0': 'A',
-'1': 'C',
-'2': 'G',
-'3': 'T',
-'4': 'N',
-'5': 'N',
-'6': 'N',
-'.': 'N',
-}
+from ngsutils.support.colorspace import double_encode, double_encode_batch
 
 
 def encoded_seq(seq):
-    ret = []
-    for s in seq.upper():
-        ret.append(_encoding[s])
-    return ''.join(ret)
+    return double_encode(seq)
 
 
-def fastq_csencode(fastq, out=sys.stdout, quiet=False):
-    for read in fastq.fetch(quiet=quiet):
+def _encode_batch(batch, out):
+    seqs = []
+    for read in batch:
         if read.seq[0] in 'ATCG':  # linker prefix
             # skip 2 bases, unable to determine the proper convertion for
             # the first colorspace base
-
-            seq = read.seq[2:]
-            qual = read.qual[1:]
+            seqs.append(read.seq[2:])
         else:
-            seq = seq[1:]
-            qual = read.qual[1:]
+            seqs.append(read.seq[1:])
+
+    for read, seq in zip(batch, double_encode_batch(seqs)):
+        out.write('@%s\n%s\n+\n%s\n' % (read.name, seq, read.qual[1:]))
+
+
+def fastq_csencode(fastq, out=sys.stdout, quiet=False, batch_size=10000):
+    batch = []
+    for read in fastq.fetch(quiet=quiet):
+        batch.append(read)
+        if len(batch) >= batch_size:
+            _encode_batch(batch, out)
+            batch = []
 
-        out.write('@%s\n%s\n+\n%s\n' % (read.name, encoded_seq(seq), qual))
+    if batch:
+        _encode_batch(batch, out)
 
 
 def usage():
@@ -8,16 +8,22 @@ batch, allowing you to use more than one criterion at a time.
 '''
 import sys
 import os
+import numpy
 
 from ngsutils.fastq import FASTQ
+from ngsutils.support.nameset import read_nameset
 
 
 def fastq_filter(filter_chain, stats_fname=None, out=sys.stdout, quiet=False):
-    for name, comment, seq, qual in filter_chain.filter():
-        if comment and comment[0] != ' ':
-            comment = ' %s' % comment
+    if hasattr(filter_chain, 'batches'):
+        for batch in filter_chain.batches():
+            batch.write(out)
+    else:
+        for name, comment, seq, qual in filter_chain.filter():
+            if comment and comment[0] != ' ':
+                comment = ' %s' % comment
 
-        out.write("@%s%s\n%s\n+\n%s\n" % (name, comment, seq, qual))
+            out.write("@%s%s\n%s\n+\n%s\n" % (name, comment, seq, qual))
 
     stats = []
     p = filter_chain
@@ -37,7 +43,112 @@ def fastq_filter(filter_chain, stats_fname=None, out=sys.stdout, quiet=False):
                 f.write('%s\t%s\t%s\t%s\n' % (name, kept, altered, removed))
 
 
+class FASTQBatch(object):
+    '''
+    A block of reads that is passed between the batch filters.
+
+    The original name/comment/seq/qual values are never copied while the
+    batch moves down the chain. Filters only flip the keep mask or move the
+    seq/qual start and end offsets (per read); the trimmed reads are built
+    once, when the batch is written out.
+    '''
+    def __init__(self, records):
+        self.names = []
+        self.comments = []
+        self.seqs = []
+        self.quals = []
+
+        for name, comment, seq, qual in records:
+            self.names.append(name)
+            self.comments.append(comment)
+            self.seqs.append(seq)
+            self.quals.append(qual)
+
+        self.keep = numpy.ones(len(self.names), dtype=bool)
+        self.seq_start = numpy.zeros(len(self.names), dtype=numpy.int64)
+        self.seq_end = numpy.array([len(x) for x in self.seqs], dtype=numpy.int64)
+        self.qual_start = numpy.zeros(len(self.names), dtype=numpy.int64)
+        self.qual_end = numpy.array([len(x) for x in self.quals], dtype=numpy.int64)
+
+        self._seq_buffer = None
+        self._qual_buffer = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def seq_buffer(self):
+        'All sequences as one uint8 array, plus the offset of each read'
+        if self._seq_buffer is None:
+            self._seq_buffer = _concat_buffer(self.seqs)
+        return self._seq_buffer
+
+    @property
+    def qual_buffer(self):
+        'All qualities as one uint8 array, plus the offset of each read'
+        if self._qual_buffer is None:
+            self._qual_buffer = _concat_buffer(self.quals)
+        return self._qual_buffer
+
+    def annotate(self, idx, tag):
+        for i in idx:
+            self.comments[i] = '%s %s' % (self.comments[i], tag)
+
+    def records(self):
+        for i in numpy.flatnonzero(self.keep):
+            yield (self.names[i], self.comments[i], self.seqs[i][self.seq_start[i]:self.seq_end[i]], self.quals[i][self.qual_start[i]:self.qual_end[i]])
+
+    def write(self, out):
+        buf = []
+        for name, comment, seq, qual in self.records():
+            if comment and comment[0] != ' ':
+                comment = ' %s' % comment
+            buf.append("@%s%s\n%s\n+\n%s\n" % (name, comment, seq, qual))
+        out.write(''.join(buf))
+
+
+def _concat_buffer(values):
+    offsets = numpy.zeros(len(values), dtype=numpy.int64)
+    if values:
+        numpy.cumsum([len(x) for x in values[:-1]], out=offsets[1:])
+    return numpy.frombuffer(''.join(values), dtype=numpy.uint8), offsets
+
+
+def _window_counts(buf, offsets, start, end, table):
+    '''
+    For each read, count the characters between start and end that are set
+    in the lookup table (indexed by character value)
+    '''
+    acc = numpy.zeros(len(buf) + 1, dtype=numpy.int64)
+    numpy.cumsum(table[buf], out=acc[1:])
+    return acc[offsets + end] - acc[offsets + start]
+
+
+_wildcard_table = numpy.zeros(256, dtype=numpy.int64)
+for _base in '4.N':
+    _wildcard_table[ord(_base)] = 1
+
+
+def _batch_records(records, size):
+    buf = []
+    for record in records:
+        buf.append(record)
+        if len(buf) >= size:
+            yield FASTQBatch(buf)
+            buf = []
+    if buf:
+        yield FASTQBatch(buf)
+
+
+def _parent_batches(parent, size):
+    if hasattr(parent, 'batches'):
+        return parent.batches()
+    return _batch_records(parent.filter(), size)
+
+
 class FASTQReader(object):
+    batch_size = 10000
+
     def __init__(self, fastq, verbose=False, discard=None):
         self.parent = None
         self.fastq = fastq
@@ -56,6 +167,9 @@ class FASTQReader(object):
                 sys.stderr.write('[FASTQ] Read: %s\n' % read.name)
             yield read.name, read.comment, read.seq, read.qual
 
+    def batches(self):
+        return _batch_records(self.filter(), self.batch_size)
+
 
 class TrimFilter(object):
     def __init__(self, parent, trim_seq, mismatch_pct, min_filter_len, verbose=False, discard=None):
@@ -212,7 +326,86 @@ class QualFilter(object):
                 yield (name, comment, seq, qual)
 
 
-class SuffixQualFilter(object):
+class BatchFilter(object):
+    '''
+    Base class for filters that work on a whole FASTQBatch at a time.
+
+    Subclasses implement filter_batch(batch, active), where active is the
+    keep mask as it was when the batch reached this filter. They update the
+    batch offsets in place and report the result through _tally(). The
+    per-record filter() generator is still available, so these filters can
+    be mixed freely with the other filters in a chain.
+
+    Filters that can't be vectorized can implement filter_read(name, comment,
+    seq, qual) instead, returning False to remove the read. The default
+    filter_batch calls it for each active read (reads can't be altered this
+    way).
+    '''
+
+    batch_size = 10000
+    label = None
+
+    def batches(self):
+        for batch in _parent_batches(self.parent, self.batch_size):
+            self.filter_batch(batch, batch.keep.copy())
+            yield batch
+
+    def filter(self):
+        for batch in self.batches():
+            for record in batch.records():
+                yield record
+
+    def filter_batch(self, batch, active):
+        removed = numpy.zeros(len(batch), dtype=bool)
+        for i in numpy.flatnonzero(active):
+            seq = batch.seqs[i][batch.seq_start[i]:batch.seq_end[i]]
+            qual = batch.quals[i][batch.qual_start[i]:batch.qual_end[i]]
+            removed[i] = not self.filter_read(batch.names[i], batch.comments[i], seq, qual)
+        self._tally(batch, active, removed=removed)
+
+    def filter_read(self, name, comment, seq, qual):
+        raise NotImplementedError
+
+    def _tally(self, batch, active, altered=None, removed=None, tag=None):
+        if removed is not None:
+            removed = removed & active
+            batch.keep &= ~removed
+        else:
+            removed = numpy.zeros(len(batch), dtype=bool)
+
+        if altered is not None:
+            altered = altered & active & ~removed
+        else:
+            altered = numpy.zeros(len(batch), dtype=bool)
+
+        removed_count = int(removed.sum())
+        altered_count = int(altered.sum())
+
+        self.removed += removed_count
+        self.altered += altered_count
+        self.kept += int(active.sum()) - removed_count - altered_count
+
+        if tag:
+            batch.annotate(numpy.flatnonzero(altered), tag)
+
+        if self.discard:
+            for idx in numpy.flatnonzero(removed):
+                self.discard(batch.names[idx])
+
+        if self.verbose:
+            for idx in numpy.flatnonzero(active):
+                if removed[idx]:
+                    status = 'removed'
+                elif altered[idx]:
+                    status = 'altered'
+                else:
+                    status = 'kept'
+                sys.stderr.write('[%s] %s (%s)\n' % (self.label, batch.names[idx], status))
+
+
+class SuffixQualFilter(BatchFilter):
+    label = 'SuffixQual'
+
     def __init__(self, parent, val, verbose=False, discard=None):
         self.parent = parent
         self.value = val
@@ -224,28 +417,33 @@ class SuffixQualFilter(object):
 
         self.discard = discard
 
-    def filter(self):
-        for name, comment, seq, qual in self.parent.filter():
-            alt = False
-            while qual and qual[-1] == self.value:
-                alt = True
-                qual = qual[:-1]
-                seq = seq[:-1]
+    def filter_batch(self, batch, active):
+        buf, offsets = batch.qual_buffer
+        if not len(buf):
+            self._tally(batch, active)
+            return
 
-            if alt:
-                if self.verbose:
-                    sys.stderr.write('[SuffixQual] %s (altered)\n' % (name,))
-                self.altered += 1
-                comment = '%s #suff' % comment
-            else:
-                if self.verbose:
-                    sys.stderr.write('[SuffixQual] %s (kept)\n' % (name,))
-                self.kept += 1
+        # index of the last base that is *not* the suffix value, at or
+        # before each position in the buffer
+        last_good = numpy.where(buf != ord(self.value), numpy.arange(len(buf)), -1)
+        numpy.maximum.accumulate(last_good, out=last_good)
+
+        qual_len = batch.qual_end - batch.qual_start
+        tail = last_good[numpy.clip(offsets + batch.qual_end - 1, 0, len(buf) - 1)] - offsets
+
+        new_end = numpy.where(tail >= batch.qual_start, tail + 1, batch.qual_start)
+        trimmed = numpy.where(qual_len > 0, batch.qual_end - new_end, 0)
+
+        altered = active & (trimmed > 0)
+        batch.qual_end = numpy.where(altered, batch.qual_end - trimmed, batch.qual_end)
+        batch.seq_end = numpy.where(altered, numpy.maximum(batch.seq_end - trimmed, batch.seq_start), batch.seq_end)
 
-            yield (name, comment, seq, qual)
+        self._tally(batch, active, altered=altered, tag='#suff')
 
 
-class TruncateFilter(object):
+class TruncateFilter(BatchFilter):
+    label = 'Truncate'
+
     def __init__(self, parent, size, verbose=False, discard=None):
         self.parent = parent
         self.size = size
@@ -257,29 +455,24 @@ class TruncateFilter(object):
 
         self.discard = discard
 
-    def filter(self):
-        for name, comment, seq, qual in self.parent.filter():
-            if len(qual) > self.size:
-                if len(seq) == len(qual):  
-                    # basespace or colorspace w/o prefix
-                    seq = seq[:self.size]
-                    qual = qual[:self.size]
-                else:
-                    # colorspace with prefix
-                    seq = seq[:self.size + 1]
-                    qual = qual[:self.size]
+    def filter_batch(self, batch, active):
+        qual_len = batch.qual_end - batch.qual_start
+        seq_len = batch.seq_end - batch.seq_start
 
-                if self.verbose:
-                    sys.stderr.write('[Truncate] %s (altered)\n' % (name,))
-                self.altered += 1
-                comment = '%s #trunc' % comment
-            else:
-                self.kept += 1
+        altered = active & (qual_len > self.size)
+
+        # colorspace reads with a prefix base keep one extra seq character
+        cs_prefix = (seq_len != qual_len).astype(batch.seq_end.dtype)
+
+        batch.qual_end = numpy.where(altered, batch.qual_start + self.size, batch.qual_end)
+        batch.seq_end = numpy.where(altered, batch.seq_start + self.size + cs_prefix, batch.seq_end)
+
+        self._tally(batch, active, altered=altered, tag='#trunc')
 
-            yield (name, comment, seq, qual)
 
+class PrefixFilter(BatchFilter):
+    label = 'Prefix'
 
-class PrefixFilter(object):
     def __init__(self, parent, size, verbose=False, discard=None):
         self.parent = parent
         self.size = size
@@ -291,37 +484,27 @@ class PrefixFilter(object):
 
         self.discard = discard
 
-    def filter(self):
-        for name, comment, seq, qual in self.parent.filter():
-            if len(qual) > self.size:
-                if len(seq) == len(qual):  
-                    # basespace or colorspace w/o prefix
-                    seq = seq[self.size:]
-                    qual = qual[self.size:]
-                else:
-                    # colorspace with prefix
-                    # can not be trimmed this way
-                    sys.stderr.write('You can not trim the prefix away with colorspace data!')
-                    sys.exit(1)
+    def filter_batch(self, batch, active):
+        qual_len = batch.qual_end - batch.qual_start
+        seq_len = batch.seq_end - batch.seq_start
 
-                if self.verbose:
-                    if seq and qual:
-                        sys.stderr.write('[Prefix] %s (altered)\n' % (name,))
-                        self.altered += 1
-                        comment = '%s #trunc' % comment
-                    else:
-                        sys.stderr.write('[Prefix] %s (removed)\n' % (name,))
-                        self.removed += 1
-                        if self.discard:
-                            self.discard(name)
-                        continue
-            else:
-                self.kept += 1
+        altered = active & (qual_len > self.size)
+
+        if (altered & (seq_len != qual_len)).any():
+            # colorspace with prefix
+            # can not be trimmed this way
+            sys.stderr.write('You can not trim the prefix away with colorspace data!')
+            sys.exit(1)
+
+        batch.seq_start = numpy.where(altered, batch.seq_start + self.size, batch.seq_start)
+        batch.qual_start = numpy.where(altered, batch.qual_start + self.size, batch.qual_start)
+
+        self._tally(batch, active, altered=altered, tag='#trunc')
 
-            yield (name, comment, seq, qual)
 
+class WildcardFilter(BatchFilter):
+    label = 'Wild'
 
-class WildcardFilter(object):
     def __init__(self, parent, max_num, verbose=False, discard=None):
         self.parent = parent
         self.max_num = max_num
@@ -333,28 +516,15 @@ class WildcardFilter(object):
 
         self.discard = discard
 
-    def filter(self):
-        for name, comment, seq, qual in self.parent.filter():
-            count = 0
-            for base in seq:
-                if base in '4.N':
-                    count += 1
-
-            if count <= self.max_num:
-                self.kept += 1
-                if self.verbose:
-                    sys.stderr.write('[Wild] %s (kept)\n' % (name,))
+    def filter_batch(self, batch, active):
+        buf, offsets = batch.seq_buffer
+        counts = _window_counts(buf, offsets, batch.seq_start, batch.seq_end, _wildcard_table)
+        self._tally(batch, active, removed=counts > self.max_num)
 
-                yield (name, comment, seq, qual)
-            else:
-                if self.verbose:
-                    sys.stderr.write('[Wild] %s (removed)\n' % (name,))
-                self.removed += 1
-                if self.discard:
-                    self.discard(name)
 
+class SizeFilter(BatchFilter):
+    label = 'Size'
 
-class SizeFilter(object):
     def __init__(self, parent, min_size, verbose=False, discard=None):
         self.parent = parent
         self.min_size = min_size
@@ -366,22 +536,14 @@ class SizeFilter(object):
 
         self.discard = discard
 
-    def filter(self):
-        for name, comment, seq, qual in self.parent.filter():
-            if len(qual) >= self.min_size:
-                self.kept += 1
-                if self.verbose:
-                    sys.stderr.write('[Size] %s (kept)\n' % (name,))
-                yield (name, comment, seq, qual)
-            else:
-                if self.verbose:
-                    sys.stderr.write('[Size] %s (removed) seq:%s size:%s\n' % (name, seq, len(qual)))
-                self.removed += 1
-                if self.discard:
-                    self.discard(name)
+    def filter_batch(self, batch, active):
+        qual_len = batch.qual_end - batch.qual_start
+        self._tally(batch, active, removed=qual_len < self.min_size)
+
 
+class WhitelistFilter(BatchFilter):
+    label = 'Whitelist'
 
-class WhitelistFilter(object):
     def __init__(self, parent, fname, verbose=False, discard=None):
         self.parent = parent
         self.fname = fname
@@ -393,28 +555,12 @@ class WhitelistFilter(object):
         self.verbose = verbose
         self.discard = discard
 
-        self.whitelist = set()
-        with open(fname) as f:
-            for line in f:
-                name = line.strip()
-                if name[0] == '@':
-                    name = name[1:]
-                self.whitelist.add(name)
+        self.whitelist = read_nameset(fname)
         sys.stderr.write('%s reads in whitelist\n' % len(self.whitelist))
 
-    def filter(self):
-        for name, comment, seq, qual in self.parent.filter():
-            if name in self.whitelist:
-                self.kept += 1
-                if self.verbose:
-                    sys.stderr.write('[Whitelist] %s (kept)\n' % (name,))
-                yield (name, comment, seq, qual)
-            else:
-                if self.verbose:
-                    sys.stderr.write('[Whitelist] %s (removed)\n' % (name,))
-                self.removed += 1
-                if self.discard:
-                    self.discard(name)
+    def filter_batch(self, batch, active):
+        self._tally(batch, active, removed=~self.whitelist.contains_all(batch.names))
+
 
 def usage():
     print __doc__
@@ -451,6 +597,8 @@ Filters:
                               (Requires an interleaved FASTQ file)
 
   -whitelist keeplist.txt     Only keep reads whose name is in the keeplist
+                              (or a name set saved with:
+                              python -m ngsutils.support.nameset)
 
 """
     sys.exit(1)
@@ -13,8 +13,10 @@ Based on: http://www.cassj.co.uk/blog/?p=490
 
 import sys
 import os
+import itertools
 import collections
 from ngsutils.support import gzip_reader
+from ngsutils.support.bgzip import BGZFWriter
 from ngsutils.fastq import convert_solexa_qual, convert_illumina_qual
 
 QseqConversionResults = collections.namedtuple('QseqConversionResults', 'reads qcfailed lenfailed passed lengths')
@@ -94,6 +96,124 @@ def read_illumina_export(qseqreader, solexa_quals=False, min_length=0, trim=Fals
     return QseqConversionResults(reads, qcfailed, lenfailed, passed, lengths)
 
 
+def _qual_table(convert):
+    '''
+    Builds a str.translate() table for a quality conversion function. Chars
+    that are outside of the printable range are left as-is.
+    '''
+    table = []
+    for i in xrange(256):
+        if 33 <= i <= 126:
+            try:
+                table.append(convert(chr(i)))
+                continue
+            except ValueError:
+                pass
+        table.append(chr(i))
+    return ''.join(table)
+
+_illumina_table = _qual_table(convert_illumina_qual)
+_solexa_table = _qual_table(convert_solexa_qual)
+
+
+def qseq_batches(fname=None, fileobj=None, quiet=False, batch_size=10000):
+    '''
+    Reads a qseq/export file in batches of lines. Each batch is returned as a
+    list of columns (the first 11, as in QseqRecord).
+
+    When every line in a batch has the same number of columns (the normal
+    case), the whole batch is split at once and the columns are sliced out
+    of the field list. Otherwise (or if there are blank lines), the lines
+    are split one at a time.
+    '''
+    if fileobj:
+        lines = iter(fileobj)
+    elif fname:
+        lines = gzip_reader(fname, quiet=quiet)
+    else:
+        raise ValueError('Must pass fname or fileobj!')
+
+    while True:
+        chunk = list(itertools.islice(lines, batch_size))
+        if not chunk:
+            break
+
+        block = ''.join(chunk)
+        if '\r' in block:
+            block = block.replace('\r', '')
+
+        # each line needs the same number of tabs (blank lines have none)
+        ntabs = set([line.count('\t') for line in chunk])
+        ncols = ntabs.pop() + 1
+
+        if not ntabs and ncols >= 11:
+            fields = block.rstrip('\n').replace('\n', '\t').split('\t')
+            yield [fields[i::ncols] for i in xrange(11)]
+        else:
+            rows = [line.strip().split('\t')[:11] for line in chunk if line.strip()]
+            if rows:
+                yield [list(x) for x in zip(*rows)]
+
+
+def convert_qseq_batches(batches, solexa_quals=False, min_length=0, trim=False, tag=None, qc_remove=True, out=sys.stdout):
+    '''
+    Batched version of read_illumina_export. Names, B-trimming, and quality
+    conversion (with a translate table) are applied to whole batches.
+    '''
+    lengths = {}
+    reads = 0
+    passed = 0
+    lenfailed = 0
+    qcfailed = 0
+
+    table = _solexa_table if solexa_quals else _illumina_table
+
+    for machine, run, lane, tile, x, y, index, read_num, seqs, quals, qcflags in batches:
+        reads += len(seqs)
+
+        qcpass = [qc != '0' and qc != 'QC' for qc in qcflags]
+        idx = range(len(seqs))
+        if qc_remove:
+            idx = [i for i in idx if qcpass[i]]
+            qcfailed += len(seqs) - len(idx)
+
+        if trim:
+            # Trim trailing 'B's
+            trimmed = []
+            for i in idx:
+                il_qual = quals[i].rstrip('B')
+                seq = seqs[i][:max(0, len(seqs[i]) - len(quals[i]) + len(il_qual))]
+
+                if not il_qual or len(seq) < min_length:
+                    lenfailed += 1
+                    continue
+
+                seqs[i] = seq
+                quals[i] = il_qual
+                trimmed.append(i)
+            idx = trimmed
+
+        if not idx:
+            continue
+
+        conv_quals = '\n'.join([quals[i] for i in idx]).translate(table).split('\n')
+
+        buf = []
+        for i, qual in itertools.izip(idx, conv_quals):
+            buf.append('@%s%s:%s:%s:%s:%s:%s #%s/%s%s\n%s\n+\n%s\n' % (tag if tag else '', machine[i], run[i], lane[i], tile[i], x[i], y[i], index[i], read_num[i], '' if qcpass[i] else ' QCFAIL', seqs[i], qual))
+
+            seqlen = len(seqs[i])
+            if not seqlen in lengths:
+                lengths[seqlen] = 1
+            else:
+                lengths[seqlen] += 1
+
+        out.write(''.join(buf))
+        passed += len(idx)
+
+    return QseqConversionResults(reads, qcfailed, lenfailed, passed, lengths)
+
+
 def usage():
     print __doc__
     print """\
@@ -105,6 +225,11 @@ Options:
   -trim       perform quality control indicator (trailing B) trimming
   -min N      the minimum allowed length for a read, post B-trimming
   -noqc       Don't remove reads that failed QC (for matching paired end data)
+
+  -o fname    Write the FASTQ output to this file (default: stdout). If the
+              name ends in .gz, the output is bgzip compressed.
+  -threads N  Use N processes to compress the output (only used with
+              -o *.gz, otherwise ignored)
 """
     sys.exit(1)
 
@@ -116,6 +241,8 @@ if __name__ == '__main__':
     last = None
     tag = None
     qc_remove = True
+    out_fname = None
+    threads = 1
 
     for arg in sys.argv[1:]:
         if arg in ['-h', '--help']:
@@ -130,9 +257,15 @@ if __name__ == '__main__':
         elif last == '-tag':
             tag = arg
             last = None
+        elif last == '-o':
+            out_fname = arg
+            last = None
+        elif last == '-threads':
+            threads = int(arg)
+            last = None
         elif arg == '-h':
             usage()
-        elif arg == '-tag':
+        elif arg in ['-tag', '-o', '-threads']:
             last = arg
         elif arg == '-trim':
             trim = True
@@ -149,7 +282,22 @@ if __name__ == '__main__':
         usage()
 
     sys.stderr.write("Converting file: %s\n(using %s scaling)\n%s" % (fname, 'Solexa' if solexa_quals else 'Illumina', '(min-length %d)\n' % min_length if min_length else ''))
-    results = read_illumina_export(qseq_reader(fname), solexa_quals, min_length, trim, tag, qc_remove)
+
+    if out_fname and (out_fname[-3:] == '.gz' or out_fname[-4:] == '.bgz'):
+        out = BGZFWriter(out_fname, threads=threads)
+    else:
+        if threads > 1:
+            sys.stderr.write('Warning: -threads is only used for compressed output (-o *.gz)\n')
+
+        if out_fname:
+            out = open(out_fname, 'w')
+        else:
+            out = sys.stdout
+
+    results = convert_qseq_batches(qseq_batches(fname), solexa_quals, min_length, trim, tag, qc_remove, out=out)
+
+    if out != sys.stdout:
+        out.close()
 
     sys.stderr.write('Reads processed     : %s\n' % results.reads)
     sys.stderr.write('Failed QC filter    : %s\n' % results.qcfailed)
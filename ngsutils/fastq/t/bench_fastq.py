@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+'''
+Throughput benchmarks for fastqutils commands
+
+Generates deterministic synthetic FASTQ files and runs filter, stats, sort,
+split, properpairs, barcode_split, trim and tobam against them. The reads/sec,
+wall time and peak RSS for each command are written to a JSON report that can
+be compared to a report from another commit with:
+
+    python -m ngsutils.support.bench old.json new.json
+
+barcode_split and trim use a Smith-Waterman alignment for each read, so they
+are run with fewer reads (-slow-reads).
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+import pysam
+
+from ngsutils.fastq import FASTQ
+from ngsutils.support.bench import BenchmarkSuite, write_report, read_report, compare_reports
+from ngsutils.support.synthetic import SyntheticReads
+
+import ngsutils.fastq.filter
+import ngsutils.fastq.stats
+import ngsutils.fastq.sort
+import ngsutils.fastq.split
+import ngsutils.fastq.properpairs
+import ngsutils.fastq.barcode_split
+import ngsutils.fastq.trim
+import ngsutils.fastq.tobam
+
+_adapter = 'CTGTAGGCACCATCAATCGTATGCCGTCTTCTGCTTG'
+_barcodes = {'bc1': 'ACGTAC', 'bc2': 'CATGCA', 'bc3': 'GTACGT', 'bc4': 'TGCATG'}
+
+
+class FASTQDatasets(object):
+    'Writes the synthetic FASTQ files needed for the benchmarks'
+    def __init__(self, tmpdir, num_reads, read_length, quality_profile, adapter_rate, slow_reads, seed=1):
+        self.tmpdir = tmpdir
+        self.num_reads = num_reads
+        self.slow_reads = slow_reads
+
+        def _gen(fname, reads, read=None):
+            fname = os.path.join(tmpdir, fname)
+            with open(fname, 'w') as out:
+                count = reads.write(out, read)
+            return fname, count
+
+        single = SyntheticReads(num_reads, read_length, seed, quality_profile, adapter=_adapter, adapter_rate=adapter_rate)
+        self.single, self.single_count = _gen('single.fastq', single)
+
+        paired = SyntheticReads(num_reads // 2, read_length, seed, quality_profile, paired=True, adapter=_adapter, adapter_rate=adapter_rate, orphan_rate=0.05)
+        self.interleaved, self.interleaved_count = _gen('interleaved.fastq', paired)
+        self.read1, self.read1_count = _gen('read1.fastq', paired, 1)
+        self.read2, self.read2_count = _gen('read2.fastq', paired, 2)
+
+        slow = SyntheticReads(slow_reads, read_length, seed, quality_profile, adapter=_adapter, adapter_rate=adapter_rate, barcodes=sorted(_barcodes.values()))
+        self.barcoded, self.barcoded_count = _gen('barcoded.fastq', slow)
+
+
+def bench_filter(data):
+    fq = FASTQ(data.single)
+    chain = ngsutils.fastq.filter.FASTQReader(fq)
+    chain = ngsutils.fastq.filter.SuffixQualFilter(chain, '#')
+    chain = ngsutils.fastq.filter.QualFilter(chain, 10, 4)
+    chain = ngsutils.fastq.filter.WildcardFilter(chain, 2)
+    chain = ngsutils.fastq.filter.SizeFilter(chain, 25)
+    with open(os.devnull, 'w') as out:
+        ngsutils.fastq.filter.fastq_filter(chain, out=out, quiet=True)
+    fq.close()
+    return data.single_count
+
+
+def bench_stats(data):
+    fq = FASTQ(data.single)
+    ngsutils.fastq.stats.fastq_stats(fq, quiet=True)
+    fq.close()
+    return data.single_count
+
+
+def bench_sort(data):
+    fq = FASTQ(data.single)
+    with open(os.devnull, 'w') as out:
+        ngsutils.fastq.sort.fastq_sort(fq, tmpdir=data.tmpdir, out=out, quiet=True)
+    fq.close()
+    return data.single_count
+
+
+def bench_split(data):
+    ngsutils.fastq.split.fastq_split(data.interleaved, os.path.join(data.tmpdir, 'split'), 4, quiet=True)
+    return data.interleaved_count
+
+
+def bench_properpairs(data):
+    fq1 = FASTQ(data.read1)
+    fq2 = FASTQ(data.read2)
+    with open(os.devnull, 'w') as out1:
+        with open(os.devnull, 'w') as out2:
+            ngsutils.fastq.properpairs.find_fastq_pairs(fq1, fq2, out1, out2, tmpdir=data.tmpdir, quiet=True)
+    fq1.close()
+    fq2.close()
+    return data.read1_count + data.read2_count
+
+
+def bench_barcode_split(data):
+    barcodes = {}
+    for tag in _barcodes:
+        barcodes[tag] = (_barcodes[tag], '5', True)
+
+    ngsutils.fastq.barcode_split.fastx_barcode_split(FASTQ(data.barcoded), os.path.join(data.tmpdir, 'bc_%s.fastq'), barcodes, edits=1)
+    return data.barcoded_count
+
+
+def bench_trim(data):
+    fq = FASTQ(data.barcoded)
+    with open(os.devnull, 'w') as out:
+        ngsutils.fastq.trim.fastq_trim(fq, linker_3=_adapter, out=out, quiet=True)
+    fq.close()
+    return data.barcoded_count
+
+
+def bench_tobam(data):
+    fq = FASTQ(data.single)
+    bam = pysam.Samfile(os.path.join(data.tmpdir, 'out.bam'), 'wb', header={'HD': {'VN': '1.0'}})
+    ngsutils.fastq.tobam.export_bam(bam, fq, None, quiet=True)
+    bam.close()
+    fq.close()
+    return data.single_count
+
+
+def fastq_benchmarks(data, params=None):
+    suite = BenchmarkSuite('fastqutils', params)
+    suite.add('filter', bench_filter, data)
+    suite.add('stats', bench_stats, data)
+    suite.add('sort', bench_sort, data)
+    suite.add('split', bench_split, data)
+    suite.add('properpairs', bench_properpairs, data)
+    suite.add('barcode_split', bench_barcode_split, data)
+    suite.add('trim', bench_trim, data)
+    suite.add('tobam', bench_tobam, data)
+    return suite
+
+
+def usage():
+    print __doc__
+    print """Usage: bench_fastq.py {opts}
+
+Options:
+  -o fname          Write the JSON report to this file (default: stdout)
+  -compare fname    Compare the results to a previous report
+
+  -reads num        Number of reads (default: 100000)
+  -slow-reads num   Number of reads for barcode_split and trim (default: 2000)
+  -len num          Read length (default: 100)
+  -qual profile     Quality profile: flat, illumina, degraded
+                    (default: illumina)
+  -adapter pct      Fraction of reads with adapter sequence (default: 0.1)
+  -seed num         Random seed (default: 1)
+
+  -only name,name   Only run these benchmarks
+  -t dir            Temporary directory
+"""
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    report_fname = None
+    compare_fname = None
+    num_reads = 100000
+    slow_reads = 2000
+    read_length = 100
+    quality_profile = 'illumina'
+    adapter_rate = 0.1
+    seed = 1
+    only = None
+    tmpdir = None
+
+    last = None
+    for arg in sys.argv[1:]:
+        if last == '-o':
+            report_fname = arg
+            last = None
+        elif last == '-compare':
+            compare_fname = arg
+            last = None
+        elif last == '-reads':
+            num_reads = int(arg)
+            last = None
+        elif last == '-slow-reads':
+            slow_reads = int(arg)
+            last = None
+        elif last == '-len':
+            read_length = int(arg)
+            last = None
+        elif last == '-qual':
+            quality_profile = arg
+            last = None
+        elif last == '-adapter':
+            adapter_rate = float(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif last == '-only':
+            only = arg.split(',')
+            last = None
+        elif last == '-t':
+            tmpdir = arg
+            last = None
+        elif arg in ['-o', '-compare', '-reads', '-slow-reads', '-len', '-qual', '-adapter', '-seed', '-only', '-t']:
+            last = arg
+        else:
+            usage()
+
+    params = {'reads': num_reads, 'slow_reads': slow_reads, 'read_length': read_length, 'quality_profile': quality_profile, 'adapter_rate': adapter_rate, 'seed': seed}
+
+    workdir = tempfile.mkdtemp(prefix='.tmp_bench', dir=tmpdir)
+    try:
+        sys.stderr.write('Generating synthetic reads...\n')
+        data = FASTQDatasets(workdir, num_reads, read_length, quality_profile, adapter_rate, slow_reads, seed)
+        report = fastq_benchmarks(data, params).run(only)
+    finally:
+        shutil.rmtree(workdir)
+
+    write_report(report, report_fname)
+
+    if compare_fname:
+        compare_reports(read_report(compare_fname), report, out=sys.stderr)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''
+Tests for fastqutils csconvert
+'''
+
+import unittest
+import StringIO
+
+from ngsutils.fastq import FASTQ
+import ngsutils.fastq.csconvert
+
+
+class CSConvertTest(unittest.TestCase):
+    def testToColorspace(self):
+        fq = StringIO.StringIO('''\
+@foo comment
+ACGTNA
++
+ABCDEF
+@bar
+GGAA
++
+AAAA
+''')
+        out = StringIO.StringIO('')
+        ngsutils.fastq.csconvert.fastq_csconvert(FASTQ(fileobj=fq), out=out, quiet=True, batch_size=1)
+
+        self.assertEqual('''@foo comment
+T3131..
++
+ABCDEF
+@bar
+T1020
++
+AAAA
+''', out.getvalue())
+
+    def testToBasespace(self):
+        fq = StringIO.StringIO('''\
+@foo
+T3131..
++
+ABCDEF
+@bar
+T1020
++
+AAAA
+''')
+        out = StringIO.StringIO('')
+        ngsutils.fastq.csconvert.fastq_csconvert(FASTQ(fileobj=fq), out=out, quiet=True)
+
+        self.assertEqual('''@foo
+ACGTNN
++
+ABCDEF
+@bar
+GGAA
++
+AAAA
+''', out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
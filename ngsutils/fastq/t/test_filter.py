@@ -3,6 +3,7 @@
 Tests for fastqutils filter
 '''
 
+import os
 import unittest
 import StringIO
 
@@ -239,6 +240,205 @@ ACGTACGT
 ;;;;;;;;
 ''')
 
+    def testFilterTruncate(self):
+        fq = StringIO.StringIO('''\
+@foo
+ACGTACGTACGTATTT
++
+;;;;;;;;;;;;;;;;
+@bar
+ACGTAC
++
+;;;;;;
+@baz
+T0123012301
++
+;;;;;;;;;;
+''')
+
+        out = StringIO.StringIO('')
+        chain = ngsutils.fastq.filter.FASTQReader(FASTQ(fileobj=fq), verbose=False)
+        chain = ngsutils.fastq.filter.TruncateFilter(chain, 8, verbose=False)
+        ngsutils.fastq.filter.fastq_filter(chain, out=out, quiet=True)
+
+        self.assertEqual(out.getvalue(), '''\
+@foo #trunc
+ACGTACGT
++
+;;;;;;;;
+@bar
+ACGTAC
++
+;;;;;;
+@baz #trunc
+T01230123
++
+;;;;;;;;
+''')
+        self.assertEqual((chain.kept, chain.altered, chain.removed), (1, 2, 0))
+
+    def testFilterPrefix(self):
+        fq = StringIO.StringIO('''\
+@foo
+ACGTACGTACGTATTT
++
+;;;;;;;;;;;;;;;!
+@bar
+ACG
++
+;;;
+''')
+
+        out = StringIO.StringIO('')
+        chain = ngsutils.fastq.filter.FASTQReader(FASTQ(fileobj=fq), verbose=False)
+        chain = ngsutils.fastq.filter.PrefixFilter(chain, 4, verbose=False)
+        ngsutils.fastq.filter.fastq_filter(chain, out=out, quiet=True)
+
+        self.assertEqual(out.getvalue(), '''\
+@foo #trunc
+ACGTACGTATTT
++
+;;;;;;;;;;;!
+@bar
+ACG
++
+;;;
+''')
+
+    def testFilterChain(self):
+        '''Batch filters mixed with per-read filters, across batch boundaries'''
+        fq = StringIO.StringIO('''\
+@foo
+ACGTACGTACATTTGG
++
+;;;;;;;;;;;;;;!!
+@bar
+ACNNACGTACGTA
++
+;;;;;;;;;;;;;
+@baz
+ACGTACATTT
++
+;;;;;;;;;;
+@quux
+ACGTACGTAAGGCC
++
+;;;;;;;;;;;;;;
+''')
+
+        discarded = []
+
+        def _discard(name):
+            discarded.append(name)
+
+        out = StringIO.StringIO('')
+        chain = ngsutils.fastq.filter.FASTQReader(FASTQ(fileobj=fq), verbose=False)
+        chain.batch_size = 3
+        chain = ngsutils.fastq.filter.SuffixQualFilter(chain, '!', verbose=False)
+        chain = ngsutils.fastq.filter.WildcardFilter(chain, 1, verbose=False, discard=_discard)
+        chain = ngsutils.fastq.filter.TrimFilter(chain, 'ATTT', 1.0, 3, verbose=False)
+        chain = ngsutils.fastq.filter.SizeFilter(chain, 8, verbose=False, discard=_discard)
+        chain = ngsutils.fastq.filter.TruncateFilter(chain, 10, verbose=False)
+        ngsutils.fastq.filter.fastq_filter(chain, out=out, quiet=True)
+
+        self.assertEqual(out.getvalue(), '''\
+@foo #suff #trim
+ACGTACGTAC
++
+;;;;;;;;;;
+@quux #trunc
+ACGTACGTAA
++
+;;;;;;;;;;
+''')
+        self.assertEqual(discarded, ['bar', 'baz'])
+
+    def testFilterWhitelist(self):
+        fq = StringIO.StringIO('''\
+@foo
+ACGTACGT
++
+;;;;;;;;
+@bar
+ACGTACGT
++
+;;;;;;;;
+@baz
+ACGTACGT
++
+;;;;;;;;
+''')
+        tmp_fname = os.path.join(os.path.dirname(__file__), 'tmp_whitelist')
+        with open(tmp_fname, 'w') as f:
+            f.write('@foo\nbaz\n')
+
+        out = StringIO.StringIO('')
+        chain = ngsutils.fastq.filter.FASTQReader(FASTQ(fileobj=fq), verbose=False)
+        chain = ngsutils.fastq.filter.WhitelistFilter(chain, tmp_fname, verbose=False)
+        ngsutils.fastq.filter.fastq_filter(chain, out=out, quiet=True)
+
+        os.unlink(tmp_fname)
+
+        self.assertEqual(out.getvalue(), '''\
+@foo
+ACGTACGT
++
+;;;;;;;;
+@baz
+ACGTACGT
++
+;;;;;;;;
+''')
+        self.assertEqual((chain.kept, chain.altered, chain.removed), (2, 0, 1))
+
+    def testFilterRead(self):
+        'BatchFilter calls filter_read for each read if filter_batch is not replaced'
+        class NameFilter(ngsutils.fastq.filter.BatchFilter):
+            label = 'Name'
+
+            def __init__(self, parent):
+                self.parent = parent
+                self.verbose = False
+                self.discard = None
+                self.altered = 0
+                self.removed = 0
+                self.kept = 0
+
+            def filter_read(self, name, comment, seq, qual):
+                return name != 'bar' and len(seq) == 4
+
+        fq = StringIO.StringIO('''\
+@foo
+ACGTACGT
++
+;;;;;;;;
+@bar
+ACGTACGT
++
+;;;;;;;;
+@baz
+ACGTACGT
++
+;;;;;;;;
+''')
+        out = StringIO.StringIO('')
+        chain = ngsutils.fastq.filter.FASTQReader(FASTQ(fileobj=fq), verbose=False)
+        chain = ngsutils.fastq.filter.TruncateFilter(chain, 4, verbose=False)
+        chain = NameFilter(chain)
+        ngsutils.fastq.filter.fastq_filter(chain, out=out, quiet=True)
+
+        self.assertEqual(out.getvalue(), '''\
+@foo #trunc
+ACGT
++
+;;;;
+@baz #trunc
+ACGT
++
+;;;;
+''')
+        self.assertEqual((chain.kept, chain.altered, chain.removed), (2, 0, 1))
+
     def testFilterTrim(self):
         fq = StringIO.StringIO('''\
 @foo
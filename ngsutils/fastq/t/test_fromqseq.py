@@ -106,5 +106,80 @@ $$$$IIII
 ''')
 
 
+    def testQseqBatch(self):
+        qseq = '''\
+foo|1|2|3|4|5|0|1|ACGTACGT|hhhhhhhh|1
+foo|1|2|3|4|6|0|1|ACGTACGT|hhhhhhBB|0
+foo|1|2|3|4|7|0|1|ACGTACGT|BBBBBBBB|1
+foo|1|2|3|4|8|0|2|ACGTACGT|@@hhhhhB|1
+foo|1|2|3|4|9|0|2|ACGTACGT|hhhhhhhh|QC
+'''.replace('|', '\t')
+
+        for opts in [{}, {'trim': True}, {'trim': True, 'min_length': 7}, {'solexa_quals': True}, {'qc_remove': False, 'tag': 'bar_'}, {'qc_remove': False, 'trim': True}]:
+            out = StringIO.StringIO('')
+            expected = ngsutils.fastq.fromqseq.read_illumina_export(ngsutils.fastq.fromqseq.qseq_reader(fileobj=StringIO.StringIO(qseq)), out=out, **opts)
+
+            batch_out = StringIO.StringIO('')
+            batches = ngsutils.fastq.fromqseq.qseq_batches(fileobj=StringIO.StringIO(qseq), batch_size=2)
+            results = ngsutils.fastq.fromqseq.convert_qseq_batches(batches, out=batch_out, **opts)
+
+            self.assertEqual(batch_out.getvalue(), out.getvalue())
+            self.assertEqual(results, expected)
+
+    def testQseqBatchColumns(self):
+        'Export files have extra columns, and might not all have the same number'
+        qseq = StringIO.StringIO('''\
+foo|1|2|3|4|5|0|1|ACGTACGT|hhhhhhhh|1|chr1|100
+foo|1|2|3|4|6|0|1|ACGTACGT|hhhhhhhh|1
+foo|1|2|3|4|7|0|1|ACGTACGT|hhhhhhhh|0|chr1|200
+'''.replace('|', '\t').replace('\n', '\r\n'))
+        out = StringIO.StringIO('')
+        results = ngsutils.fastq.fromqseq.convert_qseq_batches(ngsutils.fastq.fromqseq.qseq_batches(fileobj=qseq), out=out)
+        self.assertEqual(results.passed, 2)
+        self.assertEqual(out.getvalue(), '''\
+@foo:1:2:3:4:5 #0/1
+ACGTACGT
++
+IIIIIIII
+@foo:1:2:3:4:6 #0/1
+ACGTACGT
++
+IIIIIIII
+''')
+
+    def testQseqBatchRowColumns(self):
+        'The total number of columns matches, but not for each row'
+        qseq = StringIO.StringIO('''\
+foo|1|2|3|4|5|0|1|ACGTACGT|hhhhhhhh|1|chr1|100
+foo|1|2|3|4|6|0|1|ACGTACGT|hhhhhhhh|1|chr1
+foo|1|2|3|4|7|0|1|ACGTACGT|hhhhhhhh|1|chr1|200|x
+'''.replace('|', '\t'))
+        batches = list(ngsutils.fastq.fromqseq.qseq_batches(fileobj=qseq))
+        self.assertEqual(1, len(batches))
+        self.assertEqual(['5', '6', '7'], batches[0][5])
+        self.assertEqual(['1', '1', '1'], batches[0][10])
+
+        # blank lines are skipped
+        qseq = StringIO.StringIO('''\
+foo|1|2|3|4|5|0|1|ACGTACGT|hhhhhhhh|1
+
+foo|1|2|3|4|6|0|1|ACGTACGT|hhhhhhhh|1
+'''.replace('|', '\t'))
+        batches = list(ngsutils.fastq.fromqseq.qseq_batches(fileobj=qseq))
+        self.assertEqual(['5', '6'], batches[0][5])
+
+        # a batch with only blank lines (at the end of the file) is skipped
+        qseq = StringIO.StringIO('''\
+foo|1|2|3|4|5|0|1|ACGTACGT|hhhhhhhh|1
+foo|1|2|3|4|6|0|1|ACGTACGT|hhhhhhhh|1
+
+
+'''.replace('|', '\t'))
+        out = StringIO.StringIO('')
+        results = ngsutils.fastq.fromqseq.convert_qseq_batches(ngsutils.fastq.fromqseq.qseq_batches(fileobj=qseq, batch_size=2), out=out)
+        self.assertEqual(2, results.reads)
+        self.assertEqual(2, results.passed)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+'''
+Benchmark harness
+
+Each benchmark is run in a forked child process, so that the peak RSS that is
+reported is for that benchmark alone. For each benchmark, the wall time, the
+number of reads processed (reads/sec), and the peak RSS (KB) are recorded in a
+JSON report, along with the current git commit, so that reports from
+different commits can be compared.
+
+Usage: python -m ngsutils.support.bench old_report.json new_report.json
+
+Compares two benchmark reports.
+'''
+
+import os
+import sys
+import time
+import json
+import platform
+import datetime
+import subprocess
+import traceback
+
+from ngsutils.support.memory import peak_rss_kb
+
+
+def git_commit(path=None):
+    'Returns the current git commit (short hash) for the repository, if known'
+    if not path:
+        path = os.path.dirname(os.path.abspath(__file__))
+    try:
+        proc = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd=path, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        out = proc.communicate()[0].strip()
+        if proc.returncode == 0:
+            return out
+    except OSError:
+        pass
+    return None
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Runs func(*args, **kwargs) in a forked child process. func should return
+    the number of reads processed.
+
+    Returns a dict with: reads, wall_time, reads_per_sec, peak_rss_kb (or
+    error, if func raised an exception).
+    '''
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            start = time.time()
+            reads = func(*args, **kwargs)
+            elapsed = time.time() - start
+            result = {'reads': reads, 'wall_time': elapsed, 'reads_per_sec': reads / elapsed if elapsed > 0 else 0, 'peak_rss_kb': peak_rss_kb()}
+        except Exception:
+            result = {'error': traceback.format_exc()}
+
+        with os.fdopen(wfd, 'w') as f:
+            f.write(json.dumps(result))
+        os._exit(0)
+
+    os.close(wfd)
+    with os.fdopen(rfd) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+
+    if not data:
+        return {'error': 'benchmark process exited without a result'}
+    return json.loads(data)
+
+
+class BenchmarkSuite(object):
+    '''
+    A named set of benchmarks. Each benchmark is a function that returns the
+    number of reads it processed.
+    '''
+    def __init__(self, name, params=None):
+        self.name = name
+        self.params = params if params else {}
+        self.benchmarks = []
+
+    def add(self, name, func, *args, **kwargs):
+        self.benchmarks.append((name, func, args, kwargs))
+
+    def run(self, only=None, quiet=False):
+        'Runs the benchmarks (or only the named ones), returns the report'
+        results = {}
+        for name, func, args, kwargs in self.benchmarks:
+            if only and name not in only:
+                continue
+
+            if not quiet:
+                sys.stderr.write('Running %s... ' % name)
+                sys.stderr.flush()
+
+            results[name] = measure(func, *args, **kwargs)
+
+            if not quiet:
+                if 'error' in results[name]:
+                    sys.stderr.write('error\n%s\n' % results[name]['error'])
+                else:
+                    sys.stderr.write('%.1f reads/sec, %.2f sec, %s KB\n' % (results[name]['reads_per_sec'], results[name]['wall_time'], results[name]['peak_rss_kb']))
+
+        return {
+            'suite': self.name,
+            'commit': git_commit(),
+            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': self.params,
+            'results': results,
+        }
+
+
+def write_report(report, fname=None):
+    'Writes a report to fname (or stdout)'
+    if not fname:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+
+    with open(fname, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def read_report(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+
+def compare_reports(old, new, out=sys.stdout):
+    '''
+    Writes a table comparing the reads/sec and peak RSS for each benchmark in
+    two reports.
+    '''
+    if old.get('params') != new.get('params'):
+        out.write('Warning: the benchmark parameters are different!\n')
+
+    out.write('#benchmark\t%s reads/sec\t%s reads/sec\tchange\t%s RSS (KB)\t%s RSS (KB)\tchange\n' % (old.get('commit'), new.get('commit'), old.get('commit'), new.get('commit')))
+
+    def _pct(a, b):
+        if not a:
+            return ''
+        return '%+.1f%%' % ((float(b) - a) * 100 / a)
+
+    for name in sorted(set(old['results']) | set(new['results'])):
+        o = old['results'].get(name, {})
+        n = new['results'].get(name, {})
+        cols = [name]
+        for key in ['reads_per_sec', 'peak_rss_kb']:
+            if key in o and key in n:
+                cols.extend(['%.1f' % o[key], '%.1f' % n[key], _pct(o[key], n[key])])
+            else:
+                cols.extend(['%.1f' % o[key] if key in o else '', '%.1f' % n[key] if key in n else '', ''])
+        out.write('%s\n' % '\t'.join(cols))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print __doc__
+        sys.exit(1)
+
+    compare_reports(read_report(sys.argv[1]), read_report(sys.argv[2]))
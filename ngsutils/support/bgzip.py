@@ -4,11 +4,16 @@ Extract the blocks from a BGZip file.
 
 BAM files are stored as blocks in a bgzip archive. This class
 will load the bgzip archive and output the block information.
+
+BGZFWriter writes bgzip files, optionally compressing the blocks in
+parallel (with multiple processes).
 '''
 
 import sys
 import os
+import zlib
 import struct
+import multiprocessing
 
 
 class BGZip(object):
@@ -133,5 +138,137 @@ class BGZip(object):
         self.pos += size
         return struct.unpack(field_types, self.fileobj.read(size))
 
+# Maximum amount of uncompressed data in one block (same as samtools),
+# this ensures that the compressed block will fit in 64K
+BGZF_BLOCK_SIZE = 0xff00
+
+# Empty block that marks the end of a BGZF file
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+_bgzf_header = struct.Struct('<BBBBIBBHBBHH')
+_bgzf_footer = struct.Struct('<II')
+
+
+def bgzf_block(data, level=6):
+    'Compress up to BGZF_BLOCK_SIZE bytes into a single BGZF block'
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = comp.compress(data) + comp.flush()
+
+    # BSIZE is the total block size - 1 (header is 18 bytes, footer is 8)
+    header = _bgzf_header.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + _bgzf_footer.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def bgzf_compress(data, level=6):
+    'Compress data into as many BGZF blocks as needed'
+    return ''.join([bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level) for i in xrange(0, len(data), BGZF_BLOCK_SIZE)])
+
+
+def bgzf_blocks(fileobj):
+    '''
+    Reads the raw (compressed) BGZF blocks from a file. Yields tuples:
+    (block, uncompressed size)
+    '''
+    while True:
+        header = fileobj.read(_bgzf_header.size)
+        if not header:
+            break
+        if len(header) < _bgzf_header.size:
+            raise ValueError("Truncated BGZF block")
+
+        id1, id2, cm, flg, mtime, xfl, os_, xlen, si1, si2, slen, bsize = _bgzf_header.unpack(header)
+        if id1 != 31 or id2 != 139 or si1 != 66 or si2 != 67:
+            raise ValueError("Invalid BGZF block")
+
+        # BSIZE is the total block size - 1
+        rest = fileobj.read(bsize + 1 - _bgzf_header.size)
+        if len(rest) < bsize + 1 - _bgzf_header.size:
+            raise ValueError("Truncated BGZF block")
+
+        crc, isize = _bgzf_footer.unpack(rest[-_bgzf_footer.size:])
+        yield header + rest, isize
+
+
+def bgzf_decompress(block):
+    'Decompress a single (raw) BGZF block'
+    xlen = _bgzf_header.unpack(block[:_bgzf_header.size])[7]
+    return zlib.decompress(block[12 + xlen:-_bgzf_footer.size], -15)
+
+
+def _bgzf_compress_worker(args):
+    return bgzf_compress(*args)
+
+
+class BGZFWriter(object):
+    '''
+    Buffered writer for BGZF (bgzip) files. BGZF files are valid gzip files,
+    so they can be read with gzip/zcat or by tabix/samtools.
+
+    If threads > 1, chunks of data are compressed in parallel by a pool of
+    worker processes. The compressed chunks are always written in order.
+    '''
+    def __init__(self, fname=None, fileobj=None, threads=1, level=6, chunk_size=16 * BGZF_BLOCK_SIZE):
+        if fileobj:
+            self.fileobj = fileobj
+        elif fname:
+            self.fileobj = open(fname, 'wb')
+        else:
+            raise ValueError("Must pass either a fileobj or fname!")
+
+        self.level = level
+        self.chunk_size = chunk_size
+        self._buf = []
+        self._buflen = 0
+
+        if threads > 1:
+            self._pool = multiprocessing.Pool(threads)
+            self._max_pending = threads * 2
+        else:
+            self._pool = None
+            self._max_pending = 0
+
+        self._pending = []
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen >= self.chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        if not self._buf:
+            return
+
+        data = ''.join(self._buf)
+        self._buf = []
+        self._buflen = 0
+
+        if not self._pool:
+            self.fileobj.write(bgzf_compress(data, self.level))
+            return
+
+        self._pending.append(self._pool.apply_async(_bgzf_compress_worker, [(data, self.level)]))
+        while len(self._pending) > self._max_pending:
+            self.fileobj.write(self._pending.pop(0).get())
+
+    def flush(self):
+        self._flush_chunk()
+        while self._pending:
+            self.fileobj.write(self._pending.pop(0).get())
+        self.fileobj.flush()
+
+    def close(self):
+        self.flush()
+        self.fileobj.write(BGZF_EOF)
+
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+        if self.fileobj != sys.stdout:
+            self.fileobj.close()
+
+
 if __name__ == '__main__':
     print BGZip(sys.argv[1]).dump()
@@ -0,0 +1,376 @@
+'''
+Writes bigWig files (without the UCSC bedGraphToBigWig tool)
+
+Values are added as runs (start, end, value) for each chromosome, in order
+(see: ngsutils.bam.engine.coverage). The runs are written as they are added,
+in compressed bedGraph sections, so the input is only read once. The
+zoom levels (summaries of the values for larger and larger bins) are
+accumulated in memory while the runs are added, and are written with the
+indexes (R-trees) when the file is closed.
+
+The chromosome index is written after the data, so chromosomes don't need to
+be known in advance. If the chromosome sizes aren't given, the size of each
+chromosome is the end of its last run.
+
+ See: http://genome.ucsc.edu/goldenPath/help/bigWig.html
+      Kent et al, Bioinformatics (2010), doi:10.1093/bioinformatics/btq351
+'''
+
+import struct
+import zlib
+
+import numpy
+
+_BIGWIG_MAGIC = 0x888FFC26
+_BPT_MAGIC = 0x78CA8C91
+_CIR_MAGIC = 0x2468ACE0
+
+_max_zoom_levels = 10
+_zoom_increment = 4
+
+# the initial zoom level is set from the average length of this many runs
+_zoom_sample_size = 10000
+
+_header = struct.Struct('<IHHQQQHHQQIQ')
+_zoom_header = struct.Struct('<IIQQ')
+_summary = struct.Struct('<Qdddd')
+_section_header = struct.Struct('<IIIIIBBH')
+
+_bedgraph_item = numpy.dtype([('start', '<u4'), ('end', '<u4'), ('value', '<f4')])
+_zoom_item = numpy.dtype([('chrom', '<u4'), ('start', '<u4'), ('end', '<u4'), ('valid', '<u4'), ('min', '<f4'), ('max', '<f4'), ('sum', '<f4'), ('sumsq', '<f4')])
+
+_summary_offset = _header.size + _max_zoom_levels * _zoom_header.size
+_data_offset = _summary_offset + _summary.size
+
+
+class _ZoomLevel(object):
+    '''
+    Summaries of the values in bins of reduction bases. The last bin is kept
+    open until a run starts in a later bin.
+    '''
+    def __init__(self, reduction):
+        self.reduction = reduction
+        self.records = []  # arrays of (chrom, bin, valid, min, max, sum, sumsq)
+        self.count = 0
+        self._open = None
+
+    def add(self, chrom_id, starts, ends, values):
+        r = self.reduction
+        first = starts // r
+        nbins = (ends - 1) // r - first + 1
+
+        # split the runs at the bin edges
+        idx = numpy.repeat(numpy.arange(len(starts)), nbins)
+        bins = first[idx] + numpy.arange(len(idx)) - numpy.repeat(numpy.cumsum(nbins) - nbins, nbins)
+        sizes = numpy.minimum(ends[idx], (bins + 1) * r) - numpy.maximum(starts[idx], bins * r)
+        vals = values[idx]
+
+        edges = numpy.flatnonzero(numpy.r_[True, numpy.diff(bins) != 0])
+        cols = [numpy.repeat(chrom_id, len(edges)), bins[edges],
+                numpy.add.reduceat(sizes, edges),
+                numpy.minimum.reduceat(vals, edges),
+                numpy.maximum.reduceat(vals, edges),
+                numpy.add.reduceat(vals * sizes, edges),
+                numpy.add.reduceat(vals * vals * sizes, edges)]
+        cols = numpy.vstack([x.astype(numpy.float64) for x in cols])
+
+        if self._open is not None:
+            if self._open[0] == chrom_id and self._open[1] == cols[1, 0]:
+                cols[2, 0] += self._open[2]
+                cols[3, 0] = min(cols[3, 0], self._open[3])
+                cols[4, 0] = max(cols[4, 0], self._open[4])
+                cols[5:, 0] += self._open[5:]
+            else:
+                self._add_records(self._open[:, None])
+
+        self._open = cols[:, -1].copy()
+        self._add_records(cols[:, :-1])
+
+    def _add_records(self, cols):
+        if cols.shape[1]:
+            self.records.append(cols)
+            self.count += cols.shape[1]
+
+    def finish(self, sizes):
+        'Returns an array of the zoom records (_zoom_item)'
+        if self._open is not None:
+            self._add_records(self._open[:, None])
+            self._open = None
+
+        records = numpy.zeros(self.count, dtype=_zoom_item)
+        if self.count:
+            cols = numpy.hstack(self.records)
+            chroms = cols[0].astype(numpy.int64)
+            starts = cols[1].astype(numpy.int64) * self.reduction
+            records['chrom'] = chroms
+            records['start'] = starts
+            records['end'] = numpy.minimum(starts + self.reduction, numpy.array(sizes, dtype=numpy.int64)[chroms])
+            records['valid'] = cols[2]
+            records['min'] = cols[3]
+            records['max'] = cols[4]
+            records['sum'] = cols[5]
+            records['sumsq'] = cols[6]
+        self.records = []
+        return records
+
+
+class BigWigWriter(object):
+    '''
+    Writes a bigWig file from runs of values.
+
+    chrom_sizes         a dictionary of the chromosome sizes (optional)
+    items_per_slot      the number of items in each compressed block
+    block_size          the number of children for each node of the indexes
+    '''
+    def __init__(self, fname, chrom_sizes=None, items_per_slot=1024, block_size=256, compress=True):
+        self.fileobj = open(fname, 'wb')
+        self.chrom_sizes = chrom_sizes or {}
+        self.items_per_slot = items_per_slot
+        self.block_size = block_size
+        self.compress = compress
+
+        self.chroms = []  # in order of the chromosome ids
+        self._sizes = []
+        self._blocks = []  # (chrom id, start, end chrom id, end, offset, size)
+        self._max_block_size = 0
+
+        self._items = []  # the runs for the next section(s)
+        self._item_count = 0
+        self._run_count = 0
+
+        self._zooms = None
+        self._zoom_pending = []
+        self._zoom_pending_count = 0
+
+        self._bases = 0
+        self._min = None
+        self._max = None
+        self._sum = 0.0
+        self._sumsq = 0.0
+
+        # the header, zoom headers and summary are written when the file is
+        # closed. The data starts with the number of sections.
+        self.fileobj.write('\0' * _data_offset)
+        self.fileobj.write(struct.pack('<Q', 0))
+
+    def add(self, chrom, starts, ends, values):
+        '''
+        Adds runs of values (arrays) for a chromosome. Runs must be added in
+        order (and each chromosome must be added at once).
+        '''
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if not len(starts):
+            return
+
+        if not self.chroms or self.chroms[-1] != chrom:
+            if chrom in self.chroms:
+                raise ValueError('The runs for %s must be added together (in order)' % chrom)
+            self._write_sections(True)
+            self.chroms.append(chrom)
+            self._sizes.append(self.chrom_sizes.get(chrom, 0))
+
+        chrom_id = len(self.chroms) - 1
+        self._sizes[chrom_id] = max(self._sizes[chrom_id], int(ends[-1]))
+
+        lengths = ends - starts
+        self._bases += int(lengths.sum())
+        self._sum += float((values * lengths).sum())
+        self._sumsq += float((values * values * lengths).sum())
+        self._min = min(self._min, float(values.min())) if self._min is not None else float(values.min())
+        self._max = max(self._max, float(values.max())) if self._max is not None else float(values.max())
+
+        items = numpy.zeros(len(starts), dtype=_bedgraph_item)
+        items['start'] = starts
+        items['end'] = ends
+        items['value'] = values
+        self._items.append(items)
+        self._item_count += len(items)
+        self._run_count += len(items)
+        self._write_sections(False)
+
+        if self._zooms is None:
+            self._zoom_pending.append((chrom_id, starts, ends, values))
+            self._zoom_pending_count += len(starts)
+            if self._zoom_pending_count >= _zoom_sample_size:
+                self._start_zooms()
+        else:
+            for zoom in self._zooms:
+                zoom.add(chrom_id, starts, ends, values)
+
+    def _start_zooms(self):
+        'Sets the zoom levels from the average length of the runs (so far)'
+        lengths = sum([int((x[2] - x[1]).sum()) for x in self._zoom_pending])
+        reduction = max(10 * lengths // max(self._zoom_pending_count, 1), 10)
+
+        self._zooms = []
+        for i in xrange(_max_zoom_levels):
+            self._zooms.append(_ZoomLevel(reduction))
+            reduction *= _zoom_increment
+            if reduction > 2 ** 31:
+                break
+
+        for args in self._zoom_pending:
+            for zoom in self._zooms:
+                zoom.add(*args)
+        self._zoom_pending = []
+
+    def _write_block(self, data):
+        'Writes a (compressed) block, and returns its (offset, size)'
+        self._max_block_size = max(self._max_block_size, len(data))
+        if self.compress:
+            data = zlib.compress(data)
+        offset = self.fileobj.tell()
+        self.fileobj.write(data)
+        return offset, len(data)
+
+    def _write_sections(self, flush):
+        'Writes the pending runs in sections of items_per_slot'
+        if not self._items or (not flush and self._item_count < self.items_per_slot):
+            return
+
+        items = numpy.concatenate(self._items)
+        chrom_id = len(self.chroms) - 1
+
+        pos = 0
+        while len(items) - pos >= self.items_per_slot or (flush and pos < len(items)):
+            section = items[pos:pos + self.items_per_slot]
+            start = int(section['start'][0])
+            end = int(section['end'][-1])
+            header = _section_header.pack(chrom_id, start, end, 0, 0, 1, 0, len(section))
+            offset, size = self._write_block(header + section.tobytes())
+            self._blocks.append((chrom_id, start, chrom_id, end, offset, size))
+            pos += len(section)
+
+        self._items = [items[pos:]] if pos < len(items) else []
+        self._item_count = len(items) - pos
+
+    def close(self):
+        self._write_sections(True)
+        data_end = self.fileobj.tell()
+
+        if self._zooms is None:
+            self._start_zooms()
+
+        chrom_tree_offset = self.fileobj.tell()
+        _write_bpt(self.fileobj, sorted([(name, i, size) for i, (name, size) in enumerate(zip(self.chroms, self._sizes))]), self.block_size)
+
+        index_offset = self.fileobj.tell()
+        _write_cir_tree(self.fileobj, self._blocks, data_end, self.items_per_slot, self.block_size)
+
+        # only write the zoom levels that are (at least 2x) smaller than the
+        # level before
+        zoom_headers = []
+        last_count = self._run_count
+        for zoom in self._zooms:
+            records = zoom.finish(self._sizes)
+            if not len(records) or len(records) * 2 > last_count:
+                break
+            last_count = len(records)
+
+            data_offset = self.fileobj.tell()
+            self.fileobj.write(struct.pack('<I', len(records)))
+            blocks = []
+            for pos in xrange(0, len(records), self.items_per_slot):
+                block = records[pos:pos + self.items_per_slot]
+                offset, size = self._write_block(block.tobytes())
+                blocks.append((int(block['chrom'][0]), int(block['start'][0]), int(block['chrom'][-1]), int(block['end'][-1]), offset, size))
+
+            zoom_index_offset = self.fileobj.tell()
+            _write_cir_tree(self.fileobj, blocks, zoom_index_offset, self.items_per_slot, self.block_size)
+            zoom_headers.append(_zoom_header.pack(zoom.reduction, 0, data_offset, zoom_index_offset))
+
+        self.fileobj.write(struct.pack('<I', _BIGWIG_MAGIC))
+
+        self.fileobj.seek(0)
+        self.fileobj.write(_header.pack(_BIGWIG_MAGIC, 4, len(zoom_headers), chrom_tree_offset, _data_offset, index_offset, 0, 0, 0, _summary_offset, self._max_block_size if self.compress else 0, 0))
+        self.fileobj.write(''.join(zoom_headers))
+        self.fileobj.seek(_summary_offset)
+        self.fileobj.write(_summary.pack(self._bases, self._min or 0.0, self._max or 0.0, self._sum, self._sumsq))
+        self.fileobj.write(struct.pack('<Q', len(self._blocks)))
+        self.fileobj.close()
+
+
+def _tree_levels(count, block_size):
+    '''
+    The number of nodes at each level of a tree with count items (the leaf
+    level first). The root node is the last level.
+    '''
+    levels = []
+    while True:
+        nodes = max(1, (count + block_size - 1) // block_size)
+        levels.append(nodes)
+        if nodes == 1:
+            return levels
+        count = nodes
+
+
+def _write_bpt(f, chroms, block_size):
+    'Writes the chromosome B+ tree for the (name, id, size) tuples (sorted)'
+    key_size = max([len(name) for name, chrom_id, size in chroms] or [1])
+    block_size = max(1, min(block_size, len(chroms)))
+    f.write(struct.pack('<IIIIQQ', _BPT_MAGIC, block_size, key_size, 8, len(chroms), 0))
+
+    node_size = 4 + block_size * (key_size + 8)
+    levels = _tree_levels(len(chroms), block_size)
+
+    # the offset of the first node of each level (written from the root down)
+    offsets = {}
+    offset = f.tell()
+    for level in xrange(len(levels) - 1, -1, -1):
+        offsets[level] = offset
+        offset += levels[level] * node_size
+
+    for level in xrange(len(levels) - 1, -1, -1):
+        # the items at this level are every (block_size ** level)th chromosome
+        step = block_size ** level
+        items = range(0, len(chroms), step)
+        for node in xrange(levels[level]):
+            children = items[node * block_size:(node + 1) * block_size]
+            f.write(struct.pack('<BBH', 1 if level == 0 else 0, 0, len(children)))
+            for i, child in enumerate(children):
+                name, chrom_id, size = chroms[child]
+                if level == 0:
+                    f.write(struct.pack('<%dsII' % key_size, name, chrom_id, size))
+                else:
+                    f.write(struct.pack('<%dsQ' % key_size, name, offsets[level - 1] + (node * block_size + i) * node_size))
+            f.write('\0' * ((block_size - len(children)) * (key_size + 8)))
+
+
+def _write_cir_tree(f, blocks, data_end, items_per_slot, block_size):
+    '''
+    Writes the R-tree index for the (chrom id, start, end chrom id, end,
+    offset, size) blocks (sorted)
+    '''
+    if blocks:
+        bounds = blocks[0][:2] + blocks[-1][2:4]
+    else:
+        bounds = (0, 0, 0, 0)
+    f.write(struct.pack('<IIQIIIIQII', _CIR_MAGIC, block_size, len(blocks), bounds[0], bounds[1], bounds[2], bounds[3], data_end, items_per_slot, 0))
+
+    levels = _tree_levels(len(blocks), block_size)
+    leaf_size = 4 + block_size * 32
+    node_size = 4 + block_size * 24
+
+    offsets = {}
+    offset = f.tell()
+    for level in xrange(len(levels) - 1, -1, -1):
+        offsets[level] = offset
+        offset += levels[level] * (leaf_size if level == 0 else node_size)
+
+    for level in xrange(len(levels) - 1, -1, -1):
+        # each item at this level covers (block_size ** level) blocks
+        step = block_size ** level
+        items = range(0, len(blocks), step)
+        for node in xrange(levels[level]):
+            children = items[node * block_size:(node + 1) * block_size]
+            f.write(struct.pack('<BBH', 1 if level == 0 else 0, 0, len(children)))
+            for i, child in enumerate(children):
+                first = blocks[child]
+                last = blocks[min(child + step, len(blocks)) - 1]
+                if level == 0:
+                    f.write(struct.pack('<IIIIQQ', *first))
+                else:
+                    f.write(struct.pack('<IIIIQ', first[0], first[1], last[2], last[3], offsets[level - 1] + (node * block_size + i) * (leaf_size if level == 1 else node_size)))
+            f.write('\0' * ((block_size - len(children)) * (32 if level == 0 else 24)))
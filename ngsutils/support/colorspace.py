@@ -0,0 +1,135 @@
+'''
+Color-space (SOLiD 2-base encoding) conversions
+
+In color-space, each color represents the transition between two adjacent
+bases. With the 2-bit codes A=0, C=1, G=2, T=3, the color is the XOR of the
+codes for the two bases. A color-space read starts with a base-space primer
+base (usually 'T'), followed by one color for each base in the read. Any
+transition involving an N is an unknown color ('.'), and any base after an
+unknown color can't be decoded (N).
+
+The *_batch functions convert a whole list of sequences at once with NumPy.
+'''
+
+import numpy
+
+_base_codes = numpy.zeros(256, dtype=numpy.uint8) + 4
+for _i, _base in enumerate('ACGT'):
+    _base_codes[ord(_base)] = _i
+    _base_codes[ord(_base.lower())] = _i
+
+_color_codes = numpy.zeros(256, dtype=numpy.uint8) + 4
+for _i, _color in enumerate('0123'):
+    _color_codes[ord(_color)] = _i
+
+_base_chars = numpy.frombuffer('ACGTN', dtype=numpy.uint8)
+_color_chars = numpy.frombuffer('0123.', dtype=numpy.uint8)
+
+# "double encoding" of colors as bases, for tools that can't read colors
+_double_encode_table = ''.join(['ACGT'['0123'.index(chr(i))] if chr(i) in '0123' else 'N' for i in xrange(256)])
+_double_encode_batch_table = _double_encode_table[:10] + '\n' + _double_encode_table[11:]
+
+
+def _concat(seqs):
+    lengths = numpy.array([len(x) for x in seqs], dtype=numpy.int64)
+    starts = numpy.zeros(len(seqs), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=starts[1:])
+    return numpy.frombuffer(''.join(seqs), dtype=numpy.uint8), starts, lengths
+
+
+def _split(buf, starts, lengths, trim=0):
+    data = buf.tobytes()
+    return [data[s + trim:s + l] for s, l in zip(starts.tolist(), lengths.tolist())]
+
+
+def encode_batch(seqs, primer='T'):
+    '''
+    Converts base-space sequences to color-space (with a primer base)
+
+    >>> encode_batch(['ACGT', 'TTNA', ''])
+    ['T3131', 'T00..', 'T']
+    '''
+    if not seqs:
+        return []
+
+    buf, starts, lengths = _concat(['%s%s' % (primer, seq) for seq in seqs])
+    codes = _base_codes[buf]
+
+    colors = numpy.zeros(len(codes), dtype=numpy.uint8)
+    colors[1:] = codes[:-1] ^ codes[1:]
+    colors[1:][(codes[:-1] == 4) | (codes[1:] == 4)] = 4
+
+    out = _color_chars[colors]
+    out[starts] = buf[starts]  # keep the primer base
+
+    return _split(out, starts, lengths)
+
+
+def decode_batch(seqs):
+    '''
+    Converts color-space sequences (with a primer base) to base-space
+
+    >>> decode_batch(['T3131', 'T00..', 'T0.10', 'T', ''])
+    ['ACGT', 'TTNN', 'TNNN', '', '']
+    '''
+    if not seqs:
+        return []
+
+    # an empty read decodes the same as a lone (unknown) primer
+    buf, starts, lengths = _concat([seq or 'N' for seq in seqs])
+
+    codes = _color_codes[buf]
+    codes[starts] = _base_codes[buf[starts]]
+    invalid = (codes == 4).astype(numpy.int64)
+    codes[codes == 4] = 0
+
+    # XOR-accumulate over everything, then remove the value from the previous
+    # read(s) at the start of each read (XOR is its own inverse)
+    acc = numpy.bitwise_xor.accumulate(codes)
+    prev = numpy.zeros(len(seqs), dtype=numpy.uint8)
+    prev[1:] = acc[starts[1:] - 1]
+    acc ^= numpy.repeat(prev, lengths)
+
+    # once an unknown color is seen, everything downstream is unknown
+    inv_acc = numpy.cumsum(invalid)
+    inv_prev = numpy.zeros(len(seqs), dtype=numpy.int64)
+    inv_prev[1:] = inv_acc[starts[1:] - 1]
+    acc[(inv_acc - numpy.repeat(inv_prev, lengths)) > 0] = 4
+
+    return _split(_base_chars[acc], starts, lengths, trim=1)
+
+
+def encode(seq, primer='T'):
+    '''
+    >>> encode('ACGTTGCA')
+    'T31310131'
+    '''
+    return encode_batch([seq], primer)[0]
+
+
+def decode(seq):
+    '''
+    >>> decode('T31310131')
+    'ACGTTGCA'
+    '''
+    return decode_batch([seq])[0]
+
+
+def double_encode(seq):
+    '''
+    Converts colors to "double-encoded" bases (0123 -> ACGT, others -> N)
+
+    >>> double_encode('0123456.')
+    'ACGTNNNN'
+    '''
+    return seq.translate(_double_encode_table)
+
+
+def double_encode_batch(seqs):
+    '''
+    >>> double_encode_batch(['0123', '.10', ''])
+    ['ACGT', 'NCA', '']
+    '''
+    if not seqs:
+        return []
+    return '\n'.join(seqs).translate(_double_encode_batch_table).split('\n')
@@ -1,12 +1,37 @@
 '''
 Support package for processing a dbSNP tabix dump from UCSC.
+
+Lookups are made by position (for each mismatch in a read), so instead of
+making a tabix query for each position, the SNPs for a whole window
+(default: 100kb) are loaded at once into a dict keyed by position. The most
+recently used windows are kept (LRU), so for sorted input each window is
+only read once. Only the columns that are needed (chromStart, strand,
+observed, class) are parsed.
+
+For repeated use, the dbSNP dump can be converted (once) into a compact
+binary cache with (pos, class, alleles) for each SNP:
+
+    python -m ngsutils.support.dbsnp snp.txt.bgz snp.snpcache
+
+The cache file can be used anywhere the tabix file can.
 '''
 
-import pysam
-import collections
+import os
 import sys
+import array
+import struct
+import collections
+
+import numpy
+import pysam
+
 from ngsutils.support import revcomp
 
+_MAGIC = 'NGSDBSNP'
+_VERSION = 1
+_uint32 = struct.Struct('<I')
+_uint64 = struct.Struct('<Q')
+
 
 class SNPRecord(collections.namedtuple('SNPRecord', '''bin
 chrom
@@ -75,24 +100,103 @@ def autotype(ar, length=26):
     return out
 
 
+class SNPSite(collections.namedtuple('SNPSite', 'chrom chromStart strand observed clazz')):
+    '''
+    The columns of a dbSNP record that are needed to validate variations.
+    '''
+    __slots__ = ()
+
+    @property
+    def alleles(self):
+        alts = []
+        for alt in self.observed.split('/'):
+            if alt != '-' and self.strand == '-':
+                alt = revcomp(alt)
+
+            alts.append(alt)
+
+        return alts
+
+
+def _parse_site(tup):
+    if len(tup) < 12:
+        raise TypeError("Invalid dbSNP file! We need at least 12 columns to work with.")
+    return SNPSite(tup[1], int(tup[2]), tup[6], tup[9], tup[11])
+
+
+def is_snpcache(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
 class DBSNP(object):
-    def __init__(self, fname):
-        self.dbsnp = pysam.Tabixfile(fname)
-        self.asTup = pysam.asTuple()
+    '''
+    Position lookups in a tabix-indexed dbSNP dump (or binary SNP cache).
+
+    window is the size of the block of SNPs that is loaded at once, and
+    max_windows is the number of blocks that are kept in memory.
+    '''
+    def __init__(self, fname, window=100000, max_windows=8):
+        self.fname = fname
+        self.window = window
+        self.max_windows = max_windows
+        self._windows = collections.OrderedDict()
+
+        if is_snpcache(fname):
+            self.dbsnp = None
+            self.cache = SNPCache(fname)
+        else:
+            self.dbsnp = pysam.Tabixfile(fname)
+            self.asTup = pysam.asTuple()
+            self.cache = None
 
     def fetch(self, chrom, pos):
         'Note: pos is 0-based'
+        if self.cache:
+            for snp in self.cache.fetch(chrom, pos):
+                yield snp
+            return
+
+        key = (chrom, pos // self.window)
+        if key in self._windows:
+            sites = self._windows.pop(key)
+        else:
+            sites = self._load_window(chrom, key[1] * self.window)
+            while len(self._windows) >= self.max_windows:
+                self._windows.popitem(last=False)
+
+        self._windows[key] = sites  # most recently used
+
+        if pos in sites:
+            for snp in sites[pos]:
+                yield snp
 
+    def _load_window(self, chrom, start):
         # Note: tabix the command uses 1-based positions, but
         #       pysam.Tabixfile uses 0-based positions
+        sites = {}
+        try:
+            records = self.dbsnp.fetch(chrom, start, start + self.window, parser=self.asTup)
+        except ValueError:
+            # chrom isn't in the dbSNP file
+            return sites
 
-        for tup in self.dbsnp.fetch(chrom, pos, pos + 1, parser=self.asTup):
-            snp = SNPRecord._make(autotype(tup))
-            if snp.chromStart == pos:
-                yield snp
+        for tup in records:
+            snp = _parse_site(tup)
+            if snp.chromStart < start:
+                # this is in the previous window
+                continue
+            if snp.chromStart not in sites:
+                sites[snp.chromStart] = []
+            sites[snp.chromStart].append(snp)
+
+        return sites
 
     def close(self):
-        self.dbsnp.close()
+        if self.dbsnp:
+            self.dbsnp.close()
+        if self.cache:
+            self.cache.close()
 
     def dump(self, chrom, op, pos, base, snp, exit=True):
         print
@@ -139,3 +243,171 @@ class DBSNP(object):
                         return True
 
         return False
+
+
+class SNPCache(object):
+    '''
+    A compact binary cache of dbSNP records: (pos, class, alleles) sorted by
+    position for each chromosome. The arrays for one chromosome are loaded
+    at a time.
+
+    Layout: magic, version, then for each chromosome: positions (uint32),
+    class codes (uint8), allele offsets (uint32, count + 1), and the allele
+    strings ('/' delimited, already on the + strand). The index (class names
+    and the chromosome offsets) is written at the end of the file, followed
+    by its offset.
+    '''
+    def __init__(self, fname):
+        self.fileobj = open(fname, 'rb')
+        if self.fileobj.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("Not a SNP cache file: %s" % fname)
+
+        version = _uint32.unpack(self.fileobj.read(4))[0]
+        if version != _VERSION:
+            raise ValueError("Unknown SNP cache version: %s" % version)
+
+        self.fileobj.seek(-8, 2)
+        self.fileobj.seek(_uint64.unpack(self.fileobj.read(8))[0])
+
+        self.classes = [self._read_str() for i in xrange(self._read_int())]
+        self.chroms = {}
+        for i in xrange(self._read_int()):
+            chrom = self._read_str()
+            count = _uint64.unpack(self.fileobj.read(8))[0]
+            offset = _uint64.unpack(self.fileobj.read(8))[0]
+            self.chroms[chrom] = (count, offset)
+
+        self._chrom = None
+        self._arrays = None
+
+    def _read_int(self):
+        return _uint32.unpack(self.fileobj.read(4))[0]
+
+    def _read_str(self):
+        return self.fileobj.read(self._read_int())
+
+    def _load(self, chrom):
+        count, offset = self.chroms[chrom]
+        self.fileobj.seek(offset)
+        positions = numpy.fromfile(self.fileobj, dtype='<u4', count=count)
+        classes = numpy.fromfile(self.fileobj, dtype=numpy.uint8, count=count)
+        offsets = numpy.fromfile(self.fileobj, dtype='<u4', count=count + 1)
+        alleles = self.fileobj.read(int(offsets[-1]))
+
+        self._chrom = chrom
+        self._arrays = (positions, classes, offsets, alleles)
+
+    def fetch(self, chrom, pos):
+        if chrom not in self.chroms:
+            return
+
+        if chrom != self._chrom:
+            self._load(chrom)
+
+        positions, classes, offsets, alleles = self._arrays
+        i = numpy.searchsorted(positions, pos)
+        while i < len(positions) and positions[i] == pos:
+            yield SNPSite(chrom, pos, '+', alleles[offsets[i]:offsets[i + 1]], self.classes[classes[i]])
+            i += 1
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _write_str(out, val):
+    out.write(_uint32.pack(len(val)))
+    out.write(val)
+
+
+def _read_sites(fname):
+    tabix = pysam.Tabixfile(fname)
+    try:
+        for tup in tabix.fetch(parser=pysam.asTuple()):
+            yield _parse_site(tup)
+    finally:
+        tabix.close()
+
+
+def build_snpcache(fname, outname, quiet=False):
+    '''
+    Converts a (sorted) UCSC dbSNP dump into a binary SNP cache. Returns
+    the number of SNPs written.
+    '''
+    class_codes = {}
+    classes = []
+    chroms = []
+    total = 0
+
+    with open(outname, 'wb') as out:
+        out.write(_MAGIC)
+        out.write(_uint32.pack(_VERSION))
+
+        def _flush(chrom, positions, codes, offsets, alleles):
+            chroms.append((chrom, len(positions), out.tell()))
+            out.write(numpy.array(positions, dtype='<u4').tobytes())
+            out.write(numpy.array(codes, dtype=numpy.uint8).tobytes())
+            out.write(numpy.array(offsets, dtype='<u4').tobytes())
+            out.write(''.join(alleles))
+
+        chrom = None
+        last_pos = -1
+        positions = codes = offsets = alleles = None
+
+        for snp in _read_sites(fname):
+            if snp.chrom != chrom:
+                if chrom is not None:
+                    _flush(chrom, positions, codes, offsets, alleles)
+                if snp.chrom in [x[0] for x in chroms]:
+                    raise ValueError("dbSNP file isn't sorted (%s)" % snp.chrom)
+
+                chrom = snp.chrom
+                last_pos = -1
+                positions = array.array('I')
+                codes = array.array('B')
+                offsets = array.array('I', [0])
+                alleles = []
+
+                if not quiet:
+                    sys.stderr.write('%s\n' % chrom)
+
+            if snp.chromStart < last_pos:
+                raise ValueError("dbSNP file isn't sorted (%s:%s)" % (chrom, snp.chromStart))
+            last_pos = snp.chromStart
+
+            if snp.clazz not in class_codes:
+                class_codes[snp.clazz] = len(classes)
+                classes.append(snp.clazz)
+
+            val = '/'.join(snp.alleles)
+            positions.append(snp.chromStart)
+            codes.append(class_codes[snp.clazz])
+            alleles.append(val)
+            offsets.append(offsets[-1] + len(val))
+            total += 1
+
+        if chrom is not None:
+            _flush(chrom, positions, codes, offsets, alleles)
+
+        index_offset = out.tell()
+        out.write(_uint32.pack(len(classes)))
+        for clazz in classes:
+            _write_str(out, clazz)
+
+        out.write(_uint32.pack(len(chroms)))
+        for name, count, offset in chroms:
+            _write_str(out, name)
+            out.write(_uint64.pack(count))
+            out.write(_uint64.pack(offset))
+
+        out.write(_uint64.pack(index_offset))
+
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or not os.path.exists(sys.argv[1]):
+        print __doc__
+        print 'Usage: python -m ngsutils.support.dbsnp snp.txt.bgz snp.snpcache'
+        sys.exit(1)
+
+    sys.stderr.write('%s SNPs written\n' % build_snpcache(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,14 @@
+'''
+Memory usage of the current process
+'''
+
+import sys
+import resource
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    'Returns the peak RSS (KB) for this process (or its children)'
+    rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':  # OS X reports bytes
+        rss = rss / 1024
+    return rss
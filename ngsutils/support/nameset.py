@@ -0,0 +1,310 @@
+'''
+Compact sets of read names (for white/black lists)
+
+Loading a list of 100M read names into a Python set takes tens of GB. A
+NameSet instead stores a sorted array of 64-bit hashes of the names (8 bytes
+per name) and checks membership with a binary search. An optional Bloom
+filter can be used as a prefilter, so that most names that aren't in the set
+can be rejected without touching the (possibly memory-mapped) hash array.
+
+Because only hashes are stored, there is a small chance of a false positive
+(~ N^2 / 2^65 for N names, or about 1 in 3,700 for 100M names).
+
+NameSets can be saved to a binary file, so that the text list only needs to
+be parsed once. Anywhere a list of names is read, the saved file can be
+given instead of the text list.
+
+Usage: python -m ngsutils.support.nameset names.txt names.nameset
+
+Saves the names in a text list (one per line) as a NameSet file.
+'''
+
+import os
+import sys
+import math
+import struct
+import hashlib
+import numpy
+
+_MAGIC = 'NGSNAMES'
+_VERSION = 1
+_HEADER = struct.Struct('<8sIQQI')
+_CHUNK_SIZE = 1000000
+_uint64 = struct.Struct('<Q')
+
+
+def _digest(name):
+    return hashlib.md5(name).digest()
+
+
+def name_hash(name):
+    '''
+    Returns the 64-bit hash for a name (as an int)
+
+    >>> name_hash('foo') == int(name_hashes(['foo'])[0])
+    True
+    '''
+    return _uint64.unpack(_digest(name)[:8])[0]
+
+
+def name_hashes(names):
+    '''
+    Returns the 64-bit hashes for a list of names as a numpy array (uint64)
+    '''
+    if not names:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    return numpy.frombuffer(''.join([_digest(name)[:8] for name in names]), dtype='<u8').astype(numpy.uint64)
+
+
+class NameSet(object):
+    '''
+    A read-only set of names, stored as sorted 64-bit hashes.
+
+    >>> names = NameSet(['foo1', 'foo2', 'foo3'])
+    >>> len(names)
+    3
+    >>> 'foo2' in names
+    True
+    >>> 'bar' in names
+    False
+    >>> 'bar' in NameSet(['foo1', 'foo2'], bloom_bits=10)
+    False
+    '''
+    def __init__(self, names=None, bloom_bits=0, hashes=None):
+        if hashes is None:
+            hashes = NameSet._hash_chunks(names if names else [])
+
+        self.hashes = hashes
+        self.bloom = None
+        self.bloom_k = 0
+
+        if bloom_bits:
+            self._build_bloom(bloom_bits)
+
+    @staticmethod
+    def _hash_chunks(names):
+        chunks = []
+        buf = []
+        for name in names:
+            buf.append(name)
+            if len(buf) >= _CHUNK_SIZE:
+                chunks.append(name_hashes(buf))
+                buf = []
+
+        if buf:
+            chunks.append(name_hashes(buf))
+
+        if not chunks:
+            return numpy.zeros(0, dtype=numpy.uint64)
+
+        # sorts and removes duplicates
+        return numpy.unique(numpy.concatenate(chunks))
+
+    def _build_bloom(self, bits_per_name):
+        nbits = max(64, int(len(self.hashes) * bits_per_name))
+        nbits += (8 - nbits % 8) % 8
+
+        self.bloom_k = max(1, int(round(bits_per_name * math.log(2))))
+        bits = numpy.zeros(nbits, dtype=bool)
+
+        # The second half of each digest isn't stored, so rebuild it from the
+        # stored hash (both halves are only used as bloom indexes).
+        h1 = self.hashes
+        h2 = (self.hashes >> numpy.uint64(17)) | numpy.uint64(1)
+        for i in xrange(self.bloom_k):
+            bits[(h1 + numpy.uint64(i) * h2) % numpy.uint64(nbits)] = True
+
+        self.bloom = numpy.packbits(bits)
+
+    def _bloom_check(self, h):
+        nbits = len(self.bloom) * 8
+        h2 = (h >> 17) | 1
+        for i in xrange(self.bloom_k):
+            idx = (h + i * h2) % (1 << 64) % nbits
+            if not self.bloom[idx >> 3] & (0x80 >> (idx & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, name):
+        h = struct.unpack('<Q', _digest(name)[:8])[0]
+
+        if self.bloom is not None and not self._bloom_check(h):
+            return False
+
+        h = numpy.uint64(h)
+        idx = numpy.searchsorted(self.hashes, h)
+        return idx < len(self.hashes) and self.hashes[idx] == h
+
+    def contains_all(self, names):
+        '''
+        Vectorized membership test: returns a boolean array, one value
+        for each name given.
+        '''
+        hashes = name_hashes(names)
+        if not len(self.hashes):
+            return numpy.zeros(len(hashes), dtype=bool)
+
+        idx = numpy.searchsorted(self.hashes, hashes)
+        idx[idx >= len(self.hashes)] = 0
+        return self.hashes[idx] == hashes
+
+    def save(self, fname):
+        with open(fname, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(self.hashes), 0 if self.bloom is None else len(self.bloom), self.bloom_k))
+            f.write(self.hashes.astype('<u8').tobytes())
+            if self.bloom is not None:
+                f.write(self.bloom.tobytes())
+
+    @staticmethod
+    def load(fname):
+        'Loads a saved NameSet. The hash array is memory-mapped, not read.'
+        with open(fname, 'rb') as f:
+            magic, version, count, bloom_bytes, bloom_k = _HEADER.unpack(f.read(_HEADER.size))
+
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("%s is not a valid NameSet file" % fname)
+
+        nameset = NameSet(hashes=numpy.zeros(0, dtype=numpy.uint64))
+        if count:
+            nameset.hashes = numpy.memmap(fname, dtype='<u8', mode='r', offset=_HEADER.size, shape=(count,))
+
+        if bloom_bytes:
+            with open(fname, 'rb') as f:
+                f.seek(_HEADER.size + count * 8)
+                nameset.bloom = numpy.frombuffer(f.read(bloom_bytes), dtype=numpy.uint8)
+            nameset.bloom_k = bloom_k
+
+        return nameset
+
+
+class NameHashSet(object):
+    '''
+    A set of names (as 64-bit hashes) that names can be added to, such as the
+    names of the reads that have already been seen. New hashes are kept in a
+    set, and are merged into a sorted array (8 bytes per name) in batches.
+
+    >>> names = NameHashSet()
+    >>> names.add('foo')
+    True
+    >>> names.add('foo')
+    False
+    >>> names.add_hash(name_hash('bar'))
+    True
+    >>> len(names)
+    2
+    >>> 'bar' in names
+    True
+    '''
+    def __init__(self, batch_size=_CHUNK_SIZE):
+        self.batch_size = batch_size
+        self._hashes = numpy.zeros(0, dtype=numpy.uint64)
+        self._pending = set()
+
+    @property
+    def hashes(self):
+        'All of the hashes, as a sorted array'
+        self._merge()
+        return self._hashes
+
+    def _merge(self):
+        if not self._pending:
+            return
+        new = numpy.sort(numpy.fromiter(self._pending, dtype=numpy.uint64, count=len(self._pending)))
+        self._hashes = numpy.insert(self._hashes, numpy.searchsorted(self._hashes, new), new)
+        self._pending = set()
+
+    def _has(self, h):
+        if h in self._pending:
+            return True
+        if not len(self._hashes):
+            return False
+        h = numpy.uint64(h)
+        idx = numpy.searchsorted(self._hashes, h)
+        return idx < len(self._hashes) and self._hashes[idx] == h
+
+    def add_hash(self, h):
+        'Adds a hash, and returns False if it was already in the set'
+        if self._has(h):
+            return False
+
+        self._pending.add(h)
+        if len(self._pending) >= self.batch_size:
+            self._merge()
+        return True
+
+    def add(self, name):
+        'Adds a name, and returns False if it was already in the set'
+        return self.add_hash(name_hash(name))
+
+    def __contains__(self, name):
+        return self._has(name_hash(name))
+
+    def __len__(self):
+        return len(self._hashes) + len(self._pending)
+
+
+def is_nameset_file(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def _read_names(fname):
+    with open(fname) as f:
+        for line in f:
+            cols = line.split()
+            if not cols:
+                continue
+            name = cols[0]
+            if name[0] == '@':
+                # FASTQ style names
+                name = name[1:]
+            yield name
+
+
+def read_nameset(fname, bloom_bits=0, sidecar=False):
+    '''
+    Loads a list of read names (one per line, the name is the first
+    whitespace-delimited column) as a NameSet.
+
+    If fname is itself a saved NameSet, it is loaded directly. If bloom_bits
+    is set, a Bloom filter is added (if the saved file doesn't have one).
+
+    If sidecar is True, a fname.nameset file is used when it is newer than the
+    text list, and written after parsing the text list when it isn't (like a
+    .fai index, the sidecar is skipped if it can't be written).
+    '''
+    saved = None
+    sidecar_fname = '%s.nameset' % fname
+    if is_nameset_file(fname):
+        saved = fname
+    elif sidecar and os.path.exists(sidecar_fname) and os.stat(sidecar_fname).st_mtime >= os.stat(fname).st_mtime:
+        saved = sidecar_fname
+
+    if saved:
+        nameset = NameSet.load(saved)
+        if bloom_bits and nameset.bloom is None:
+            nameset._build_bloom(bloom_bits)
+        return nameset
+
+    nameset = NameSet(_read_names(fname), bloom_bits=bloom_bits)
+
+    if sidecar:
+        try:
+            nameset.save(sidecar_fname)
+        except (IOError, OSError):
+            sys.stderr.write('Unable to write name index: %s\n' % sidecar_fname)
+            if os.path.exists(sidecar_fname):
+                os.unlink(sidecar_fname)
+
+    return nameset
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print __doc__
+        sys.exit(1)
+
+    NameSet(_read_names(sys.argv[1]), bloom_bits=10).save(sys.argv[2])
@@ -0,0 +1,132 @@
+'''
+Cached lookups in an indexed reference FASTA file.
+
+Callers that need the reference base at a position (for each position or
+mismatch) would otherwise make a separate FASTA query for each base. Instead,
+the sequence for a whole window (default: 1Mb) is loaded at once, and
+lookups are made from memory. The most recently used windows are kept (LRU),
+so for sorted input each window is only read once.
+
+Chromosome names are matched to the names in the FASTA index once (for each
+name), so that Ensembl names (1, 2, MT) can be used with a UCSC reference
+(chr1, chr2, chrM), or the other way around.
+'''
+
+import os
+import collections
+
+import pysam
+
+# Ensembl <=> UCSC names that aren't just a 'chr' prefix
+_aliases = {'MT': 'chrM', 'chrM': 'MT'}
+
+
+class RefCache(object):
+    '''
+    Reference sequence lookups from an indexed FASTA file (the index is
+    built if it is missing).
+
+    window is the size of the block of sequence that is loaded at once, and
+    max_windows is the number of blocks that are kept in memory.
+
+    fetch() can be used in place of pysam.Fastafile.fetch(). Sequences are
+    returned as they are in the FASTA file (not upper-cased), and are empty
+    for unknown chromosomes.
+    '''
+    def __init__(self, fname, window=1000000, max_windows=4):
+        self.filename = fname
+        self.window = window
+        self.max_windows = max_windows
+        self._windows = collections.OrderedDict()
+
+        if not os.path.exists('%s.fai' % fname):
+            pysam.faidx(fname)
+
+        self.ref = pysam.Fastafile(fname)
+
+        self.lengths = {}
+        with open('%s.fai' % fname) as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                self.lengths[cols[0]] = int(cols[1])
+
+        self._names = {}
+
+        # the most recent window for base(): (chrom, start, end, upper-case seq)
+        self._current = None
+
+    def name(self, chrom):
+        '''
+        Returns the name of the chromosome in the FASTA file (or None)
+
+        Names are tried as given, with or without a 'chr' prefix, and for the
+        mitochondria as chrM or MT.
+        '''
+        if chrom in self._names:
+            return self._names[chrom]
+
+        name = None
+        for alias in [chrom, 'chr%s' % chrom, chrom[3:] if chrom[:3] == 'chr' else None, _aliases.get(chrom)]:
+            if alias and alias in self.lengths:
+                name = alias
+                break
+
+        self._names[chrom] = name
+        return name
+
+    def fetch(self, chrom, start, end):
+        'Returns the sequence from start to end (0-based, half-open)'
+        name = self.name(chrom)
+        if not name:
+            return ''
+
+        start = max(start, 0)
+        end = min(end, self.lengths[name])
+        if start >= end:
+            return ''
+
+        if end - start > self.window:
+            return self.ref.fetch(name, start, end)
+
+        first = start // self.window
+        last = (end - 1) // self.window
+        if first == last:
+            seq = self._load(name, first)
+            offset = first * self.window
+            return seq[start - offset:end - offset]
+
+        return ''.join([self.fetch(name, max(start, idx * self.window), min(end, (idx + 1) * self.window)) for idx in xrange(first, last + 1)])
+
+    def base(self, chrom, pos):
+        'Returns the (upper-case) base at pos (0-based), or an empty string'
+        current = self._current
+        if current and current[0] == chrom and current[1] <= pos < current[2]:
+            return current[3][pos - current[1]]
+
+        name = self.name(chrom)
+        if not name or pos < 0 or pos >= self.lengths[name]:
+            return ''
+
+        idx = pos // self.window
+        seq = self._load(name, idx).upper()
+        start = idx * self.window
+        self._current = (chrom, start, start + len(seq), seq)
+        return seq[pos - start]
+
+    def _load(self, name, idx):
+        key = (name, idx)
+        if key in self._windows:
+            seq = self._windows.pop(key)
+        else:
+            start = idx * self.window
+            seq = self.ref.fetch(name, start, min(start + self.window, self.lengths[name]))
+            while len(self._windows) >= self.max_windows:
+                self._windows.popitem(last=False)
+
+        self._windows[key] = seq  # most recently used
+        return seq
+
+    def close(self):
+        self._windows.clear()
+        self._current = None
+        self.ref.close()
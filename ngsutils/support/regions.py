@@ -104,11 +104,26 @@ class RegionTagger(object):
         self.counts['mitochondrial'] = 0
 
     def add_read(self, read, chrom):
+        tag, is_rev = self.tag_read(read, chrom)
+
+        if tag:
+            if is_rev:
+                self.counts['%s-rev' % tag] += 1
+            else:
+                self.counts[tag] += 1
+
+        return tag
+
+    def tag_read(self, read, chrom):
+        '''
+        returns (region, is_reverse_orientation) for a read, without counting
+        it. Reads that aren't counted return (None, False).
+        '''
         if read.is_unmapped:
-            return
-        
+            return None, False
+
         if self.only_first_fragment and read.is_paired and not read.is_read1:
-            return
+            return None, False
 
         tag = None
         is_rev = False
@@ -133,13 +148,12 @@ class RegionTagger(object):
         if not tag:
             tag = 'intergenic'
 
-        if tag:
-            if is_rev:
-                self.counts['%s-rev' % tag] += 1
-            else:
-                self.counts[tag] += 1
+        return tag, is_rev
 
-        return tag
+    def merge_counts(self, counts):
+        'Adds counts (like self.counts) from another set of reads'
+        for k in counts:
+            self.counts[k] += counts[k]
 
     def tag_region(self, chrom, start, end, strand):
         tag = None
@@ -2,6 +2,7 @@
 various statistical tests and methods...
 '''
 import math
+import numpy
 from ngsutils.support import memoize
 
 def median(vals):
@@ -156,6 +157,147 @@ def _factorial(x):
     '''
     return math.factorial(x)
 
+def _log_beta(a, b):
+    lgamma = numpy.frompyfunc(math.lgamma, 1, 1)
+    return (lgamma(a) + lgamma(b) - lgamma(a + b)).astype(float)
+
+
+def _betacf(x, a, b, maxiter=10000, eps=1e-15):
+    '''
+    Continued fraction for the incomplete beta function (modified Lentz's
+    method, see Numerical Recipes: betacf), for arrays of x, a, b. Values
+    that have converged are dropped from the later iterations.
+    '''
+    tiny = 1e-300
+    result = numpy.ones(x.shape)
+
+    # the indexes of the values that haven't converged yet
+    todo = numpy.arange(x.size)
+    x = x.ravel()
+    a = a.ravel()
+    b = b.ravel()
+    qab = a + b
+    qap = a + 1
+    qam = a - 1
+
+    c = numpy.ones(x.shape)
+    d = 1 - qab * x / qap
+    d[numpy.abs(d) < tiny] = tiny
+    d = 1 / d
+    h = d.copy()
+
+    for m in xrange(1, maxiter + 1):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1 + aa * d
+        d[numpy.abs(d) < tiny] = tiny
+        c = 1 + aa / c
+        c[numpy.abs(c) < tiny] = tiny
+        d = 1 / d
+        h *= d * c
+
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1 + aa * d
+        d[numpy.abs(d) < tiny] = tiny
+        c = 1 + aa / c
+        c[numpy.abs(c) < tiny] = tiny
+        d = 1 / d
+        delta = d * c
+        h *= delta
+
+        done = numpy.abs(delta - 1) < eps
+        if done.any():
+            result.flat[todo[done]] = h[done]
+            left = ~done
+            if not left.any():
+                return result
+            todo, x, a, b, qab, qap, qam, c, d, h = [val[left] for val in (todo, x, a, b, qab, qap, qam, c, d, h)]
+
+    result.flat[todo] = h
+    return result
+
+
+def betainc(x, a, b):
+    '''
+    The regularized incomplete beta function I_x(a, b) (the CDF of the beta
+    distribution). The arguments can be numbers or arrays.
+
+    >>> round(betainc(0.5, 2, 2), 12)
+    0.5
+    >>> round(betainc(0.2, 1, 3), 12)  # 1 - (1 - x) ** b
+    0.488
+    >>> [round(x, 12) for x in betainc([0, 0.25, 1], 3, 1).tolist()]  # x ** a
+    [0.0, 0.015625, 1.0]
+    '''
+    x, a, b = [numpy.asarray(val, dtype=float) for val in numpy.broadcast_arrays(x, a, b)]
+    scalar = x.ndim == 0
+    x, a, b = [numpy.atleast_1d(val) for val in (x, a, b)]
+
+    # a, b must be positive (otherwise NaN, as in R)
+    invalid = ~((a > 0) & (b > 0))
+    a = numpy.where(invalid, 1, a)
+    b = numpy.where(invalid, 1, b)
+
+    # the continued fraction converges quickly for x < (a + 1) / (a + b + 2),
+    # otherwise use the symmetry I_x(a, b) = 1 - I_(1-x)(b, a)
+    swap = x > (a + 1) / (a + b + 2)
+    xx = numpy.clip(numpy.where(swap, 1 - x, x), 0, 1)
+    aa = numpy.where(swap, b, a)
+    bb = numpy.where(swap, a, b)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        front = numpy.exp(aa * numpy.log(xx) + bb * numpy.log1p(-xx) - _log_beta(aa, bb))
+        val = front * _betacf(xx, aa, bb) / aa
+
+    val = numpy.where(swap, 1 - val, val)
+    val[x <= 0] = 0
+    val[x >= 1] = 1
+    val[invalid] = numpy.nan
+
+    if scalar:
+        return float(val[0])
+    return val
+
+
+def beta_ppf(p, a, b):
+    '''
+    The quantile function of the beta distribution (the inverse of betainc,
+    the same as qbeta in R), by bisection. The arguments can be numbers or
+    arrays.
+
+    >>> round(beta_ppf(0.5, 2, 2), 12)
+    0.5
+    >>> round(beta_ppf(0.488, 1, 3), 12)
+    0.2
+    >>> [round(x, 12) for x in beta_ppf(0.015625, [3, 1], [1, 1]).tolist()]
+    [0.25, 0.015625]
+    >>> beta_ppf(0.5, [-1, 2], [2, 0]).tolist()
+    [nan, nan]
+    '''
+    p, a, b = [numpy.asarray(val, dtype=float) for val in numpy.broadcast_arrays(p, a, b)]
+    scalar = p.ndim == 0
+    p, a, b = [numpy.atleast_1d(val) for val in (p, a, b)]
+
+    # only the valid shapes are searched (the others are NaN)
+    val = numpy.empty(p.shape)
+    val.fill(numpy.nan)
+    valid = (a > 0) & (b > 0) & ~numpy.isnan(p)
+    p, a, b = p[valid], a[valid], b[valid]
+
+    lo = numpy.zeros(p.shape)
+    hi = numpy.ones(p.shape)
+    for i in xrange(64):
+        mid = (lo + hi) / 2
+        below = betainc(mid, a, b) < p
+        lo = numpy.where(below, mid, lo)
+        hi = numpy.where(below, hi, mid)
+
+    val[valid] = (lo + hi) / 2
+    if scalar:
+        return float(val[0])
+    return val
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,255 @@
+'''
+Deterministic synthetic read generators (for benchmarks)
+
+Reads are generated in chunks with NumPy from a fixed seed, so the same
+parameters always produce the same reads. Each read has a random sequence
+(with an optional 5' barcode and 3' adapter read-through), a small rate of Ns,
+and quality values drawn from a positional quality profile.
+
+SyntheticGenes generates a set of gene models (GTF), a reference (FASTA) and
+coordinate-sorted, indexed alignments (BAM) for those genes, for
+benchmarking bamutils.
+
+Quality profiles:
+    flat      all positions ~Q35
+    illumina  ~Q38 at the 5' end, dropping to ~Q25 at the 3' end
+    degraded  ~Q35 at the 5' end, dropping to ~Q5 at the 3' end (so that
+              quality-based filters/trimming have something to do)
+'''
+
+import numpy
+import pysam
+
+from ngsutils.fastq import FASTQRead
+
+_bases = numpy.frombuffer('ACGTN', dtype=numpy.uint8)
+
+quality_profiles = {
+    'flat': (35, 35, 2),
+    'illumina': (38, 25, 4),
+    'degraded': (35, 5, 6),
+}
+
+
+class SyntheticReads(object):
+    '''
+    Generates num_reads random FASTQ reads (or num_reads pairs if paired).
+
+    >>> reads = list(SyntheticReads(2, 10, seed=1).fetch())
+    >>> [len(x.seq) for x in reads]
+    [10, 10]
+    >>> reads == list(SyntheticReads(2, 10, seed=1).fetch())
+    True
+    >>> [x.name for x in SyntheticReads(2, 10, paired=True).fetch()]
+    ['read0', 'read0', 'read1', 'read1']
+    '''
+    def __init__(self, num_reads=100000, read_length=100, seed=1, quality_profile='illumina', paired=False, adapter=None, adapter_rate=0.0, barcodes=None, n_rate=0.001, orphan_rate=0.0, name_prefix='read', chunk_size=10000):
+        if quality_profile not in quality_profiles:
+            raise ValueError("Unknown quality profile: %s" % quality_profile)
+
+        self.num_reads = num_reads
+        self.read_length = read_length
+        self.seed = seed
+        self.quality_profile = quality_profile
+        self.paired = paired
+        self.adapter = adapter
+        self.adapter_rate = adapter_rate if adapter else 0.0
+        self.barcodes = barcodes if barcodes else []
+        self.n_rate = n_rate
+        self.orphan_rate = orphan_rate
+        self.name_prefix = name_prefix
+        self.chunk_size = chunk_size
+
+    def _quals(self, rand, n):
+        start, end, noise = quality_profiles[self.quality_profile]
+        mean = numpy.linspace(start, end, self.read_length)
+        quals = mean + rand.normal(0, noise, (n, self.read_length))
+        return numpy.clip(numpy.round(quals), 2, 41).astype(numpy.uint8) + 33
+
+    def _chunk(self, rand, n):
+        bases = rand.randint(0, 4, (n, self.read_length)).astype(numpy.uint8)
+        quals = self._quals(rand, n)
+
+        wild = rand.random_sample((n, self.read_length)) < self.n_rate
+        bases[wild] = 4
+        quals[wild] = 35  # '#'
+
+        seqs = _bases[bases]
+        seq_data = seqs.tobytes()
+        qual_data = quals.tobytes()
+
+        insert_sizes = rand.randint(self.read_length // 2, self.read_length, n)
+        has_adapter = rand.random_sample(n) < self.adapter_rate
+        barcode_idx = rand.randint(0, max(1, len(self.barcodes)), n)
+
+        ret = []
+        for i in xrange(n):
+            seq = seq_data[i * self.read_length:(i + 1) * self.read_length]
+            qual = qual_data[i * self.read_length:(i + 1) * self.read_length]
+
+            if self.barcodes:
+                barcode = self.barcodes[barcode_idx[i]]
+                seq = barcode + seq[len(barcode):]
+
+            if has_adapter[i]:
+                size = insert_sizes[i]
+                seq = (seq[:size] + self.adapter)[:self.read_length]
+                seq += seq_data[i * self.read_length + len(seq):(i + 1) * self.read_length]
+
+            ret.append((seq, qual))
+        return ret
+
+    def fetch(self, read=None):
+        '''
+        Yields FASTQRead records. For paired reads, both reads are yielded
+        (interleaved) unless read (1 or 2) is given. Orphaned reads (the other
+        read was "lost") are only included in the read 1 or read 2 files.
+        '''
+        rand = numpy.random.RandomState(self.seed)
+        i = 0
+        while i < self.num_reads:
+            n = min(self.chunk_size, self.num_reads - i)
+            reads1 = self._chunk(rand, n)
+            reads2 = self._chunk(rand, n) if self.paired else None
+            orphans = rand.random_sample(n) < self.orphan_rate if self.paired else None
+
+            for j in xrange(n):
+                name = '%s%s' % (self.name_prefix, i + j)
+                if not self.paired:
+                    yield FASTQRead(name, '', reads1[j][0], reads1[j][1])
+                    continue
+
+                seq2, qual2 = reads2[j]
+
+                # orphans are split evenly between the two files
+                if read is None or read == 1:
+                    if not orphans[j] or read == 1 and j % 2 == 0:
+                        yield FASTQRead(name, '', reads1[j][0], reads1[j][1])
+                if read is None or read == 2:
+                    if not orphans[j] or read == 2 and j % 2 == 1:
+                        yield FASTQRead(name, '', seq2, qual2)
+
+            i += n
+
+    def write(self, out, read=None):
+        'Writes the reads to out, returns the number of reads written'
+        count = 0
+        for record in self.fetch(read):
+            record.write(out)
+            count += 1
+        return count
+
+
+class SyntheticGenes(object):
+    '''
+    Generates num_genes random genes (spread over num_chroms chromosomes) and
+    num_reads alignments. Each gene has two isoforms (the second skips one
+    of the internal exons). Most reads are taken from an exon of the first
+    isoform (spliced to the next exon if they run over the end of the exon),
+    the rest are intergenic. A fraction of the reads (multi_rate) are
+    flagged as multi-mapped (NH tag).
+
+    >>> genes = SyntheticGenes(10, 100, 20, num_chroms=2)
+    >>> [x[0] for x in genes.chroms]
+    ['chr1', 'chr2']
+    >>> len(genes.genes)
+    10
+    >>> len(list(genes.alignments()))
+    100
+    '''
+    def __init__(self, num_genes=1000, num_reads=100000, read_length=50, seed=1, num_chroms=4, gene_spacing=20000, intergenic_rate=0.1, multi_rate=0.1, paired=False):
+        self.num_reads = num_reads
+        self.read_length = read_length
+        self.seed = seed
+        self.intergenic_rate = intergenic_rate
+        self.multi_rate = multi_rate
+        self.paired = paired
+
+        rand = numpy.random.RandomState(seed)
+        per_chrom = (num_genes + num_chroms - 1) // num_chroms
+        self.chroms = [('chr%s' % (i + 1), (per_chrom + 1) * gene_spacing) for i in xrange(num_chroms)]
+
+        # (gene_id, chrom, strand, exons (start, end), skipped exon)
+        self.genes = []
+        for i in xrange(num_genes):
+            pos = (i // num_chroms) * gene_spacing + rand.randint(0, gene_spacing // 4)
+            exons = []
+            for j in xrange(rand.randint(3, 9)):
+                size = rand.randint(80, 400)
+                exons.append((pos, pos + size))
+                pos += size + rand.randint(100, 2000)
+            self.genes.append(('gene%s' % i, self.chroms[i % num_chroms][0], '+' if rand.randint(0, 2) else '-', exons, rand.randint(1, len(exons) - 1)))
+
+    def write_gtf(self, out):
+        '''Writes the gene models to out (as GTF)'''
+        for gene_id, chrom, strand, exons, skipped in self.genes:
+            for isoform in [1, 2]:
+                for j, (start, end) in enumerate(exons):
+                    if isoform == 2 and j == skipped:
+                        continue
+                    out.write('%s\tsynthetic\texon\t%s\t%s\t0\t%s\t.\tgene_id "%s"; transcript_id "%s.%s"; gene_name "%s";\n' % (chrom, start + 1, end, strand, gene_id, gene_id, isoform, gene_id))
+
+    def write_fasta(self, out, wrap=60):
+        '''Writes a random reference sequence for the chromosomes to out (as FASTA)'''
+        rand = numpy.random.RandomState(self.seed + 2)
+        for name, length in self.chroms:
+            seq_data = _bases[rand.randint(0, 4, length)].tobytes()
+            out.write('>%s\n' % name)
+            for i in xrange(0, length, wrap):
+                out.write('%s\n' % seq_data[i:i + wrap])
+
+    def alignments(self):
+        '''
+        Yields the alignments (in coordinate order) as tuples:
+        (tid, pos, name, cigar, flags, tags)
+        '''
+        rand = numpy.random.RandomState(self.seed + 1)
+        rlen = self.read_length
+        reads = []
+        for i in xrange(self.num_reads):
+            if rand.random_sample() < self.intergenic_rate:
+                tid = rand.randint(0, len(self.chroms))
+                pos = rand.randint(0, self.chroms[tid][1] - rlen)
+                cigar = [(0, rlen)]
+            else:
+                gene_id, chrom, strand, exons, skipped = self.genes[rand.randint(0, len(self.genes))]
+                tid = int(chrom[3:]) - 1
+                j = rand.randint(0, len(exons))
+                start, end = exons[j]
+                pos = rand.randint(start, end)
+                if pos + rlen > end and j + 1 < len(exons):
+                    cigar = [(0, end - pos), (3, exons[j + 1][0] - end), (0, rlen - (end - pos))]
+                else:
+                    cigar = [(0, rlen)]
+
+            flags = 0x10 if rand.randint(0, 2) else 0
+            if self.paired:
+                flags |= 0x41 if rand.randint(0, 2) else 0x81
+            tags = [('NH', 2)] if rand.random_sample() < self.multi_rate else [('NH', 1)]
+            reads.append((tid, pos, 'read%s' % i, cigar, flags, tags))
+
+        reads.sort()
+        for read in reads:
+            yield read
+
+    def write_bam(self, fname):
+        '''Writes the alignments to a (sorted, indexed) BAM file, returns the number of reads'''
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'SN': name, 'LN': length} for name, length in self.chroms]}
+        bam = pysam.Samfile(fname, 'wb', header=header)
+        count = 0
+        for tid, pos, name, cigar, flags, tags in self.alignments():
+            read = pysam.AlignedRead()
+            read.qname = name
+            read.tid = tid
+            read.pos = pos
+            read.seq = 'A' * self.read_length
+            read.qual = 'I' * self.read_length
+            read.cigar = cigar
+            read.flag = flags
+            read.mapq = 50
+            read.tags = tags
+            bam.write(read)
+            count += 1
+        bam.close()
+        pysam.index(fname)
+        return count
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.bgzip
+'''
+
+import os
+import gzip
+import unittest
+
+from ngsutils.support.bgzip import BGZFWriter, BGZF_EOF, BGZF_BLOCK_SIZE
+
+
+class BGZFWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'tmp_bgzf.gz')
+        self.data = ''.join(['@read%s\nACGTACGTACGT\n+\nIIIIIIIIIIII\n' % i for i in xrange(20000)])
+
+    def tearDown(self):
+        if os.path.exists(self.fname):
+            os.unlink(self.fname)
+
+    def _check(self, threads):
+        out = BGZFWriter(self.fname, threads=threads, chunk_size=BGZF_BLOCK_SIZE)
+        for i in xrange(0, len(self.data), 1000):
+            out.write(self.data[i:i + 1000])
+        out.close()
+
+        with open(self.fname, 'rb') as f:
+            raw = f.read()
+        self.assertTrue(raw.endswith(BGZF_EOF))
+
+        f = gzip.open(self.fname)
+        self.assertEqual(f.read(), self.data)
+        f.close()
+
+    def testWrite(self):
+        self._check(1)
+
+    def testWriteThreads(self):
+        self._check(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.bigwig
+'''
+
+import os
+import random
+import struct
+import tempfile
+import unittest
+import zlib
+
+from ngsutils.support.bigwig import BigWigWriter
+
+
+def _blocks(data):
+    'The (decompressed) blocks written one after the other'
+    blocks = []
+    while data:
+        dec = zlib.decompressobj()
+        blocks.append(dec.decompress(data))
+        data = dec.unused_data
+    return blocks
+
+
+def _read_chroms(f, offset, key_size, chroms):
+    f.seek(offset)
+    is_leaf, reserved, count = struct.unpack('<BBH', f.read(4))
+    items = [struct.unpack('<%ds8s' % key_size, f.read(key_size + 8)) for i in xrange(count)]
+    for key, val in items:
+        if is_leaf:
+            chroms[struct.unpack('<I', val[:4])[0]] = (key.rstrip('\0'), struct.unpack('<I', val[4:])[0])
+        else:
+            _read_chroms(f, struct.unpack('<Q', val)[0], key_size, chroms)
+
+
+def read_bigwig(fname):
+    '''
+    Reads a bigWig file written by BigWigWriter (the blocks are read in
+    order, not with the indexes).
+
+    Returns the chromosome sizes, the runs as (chrom, start, end, value),
+    and the zoom records for each level.
+    '''
+    with open(fname, 'rb') as f:
+        header = struct.unpack('<IHHQQQHHQQIQ', f.read(64))
+        assert header[0] == 0x888FFC26
+        zooms = [struct.unpack('<IIQQ', f.read(24)) for i in xrange(header[2])]
+
+        f.seek(header[3])
+        magic, block_size, key_size, val_size, count, reserved = struct.unpack('<IIIIQQ', f.read(32))
+        assert magic == 0x78CA8C91
+        chroms = {}
+        _read_chroms(f, f.tell(), key_size, chroms)
+
+        f.seek(header[4])
+        sections = struct.unpack('<Q', f.read(8))[0]
+        runs = []
+        blocks = _blocks(f.read(header[3] - f.tell()))
+        assert sections == len(blocks)
+        for block in blocks:
+            chrom_id, start, end, step, span, kind, reserved, count = struct.unpack('<IIIIIBBH', block[:24])
+            for i in xrange(count):
+                runs.append((chroms[chrom_id][0],) + struct.unpack('<IIf', block[24 + i * 12:36 + i * 12]))
+
+        levels = []
+        for reduction, reserved, data_offset, index_offset in zooms:
+            f.seek(data_offset)
+            count = struct.unpack('<I', f.read(4))[0]
+            records = []
+            for block in _blocks(f.read(index_offset - f.tell())):
+                for i in xrange(0, len(block), 32):
+                    rec = struct.unpack('<IIIIffff', block[i:i + 32])
+                    records.append((chroms[rec[0]][0],) + rec[1:])
+            assert count == len(records)
+            levels.append((reduction, records))
+
+    return dict(chroms.values()), runs, levels
+
+
+class BigWigTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.fname = tempfile.mkstemp(suffix='.bw')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.fname)
+
+    def testRuns(self):
+        rand = random.Random(1)
+        expected = []
+        writer = BigWigWriter(self.fname, {'chr2': 1000000}, items_per_slot=64, block_size=4)
+        for chrom in ['chr2', 'chr1', 'chr3']:
+            pos = 0
+            runs = []
+            for i in xrange(rand.randint(1000, 5000)):
+                pos += rand.randint(0, 20)
+                runs.append((chrom, pos, pos + rand.randint(1, 100), rand.randint(1, 20) * 0.5))
+                pos = runs[-1][2]
+
+            for i in xrange(0, len(runs), 1000):
+                writer.add(chrom, *zip(*runs[i:i + 1000])[1:])
+            expected.extend(runs)
+        writer.close()
+
+        sizes, runs, levels = read_bigwig(self.fname)
+        self.assertEqual(1000000, sizes['chr2'])
+        self.assertEqual(expected[-1][2], sizes['chr3'])
+        self.assertEqual(expected, runs)
+
+        # each zoom level is a summary of the same runs
+        self.assertTrue(levels)
+        total = sum([(end - start) * val for chrom, start, end, val in runs])
+        last = len(runs)
+        for reduction, records in levels:
+            self.assertTrue(len(records) * 2 <= last)
+            last = len(records)
+            self.assertAlmostEqual(1, sum([x[6] for x in records]) / total, 4)
+            self.assertEqual(sum([end - start for chrom, start, end, val in runs]), sum([x[3] for x in records]))
+            for chrom, start, end, valid, minval, maxval, sumval, sumsq in records:
+                self.assertEqual(0, start % reduction)
+                self.assertTrue(0 < valid <= end - start <= reduction)
+
+    def testOrder(self):
+        writer = BigWigWriter(self.fname)
+        writer.add('chr1', [0], [10], [1])
+        writer.add('chr2', [0], [10], [1])
+        self.assertRaises(ValueError, writer.add, 'chr1', [20], [30], [1])
+        writer.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.colorspace
+'''
+
+import unittest
+import doctest
+
+import ngsutils.support.colorspace
+from ngsutils.support.colorspace import encode, decode, encode_batch, decode_batch
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.colorspace))
+    return tests
+
+
+class ColorspaceTest(unittest.TestCase):
+    def testRoundTrip(self):
+        seqs = ['ACGTACGTTTGGCCAA', 'A', '', 'GATTACA', 'acgt']
+        css = encode_batch(seqs)
+        self.assertEqual([encode(x) for x in seqs], css)
+        self.assertEqual([x.upper() for x in seqs], decode_batch(css))
+
+    def testPrimer(self):
+        self.assertEqual('T3', encode('A'))
+        self.assertEqual('G2', encode('A', primer='G'))
+        self.assertEqual('A', decode('G2'))
+
+    def testUnknown(self):
+        self.assertEqual('T0.', encode('TN'))
+        self.assertEqual('T0..1', encode('TNAC'))
+        self.assertEqual('TNNN', decode('T0.10'))
+        self.assertEqual('TNNN', decode('T0410'))
+
+    def testBatchIsolation(self):
+        # an unknown color in one read shouldn't affect the next read
+        self.assertEqual(['TN', 'AC', 'NNN'], decode_batch(['T0.', 'T31', 'N000']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.dbsnp
+'''
+
+import os
+import unittest
+
+import pysam
+
+from ngsutils.support.dbsnp import DBSNP, build_snpcache
+
+_rows = [
+    # bin chrom chromStart chromEnd name score strand refNCBI refUCSC observed molType class
+    ['585', 'chr1', '10', '11', 'rs1', '0', '+', 'A', 'A', 'A/G', 'genomic', 'single'],
+    ['585', 'chr1', '10', '11', 'rs2', '0', '-', 'A', 'A', 'C/T', 'genomic', 'single'],
+    ['585', 'chr1', '20', '20', 'rs3', '0', '+', '-', '-', '-/AC', 'genomic', 'insertion'],
+    ['585', 'chr1', '30', '32', 'rs4', '0', '-', 'GT', 'GT', '-/AC', 'genomic', 'deletion'],
+    ['585', 'chr1', '150', '151', 'rs5', '0', '+', 'C', 'C', 'C/T', 'genomic', 'single'],
+    ['585', 'chr1', '160', '161', 'rs6', '0', '+', 'C', 'C', '(AC)5', 'genomic', 'microsatellite'],
+    ['585', 'chr2', '10', '11', 'rs7', '0', '+', 'G', 'G', 'G/T', 'genomic', 'single'],
+]
+
+
+class DBSNPTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.dirname(__file__)
+        fname = os.path.join(self.dirname, 'tmp_dbsnp.txt')
+        with open(fname, 'w') as f:
+            for row in _rows:
+                f.write('%s\n' % '\t'.join(row))
+
+        self.fname = pysam.tabix_index(fname, seq_col=1, start_col=2, end_col=3, zerobased=True, force=True)
+        self.cachename = os.path.join(self.dirname, 'tmp_dbsnp.snpcache')
+
+    def tearDown(self):
+        for fname in [self.fname, '%s.tbi' % self.fname, self.cachename]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def _check(self, dbsnp):
+        self.assertEqual([['A', 'G'], ['G', 'A']], [x.alleles for x in dbsnp.fetch('chr1', 10)])
+        self.assertEqual([], list(dbsnp.fetch('chr1', 11)))
+        self.assertEqual([], list(dbsnp.fetch('chr3', 10)))
+
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 10, 'G'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 10, 'A'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 0, 10, 'T'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 1, 20, 'AC'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 2, 30, 'GT'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 2, 30, 'AC'))
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 150, 'T'))
+        self.assertFalse(dbsnp.is_valid_variation('chr1', 0, 160, 'C'))
+        self.assertTrue(dbsnp.is_valid_variation('chr2', 0, 10, 'T'))
+
+        # out of order, after the windows have been evicted
+        self.assertTrue(dbsnp.is_valid_variation('chr1', 0, 10, 'G'))
+
+    def testTabix(self):
+        dbsnp = DBSNP(self.fname, window=100, max_windows=1)
+        self._check(dbsnp)
+        self.assertEqual(1, len(dbsnp._windows))
+        dbsnp.close()
+
+    def testCache(self):
+        self.assertEqual(7, build_snpcache(self.fname, self.cachename, quiet=True))
+        dbsnp = DBSNP(self.cachename)
+        self.assertTrue(dbsnp.cache is not None)
+        self._check(dbsnp)
+        dbsnp.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.nameset
+'''
+
+import os
+import unittest
+import doctest
+
+import ngsutils.support.nameset
+from ngsutils.support.nameset import NameSet, NameHashSet, read_nameset
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.nameset))
+    return tests
+
+
+class NameSetTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'tmp_names.txt')
+        with open(self.fname, 'w') as f:
+            f.write('foo1\n@foo2 extra\n\nfoo3\tmore\nfoo1\n')
+
+    def tearDown(self):
+        for fname in [self.fname, '%s.nameset' % self.fname, '%s.bin' % self.fname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def testContains(self):
+        names = NameSet(['read%s' % i for i in xrange(1000)])
+        self.assertEqual(len(names), 1000)
+        for i in xrange(1000):
+            self.assertTrue('read%s' % i in names)
+        for i in xrange(1000, 2000):
+            self.assertFalse('read%s' % i in names)
+
+    def testContainsAll(self):
+        names = NameSet(['foo1', 'foo2'])
+        self.assertEqual(list(names.contains_all(['foo1', 'bar', 'foo2'])), [True, False, True])
+        self.assertEqual(list(NameSet().contains_all(['foo1'])), [False])
+
+    def testBloom(self):
+        names = NameSet(['read%s' % i for i in xrange(1000)], bloom_bits=10)
+        for i in xrange(1000):
+            self.assertTrue('read%s' % i in names)
+        for i in xrange(1000, 2000):
+            self.assertFalse('read%s' % i in names)
+
+    def testReadNameSet(self):
+        names = read_nameset(self.fname, bloom_bits=10)
+        self.assertEqual(len(names), 3)
+        self.assertTrue('foo1' in names)
+        self.assertTrue('foo2' in names)
+        self.assertTrue('foo3' in names)
+        self.assertFalse('extra' in names)
+        self.assertFalse(os.path.exists('%s.nameset' % self.fname))
+
+    def testSidecar(self):
+        read_nameset(self.fname, sidecar=True)
+        self.assertTrue(os.path.exists('%s.nameset' % self.fname))
+
+        # loaded from the sidecar
+        names = read_nameset(self.fname, sidecar=True)
+        self.assertEqual(len(names), 3)
+        self.assertTrue('foo2' in names)
+        self.assertFalse('foo4' in names)
+
+    def testSaveLoad(self):
+        names = NameSet(['foo1', 'foo2', 'foo3'], bloom_bits=8)
+        names.save('%s.bin' % self.fname)
+
+        loaded = read_nameset('%s.bin' % self.fname)
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded.bloom_k, names.bloom_k)
+        self.assertTrue('foo3' in loaded)
+        self.assertFalse('foo4' in loaded)
+
+
+class NameHashSetTest(unittest.TestCase):
+    def testAdd(self):
+        # a small batch, so that the new names are merged a few times
+        names = NameHashSet(batch_size=64)
+        for i in xrange(1000):
+            self.assertTrue(names.add('read%s' % (i * 7 % 1000)))
+            self.assertFalse(names.add('read%s' % (i * 7 % 1000)))
+        self.assertEqual(1000, len(names))
+        for i in xrange(2000):
+            self.assertEqual(i < 1000, 'read%s' % i in names)
+        self.assertEqual(sorted(names.hashes.tolist()), names.hashes.tolist())
+        self.assertEqual(1000, len(set(names.hashes.tolist())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.refcache
+'''
+
+import os
+import random
+import unittest
+
+import pysam
+
+from ngsutils.support.refcache import RefCache
+
+
+class RefCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'tmp_refcache.fa')
+
+        rand = random.Random(1)
+        self.seqs = {}
+        with open(self.fname, 'w') as out:
+            for name, length in [('chr1', 1000), ('chr2', 333), ('MT', 50)]:
+                seq = ''.join([rand.choice('ACGTacgtN') for i in xrange(length)])
+                self.seqs[name] = seq
+                out.write('>%s\n' % name)
+                for i in xrange(0, length, 60):
+                    out.write('%s\n' % seq[i:i + 60])
+
+    def tearDown(self):
+        for fname in [self.fname, '%s.fai' % self.fname]:
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+    def testFetch(self):
+        ref = RefCache(self.fname, window=100, max_windows=2)
+        fasta = pysam.Fastafile(self.fname)
+
+        rand = random.Random(2)
+        for i in xrange(500):
+            chrom = rand.choice(['chr1', 'chr2'])
+            start = rand.randint(0, 1000)
+            end = start + rand.choice([1, 5, 150, 400])
+            self.assertEqual(self.seqs[chrom][start:end], ref.fetch(chrom, start, end))
+            if start < len(self.seqs[chrom]):
+                self.assertEqual(fasta.fetch(chrom, start, min(end, len(self.seqs[chrom]))), ref.fetch(chrom, start, end))
+
+        self.assertTrue(len(ref._windows) <= 2)
+        self.assertEqual('', ref.fetch('chr3', 0, 10))
+        self.assertEqual(self.seqs['chr1'][:10], ref.fetch('chr1', -5, 10))
+        fasta.close()
+        ref.close()
+
+    def testBase(self):
+        ref = RefCache(self.fname, window=100)
+        for pos in xrange(len(self.seqs['chr2'])):
+            self.assertEqual(self.seqs['chr2'][pos].upper(), ref.base('chr2', pos))
+        self.assertEqual('', ref.base('chr2', 333))
+        self.assertEqual('', ref.base('chr3', 0))
+        ref.close()
+
+    def testAliases(self):
+        ref = RefCache(self.fname)
+        self.assertEqual('chr1', ref.name('1'))
+        self.assertEqual('chr1', ref.name('chr1'))
+        self.assertEqual('MT', ref.name('chrM'))
+        self.assertEqual('MT', ref.name('chrMT'))
+        self.assertEqual(None, ref.name('3'))
+        self.assertEqual(self.seqs['chr1'][10:20], ref.fetch('1', 10, 20))
+        self.assertEqual(self.seqs['MT'][5].upper(), ref.base('chrM', 5))
+        ref.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Tests for ngsutils.support.synthetic and ngsutils.support.bench
+'''
+
+import unittest
+import doctest
+import StringIO
+
+import ngsutils.support.synthetic
+from ngsutils.support.synthetic import SyntheticReads
+from ngsutils.support.bench import measure, BenchmarkSuite, compare_reports
+from ngsutils.fastq import FASTQ
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(ngsutils.support.synthetic))
+    return tests
+
+
+class SyntheticTest(unittest.TestCase):
+    def testDeterministic(self):
+        reads1 = list(SyntheticReads(25, 30, seed=2, chunk_size=10).fetch())
+        reads2 = list(SyntheticReads(25, 30, seed=2).fetch())
+        reads3 = list(SyntheticReads(25, 30, seed=3).fetch())
+        self.assertEqual(25, len(reads1))
+        self.assertEqual([x.seq for x in reads1[:10]], [x.seq for x in reads2[:10]])
+        self.assertNotEqual(reads1, reads3)
+
+    def testFormat(self):
+        out = StringIO.StringIO()
+        self.assertEqual(10, SyntheticReads(10, 40, quality_profile='degraded').write(out))
+        reads = list(FASTQ(fileobj=StringIO.StringIO(out.getvalue())).fetch(quiet=True))
+        self.assertEqual(10, len(reads))
+        for read in reads:
+            self.assertEqual(40, len(read.seq))
+            self.assertEqual(40, len(read.qual))
+            self.assertTrue(min(read.qual) >= '#')
+
+    def testAdaptersBarcodes(self):
+        for read in SyntheticReads(20, 50, adapter='GGGGGGGGGGGGGGGGGGGGGGGGGGGGGG', adapter_rate=1.0, barcodes=['AAAA', 'CCCC']).fetch():
+            self.assertTrue(read.seq[:4] in ['AAAA', 'CCCC'])
+            self.assertEqual('G', read.seq[-1])
+            self.assertEqual(50, len(read.seq))
+
+    def testPaired(self):
+        reads = SyntheticReads(100, 20, paired=True, orphan_rate=0.2)
+        interleaved = [x.name for x in reads.fetch()]
+        read1 = [x.name for x in reads.fetch(1)]
+        read2 = [x.name for x in reads.fetch(2)]
+
+        self.assertEqual(interleaved[::2], interleaved[1::2])
+        self.assertTrue(len(read1) > len(interleaved) / 2)
+        self.assertTrue(len(read2) > len(interleaved) / 2)
+        self.assertEqual(sorted(set(read1) & set(read2)), sorted(interleaved[::2]))
+
+    def testBadProfile(self):
+        self.assertRaises(ValueError, SyntheticReads, 10, 10, quality_profile='foo')
+
+
+class BenchTest(unittest.TestCase):
+    def testMeasure(self):
+        result = measure(lambda x: x * 2, 5)
+        self.assertEqual(10, result['reads'])
+        self.assertTrue(result['peak_rss_kb'] > 0)
+
+        result = measure(lambda: 1 / 0)
+        self.assertTrue('ZeroDivisionError' in result['error'])
+
+    def testSuite(self):
+        suite = BenchmarkSuite('test', {'foo': 1})
+        suite.add('one', lambda: 1)
+        suite.add('two', lambda: 2)
+        report = suite.run(only=['two'], quiet=True)
+        self.assertEqual(['two'], report['results'].keys())
+        self.assertEqual({'foo': 1}, report['params'])
+
+        out = StringIO.StringIO()
+        compare_reports(report, report, out)
+        self.assertTrue('two\t' in out.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ setup(name='ngsutils',
       author='Marcus Breese',
       author_email='mbreese@stanford.edu',
       url='http://ngsutils.org',
-      packages=['ngsutils', 'ngsutils.bam', 'ngsutils.bed', 'ngsutils.fastq', 'ngsutils.gtf', 'ngsutils.support', 'ngsutils.ngs'],
+      packages=['ngsutils', 'ngsutils.bam', 'ngsutils.bam.engine', 'ngsutils.bed', 'ngsutils.fastq', 'ngsutils.gtf', 'ngsutils.support', 'ngsutils.ngs'],
       scripts=['bin/ngsutils', 'bin/fastqutils', 'bin/bamutils', 'bin/bedutils', 'bin/gtfutils'],
-      install_requires = ['pysam>=0.7.5', 'coverage>=3.5.3', 'eta>=0.9', 'swalign>=0.2']
+      install_requires = ['pysam>=0.7.5', 'numpy>=1.9', 'coverage>=3.5.3', 'eta>=0.9', 'swalign>=0.2']
      )